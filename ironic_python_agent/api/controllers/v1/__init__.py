@@ -24,6 +24,7 @@ import wsmeext.pecan as wsme_pecan
 
 from ironic_python_agent.api.controllers.v1 import base
 from ironic_python_agent.api.controllers.v1 import command
+from ironic_python_agent.api.controllers.v1 import image
 from ironic_python_agent.api.controllers.v1 import link
 from ironic_python_agent.api.controllers.v1 import status
 
@@ -107,6 +108,7 @@ class Controller(rest.RestController):
 
     commands = command.CommandController()
     status = status.StatusController()
+    images = image.ImageController()
 
     @wsme_pecan.wsexpose(V1)
     def get(self):
@@ -0,0 +1,42 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from ironic_lib import metrics_utils
+import pecan
+from pecan import rest
+
+from ironic_python_agent import image_swarm
+
+
+class ImageController(rest.RestController):
+    """Controller serving the verified chunks of images to peer agents."""
+
+    @pecan.expose(content_type='application/octet-stream')
+    def get_one(self, image_key, index):
+        """Get a chunk of a shared image.
+
+        :param image_key: The key the image is shared as.
+        :param index: The index of the chunk.
+        :returns: The content of the chunk.
+        """
+        with metrics_utils.get_metrics_logger(__name__).timer('get_one'):
+            shared_image = image_swarm.get_shared_image(image_key)
+            try:
+                index = int(index)
+            except ValueError:
+                pecan.abort(400, 'Invalid chunk index')
+            data = None
+            if shared_image is not None:
+                data = shared_image.read_chunk(index)
+            if data is None:
+                pecan.abort(404, 'Chunk not available')
+            return data
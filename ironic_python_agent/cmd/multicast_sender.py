@@ -0,0 +1,60 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import logging
+import sys
+
+from ironic_python_agent import multicast
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Send an image to ironic-python-agent instances over '
+                    'UDP multicast. The agents receive it when the '
+                    '"multicast" field of image_info names the same group, '
+                    'port and session.')
+    parser.add_argument('image', help='Path of the image file to send.')
+    parser.add_argument('--group', required=True,
+                        help='IPv4 address of the multicast group.')
+    parser.add_argument('--port', type=int, required=True,
+                        help='UDP port to send to.')
+    parser.add_argument('--session', type=int, default=0,
+                        help='Session number of the transmission.')
+    parser.add_argument('--block-size', type=int,
+                        default=multicast.DEFAULT_BLOCK_SIZE,
+                        help='Size of a block in bytes.')
+    parser.add_argument('--group-size', type=int,
+                        default=multicast.DEFAULT_GROUP_SIZE,
+                        help='Number of data blocks in a group.')
+    parser.add_argument('--parity', type=int,
+                        default=multicast.DEFAULT_PARITY,
+                        help='Number of parity blocks sent after every '
+                             'group.')
+    parser.add_argument('--ttl', type=int, default=1,
+                        help='Multicast TTL.')
+    parser.add_argument('--interface',
+                        help='IPv4 address of the interface to send from.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Maximum rate in Mbit/s, 0 for no limit.')
+    return parser.parse_args(args)
+
+
+def run():
+    """Entrypoint for the multicast image sender."""
+    args = _parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
+    multicast.Sender(args.group, args.port, session=args.session,
+                     block_size=args.block_size, group_size=args.group_size,
+                     parity=args.parity, ttl=args.ttl,
+                     interface=args.interface, rate=args.rate).send(
+                         args.image)
@@ -209,6 +209,460 @@ cli_opts = [
                     'Must be provided together with "certfile" option. '
                     'Default is to not present any client certificates to '
                     'the server.'),
+    cfg.IntOpt('image_download_connections',
+               default=int(APARAMS.get('ipa-image-download-connections', 1)),
+               min=1,
+               help='The number of parallel HTTP connections used to '
+                    'download an image when the image server supports '
+                    'byte range requests. The default of 1 downloads the '
+                    'image over a single stream. Can be overridden per '
+                    'image with the "download_connections" field of '
+                    'image_info. '
+                    'Can be supplied as "ipa-image-download-connections" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_download_range_size',
+               default=int(APARAMS.get('ipa-image-download-range-size', 64)),
+               min=1,
+               help='The size, in MiB, of each byte range requested when '
+                    'an image is downloaded over several connections. Can '
+                    'be overridden per image with the "download_range_size" '
+                    'field of image_info. '
+                    'Can be supplied as "ipa-image-download-range-size" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_mirror_selection',
+               default=APARAMS.get('ipa-image-mirror-selection', 'ordered'),
+               choices=['ordered', 'fastest'],
+               help='How the URL an image is downloaded from is chosen '
+                    'among the "urls" of image_info. With "ordered", the '
+                    'URLs are tried in turn and the first one which '
+                    'answers is used. With "fastest", all of them are '
+                    'probed concurrently with a small byte range request '
+                    'and tried from the fastest to the slowest. Can be '
+                    'overridden per image with the "mirror_selection" '
+                    'field of image_info. '
+                    'Can be supplied as "ipa-image-mirror-selection" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_mirror_probe_size',
+               default=int(APARAMS.get('ipa-image-mirror-probe-size', 1024)),
+               min=1,
+               help='The size, in KiB, of the byte range requested from '
+                    'every image URL when the fastest one is selected. '
+                    'Can be supplied as "ipa-image-mirror-probe-size" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_mirror_probe_timeout',
+               default=int(APARAMS.get('ipa-image-mirror-probe-timeout',
+                                       10)),
+               min=1,
+               help='The time, in seconds, after which an image URL which '
+                    'has not answered a probe is ranked last. '
+                    'Can be supplied as "ipa-image-mirror-probe-timeout" '
+                    'kernel parameter.'),
+    cfg.FloatOpt('image_mirror_failover_throughput',
+                 default=float(APARAMS.get(
+                     'ipa-image-mirror-failover-throughput', 0)),
+                 min=0,
+                 help='The throughput, in MB/s, below which an image '
+                      'download switches to another of the "urls" of '
+                      'image_info, carrying on from the current byte '
+                      'offset. The download also switches when the '
+                      'connection fails or stalls. The default of 0 '
+                      'disables switching. Only applies to images '
+                      'downloaded over a single connection. Can be '
+                      'overridden per image with the '
+                      '"mirror_failover_throughput" field of image_info. '
+                      'Can be supplied as '
+                      '"ipa-image-mirror-failover-throughput" kernel '
+                      'parameter.'),
+    cfg.IntOpt('image_mirror_failover_window',
+               default=int(APARAMS.get('ipa-image-mirror-failover-window',
+                                       30)),
+               min=1,
+               help='The time, in seconds, over which the throughput of an '
+                    'image download is measured to decide whether to '
+                    'switch to another URL. A connection which does not '
+                    'receive any data for this long is considered failed. '
+                    'Can be supplied as "ipa-image-mirror-failover-window" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_download_checkpoints',
+                default=APARAMS.get('ipa-image-download-checkpoints', False),
+                help='Whether progress of image downloads is checkpointed, '
+                     'so that a failed download, or a later retry of the '
+                     'same deployment, only fetches the part of the image '
+                     'which is missing. Can be overridden per image with '
+                     'the "download_checkpoints" field of image_info. '
+                     'Can be supplied as "ipa-image-download-checkpoints" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_download_resume_attempts',
+               default=int(APARAMS.get('ipa-image-download-resume-attempts',
+                                       3)),
+               min=0,
+               help='The number of times a checkpointed image download is '
+                    'resumed after it fails, before the deployment fails. '
+                    'Can be overridden per image with the '
+                    '"download_resume_attempts" field of image_info. '
+                    'Can be supplied as "ipa-image-download-resume-attempts" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_cache_size',
+               default=int(APARAMS.get('ipa-image-cache-size', 0)),
+               min=0,
+               help='The maximum total size, in MiB, of the verified images '
+                    'kept in the on-node image cache, keyed by their '
+                    'checksums, so that caching or preparing the same image '
+                    'again does not download it again. The least recently '
+                    'used images are evicted first. The default of 0 '
+                    'disables the cache. '
+                    'Can be supplied as "ipa-image-cache-size" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_cache_dir',
+               default=APARAMS.get('ipa-image-cache-dir',
+                                   '/tmp/ipa-image-cache'),
+               help='The directory the image cache keeps images in. It '
+                    'should be on the same file system as /tmp, where '
+                    'images are downloaded, so that they are cached without '
+                    'being copied. '
+                    'Can be supplied as "ipa-image-cache-dir" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_cache_scratch_dir',
+               default=APARAMS.get('ipa-image-cache-scratch-dir'),
+               help='A directory on disk, outside of the install device, '
+                    'the image cache moves images to when keeping them in '
+                    'memory would leave less than '
+                    '"image_cache_memory_reserve" free. By default, such '
+                    'images are not cached. '
+                    'Can be supplied as "ipa-image-cache-scratch-dir" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_cache_memory_reserve',
+               default=int(APARAMS.get('ipa-image-cache-memory-reserve',
+                                       1024)),
+               min=0,
+               help='The amount of memory, in MiB, left free when images '
+                    'are kept in the image cache in memory. '
+                    'Can be supplied as "ipa-image-cache-memory-reserve" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_staging_memory_reserve',
+               default=int(APARAMS.get('ipa-image-staging-memory-reserve',
+                                       1024)),
+               min=0,
+               help='The amount of memory, in MiB, left free when an image '
+                    'which is not streamed is downloaded to /tmp, in '
+                    'memory. Larger images are staged on a local disk, see '
+                    '"image_staging_scratch_dir" and '
+                    '"image_staging_device_tail". '
+                    'Can be supplied as "ipa-image-staging-memory-reserve" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_staging_scratch_dir',
+               default=APARAMS.get('ipa-image-staging-scratch-dir'),
+               help='A directory on disk, outside of the install device, '
+                    'images are downloaded to when they do not fit in '
+                    'memory. They are removed once written. '
+                    'Can be supplied as "ipa-image-staging-scratch-dir" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_staging_device_tail',
+                default=APARAMS.get('ipa-image-staging-device-tail', False),
+                help='Whether a whole disk image which does not fit in '
+                     'memory, nor in "image_staging_scratch_dir", is '
+                     'downloaded to the end of the install device before '
+                     'being written to its start. The device must be at '
+                     'least twice as large as the image, and as large as '
+                     'the virtual size of the image plus its size. '
+                     'Can be overridden per image with the '
+                     '"staging_device_tail" field of image_info. '
+                     'Can be supplied as "ipa-image-staging-device-tail" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_decompress_threads',
+               default=int(APARAMS.get('ipa-image-decompress-threads', 4)),
+               min=1,
+               help='The number of frames of a compressed image, as '
+                    'declared by the "compression" field of image_info, '
+                    'decompressed in parallel. Only multi-frame zstd and '
+                    'BGZF gzip images are decompressed in parallel. Can be '
+                    'overridden per image with the "decompress_threads" '
+                    'field of image_info. '
+                    'Can be supplied as "ipa-image-decompress-threads" '
+                    'kernel parameter.'),
+    cfg.FloatOpt('image_download_rate',
+                 default=float(APARAMS.get('ipa-image-download-rate', 0)),
+                 min=0,
+                 help='The maximum rate of image downloads in MB/s, or 0 '
+                      'for no limit. Limiting the rate of every agent '
+                      'deploying at the same time keeps the image servers '
+                      'from being saturated. The rate can be changed while '
+                      'an image is downloading with the '
+                      '"standby.set_download_rate" command. Can be '
+                      'overridden per image with the "download_rate" field '
+                      'of image_info. '
+                      'Can be supplied as "ipa-image-download-rate" '
+                      'kernel parameter.'),
+    cfg.IntOpt('image_multicast_timeout',
+               default=int(APARAMS.get('ipa-image-multicast-timeout', 10)),
+               min=1,
+               help='The number of seconds without any packet after which '
+                    'the multicast transmission of an image, requested by '
+                    'the "multicast" field of image_info, is considered '
+                    'over. The rest of the image is then fetched with HTTP '
+                    'Range requests. Can be overridden per image with the '
+                    '"timeout" field of the "multicast" field of '
+                    'image_info. '
+                    'Can be supplied as "ipa-image-multicast-timeout" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_multicast_buffer',
+               default=int(APARAMS.get('ipa-image-multicast-buffer', 64)),
+               min=1,
+               help='The amount of memory, in MiB, used to buffer blocks '
+                    'received over multicast ahead of the one being '
+                    'written. Blocks received beyond it are dropped and '
+                    'fetched with HTTP Range requests. '
+                    'Can be supplied as "ipa-image-multicast-buffer" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_multicast_interface',
+               default=APARAMS.get('ipa-image-multicast-interface'),
+               help='The IPv4 address of the interface multicast groups '
+                    'are joined on. By default, the kernel chooses the '
+                    'interface. Can be overridden per image with the '
+                    '"interface" field of the "multicast" field of '
+                    'image_info. '
+                    'Can be supplied as "ipa-image-multicast-interface" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_swarm_connections',
+               default=int(APARAMS.get('ipa-image-swarm-connections', 4)),
+               min=1,
+               help='The minimum number of chunks fetched in parallel when '
+                    'an image is downloaded from peer agents, as requested '
+                    'by the "swarm" field of image_info. '
+                    'Can be supplied as "ipa-image-swarm-connections" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_swarm_share',
+                default=APARAMS.get('ipa-image-swarm-share', True),
+                help='Whether the verified chunks of images with a "swarm" '
+                     'field in image_info are served to peer agents over '
+                     'the agent API once they have been written. '
+                     'Can be supplied as "ipa-image-swarm-share" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_chunk_verify_threads',
+               default=int(APARAMS.get('ipa-image-chunk-verify-threads', 4)),
+               min=1,
+               help='The number of threads verifying the chunks of an image '
+                    'against the chunk manifest given in the '
+                    '"chunk_manifest" field of image_info. As many chunks '
+                    'are held in memory while they are verified. Can be '
+                    'overridden per image with the "chunk_verify_threads" '
+                    'field of image_info. '
+                    'Can be supplied as "ipa-image-chunk-verify-threads" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_chunk_refetch_attempts',
+               default=int(APARAMS.get('ipa-image-chunk-refetch-attempts',
+                                       0)),
+               min=0,
+               help='The number of times a chunk of an image which does not '
+                    'match its digest in the chunk manifest is fetched '
+                    'again, before the deployment fails. The default of 0 '
+                    'fails the deployment on the first mismatch. Can be '
+                    'overridden per image with the "chunk_refetch_attempts" '
+                    'field of image_info. '
+                    'Can be supplied as "ipa-image-chunk-refetch-attempts" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_pipeline_chunks',
+               default=int(APARAMS.get('ipa-image-pipeline-chunks', 0)),
+               min=0,
+               help='The number of 1 MiB image chunks that may be in '
+                    'flight between the download, checksum and write '
+                    'stages of an image, which run in separate threads '
+                    'when this is greater than 0. This caps the memory '
+                    'used by the pipeline. The default of 0 downloads, '
+                    'checksums and writes each chunk in turn. Can be '
+                    'overridden per image with the "pipeline_chunks" '
+                    'field of image_info. '
+                    'Can be supplied as "ipa-image-pipeline-chunks" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('stream_qcow2_images',
+                default=APARAMS.get('ipa-stream-qcow2-images', False),
+                help='Whether whole disk qcow2 images are decoded while '
+                     'they are downloaded and written straight to the '
+                     'install device, instead of being staged in full in '
+                     'the ramdisk and converted with qemu-img. Can be '
+                     'overridden per image with the "stream_qcow2_images" '
+                     'field of image_info. '
+                     'Can be supplied as "ipa-stream-qcow2-images" '
+                     'kernel parameter.'),
+    cfg.BoolOpt('stream_partition_images',
+                default=APARAMS.get('ipa-stream-partition-images', False),
+                help='Whether raw and qcow2 partition images are streamed '
+                     'straight into the root partition once the partitions '
+                     'of the install device have been created, instead of '
+                     'being staged in full in the ramdisk first. qcow2 '
+                     'images are decoded while they are downloaded. Can be '
+                     'overridden per image with the '
+                     '"stream_partition_images" field of image_info. '
+                     'Can be supplied as "ipa-stream-partition-images" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_stream_spill_size',
+               default=int(APARAMS.get('ipa-image-stream-spill-size', 256)),
+               min=0,
+               help='The maximum amount of memory, in MiB, used to hold '
+                    'parts of a streamed qcow2 image which arrive before '
+                    'the tables describing them. '
+                    'Can be supplied as "ipa-image-stream-spill-size" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_direct_io_queue_depth',
+               default=int(APARAMS.get('ipa-image-direct-io-queue-depth',
+                                       0)),
+               min=0,
+               help='The number of writes kept outstanding by a pool of '
+                    'writer threads when a raw image is streamed onto the '
+                    'install device with direct I/O, bypassing the page '
+                    'cache. The default of 0 streams the image with '
+                    'buffered writes. Can be overridden per image with the '
+                    '"direct_io_queue_depth" field of image_info. '
+                    'Can be supplied as "ipa-image-direct-io-queue-depth" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_direct_io_block_size',
+               default=int(APARAMS.get('ipa-image-direct-io-block-size',
+                                       4)),
+               min=1,
+               help='The size, in MiB, of each direct I/O write issued '
+                    'when a raw image is streamed onto the install device '
+                    'with direct I/O. Can be overridden per image with the '
+                    '"direct_io_block_size" field of image_info. '
+                    'Can be supplied as "ipa-image-direct-io-block-size" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_verify_writes',
+                default=APARAMS.get('ipa-image-verify-writes', False),
+                help='Whether whole disk images are read back from the '
+                     'install device once written, with direct I/O, and '
+                     'verified against the chunk manifest of the image, or '
+                     'its checksum, to catch writes lost by the disk or its '
+                     'controller before the node is rebooted. Only raw '
+                     'images, whose content is written as is, can be '
+                     'verified. Can be overridden per image with the '
+                     '"verify_writes" field of image_info. '
+                     'Can be supplied as "ipa-image-verify-writes" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_verify_threads',
+               default=int(APARAMS.get('ipa-image-verify-threads', 4)),
+               min=1,
+               help='The number of blocks of "image_direct_io_block_size" '
+                    'MiB read in parallel when an image is read back to '
+                    'verify it. Can be overridden per image with the '
+                    '"verify_threads" field of image_info. '
+                    'Can be supplied as "ipa-image-verify-threads" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_delta_deploy',
+                default=APARAMS.get('ipa-image-delta-deploy', False),
+                help='Whether raw whole disk images with a chunk manifest '
+                     'are deployed as a delta of the install device. The '
+                     'device is compared with the chunk manifest, and only '
+                     'the differing chunks are fetched with byte range '
+                     'requests and written, which saves most of the '
+                     'download when a node is rebuilt with a new version '
+                     'of its image. Images which cannot be deployed this '
+                     'way are deployed in full. Can be overridden per image '
+                     'with the "delta_deploy" field of image_info. '
+                     'Can be supplied as "ipa-image-delta-deploy" '
+                     'kernel parameter.'),
+    cfg.BoolOpt('image_zero_copy',
+                default=APARAMS.get('ipa-image-zero-copy', False),
+                help='Whether raw images streamed to the install device '
+                     'from plain HTTP servers are moved from the socket to '
+                     'the device with splice, without being copied by the '
+                     'agent. The checksums are then computed by reading '
+                     'the image back from the device. Images served over '
+                     'HTTPS or through a proxy, compressed images, and '
+                     'images written sparsely, resumed from checkpoints or '
+                     'received from peers are streamed as usual. '
+                     'Can be overridden per image with the "zero_copy" '
+                     'field of image_info. '
+                     'Can be supplied as "ipa-image-zero-copy" '
+                     'kernel parameter.'),
+    cfg.BoolOpt('image_sparse_writes',
+                default=APARAMS.get('ipa-image-sparse-writes', False),
+                help='Whether blocks of zeroes in whole disk images are '
+                     'skipped instead of being written to the install '
+                     'device. Skipped ranges are zeroed with BLKZEROOUT or '
+                     'BLKDISCARD, which is only done if the device '
+                     'guarantees that they read back as zeroes. Can be '
+                     'overridden per image with the "sparse_writes" field '
+                     'of image_info. '
+                     'Can be supplied as "ipa-image-sparse-writes" '
+                     'kernel parameter.'),
+    cfg.BoolOpt('image_discard_device',
+                default=APARAMS.get('ipa-image-discard-device', False),
+                help='Whether all the blocks of the install device are '
+                     'discarded before a whole disk image is written to '
+                     'it, if the device supports discard, so that SSDs and '
+                     'thin provisioned volumes do not have to preserve '
+                     'their previous content. When the device guarantees '
+                     'that discarded blocks read back as zeroes, images '
+                     'written sparsely leave blocks of zeroes as they are. '
+                     'The guarantee is read from the discard_zeroes_data '
+                     'attribute of the device in sysfs, which is always 0 '
+                     'since Linux 4.12, so blocks of zeroes are still '
+                     'zeroed on newer kernels. '
+                     'The device is not discarded when an image is '
+                     'deployed as a delta or resumed from a download '
+                     'checkpoint. Can be overridden per image with the '
+                     '"discard_device" field of image_info. '
+                     'Can be supplied as "ipa-image-discard-device" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_writeback_window',
+               default=int(APARAMS.get('ipa-image-writeback-window', 0)),
+               min=0,
+               help='The size in MiB of the windows of image data written '
+                    'to the install device through the page cache that '
+                    'are flushed while the image is still being written. '
+                    'Every window is flushed in the background once it '
+                    'has been written, then dropped from the page cache '
+                    'once the next one has, which bounds the dirty memory '
+                    'of the agent and shortens the sync done once the '
+                    'image has been written. 0 leaves the written data for '
+                    'the kernel to flush. Does not apply to writes done '
+                    'with direct I/O. Can be overridden per image with the '
+                    '"writeback_window" field of image_info. '
+                    'Can be supplied as "ipa-image-writeback-window" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_converter',
+               default=APARAMS.get('ipa-image-converter', 'builtin'),
+               help='The image converter writing downloaded whole disk '
+                    'images to the install device, the name of an entry '
+                    'point in the ironic_python_agent.image_converters '
+                    'namespace. "builtin" writes raw and qcow2 images '
+                    'in-process and "qemu-img" uses qemu-img, which is '
+                    'also used for the formats an image converter does not '
+                    'support. Can be overridden per image with the '
+                    '"image_converter" field of image_info. '
+                    'Can be supplied as "ipa-image-converter" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_convert_cache_mode',
+               default=APARAMS.get('ipa-image-convert-cache-mode', 'none'),
+               choices=['none', 'directsync', 'writeback'],
+               help='How an image converter writes to the install device: '
+                    'with direct I/O ("none"), with direct I/O synced on '
+                    'every write ("directsync") or through the page cache '
+                    '("writeback"). The device is always flushed once the '
+                    'image has been written. Can be overridden per image '
+                    'with the "convert_cache_mode" field of image_info. '
+                    'Can be supplied as "ipa-image-convert-cache-mode" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_convert_queue_depth',
+               default=int(APARAMS.get('ipa-image-convert-queue-depth', 8)),
+               min=1,
+               help='The number of writes of "image_direct_io_block_size" '
+                    'MiB kept outstanding by the builtin image converter, '
+                    'which complete in any order. Can be overridden per '
+                    'image with the "convert_queue_depth" field of '
+                    'image_info. '
+                    'Can be supplied as "ipa-image-convert-queue-depth" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_convert_memory_percent',
+               default=int(APARAMS.get('ipa-image-convert-memory-percent',
+                                       25)),
+               min=1, max=90,
+               help='The percentage of the available memory an image '
+                    'conversion may use. It bounds the write buffers and '
+                    'the qcow2 data held by the builtin image converter, '
+                    'and the address space of qemu-img, which is given at '
+                    'least 1 GiB. '
+                    'Can be supplied as "ipa-image-convert-memory-percent" '
+                    'kernel parameter.'),
     cfg.BoolOpt('disable_raid_config',
                 default=APARAMS.get("disable_raid_config", True),
                 help='indicate if configuring RAID is disabled'
@@ -0,0 +1,465 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-the-fly decompression of images compressed with gzip, xz or zstd.
+
+Compressed streams made of independent frames, such as multi-frame zstd
+or BGZF gzip as written by bgzip and other parallel gzip tools, are split
+into frames which are decompressed in parallel on a pool of threads, as
+zlib and zstd release the GIL while decompressing. Frames which cannot be
+delimited without decompressing them, or which could decompress to too much
+data to be held in memory, are decompressed sequentially, in pieces of
+bounded size.
+"""
+
+import collections
+from multiprocessing import pool
+import struct
+import zlib
+
+import six
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ('gzip', 'xz', 'zstd')
+
+OUTPUT_CHUNK_SIZE = 1024 * 1024
+"""The maximum size of the pieces of decompressed data returned."""
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+"""The maximum compressed size of a frame decompressed in parallel."""
+
+MAX_FRAME_OUTPUT = 64 * 1024 * 1024
+"""The maximum decompressed size of a frame decompressed in parallel."""
+
+UNKNOWN = object()
+"""The frame cannot be delimited without decompressing it."""
+
+_ZSTD_MAGIC = 0xFD2FB528
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+_ZSTD_BLOCK_MAX = 128 * 1024
+
+# zlib decompressors only tell when a stream ends on Python 3
+_ZLIB_EOF = hasattr(zlib.decompressobj(), 'eof')
+
+
+class DecompressionError(Exception):
+    """The compressed data is invalid or truncated."""
+
+
+class _GzipStream(object):
+    """Decompresses a single gzip member sequentially.
+
+    Without the eof attribute of zlib decompressors, the member is known to
+    have ended once data follows it, or once its trailer, the CRC32 and the
+    size of the decompressed data, has been consumed.
+    """
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._crc = 0
+        self._size = 0
+        self._tail = b''
+
+    @property
+    def eof(self):
+        if _ZLIB_EOF:
+            return self._decompressor.eof
+        return bool(self._decompressor.unused_data) or (
+            self._tail == struct.pack('<II', self._crc & 0xffffffff,
+                                      self._size & 0xffffffff))
+
+    @property
+    def unused_data(self):
+        return self._decompressor.unused_data
+
+    def feed(self, data):
+        while not self.eof:
+            out = self._decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+            if not _ZLIB_EOF:
+                consumed = len(data) - len(
+                    self._decompressor.unconsumed_tail) - len(
+                    self._decompressor.unused_data)
+                self._tail = (self._tail + data[:consumed])[-8:]
+                self._crc = zlib.crc32(out, self._crc)
+                self._size += len(out)
+            data = self._decompressor.unconsumed_tail
+            if out:
+                yield out
+            if not data and len(out) < OUTPUT_CHUNK_SIZE:
+                break
+
+
+class _Gzip(object):
+    """gzip streams, decompressed in parallel when made of BGZF members."""
+
+    def frame(self, data):
+        """Delimit the frame at the start of the data.
+
+        :param data: The compressed data, starting at a frame boundary.
+        :returns: A tuple of the compressed length of the frame and the
+                  maximum size of its decompressed data, UNKNOWN, or None if
+                  more data is needed.
+        """
+        if len(data) < 12:
+            return None
+        if data[0:2] != b'\x1f\x8b':
+            raise DecompressionError('Not a gzip member')
+        (flags,) = struct.unpack_from('<B', data, 3)
+        if not flags & 4:
+            return UNKNOWN
+        (extra_length,) = struct.unpack_from('<H', data, 10)
+        if len(data) < 12 + extra_length:
+            return None
+        position = 12
+        while position + 4 <= 12 + extra_length:
+            identifier = data[position:position + 2]
+            (field_length,) = struct.unpack_from('<H', data, position + 2)
+            if identifier == b'BC' and field_length == 2:
+                (block_size,) = struct.unpack_from('<H', data, position + 4)
+                length = block_size + 1
+                if len(data) < length:
+                    return None
+                (size,) = struct.unpack_from('<I', data, length - 4)
+                return length, size
+            position += 4 + field_length
+        return UNKNOWN
+
+    def decode(self, frame):
+        return zlib.decompress(frame, 16 + zlib.MAX_WBITS)
+
+    def stream(self):
+        return _GzipStream()
+
+
+class _XzStream(object):
+    """Decompresses a single xz stream sequentially."""
+
+    def __init__(self):
+        self._decompressor = lzma.LZMADecompressor()
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self._decompressor.unused_data
+
+    def feed(self, data):
+        while not self.eof:
+            out = self._decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+            data = b''
+            if out:
+                yield out
+            if self._decompressor.needs_input:
+                break
+
+
+class _Xz(object):
+    """xz streams, which are always decompressed sequentially."""
+
+    def frame(self, data):
+        return UNKNOWN
+
+    def stream(self):
+        return _XzStream()
+
+
+def _zstd_header(data):
+    """Get the header size and checksum flag of a zstd frame.
+
+    :param data: The compressed data, starting at a frame, of at least 5
+                 bytes.
+    :returns: A tuple of the size of the header in bytes and whether the
+              frame ends with a checksum.
+    """
+    (magic,) = struct.unpack_from('<I', data)
+    if magic != _ZSTD_MAGIC:
+        raise DecompressionError('Not a zstd frame')
+    (descriptor,) = struct.unpack_from('<B', data, 4)
+    single_segment = (descriptor >> 5) & 1
+    content_size = (single_segment, 2, 4, 8)[descriptor >> 6]
+    dictionary = (0, 1, 2, 4)[descriptor & 3]
+    return (5 + (1 - single_segment) + dictionary + content_size,
+            bool(descriptor & 4))
+
+
+def _zstd_block(data, position):
+    """Get the size of a zstd block.
+
+    :param data: The compressed data.
+    :param position: The offset of the block header in the data.
+    :returns: A tuple of the size of the block, including its header, and
+              whether it is the last block of its frame.
+    """
+    (header,) = struct.unpack('<I', bytes(data[position:position + 3]) +
+                              b'\0')
+    block_type = (header >> 1) & 3
+    if block_type == 3:
+        raise DecompressionError('Invalid zstd block type')
+    size = 1 if block_type == 1 else header >> 3
+    return 3 + size, bool(header & 1)
+
+
+class _ZstdStream(object):
+    """Decompresses a single zstd frame sequentially, block by block.
+
+    A zstd block never decompresses to more than 128 KiB, so feeding the
+    decompressor one block at a time bounds the memory used.
+    """
+
+    def __init__(self):
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._buffer = bytearray()
+        self._position = 0
+        self._state = 'start'
+        self._checksum = False
+        self._skip = 0
+        self.unused_data = b''
+
+    @property
+    def eof(self):
+        return self._state == 'done'
+
+    def _next_unit(self):
+        """Take the next complete part of the frame from the buffer.
+
+        :returns: The part of the frame, which is empty if it holds nothing
+                  to decompress, or None if more data is needed.
+        """
+        available = len(self._buffer) - self._position
+        if self._state == 'start':
+            if available < 8:
+                return None
+            (magic,) = struct.unpack_from('<I', self._buffer,
+                                          self._position)
+            if magic & 0xFFFFFFF0 == _ZSTD_SKIPPABLE_MAGIC:
+                (self._skip,) = struct.unpack_from('<I', self._buffer,
+                                                   self._position + 4)
+                self._position += 8
+                self._state = 'skip'
+                return b''
+            size, checksum = _zstd_header(
+                self._buffer[self._position:self._position + 5])
+            if available < size:
+                return None
+            self._checksum = checksum
+            self._state = 'block'
+        elif self._state == 'skip':
+            size = min(self._skip, available)
+            self._position += size
+            self._skip -= size
+            if not self._skip:
+                self._state = 'done'
+            elif not size:
+                return None
+            return b''
+        elif self._state == 'block':
+            if available < 3:
+                return None
+            size, last = _zstd_block(self._buffer, self._position)
+            if available < size:
+                return None
+            if last:
+                self._state = 'checksum' if self._checksum else 'done'
+        else:
+            size = 4
+            if available < size:
+                return None
+            self._state = 'done'
+        unit = bytes(self._buffer[self._position:self._position + size])
+        self._position += size
+        return unit
+
+    def feed(self, data):
+        self._buffer += data
+        while not self.eof:
+            unit = self._next_unit()
+            if unit is None:
+                break
+            if unit:
+                out = self._decompressor.decompress(unit)
+                if out:
+                    yield out
+        del self._buffer[:self._position]
+        self._position = 0
+        if self.eof:
+            self.unused_data = bytes(self._buffer)
+
+
+class _Zstd(object):
+    """zstd streams, decompressed in parallel when made of several frames."""
+
+    def frame(self, data):
+        """Delimit the frame at the start of the data.
+
+        :param data: The compressed data, starting at a frame boundary.
+        :returns: A tuple of the compressed length of the frame and the
+                  maximum size of its decompressed data, UNKNOWN, or None if
+                  more data is needed.
+        """
+        if len(data) < 8:
+            return None
+        (magic,) = struct.unpack_from('<I', data)
+        if magic & 0xFFFFFFF0 == _ZSTD_SKIPPABLE_MAGIC:
+            (size,) = struct.unpack_from('<I', data, 4)
+            return 8 + size, 0
+        position, checksum = _zstd_header(data)
+        blocks = 0
+        last = False
+        while not last:
+            if len(data) < position + 3:
+                return None
+            size, last = _zstd_block(data, position)
+            position += size
+            blocks += 1
+        if checksum:
+            position += 4
+        if len(data) < position:
+            return None
+        return position, blocks * _ZSTD_BLOCK_MAX
+
+    def decode(self, frame):
+        (magic,) = struct.unpack_from('<I', frame)
+        if magic & 0xFFFFFFF0 == _ZSTD_SKIPPABLE_MAGIC:
+            return b''
+        return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+
+    def stream(self):
+        return _ZstdStream()
+
+
+def _codec(compression):
+    """Get the codec of a compression type.
+
+    :param compression: One of COMPRESSIONS.
+    :raises: DecompressionError if the compression type is not supported.
+    """
+    if compression == 'gzip':
+        return _Gzip()
+    if compression == 'xz':
+        if lzma is None:
+            raise DecompressionError('The lzma module is not available')
+        return _Xz()
+    if compression == 'zstd':
+        if zstandard is None:
+            raise DecompressionError('The zstandard module is not available')
+        return _Zstd()
+    raise DecompressionError('Unknown compression {}'.format(compression))
+
+
+def _errors():
+    """Get the exceptions raised by the codecs on invalid data."""
+    result = (zlib.error, EOFError, struct.error)
+    if lzma is not None:
+        result += (lzma.LZMAError,)
+    if zstandard is not None:
+        result += (zstandard.ZstdError,)
+    return result
+
+
+class _Decompressor(object):
+    """Decompresses a stream of chunks, frame by frame."""
+
+    def __init__(self, codec, threads):
+        self._codec = codec
+        self._threads = threads
+        self._buffer = bytearray()
+        self._stream = None
+        self._pending = collections.deque()
+
+    def _split(self, data):
+        for start in six.moves.range(0, len(data), OUTPUT_CHUNK_SIZE):
+            yield data[start:start + OUTPUT_CHUNK_SIZE]
+
+    def _drain(self, keep):
+        """Return the decompressed frames until at most keep are pending."""
+        while len(self._pending) > keep:
+            for part in self._split(self._pending.popleft().get()):
+                yield part
+
+    def _process(self, workers, final=False):
+        """Decompress as much of the buffered data as possible."""
+        while True:
+            if self._stream is not None:
+                data = bytes(self._buffer)
+                del self._buffer[:]
+                for out in self._stream.feed(data):
+                    for part in self._split(out):
+                        yield part
+                if not self._stream.eof:
+                    if final:
+                        raise DecompressionError('The image is truncated')
+                    return
+                self._buffer += self._stream.unused_data
+                self._stream = None
+                continue
+            if not self._buffer:
+                return
+            frame = self._codec.frame(self._buffer)
+            if frame is None and not final:
+                if len(self._buffer) <= MAX_FRAME_SIZE:
+                    return
+            if (frame is None or frame is UNKNOWN or
+                    frame[0] > MAX_FRAME_SIZE or
+                    frame[1] > MAX_FRAME_OUTPUT):
+                # Frames are returned in order, so pending frames go first
+                for part in self._drain(0):
+                    yield part
+                self._stream = self._codec.stream()
+                continue
+            length = frame[0]
+            self._pending.append(workers.apply_async(
+                self._codec.decode, (bytes(self._buffer[:length]),)))
+            del self._buffer[:length]
+            for part in self._drain(self._threads):
+                yield part
+
+    def decompress(self, chunks):
+        workers = pool.ThreadPool(self._threads)
+        try:
+            for chunk in chunks:
+                self._buffer += chunk
+                for part in self._process(workers):
+                    yield part
+            for part in self._process(workers, final=True):
+                yield part
+            for part in self._drain(0):
+                yield part
+        except _errors() as e:
+            raise DecompressionError(str(e))
+        finally:
+            workers.terminate()
+
+
+def decompress(chunks, compression, threads=1):
+    """Decompress a stream of chunks.
+
+    :param chunks: An iterator of chunks of compressed data.
+    :param compression: The compression type, one of COMPRESSIONS.
+    :param threads: Optional. The number of frames decompressed in
+                    parallel.
+    :raises: DecompressionError if the compression type is not supported,
+             or the data is invalid or truncated.
+    :returns: An iterator of chunks of decompressed data, of at most
+              OUTPUT_CHUNK_SIZE bytes.
+    """
+    return _Decompressor(_codec(compression), threads).decompress(chunks)
@@ -174,6 +174,15 @@ class ImageWriteError(RESTError):
         super(ImageWriteError, self).__init__(details)
 
 
+class ImageFormatError(RESTError):
+    """Error raised when an image cannot be decoded."""
+
+    message = 'Error decoding image'
+
+    def __init__(self, details):
+        super(ImageFormatError, self).__init__(details)
+
+
 class SystemRebootError(RESTError):
     """Error raised when a system cannot reboot."""
 
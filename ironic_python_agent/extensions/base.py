@@ -27,6 +27,9 @@ from ironic_python_agent import errors
 
 LOG = log.getLogger()
 
+# The asynchronous command executing on the current thread, if any
+_command_context = threading.local()
+
 
 class AgentCommandStatus(object):
     """Mapping of agent command statuses."""
@@ -119,6 +122,7 @@ class AsyncCommandResult(BaseCommandResult):
         self.agent = agent
         self.execute_method = execute_method
         self.command_state_lock = threading.Lock()
+        self.progress = None
 
         thread_name = 'agent-command-{}'.format(self.id)
         self.execution_thread = threading.Thread(target=self.run,
@@ -130,7 +134,11 @@ class AsyncCommandResult(BaseCommandResult):
         :returns: dict containing serializable fields in AsyncCommandResult
         """
         with self.command_state_lock:
-            return super(AsyncCommandResult, self).serialize()
+            result = super(AsyncCommandResult, self).serialize()
+            if (self.command_status == AgentCommandStatus.RUNNING and
+                    self.progress is not None):
+                result['command_result'] = {'progress': self.progress()}
+            return result
 
     def start(self):
         """Begin background execution of command."""
@@ -156,6 +164,7 @@ class AsyncCommandResult(BaseCommandResult):
 
     def run(self):
         """Run a command."""
+        _command_context.command = self
         try:
             result = self.execute_method(**self.command_params)
 
@@ -183,10 +192,26 @@ class AsyncCommandResult(BaseCommandResult):
                 self.command_error = e
                 self.command_status = AgentCommandStatus.FAILED
         finally:
+            _command_context.command = None
             if self.agent:
                 self.agent.force_heartbeat()
 
 
+def report_progress(progress):
+    """Report the progress of the command executing on the current thread.
+
+    While the command is running, its result holds the progress, under the
+    'progress' key. Nothing is reported outside of asynchronous commands.
+
+    :param progress: A callable returning a dictionary describing the
+                     progress, called whenever the result is serialized.
+    """
+    command = getattr(_command_context, 'command', None)
+    if command is not None:
+        with command.command_state_lock:
+            command.progress = progress
+
+
 class BaseAgentExtension(object):
     def __init__(self, agent=None):
         super(BaseAgentExtension, self).__init__()
@@ -239,13 +264,16 @@ class ExecuteCommandMixin(object):
                       {'name': command_name, 'args': kwargs})
             extension_part, command_part = self.split_command(command_name)
 
+            busy = False
             if len(self.command_results) > 0:
                 last_command = list(self.command_results.values())[-1]
-                if not last_command.is_done():
-                    LOG.error('Tried to execute %(command)s, agent is still '
-                              'executing %(last)s', {'command': command_name,
-                                                     'last': last_command})
-                    raise errors.CommandExecutionError('agent is busy')
+                busy = not last_command.is_done()
+            if busy and not self._allowed_while_busy(extension_part,
+                                                     command_part):
+                LOG.error('Tried to execute %(command)s, agent is still '
+                          'executing %(last)s', {'command': command_name,
+                                                 'last': last_command})
+                raise errors.CommandExecutionError('agent is busy')
 
             try:
                 ext = self.get_extension(extension_part)
@@ -267,9 +295,21 @@ class ExecuteCommandMixin(object):
                 result = SyncCommandResult(command_name, kwargs, False, e)
             LOG.info('Command %(name)s completed: %(result)s',
                      {'name': command_name, 'result': result})
-            self.command_results[result.id] = result
+            if not busy:
+                # A command run while another one is executing is not
+                # recorded, so that the executing command stays the last one.
+                self.command_results[result.id] = result
             return result
 
+    def _allowed_while_busy(self, extension_name, command_name):
+        """Whether a command may run while another one is executing."""
+        try:
+            ext = self.get_extension(extension_name)
+        except (KeyError, errors.ExtensionError):
+            return False
+        cmd = getattr(ext, 'command_map', {}).get(command_name)
+        return getattr(cmd, 'allowed_while_busy', False)
+
 
 def async_command(command_name, validator=None):
     """Will run the command in an AsyncCommandResult in its own thread.
@@ -301,15 +341,20 @@ def async_command(command_name, validator=None):
     return async_decorator
 
 
-def sync_command(command_name, validator=None):
+def sync_command(command_name, validator=None, allowed_while_busy=False):
     """Decorate a method to wrap its return value in a SyncCommandResult.
 
     For consistency with @async_command() can also accept a
     validator which will be used to validate input, although a synchronous
     command can also choose to implement validation inline.
+
+    Commands with allowed_while_busy set can be executed while another
+    command is executing, for example to adjust it. They are then not
+    recorded in the command results.
     """
     def sync_decorator(func):
         func.command_name = command_name
+        func.allowed_while_busy = allowed_while_busy
 
         @functools.wraps(func)
         def wrapper(self, **command_params):
@@ -12,26 +12,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import errno
 import hashlib
+import json
+from multiprocessing import pool
 import os
+import random
+import re
+import tempfile
+import threading
 import time
+import zlib
 
 from ironic_lib import disk_utils
+from ironic_lib import exception
+from ironic_lib import metrics_utils
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import strutils
+from oslo_utils import units
 import requests
 import six
+from six.moves import queue
 
+from ironic_python_agent import decompress
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import image_cache
+from ironic_python_agent import image_convert
+from ironic_python_agent import image_staging
+from ironic_python_agent import image_swarm
+from ironic_python_agent import image_writer
+from ironic_python_agent import multicast
+from ironic_python_agent import progress
+from ironic_python_agent import qcow2
+from ironic_python_agent import throttle
 from ironic_python_agent import utils
+from ironic_python_agent import zero_copy
 
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
 IMAGE_CHUNK_SIZE = 1024 * 1024  # 1MB
+# Number of attempts made to fetch a single byte range before giving up
+RANGE_FETCH_ATTEMPTS = 3
+# Marks the end of the stream between the stages of an _ImagePipeline
+_PIPELINE_END = object()
+# Marks an image which has not been looked up in the image cache yet
+_NOT_LOOKED_UP = object()
+# Amount of image data covered by each digest of a download checkpoint
+CHECKPOINT_SEGMENT_SIZE = 64 * units.Mi
+# Delay in seconds before a failed download is first resumed, doubled for
+# every further attempt up to the maximum
+RESUME_DELAY = 2
+RESUME_MAX_DELAY = 30
+# Number of chunks queued for each checksum thread of an image download
+HASH_QUEUE_CHUNKS = 8
+# Maximum number of times a single image download switches to another URL
+MIRROR_SWITCH_LIMIT = 10
+# Number of peers asked for a chunk before it is fetched from the image URL
+SWARM_PEER_ATTEMPTS = 3
+# Time in seconds after which a peer which does not answer is given up on
+SWARM_PEER_TIMEOUT = 10
+
+MULTICAST_REPAIR_SIZE = 8 * units.Mi
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+# Limits the rate of all image downloads, see the set_download_rate command
+_download_limiter = throttle.TokenBucket()
+# The rate in bytes per second of the image being downloaded, and the rate
+# set with the set_download_rate command, which takes precedence over it
+# until it is cleared
+_image_download_rate = 0.0
+_download_rate_override = None
+# The staging areas of the images downloaded before being written, by ID
+_staged_images = {}
+# The devices discarded before being written, whose discarded blocks read
+# back as zeroes
+_discarded_devices = set()
 
 
 def _image_location(image_info):
@@ -40,23 +100,31 @@ def _image_location(image_info):
     :param image_info: Image information dictionary.
     :returns: The full, absolute path to the image as a string.
     """
-    return '/tmp/{}'.format(image_info['id'])
+    staged = _staged_images.get(image_info['id'])
+    if staged is not None:
+        return staged.path
+    return os.path.join(image_staging.MEMORY_DIR, image_info['id'])
 
 
-def _path_to_script(script):
-    """Get the location of a script which ships with ironic-python-agent.
+def _image_size(image):
+    """Get the size of a local image.
 
-    :param script: The script name as a string.
-    :returns: The relative path to the script.
+    :param image: The path of the image, which may be a loop device when
+                  the image is staged at the end of a device.
+    :returns: The size of the image in bytes.
     """
-    cwd = os.path.dirname(os.path.realpath(__file__))
-    return os.path.join(cwd, '..', script)
+    for staged in _staged_images.values():
+        if staged.path == image and staged.device is not None:
+            return staged.size
+    return os.path.getsize(image)
 
 
 def _write_partition_image(image, image_info, device):
     """Call disk_util to create partition and write the partition image.
 
-    :param image: Local path to image file to be written to the partition.
+    :param image: Local path to image file to be written to the partition,
+                  or None to leave the root partition empty, for the image
+                  to be streamed into it.
     :param image_info: Image information dictionary.
     :param device: The device name, as a string, on which to store the image.
                    Example: '/dev/sda'
@@ -71,8 +139,11 @@ def _write_partition_image(image, image_info, device):
     boot_option = image_info.get('boot_option', 'netboot')
     boot_mode = image_info.get('deploy_boot_mode', 'bios')
     disk_label = image_info.get('disk_label', 'msdos')
-    image_mb = disk_utils.get_image_mb(image)
     root_mb = image_info['root_mb']
+    if image is None:
+        image_mb = _partition_image_mb(image_info)
+    else:
+        image_mb = disk_utils.get_image_mb(image)
     if image_mb > int(root_mb):
         msg = ('Root partition is too small for requested image. Image '
                'virtual size: {} MB, Root size: {} MB').format(image_mb,
@@ -93,38 +164,148 @@ def _write_partition_image(image, image_info, device):
         raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
 
 
-def _write_whole_disk_image(image, image_info, device):
+def _partition_image_mb(image_info):
+    """Get the size of a partition image streamed into its partition.
+
+    :param image_info: Image information dictionary.
+    :returns: The size in MiB, rounded up, or 0 if it is only known once
+              the image is downloaded.
+    """
+    image_size = image_info.get('image_size')
+    if (image_size is None or image_info.get('compression') or
+            image_info.get('disk_format') != 'raw'):
+        return 0
+    return (int(image_size) + units.Mi - 1) // units.Mi
+
+
+def _stream_partition_images(image_info):
+    """Get whether a partition image is streamed into its partition.
+
+    :param image_info: Image information dictionary.
+    """
+    return (image_info.get('image_type') == 'partition' and
+            image_info.get('disk_format') in ('raw', 'qcow2') and
+            strutils.bool_from_string(
+                image_info.get('stream_partition_images',
+                               CONF.stream_partition_images)))
+
+
+def _convert_settings(image_info):
+    """Get the settings used to convert a whole disk image onto a device.
+
+    :param image_info: Image information dictionary.
+    :returns: A tuple of the name of the image converter, the cache mode,
+              the queue depth, the block size in bytes and the memory
+              budget in bytes.
+    """
+    name = image_info.get('image_converter') or CONF.image_converter
+    cache_mode = (image_info.get('convert_cache_mode') or
+                  CONF.image_convert_cache_mode)
+    queue_depth = image_info.get('convert_queue_depth')
+    if queue_depth is None:
+        queue_depth = CONF.image_convert_queue_depth
+    _queue_depth, block_size = _direct_io_settings(image_info)
+    memory_limit = image_convert.memory_budget(
+        CONF.image_convert_memory_percent)
+    return name, cache_mode, int(queue_depth), block_size, memory_limit
+
+
+def _write_whole_disk_image(image, image_info, device, zero_request=None):
     """Writes a whole disk image to the specified device.
 
+    The image is written by the image converter selected with the
+    'image_converter' field of image_info or the image_converter option.
+    Images in formats it does not handle, or which it cannot decode, are
+    written with qemu-img.
+
     :param image: Local path to image file to be written to the disk.
     :param image_info: Image information dictionary.
-                       This parameter is currently unused by the function.
     :param device: The device name, as a string, on which to store the image.
                    Example: '/dev/sda'
+    :param zero_request: Optional. BLKZEROOUT or BLKDISCARD, to skip blocks
+                         of zeroes and zero them with an ioctl instead.
 
-    :raises: ImageWriteError if the command to write the image encounters an
-             error.
+    :raises: ImageWriteError if writing the image encounters an error.
+    :returns: A tuple of the number of bytes written, zeroed and skipped,
+              or None if unknown.
     """
-    script = _path_to_script('shell/write_image.sh')
-    command = ['/bin/bash', script, image, device]
-    LOG.info('Writing image with command: {}'.format(' '.join(command)))
+    name, cache_mode, queue_depth, block_size, memory_limit = (
+        _convert_settings(image_info))
     try:
-        stdout, stderr = utils.execute(*command, check_exit_code=[0])
+        converter = image_convert.get_converter(name)
+    except RuntimeError as e:
+        raise errors.ImageWriteError(device, None, None, str(e))
+    image_format = disk_utils.qemu_img_info(image).file_format
+    if not converter.supports(image_format):
+        LOG.info('Image converter %s does not support %s images, writing '
+                 'image %s with qemu-img', name, image_format, image)
+        converter = image_convert.QemuImgConverter()
+        zero_request = None
+
+    image_progress = progress.ImageProgress(image_info['id'],
+                                            _image_size(image))
+    base.report_progress(image_progress.to_dict)
+    try:
+        try:
+            stats = converter.convert(image, image_format, device,
+                                      cache_mode, queue_depth, block_size,
+                                      memory_limit,
+                                      zero_request=zero_request,
+                                      image_progress=image_progress,
+                                      writeback_window=_writeback_window(
+                                          image_info))
+        except errors.ImageFormatError as e:
+            LOG.warning('Image converter %s cannot decode image %s, writing '
+                        'it with qemu-img. Error: %s', name, image, e)
+            stats = image_convert.QemuImgConverter().convert(
+                image, image_format, device, cache_mode, queue_depth,
+                block_size, memory_limit)
     except processutils.ProcessExecutionError as e:
         raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
+    except (IOError, OSError) as e:
+        raise errors.ImageWriteError(device, None, None, str(e))
+    LOG.info('Image %s converted to device %s, %s', image, device,
+             image_progress.summary())
+    return stats
+
 
+def _write_whole_disk_image_sparse(image, image_info, device, zero_request):
+    """Writes a whole disk image to the specified device, skipping zeroes.
+
+    Raw and qcow2 images are written by the image converter, skipping
+    blocks of zeroes. Images in other formats are written with qemu-img.
+
+    :param image: Local path to image file to be written to the disk.
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string, on which to store the image.
+                   Example: '/dev/sda'
+    :param zero_request: BLKZEROOUT or BLKDISCARD, used to zero the skipped
+                         blocks.
 
-def _write_image(image_info, device):
+    :raises: ImageWriteError if writing the image encounters an error.
+    :returns: A tuple of the number of bytes written and the number of
+              bytes skipped, or None if the image was not written sparsely.
+    """
+    stats = _write_whole_disk_image(image, image_info, device, zero_request)
+    if stats is None:
+        return None
+    written, zeroed, skipped = stats
+    return (written + zeroed, skipped)
+
+
+def _write_image(image_info, device, image=None):
     """Writes an image to the specified device.
 
     :param image_info: Image information dictionary.
     :param device: The disk name, as a string, on which to store the image.
                    Example: '/dev/sda'
+    :param image: Optional. Local path to the image file. Defaults to the
+                  location the image is downloaded to.
     :raises: ImageWriteError if the command to write the image encounters an
              error.
     """
     starttime = time.time()
-    image = _image_location(image_info)
+    image = image or _image_location(image_info)
     uuids = {}
     if image_info.get('image_type') == 'partition':
         uuids = _write_partition_image(image, image_info, device)
@@ -158,145 +339,2474 @@ def _message_format(msg, image_info, device, partition_uuids):
     return message
 
 
-class ImageDownload(object):
-    """Helper class that opens a HTTP connection to download an image.
+def _request_options(image_info):
+    """Get the keyword arguments used for every image download request.
+
+    :param image_info: Image information dictionary.
+    :returns: A dictionary with the proxies and SSL options to pass to
+              requests.
+    """
+    no_proxy = image_info.get('no_proxy')
+    if no_proxy:
+        os.environ['no_proxy'] = no_proxy
+    proxies = image_info.get('proxies', {})
+    verify, cert = utils.get_ssl_client_options(CONF)
+    return {'proxies': proxies, 'verify': verify, 'cert': cert}
+
+
+def _expected_checksums(image_info):
+    """Get the checksums an image is verified against.
+
+    The legacy 'checksum' field holds an MD5 checksum. The 'os_hash_algo'
+    and 'os_hash_value' fields hold the name of another hashlib algorithm,
+    such as sha256 or sha512, and the checksum computed with it; both may
+    also be lists, if more than one checksum is given.
+
+    :param image_info: Image information dictionary.
+    :returns: A list of (algorithm, checksum) tuples.
+    """
+    expected = []
+    if image_info.get('checksum'):
+        expected.append(('md5', image_info['checksum'].lower()))
+    algos = image_info.get('os_hash_algo')
+    values = image_info.get('os_hash_value')
+    if algos and values:
+        if isinstance(algos, six.string_types):
+            algos = [algos]
+            values = [values]
+        for algo, value in zip(algos, values):
+            algo = algo.lower()
+            if algo not in (a for a, _v in expected):
+                expected.append((algo, value.lower()))
+    return expected
+
+
+def _new_hash(algo):
+    if algo == 'md5':
+        return hashlib.md5()
+    return hashlib.new(algo)
+
+
+class _ImageHashes(object):
+    """Checksums of an image, computed with one or more algorithms."""
+
+    def __init__(self, algorithms, hashes=None):
+        """Initialize an instance of the _ImageHashes class.
+
+        :param algorithms: The names of the hashlib algorithms to use.
+        :param hashes: Optional. The hashlib objects to continue from.
+        """
+        self.algorithms = list(algorithms)
+        self._hashes = hashes or [_new_hash(a) for a in self.algorithms]
+
+    def update(self, data):
+        """Add a chunk of the image to every checksum."""
+        for checksum in self._hashes:
+            checksum.update(data)
+
+    def update_one(self, index, data):
+        """Add a chunk of the image to a single checksum.
+
+        :param index: The index of the algorithm in self.algorithms.
+        :param data: The chunk of the image.
+        """
+        self._hashes[index].update(data)
+
+    def copy(self):
+        """Get a copy of the current state of the checksums."""
+        return _ImageHashes(self.algorithms,
+                            [checksum.copy() for checksum in self._hashes])
+
+    def hexdigests(self):
+        """Get the checksums as a dictionary of hexadecimal strings."""
+        return dict((algo, checksum.hexdigest()) for algo, checksum in
+                    zip(self.algorithms, self._hashes))
+
+
+class _HashThreads(object):
+    """Computes the checksums of an image on dedicated threads.
+
+    Every algorithm gets its own thread, which consumes the same chunks
+    from a bounded queue, so the checksums are computed in parallel in a
+    single pass over the image, without holding up the thread reading from
+    the network. Chunks must not be modified once they have been passed to
+    update().
+    """
+
+    def __init__(self, hashes):
+        """Initialize an instance of the _HashThreads class.
+
+        :param hashes: The _ImageHashes object to update.
+        """
+        self._hashes = hashes
+        self._error = None
+        self._queues = []
+        self._threads = []
+        for index, algo in enumerate(hashes.algorithms):
+            chunks = queue.Queue(HASH_QUEUE_CHUNKS)
+            thread = threading.Thread(target=self._run, args=(index, chunks),
+                                      name='image-hash-{}'.format(algo))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(chunks)
+            self._threads.append(thread)
+
+    def _run(self, index, chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is _PIPELINE_END:
+                return
+            if self._error is None:
+                try:
+                    self._hashes.update_one(index, chunk)
+                except Exception as e:
+                    self._error = e
+
+    def update(self, chunk):
+        """Queue a chunk of the image for every checksum thread."""
+        for chunks in self._queues:
+            chunks.put(chunk)
+
+    def finish(self):
+        """Wait until all queued chunks have been hashed.
+
+        :raises: Any error raised while computing a checksum.
+        """
+        for chunks in self._queues:
+            chunks.put(_PIPELINE_END)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def _fetch_byte_range(session, url, image_id, start, end, request_options):
+    """Fetch a byte range of an image, retrying on failures.
+
+    :param session: The requests session to use.
+    :param url: The URL string to request the image from.
+    :param image_id: The ID of the image.
+    :param start: The offset of the first byte of the range.
+    :param end: The offset of the last byte of the range.
+    :param request_options: The keyword arguments to pass to requests.
+    :raises: ImageDownloadError if the range cannot be fetched.
+    :returns: The content of the range as bytes.
+    """
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    error = None
+    for attempt in six.moves.range(RANGE_FETCH_ATTEMPTS):
+        try:
+            resp = session.get(url, headers=headers, **request_options)
+        except requests.RequestException as e:
+            error = str(e)
+            continue
+        if resp.status_code != 206:
+            error = ('Received status code {}, expected '
+                     '206'.format(resp.status_code))
+        elif len(resp.content) != end - start + 1:
+            error = ('Received {} bytes, expected '
+                     '{}'.format(len(resp.content), end - start + 1))
+        else:
+            return resp.content
+        LOG.warning('Attempt {} to fetch bytes {}-{} of image {} from '
+                    '{} failed: {}'.format(attempt + 1, start, end, image_id,
+                                           url, error))
+    msg = 'Unable to fetch bytes {}-{} from {}. Error: {}'.format(
+        start, end, url, error)
+    raise errors.ImageDownloadError(image_id, msg)
+
+
+class _RangedDownload(object):
+    """Downloads an image over several parallel HTTP Range requests.
+
+    The image is split into byte ranges which are fetched by a pool of
+    worker threads, each using its own HTTP session. Ranges are handed back
+    to the caller strictly in order, and at most two ranges per connection
+    are kept in memory at any time.
+    """
+
+    def __init__(self, image_info, url, size, connections, range_size,
+                 offset=0):
+        """Initialize an instance of the _RangedDownload class.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string to request the image from.
+        :param size: The total size of the image in bytes.
+        :param connections: The number of parallel connections to use.
+        :param range_size: The size of each byte range in bytes.
+        :param offset: Optional. The offset in bytes to start downloading
+                       the image at. Defaults to 0.
+        """
+        self._image_id = image_info['id']
+        self._url = url
+        self._request_options = _request_options(image_info)
+        self._ranges = [(start, min(start + range_size, size) - 1)
+                        for start in six.moves.range(offset, size,
+                                                     range_size)]
+        self._window = connections * 2
+        self._results = {}
+        self._next_range = 0
+        self._consumed = 0
+        self._error = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._worker,
+                             name='image-download-{}'.format(i))
+            for i in six.moves.range(min(connections, len(self._ranges)))]
+        for worker in self._workers:
+            worker.daemon = True
+
+    def _claim_range(self):
+        """Get the index of the next range to fetch, waiting for space.
+
+        :returns: A range index, or None if there is nothing left to fetch.
+        """
+        with self._condition:
+            while (not self._stopped and
+                   self._next_range < len(self._ranges) and
+                   self._next_range - self._consumed >= self._window):
+                self._condition.wait()
+            if self._stopped or self._next_range >= len(self._ranges):
+                return None
+            index = self._next_range
+            self._next_range += 1
+            return index
+
+    def _fetch_range(self, session, index):
+        """Fetch a single byte range, retrying on failures.
+
+        :param session: The requests session to use.
+        :param index: The index of the range to fetch.
+        :raises: ImageDownloadError if the range cannot be fetched.
+        :returns: The content of the range as bytes.
+        """
+        start, end = self._ranges[index]
+        return _fetch_byte_range(session, self._url, self._image_id, start,
+                                 end, self._request_options)
+
+    def _worker(self):
+        """Fetch ranges until the image is complete or an error occurs."""
+        session = requests.Session()
+        try:
+            while True:
+                index = self._claim_range()
+                if index is None:
+                    return
+                content = self._fetch_range(session, index)
+                with self._condition:
+                    self._results[index] = content
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                if self._error is None:
+                    self._error = e
+                self._stopped = True
+                self._condition.notify_all()
+        finally:
+            session.close()
+
+    def stop(self):
+        """Stop all workers once their current range has been fetched."""
+        with self._condition:
+            self._stopped = True
+            self._results.clear()
+            self._condition.notify_all()
+
+    def __iter__(self):
+        """Returns the image in order, in chunks of IMAGE_CHUNK_SIZE.
+
+        :raises: ImageDownloadError if any of the ranges cannot be fetched.
+        """
+        for worker in self._workers:
+            worker.start()
+        try:
+            for index in six.moves.range(len(self._ranges)):
+                with self._condition:
+                    while (index not in self._results and
+                           self._error is None):
+                        self._condition.wait()
+                    if index not in self._results:
+                        raise self._error
+                    content = self._results.pop(index)
+                    self._consumed = index + 1
+                    self._condition.notify_all()
+                for offset in six.moves.range(0, len(content),
+                                              IMAGE_CHUNK_SIZE):
+                    yield content[offset:offset + IMAGE_CHUNK_SIZE]
+        finally:
+            self.stop()
+
+
+class _ChunkVerifier(object):
+    """Verifies an image chunk by chunk against a manifest of digests.
+
+    The manifest lists the digest of every chunk_size bytes of the image.
+    Chunks are hashed by a pool of threads as they arrive, and are only
+    passed on, in order, once they have been verified. A chunk which does
+    not match its digest either fails the download straight away or is
+    fetched again with a HTTP Range request, so that corrupted data is never
+    written and does not require the whole image to be downloaded again.
+    """
+
+    def __init__(self, image_info, url, manifest, offset=0):
+        """Initialize an instance of the _ChunkVerifier class.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL the image is downloaded from.
+        :param manifest: The chunk manifest, as a dictionary with the
+                         'digests' of the chunks, their 'chunk_size' in
+                         bytes and, optionally, the hashlib 'algorithm'
+                         used, which defaults to sha256.
+        :param offset: Optional. The offset in bytes the download starts
+                       at. Data before the first chunk boundary after it is
+                       passed on without being verified.
+        """
+        self._image_id = image_info['id']
+        self._url = url
+        self._request_options = _request_options(image_info)
+        self._algorithm = manifest.get('algorithm', 'sha256').lower()
+        self.chunk_size = int(manifest['chunk_size'])
+        self._digests = [digest.lower() for digest in manifest['digests']]
+        self._threads = int(image_info.get('chunk_verify_threads') or
+                            CONF.image_chunk_verify_threads)
+        attempts = image_info.get('chunk_refetch_attempts')
+        if attempts is None:
+            attempts = CONF.image_chunk_refetch_attempts
+        self._refetch_attempts = int(attempts)
+        self._first_index = -(-offset // self.chunk_size)
+        self._unverified = self._first_index * self.chunk_size - offset
+
+    @classmethod
+    def for_image(cls, image_info, url, offset=0):
+        """Get the chunk verifier of an image, if it has a chunk manifest.
+
+        The 'chunk_manifest' field of image_info holds either the manifest
+        itself, or the URL of a JSON document holding it.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL the image is downloaded from.
+        :param offset: Optional. The offset in bytes the download starts at.
+        :raises: ImageDownloadError if the manifest cannot be retrieved or
+                 is invalid.
+        :returns: A _ChunkVerifier object, or None if the image has no chunk
+                  manifest.
+        """
+        manifest = image_info.get('chunk_manifest')
+        if not manifest:
+            return None
+        if isinstance(manifest, six.string_types):
+            try:
+                resp = requests.get(manifest, **_request_options(image_info))
+            except requests.RequestException as e:
+                msg = 'Unable to fetch the chunk manifest from {}: {}'.format(
+                    manifest, e)
+                raise errors.ImageDownloadError(image_info['id'], msg)
+            if resp.status_code != 200:
+                msg = ('Received status code {} from {}, expected 200 for '
+                       'the chunk manifest').format(resp.status_code, manifest)
+                raise errors.ImageDownloadError(image_info['id'], msg)
+            try:
+                manifest = resp.json()
+            except ValueError as e:
+                msg = 'The chunk manifest is not valid JSON: {}'.format(e)
+                raise errors.ImageDownloadError(image_info['id'], msg)
+        try:
+            verifier = cls(image_info, url, manifest, offset)
+            _new_hash(verifier._algorithm)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            msg = 'The chunk manifest is invalid: {}'.format(e)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        if verifier.chunk_size <= 0:
+            msg = 'The chunk manifest has an invalid chunk size'
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        return verifier
+
+    def _hash(self, data):
+        checksum = _new_hash(self._algorithm)
+        checksum.update(data)
+        return checksum.hexdigest()
+
+    def _expected(self, index):
+        if index >= len(self._digests):
+            msg = ('The image is larger than the {} chunks listed in its '
+                   'chunk manifest').format(len(self._digests))
+            raise errors.ImageDownloadError(self._image_id, msg)
+        return self._digests[index]
+
+    def matches(self, index, data):
+        """Check a chunk of the image against its digest.
+
+        :param index: The index of the chunk.
+        :param data: The content of the chunk.
+        :raises: ImageDownloadError if the manifest has no such chunk.
+        :returns: True if the chunk matches its digest.
+        """
+        return self._hash(data) == self._expected(index)
+
+    def check(self, index, chunk, location=None):
+        """Verify a chunk of the image, fetching it again if it is corrupted.
+
+        :param index: The index of the chunk.
+        :param chunk: The content of the chunk.
+        :param location: Optional. Where the chunk was read from. If given,
+                         a chunk which does not match its digest is not
+                         fetched again, and the error reports this location.
+        :raises: ImageDownloadError if the manifest has no such chunk.
+        :raises: ImageChecksumError if the chunk does not match its digest
+                 and no intact copy of it could be fetched.
+        :returns: The content of the chunk, as given or fetched again.
+        """
+        expected = self._expected(index)
+        digest = self._hash(chunk)
+        if digest == expected:
+            return chunk
+        if location is None:
+            return self._refetch(index, len(chunk), digest)
+        LOG.error(errors.ImageChecksumError.details_str.format(
+            location, self._image_id, expected, digest))
+        raise errors.ImageChecksumError(location, self._image_id, expected,
+                                        digest)
+
+    def _refetch(self, index, length, digest):
+        """Fetch a chunk which does not match its digest again.
+
+        :param index: The index of the chunk.
+        :param length: The length of the chunk in bytes.
+        :param digest: The digest of the chunk as it was received.
+        :raises: ImageChecksumError if no intact copy of the chunk could be
+                 fetched.
+        :returns: The content of the chunk.
+        """
+        start = index * self.chunk_size
+        end = start + length - 1
+        location = 'bytes {}-{} of {}'.format(start, end, self._url)
+        expected = self._digests[index]
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        for attempt in six.moves.range(self._refetch_attempts):
+            LOG.warning('Chunk at %s has %s digest %s, expected %s. '
+                        'Fetching it again, attempt %d of %d', location,
+                        self._algorithm, digest, expected, attempt + 1,
+                        self._refetch_attempts)
+            try:
+                resp = requests.get(self._url, headers=headers,
+                                    **self._request_options)
+            except requests.RequestException as e:
+                LOG.warning('Unable to fetch %s: %s', location, e)
+                continue
+            if resp.status_code != 206 or len(resp.content) != length:
+                LOG.warning('Unable to fetch %s: received status code %s '
+                            'and %d bytes', location, resp.status_code,
+                            len(resp.content))
+                continue
+            digest = self._hash(resp.content)
+            if digest == expected:
+                return resp.content
+        LOG.error(errors.ImageChecksumError.details_str.format(
+            location, self._image_id, expected, digest))
+        raise errors.ImageChecksumError(location, self._image_id, expected,
+                                        digest)
+
+    def verify(self, chunks):
+        """Verify a stream of chunks of the image.
+
+        :param chunks: An iterator of chunks of the image, starting at the
+                       offset given to the constructor.
+        :raises: ImageChecksumError if a chunk does not match its digest.
+        :raises: ImageDownloadError if the size of the image does not match
+                 the manifest.
+        :returns: An iterator of verified chunks of the image, of at most
+                  IMAGE_CHUNK_SIZE bytes.
+        """
+        workers = pool.ThreadPool(self._threads)
+        pending = collections.deque()
+
+        def _complete():
+            index, data, result = pending.popleft()
+            digest = result.get()
+            if digest != self._digests[index]:
+                data = self._refetch(index, len(data), digest)
+            return data
+
+        def _split(data):
+            for start in six.moves.range(0, len(data), IMAGE_CHUNK_SIZE):
+                yield data[start:start + IMAGE_CHUNK_SIZE]
+
+        try:
+            unverified = self._unverified
+            index = self._first_index
+            parts = []
+            filled = 0
+            for chunk in chunks:
+                if unverified:
+                    passed = chunk[:unverified]
+                    chunk = chunk[len(passed):]
+                    unverified -= len(passed)
+                    yield passed
+                    if not chunk:
+                        continue
+                parts.append(chunk)
+                filled += len(chunk)
+                while filled >= self.chunk_size:
+                    data = b''.join(parts)
+                    parts = [data[self.chunk_size:]]
+                    data = data[:self.chunk_size]
+                    filled -= self.chunk_size
+                    self._expected(index)
+                    pending.append((index, data,
+                                    workers.apply_async(self._hash, (data,))))
+                    index += 1
+                    if len(pending) > self._threads:
+                        for part in _split(_complete()):
+                            yield part
+            if filled:
+                data = b''.join(parts)
+                self._expected(index)
+                pending.append((index, data,
+                                workers.apply_async(self._hash, (data,))))
+                index += 1
+            while pending:
+                for part in _split(_complete()):
+                    yield part
+            if index < len(self._digests):
+                msg = ('The image is smaller than the {} chunks listed in '
+                       'its chunk manifest').format(len(self._digests))
+                raise errors.ImageDownloadError(self._image_id, msg)
+        finally:
+            workers.terminate()
+
+
+class _SwarmDownload(_RangedDownload):
+    """Downloads an image from peer agents, falling back to the image URL.
+
+    Every chunk of the chunk manifest of the image is requested from a few
+    randomly chosen peers which may hold it, and only fetched from the
+    image URL with a HTTP Range request if no peer provided an intact
+    copy. Every chunk is verified against the manifest, whatever its
+    source.
+    """
+
+    def __init__(self, image_info, url, size, connections, verifier, key,
+                 peers, offset=0):
+        """Initialize an instance of the _SwarmDownload class.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string to fall back to.
+        :param size: The total size of the image in bytes.
+        :param connections: The number of chunks fetched in parallel.
+        :param verifier: The _ChunkVerifier of the image.
+        :param key: The key the image is shared as by peers.
+        :param peers: The base URLs of the agent API of the peers.
+        :param offset: Optional. The offset in bytes to start downloading
+                       the image at, which must be a multiple of the chunk
+                       size. Defaults to 0.
+        """
+        super(_SwarmDownload, self).__init__(image_info, url, size,
+                                             connections,
+                                             verifier.chunk_size,
+                                             offset=offset)
+        self._verifier = verifier
+        self._key = key
+        self._peers = list(peers)
+        self._failed_peers = set()
+        self._peer_options = {'verify': self._request_options['verify'],
+                              'cert': self._request_options['cert'],
+                              'timeout': SWARM_PEER_TIMEOUT}
+        self.bytes_from_peers = 0
+
+    def _fetch_from_peers(self, session, chunk_index, length):
+        """Fetch a chunk from the peers.
+
+        :param session: The requests session to use.
+        :param chunk_index: The index of the chunk in the manifest.
+        :param length: The length of the chunk in bytes.
+        :returns: The content of the chunk, or None if no peer provided an
+                  intact copy.
+        """
+        peers = [peer for peer in self._peers
+                 if peer not in self._failed_peers]
+        random.shuffle(peers)
+        for peer in peers[:SWARM_PEER_ATTEMPTS]:
+            try:
+                resp = session.get(
+                    image_swarm.chunk_url(peer, self._key, chunk_index),
+                    **self._peer_options)
+            except requests.RequestException as e:
+                LOG.warning('Unable to reach peer %s, no longer fetching '
+                            'chunks from it: %s', peer, e)
+                self._failed_peers.add(peer)
+                continue
+            if resp.status_code != 200:
+                continue
+            if (len(resp.content) == length and
+                    self._verifier.matches(chunk_index, resp.content)):
+                return resp.content
+            LOG.warning('Chunk %d of image %s from peer %s does not match '
+                        'its digest', chunk_index, self._image_id, peer)
+        return None
+
+    def _fetch_range(self, session, index):
+        """Fetch a chunk from the peers or from the image URL.
+
+        :param session: The requests session to use.
+        :param index: The index of the range to fetch.
+        :raises: ImageDownloadError if the chunk cannot be fetched.
+        :raises: ImageChecksumError if the chunk fetched from the image URL
+                 does not match its digest.
+        :returns: The content of the chunk as bytes.
+        """
+        start, end = self._ranges[index]
+        chunk_index = start // self._verifier.chunk_size
+        content = self._fetch_from_peers(session, chunk_index,
+                                         end - start + 1)
+        if content is not None:
+            with self._condition:
+                self.bytes_from_peers += len(content)
+            return content
+        content = super(_SwarmDownload, self)._fetch_range(session, index)
+        location = 'bytes {}-{} of {}'.format(start, end, self._url)
+        return self._verifier.check(chunk_index, content, location)
+
+    def __iter__(self):
+        """Returns the image in order, in chunks of IMAGE_CHUNK_SIZE.
+
+        :raises: ImageDownloadError if any of the chunks cannot be fetched.
+        :raises: ImageChecksumError if a chunk does not match its digest.
+        """
+        for chunk in super(_SwarmDownload, self).__iter__():
+            yield chunk
+        LOG.info('%d bytes of image %s were fetched from peers',
+                 self.bytes_from_peers, self._image_id)
+
+
+def _apply_download_rate(image_info):
+    """Limit the download rate to the rate of an image.
+
+    The rate is the 'download_rate' field of image_info, or the
+    image_download_rate option, in MB/s. It only applies once a rate set
+    with the set_download_rate command has been cleared.
+
+    :param image_info: Image information dictionary.
+    """
+    global _image_download_rate
+    rate = image_info.get('download_rate')
+    if rate is None:
+        rate = CONF.image_download_rate
+    _image_download_rate = float(rate) * units.M
+    if _download_rate_override is None:
+        _download_limiter.set_rate(_image_download_rate)
+
+
+def _swarm_key(image_info):
+    """Get the key an image is shared as between peer agents.
+
+    :param image_info: Image information dictionary.
+    """
+    return image_cache.cache_keys(_expected_checksums(image_info))[0]
+
+
+def _shared_image(image_download, image_info, path):
+    """Get the SharedImage recording the chunks of an image as it is written.
+
+    :param image_download: The ImageDownload object the image is read from.
+    :param image_info: Image information dictionary.
+    :param path: The path of the file or device the image is written to.
+    :returns: A SharedImage object, or None if the image is not shared with
+              peers.
+    """
+    if (image_info.get('swarm') is None or not CONF.image_swarm_share or
+            image_download.chunk_size is None or
+            image_info.get('compression')):
+        # Peers verify chunks of the compressed image, which is not kept
+        return None
+    return image_swarm.SharedImage(path, image_download.chunk_size)
+
+
+class _MulticastDownload(object):
+    """Receives an image from a multicast group, repairing it over HTTP.
+
+    Groups of blocks are taken from the multicast receiver in order. Blocks
+    lost in transmission are recovered from the parity blocks of their
+    group when possible, and fetched from the image URL with HTTP Range
+    requests otherwise. Groups sent before the receiver joined, or after it
+    gave up, are fetched from the image URL in larger ranges.
+    """
+
+    def __init__(self, image_info, url, size, receiver, block_size,
+                 group_size, parity, offset=0):
+        """Initialize an instance of the _MulticastDownload class.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string to repair the image from.
+        :param size: The total size of the image in bytes.
+        :param receiver: A multicast.Receiver joined to the group.
+        :param block_size: The size of a block in bytes.
+        :param group_size: The number of data blocks in a group.
+        :param parity: The number of parity blocks of a group.
+        :param offset: Optional. The offset in bytes to start receiving the
+                       image at. Defaults to 0.
+        """
+        self._image_id = image_info['id']
+        self._url = url
+        self._request_options = _request_options(image_info)
+        self._size = size
+        self._receiver = receiver
+        self._block_size = block_size
+        self._group_size = group_size
+        self._parity = parity
+        self._group_bytes = block_size * group_size
+        self._offset = offset
+        self._groups = -(-size // self._group_bytes)
+        self._repair_groups = max(1, MULTICAST_REPAIR_SIZE //
+                                  self._group_bytes)
+        self.blocks_received = 0
+        self.blocks_recovered = 0
+        self.bytes_repaired = 0
+
+    def _lengths(self, group):
+        """Get the lengths of the data blocks of a group."""
+        start = group * self._group_bytes
+        end = min(start + self._group_bytes, self._size)
+        return [min(self._block_size, end - block)
+                for block in six.moves.range(start, end, self._block_size)]
+
+    def _repair(self, session, start, end):
+        """Fetch a byte range of the image from the image URL."""
+        self.bytes_repaired += end - start + 1
+        return _fetch_byte_range(session, self._url, self._image_id, start,
+                                 end, self._request_options)
+
+    def _receive_group(self, session, group):
+        """Get the content of a group, repairing its lost blocks.
+
+        :param session: The requests session to use for repairs.
+        :param group: The group number.
+        :returns: The content of the group as bytes.
+        """
+        lengths = self._lengths(group)
+        blocks, parity_blocks = self._receiver.take(group, len(lengths))
+        for index in list(blocks):
+            if index >= len(lengths) or len(blocks[index]) != lengths[index]:
+                del blocks[index]
+        self.blocks_received += len(blocks)
+        if len(blocks) < len(lengths):
+            self.blocks_recovered += multicast.recover(
+                blocks, parity_blocks, lengths, self._parity,
+                self._block_size)
+        index = 0
+        while index < len(lengths):
+            if index in blocks:
+                index += 1
+                continue
+            first = index
+            while index < len(lengths) and index not in blocks:
+                index += 1
+            start = group * self._group_bytes + first * self._block_size
+            data = self._repair(session, start,
+                                start + sum(lengths[first:index]) - 1)
+            for missing in six.moves.range(first, index):
+                offset = (missing - first) * self._block_size
+                blocks[missing] = data[offset:offset + lengths[missing]]
+        return b''.join(blocks[i] for i in six.moves.range(len(lengths)))
+
+    def __iter__(self):
+        """Returns the image in order, in chunks of at most IMAGE_CHUNK_SIZE.
+
+        :raises: ImageDownloadError if lost blocks cannot be repaired.
+        """
+        self._receiver.start()
+        session = requests.Session()
+        try:
+            group = self._offset // self._group_bytes
+            skip = self._offset - group * self._group_bytes
+            while group < self._groups:
+                missed = 0
+                while (group + missed < self._groups and
+                       missed < self._repair_groups and
+                       self._receiver.missed(group + missed)):
+                    missed += 1
+                if missed:
+                    start = group * self._group_bytes
+                    end = min((group + missed) * self._group_bytes,
+                              self._size) - 1
+                    data = self._repair(session, start, end)
+                    group += missed
+                    self._receiver.skip(group)
+                else:
+                    data = self._receive_group(session, group)
+                    group += 1
+                if skip:
+                    data = data[skip:]
+                    skip = 0
+                for offset in six.moves.range(0, len(data),
+                                              IMAGE_CHUNK_SIZE):
+                    yield data[offset:offset + IMAGE_CHUNK_SIZE]
+            LOG.info('Image %s received over multicast: %d blocks '
+                     'received, %d blocks recovered from parity, %d bytes '
+                     'fetched from %s', self._image_id, self.blocks_received,
+                     self.blocks_recovered, self.bytes_repaired, self._url)
+        finally:
+            self._receiver.stop()
+            session.close()
+
+
+def _probe_mirror(image_info, url, probe_size):
+    """Measure how fast an image can be downloaded from a URL.
+
+    :param image_info: Image information dictionary.
+    :param url: The URL string to probe.
+    :param probe_size: The number of bytes to request.
+    :returns: A tuple of the time to first byte in seconds and the
+              throughput in bytes per second, or None if the URL does not
+              serve the image.
+    """
+    options = _request_options(image_info)
+    headers = {'Range': 'bytes=0-{}'.format(probe_size - 1)}
+    received = 0
+    starttime = time.time()
+    first_byte = None
+    try:
+        resp = requests.get(url, stream=True, headers=headers,
+                            timeout=CONF.image_mirror_probe_timeout,
+                            **options)
+        try:
+            if resp.status_code not in (200, 206):
+                LOG.warning('Probe of image URL %s received status code %s',
+                            url, resp.status_code)
+                return None
+            for chunk in resp.iter_content(64 * units.Ki):
+                if first_byte is None:
+                    first_byte = time.time()
+                received += len(chunk)
+                if received >= probe_size:
+                    break
+        finally:
+            resp.close()
+    except requests.RequestException as e:
+        LOG.warning('Probe of image URL %s failed: %s', url, e)
+        return None
+    if not received:
+        return None
+    elapsed = max(time.time() - starttime, 1e-6)
+    return first_byte - starttime, received / elapsed
+
+
+def _rank_mirrors(image_info, urls):
+    """Order the URLs of an image from the fastest to the slowest.
+
+    Every URL is probed concurrently with a small byte range request, and
+    ranked by its throughput, then by its time to first byte. URLs which
+    could not be probed are kept last, in their original order, so that
+    they are still tried if all the others fail.
+
+    :param image_info: Image information dictionary.
+    :param urls: The list of URL strings to rank.
+    :returns: The ranked list of URL strings.
+    """
+    probe_size = CONF.image_mirror_probe_size * units.Ki
+    workers = pool.ThreadPool(len(urls))
+    try:
+        results = workers.map(
+            lambda url: _probe_mirror(image_info, url, probe_size), urls)
+    finally:
+        workers.terminate()
+    ranked = []
+    failed = []
+    for url, result in zip(urls, results):
+        if result is None:
+            failed.append(url)
+            continue
+        ttfb, throughput = result
+        LOG.info('Image URL %s: %.3f seconds to first byte, %.2f MB/s',
+                 url, ttfb, throughput / units.M)
+        ranked.append((-throughput, ttfb, url))
+    ranked.sort(key=lambda item: item[:2])
+    return [url for _throughput, _ttfb, url in ranked] + failed
+
+
+class ImageDownload(object):
+    """Helper class that opens a HTTP connection to download an image.
+
+    This class opens a HTTP connection to download an image from a URL
+    and create an iterator so the image can be downloaded in chunks. The
+    checksums of the image being downloaded, for all the algorithms given
+    in image_info, are calculated on-the-fly on dedicated threads.
+    """
+
+    def __init__(self, image_info, time_obj=None, offset=0, hashes=None):
+        """Initialize an instance of the ImageDownload class.
+
+        Trys each URL in image_info successively until a URL returns a
+        successful request code. Once the object is initialized, the user may
+        retrieve chunks of the image through the standard python iterator
+        interface until either the image is fully downloaded, or an error is
+        encountered.
+
+        If more than one download connection is requested, either through the
+        'download_connections' field of image_info or the
+        image_download_connections option, and the server advertises support
+        for byte range requests, the image is fetched over several parallel
+        connections instead of the initial stream.
+
+        A download can be resumed by passing the offset to start at, along
+        with the checksums of the image data before that offset. The rest of
+        the image is then requested with a HTTP Range header.
+
+        If image_info has a 'chunk_manifest', every chunk of the image is
+        verified against it before being returned.
+
+        With the 'fastest' mirror selection, set through the
+        'mirror_selection' field of image_info or the image_mirror_selection
+        option, the URLs are probed concurrently and tried from the fastest
+        to the slowest. If a mirror failover throughput is set, a single
+        stream download which falls below it, stalls or fails switches to
+        another URL, carrying on from the current byte offset.
+
+        If image_info also has a 'swarm', the chunks of the image are fetched
+        from the peer agents sharing it first, and from the URL only when no
+        peer provides an intact copy.
+
+        If image_info has a 'multicast' group, the image is received from it
+        instead, and blocks lost in transmission are fetched from the URL
+        with HTTP Range requests.
+
+        If image_info declares a 'compression' type, the image is
+        decompressed on the fly. Its checksums are computed over the
+        compressed image, unless the 'checksum_stream' field of image_info
+        is 'decompressed'. The chunk manifest always applies to the
+        compressed image.
+
+        The download rate is limited to the 'download_rate' field of
+        image_info, or the image_download_rate option, in MB/s, unless a
+        rate has been set with the set_download_rate command.
+
+        The progress of the image is tracked in the progress attribute, and
+        reported in the result of the command downloading it while it runs.
+
+        :param image_info: Image information dictionary.
+        :param time_obj: Optional time object to indicate when the image
+                         download began. Defaults to None. If None, then
+                         time.time() will be used to find the start time of
+                         the download.
+        :param offset: Optional. The offset in bytes to start downloading
+                       the image at. Defaults to 0.
+        :param hashes: Optional. An _ImageHashes object which has already
+                       been updated with the first offset bytes of the
+                       image.
+
+        :raises: ImageDownloadError if starting the image download fails for
+                 any reason.
+        """
+        self._hashes = hashes or _ImageHashes(
+            algo for algo, _value in _expected_checksums(image_info))
+        self._time = time_obj or time.time()
+        self._offset = offset
+        self._skip = 0
+        self._request = None
+        self._ranged_download = None
+        self._chunk_verifier = None
+        self.chunk_size = None
+        self._image_info = image_info
+        self._compression = image_info.get('compression')
+        self._hash_output = (not self._compression or
+                             image_info.get('checksum_stream') ==
+                             'decompressed')
+        self._urls = list(image_info['urls'])
+        selection = (image_info.get('mirror_selection') or
+                     CONF.image_mirror_selection)
+        if selection == 'fastest' and len(self._urls) > 1:
+            self._urls = _rank_mirrors(image_info, self._urls)
+        self._failover_throughput = 0.0
+        if len(self._urls) > 1:
+            throughput = image_info.get('mirror_failover_throughput')
+            if throughput is None:
+                throughput = CONF.image_mirror_failover_throughput
+            self._failover_throughput = float(throughput)
+        self._switches = 0
+        _apply_download_rate(image_info)
+        details = []
+        for url in self._urls:
+            try:
+                LOG.info("Attempting to download image from {}".format(url))
+                self._request = self._download_file(image_info, url)
+            except errors.ImageDownloadError as e:
+                failtime = time.time() - self._time
+                log_msg = ('URL: {}; time: {} '
+                           'seconds. Error: {}').format(
+                    url, failtime, e.secondary_message)
+                LOG.warning(log_msg)
+                details.append(log_msg)
+                continue
+            else:
+                break
+        else:
+            details = '\n '.join(details)
+            raise errors.ImageDownloadError(image_info['id'], details)
+        self._url = url
+        self.progress = progress.ImageProgress(image_info['id'],
+                                               self._image_size(), offset)
+        base.report_progress(self.progress.to_dict)
+
+        try:
+            self._chunk_verifier = _ChunkVerifier.for_image(image_info, url,
+                                                            offset)
+        except errors.ImageDownloadError:
+            self._request.close()
+            raise
+        if self._chunk_verifier is not None:
+            self.chunk_size = self._chunk_verifier.chunk_size
+
+        if image_info.get('multicast'):
+            self._ranged_download = self._start_multicast_download(
+                image_info, url)
+        if self._ranged_download is None:
+            peers = self._swarm_peers(image_info)
+            connections = int(image_info.get('download_connections') or
+                              CONF.image_download_connections)
+            if connections > 1 or peers:
+                self._ranged_download = self._start_ranged_download(
+                    image_info, url, connections, peers=peers)
+
+    def _swarm_peers(self, image_info):
+        """Get the peers to fetch the chunks of the image from.
+
+        :param image_info: Image information dictionary.
+        :returns: A list of base URLs of the agent API of peers, which is
+                  empty if the image is not to be fetched from peers.
+        """
+        swarm = image_info.get('swarm')
+        if not swarm or self._chunk_verifier is None:
+            return []
+        if self._offset % self._chunk_verifier.chunk_size:
+            LOG.info('Not fetching image %s from peers, as the download '
+                     'resumes in the middle of a chunk', image_info['id'])
+            return []
+        options = _request_options(image_info)
+        options['timeout'] = SWARM_PEER_TIMEOUT
+        return image_swarm.discover_peers(swarm, _swarm_key(image_info),
+                                          options)
+
+    def _download_file(self, image_info, url):
+        """Opens a download stream for the given URL.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string to request the image from.
+
+        :raises: ImageDownloadError if the download stream was not started
+                 properly.
+        """
+        options = _request_options(image_info)
+        self._skip = 0
+        if self._offset:
+            options['headers'] = {'Range': 'bytes={}-'.format(self._offset)}
+        if self._failover_throughput:
+            # Time out stalled reads, so that another URL is tried
+            options['timeout'] = CONF.image_mirror_failover_window
+        resp = requests.get(url, stream=True, **options)
+        if self._offset and resp.status_code == 206:
+            match = _CONTENT_RANGE.match(resp.headers.get('Content-Range',
+                                                          ''))
+            if match is None or int(match.group(1)) != self._offset:
+                msg = ('Received Content-Range {} from {}, expected the '
+                       'image from offset {}').format(
+                    resp.headers.get('Content-Range'), url, self._offset)
+                resp.close()
+                raise errors.ImageDownloadError(image_info['id'], msg)
+            return resp
+        if resp.status_code != 200:
+            msg = ('Received status code {} from {}, expected 200. Response '
+                   'body: {}').format(resp.status_code, url, resp.text)
+            raise errors.ImageDownloadError(image_info['id'], msg)
+        if self._offset:
+            LOG.warning('Image server at {} ignored the byte range request, '
+                        'skipping the first {} bytes of the '
+                        'image'.format(url, self._offset))
+            self._skip = self._offset
+        return resp
+
+    def _start_ranged_download(self, image_info, url, connections,
+                               peers=None):
+        """Switches to a multi-connection download if the server allows it.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string the image is being downloaded from.
+        :param connections: The number of parallel connections to use.
+        :param peers: Optional. The base URLs of the agent API of peers to
+                      fetch the chunks of the image from first.
+        :returns: A _RangedDownload object, or None if the server does not
+                  advertise support for byte range requests, in which case
+                  the already opened single stream is used.
+        """
+        size = self._ranged_size()
+        if size is None:
+            LOG.info('Image server at {} does not support byte range '
+                     'requests, downloading over a single '
+                     'connection'.format(url))
+            return None
+
+        self._request.close()
+        self._skip = 0
+        if peers:
+            connections = max(connections, CONF.image_swarm_connections)
+            LOG.info('Downloading image from {} peers over {} connections, '
+                     'falling back to {}'.format(len(peers), connections,
+                                                 url))
+            verifier = self._chunk_verifier
+            # Chunks are verified as they are fetched
+            self._chunk_verifier = None
+            return _SwarmDownload(image_info, url, size, connections,
+                                  verifier, _swarm_key(image_info), peers,
+                                  offset=self._offset)
+
+        range_size = int(image_info.get('download_range_size') or
+                         CONF.image_download_range_size) * units.Mi
+        LOG.info('Downloading image from {} over {} connections in ranges '
+                 'of {} bytes'.format(url, connections, range_size))
+        return _RangedDownload(image_info, url, size, connections,
+                               range_size, offset=self._offset)
+
+    def _image_size(self):
+        """Get the size of the image, as announced by the server.
+
+        :returns: The size of the image in bytes, or None if it is unknown.
+        """
+        headers = self._request.headers
+        if self._request.status_code == 206:
+            size = _CONTENT_RANGE.match(headers['Content-Range']).group(3)
+        else:
+            size = headers.get('Content-Length')
+        if not isinstance(size, six.string_types) or not size.isdigit():
+            return None
+        return int(size)
+
+    def _ranged_size(self):
+        """Get the size of the image, if the server supports byte ranges.
+
+        :returns: The size of the image in bytes, or None if the server does
+                  not advertise support for byte range requests.
+        """
+        if (self._request.status_code != 206 and
+                self._request.headers.get('Accept-Ranges',
+                                          '').lower() != 'bytes'):
+            return None
+        return self._image_size()
+
+    def _start_multicast_download(self, image_info, url):
+        """Switches to receiving the image from a multicast group.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL string the image is being downloaded from.
+        :returns: A _MulticastDownload object, or None if the server does
+                  not advertise support for byte range requests, which are
+                  needed to repair lost blocks, or if the group cannot be
+                  joined, in which case the already opened single stream is
+                  used.
+        """
+        size = self._ranged_size()
+        if size is None:
+            LOG.warning('Image server at {} does not support byte range '
+                        'requests, which are needed to repair blocks lost '
+                        'in multicast transmission, downloading over a '
+                        'single connection'.format(url))
+            return None
+
+        info = image_info['multicast']
+        block_size = int(info.get('block_size') or
+                         multicast.DEFAULT_BLOCK_SIZE)
+        group_size = int(info.get('group_size') or
+                         multicast.DEFAULT_GROUP_SIZE)
+        parity = info.get('parity')
+        if parity is None:
+            parity = multicast.DEFAULT_PARITY
+        timeout = info.get('timeout') or CONF.image_multicast_timeout
+        max_groups = (CONF.image_multicast_buffer * units.Mi //
+                      (block_size * group_size))
+        try:
+            receiver = multicast.Receiver(
+                info['group'], int(info['port']),
+                session=int(info.get('session') or 0),
+                interface=(info.get('interface') or
+                           CONF.image_multicast_interface),
+                timeout=int(timeout), max_groups=max(1, max_groups))
+        except (IOError, OSError, ValueError) as e:
+            LOG.warning('Unable to join multicast group {}:{}, downloading '
+                        'over a single connection. Error: {}'.format(
+                            info['group'], info['port'], e))
+            return None
+
+        self._request.close()
+        self._skip = 0
+        LOG.info('Receiving image from multicast group {}:{}, repairing '
+                 'lost blocks from {}'.format(info['group'], info['port'],
+                                              url))
+        return _MulticastDownload(image_info, url, size, receiver,
+                                  block_size, group_size, int(parity),
+                                  offset=self._offset)
+
+    def iter_chunks(self):
+        """Downloads and returns the next chunk without checksumming it.
+
+        Callers using this method directly are responsible for passing every
+        chunk, in order, to update_checksum().
+
+        :returns: A chunk of the image. Size of chunk is at most
+                  IMAGE_CHUNK_SIZE which is a constant in this module.
+        """
+        if self._ranged_download is not None:
+            chunks = iter(self._ranged_download)
+        elif self._failover_throughput:
+            chunks = self._failover_chunks()
+        else:
+            chunks = self._stream_chunks()
+        chunks = self._receive_chunks(chunks)
+        if self._chunk_verifier is not None:
+            chunks = self._chunk_verifier.verify(chunks)
+        if self._compression:
+            if not self._hash_output:
+                chunks = self._hash_chunks(chunks)
+            chunks = self._decompress_chunks(chunks)
+        return chunks
+
+    def _receive_chunks(self, chunks):
+        """Records and limits the rate of the chunks of the image received.
+
+        :param chunks: An iterator of chunks of the image.
+        :raises: ImageDownloadError if the image cannot be received.
+        """
+        # Multicast packets arrive at the rate of the sender
+        throttle = not isinstance(self._ranged_download, _MulticastDownload)
+        try:
+            for chunk in chunks:
+                if throttle:
+                    _download_limiter.consume(len(chunk))
+                self.progress.add(progress.RECEIVED, len(chunk))
+                yield chunk
+        except errors.RESTError:
+            raise
+        except Exception as e:
+            # Such as a connection reset while the image is received
+            msg = 'Unable to receive the image from {}: {}'.format(
+                self._url, e)
+            raise errors.ImageDownloadError(self._image_info['id'], msg)
+
+    def _decompress_chunks(self, chunks):
+        """Decompresses the chunks of the image.
+
+        :param chunks: An iterator of chunks of the compressed image.
+        :raises: ImageDownloadError if the image cannot be decompressed.
+        """
+        threads = int(self._image_info.get('decompress_threads') or
+                      CONF.image_decompress_threads)
+        try:
+            for chunk in decompress.decompress(chunks, self._compression,
+                                               threads):
+                yield chunk
+        except decompress.DecompressionError as e:
+            msg = 'Unable to decompress the {} compressed image: {}'.format(
+                self._compression, e)
+            raise errors.ImageDownloadError(self._image_info['id'], msg)
+
+    def _stream_chunks(self):
+        """Returns the chunks of the image from the current request."""
+        if self._skip:
+            return self._skip_chunks(
+                self._request.iter_content(IMAGE_CHUNK_SIZE), self._skip)
+        return self._request.iter_content(IMAGE_CHUNK_SIZE)
+
+    def _failover_chunks(self):
+        """Returns the chunks of the image, switching URLs when needed.
+
+        The throughput is measured over every image_mirror_failover_window
+        seconds. When it falls below the failover throughput, or the
+        connection fails, the rest of the image is requested from the next
+        URL.
+
+        :raises: ImageDownloadError if the connection fails and no other
+                 URL can serve the rest of the image.
+        """
+        window = CONF.image_mirror_failover_window
+        position = self._offset
+        chunks = self._stream_chunks()
+        while True:
+            window_start = time.time()
+            window_bytes = 0
+            switched = False
+            try:
+                for chunk in chunks:
+                    position += len(chunk)
+                    window_bytes += len(chunk)
+                    yield chunk
+                    elapsed = time.time() - window_start
+                    if elapsed < window:
+                        continue
+                    throughput = window_bytes / elapsed / units.M
+                    window_start += elapsed
+                    window_bytes = 0
+                    if throughput >= self._failover_throughput:
+                        continue
+                    reason = 'throughput fell to {:.2f} MB/s'.format(
+                        throughput)
+                    if self._switch_url(position, reason):
+                        switched = True
+                        break
+            except requests.RequestException as e:
+                if not self._switch_url(position, str(e)):
+                    msg = ('Download from {} failed at offset {} and no '
+                           'other URL could serve the rest of the image. '
+                           'Error: {}').format(self._url, position, e)
+                    raise errors.ImageDownloadError(self._image_info['id'],
+                                                    msg)
+                switched = True
+            if not switched:
+                return
+            chunks = self._stream_chunks()
+
+    def _switch_url(self, position, reason):
+        """Continues the download from the next URL which answers.
+
+        :param position: The offset in bytes to continue the download at.
+        :param reason: Why the current URL is abandoned, for logging.
+        :returns: True if the download switched to another URL, False if
+                  no other URL could be used.
+        """
+        if self._switches >= MIRROR_SWITCH_LIMIT:
+            LOG.warning('Download of image %s from %s: %s, but it has '
+                        'already switched URLs %d times',
+                        self._image_info['id'], self._url, reason,
+                        self._switches)
+            return False
+        index = self._urls.index(self._url)
+        candidates = self._urls[index + 1:] + self._urls[:index]
+        for url in candidates:
+            LOG.warning('Download of image %s from %s: %s. Switching to %s '
+                        'at offset %d', self._image_info['id'], self._url,
+                        reason, url, position)
+            self._offset = position
+            try:
+                request = self._download_file(self._image_info, url)
+            except (errors.ImageDownloadError, requests.RequestException) as e:
+                LOG.warning('Unable to continue the download from %s: %s',
+                            url, e)
+                continue
+            self._request.close()
+            self._request = request
+            self._url = url
+            self._switches += 1
+            return True
+        return False
+
+    @staticmethod
+    def _skip_chunks(chunks, skip):
+        """Drops the first bytes of a stream of chunks.
+
+        :param chunks: An iterator of chunks.
+        :param skip: The number of bytes to drop.
+        """
+        for chunk in chunks:
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            if skip:
+                chunk = chunk[skip:]
+                skip = 0
+            yield chunk
+
+    def update_checksum(self, chunk):
+        """Adds a chunk of the image to the checksums being computed.
+
+        The checksums are updated in the calling thread, so the chunk may be
+        reused as soon as this returns.
+
+        :param chunk: The chunk of the image, as returned by iter_chunks().
+        """
+        if self._hash_output:
+            self._hashes.update(chunk)
+            self.progress.add(progress.HASHED, len(chunk))
+
+    def __iter__(self):
+        """Downloads and returns the next chunk of the image.
+
+        :returns: A chunk of the image. Size of chunk is IMAGE_CHUNK_SIZE
+                  which is a constant in this module.
+        :raises: Any error raised while computing the checksums, once the
+                 whole image has been returned.
+        """
+        chunks = self.iter_chunks()
+        if self._hash_output:
+            chunks = self._hash_chunks(chunks)
+        return chunks
+
+    def _hash_chunks(self, chunks):
+        """Computes the checksums of the chunks passed through.
+
+        :param chunks: An iterator of chunks of the image.
+        :raises: Any error raised while computing the checksums, once the
+                 whole image has been returned.
+        """
+        hash_threads = _HashThreads(self._hashes)
+        try:
+            for chunk in chunks:
+                hash_threads.update(chunk)
+                self.progress.add(progress.HASHED, len(chunk))
+                yield chunk
+        except BaseException:
+            try:
+                hash_threads.finish()
+            except Exception:
+                LOG.exception('Error while computing image checksums')
+            raise
+        hash_threads.finish()
+
+    def hexdigests(self):
+        """Returns the checksums of the downloaded image.
+
+        Note that the checksums will not be the true checksums of the image
+        until the download has been fully completed through this object's
+        iterator interface.
+
+        :returns: A dictionary mapping algorithm names to checksums of the
+                  image as strings in hexadecimal.
+        """
+        return self._hashes.hexdigests()
+
+    def md5sum(self):
+        """Computes and returns the md5 checksum of the downloaded image.
+
+        Note that md5sum will not return the true checksum of the image until
+        the download has been fully completed through this object's
+        iterator inferface.
+
+        :returns: The md5 checksum of the image as a string in hexadecimal,
+                  or None if no MD5 checksum was requested in image_info.
+        """
+        return self.hexdigests().get('md5')
+
+
+class _ImagePipeline(object):
+    """Overlaps the download, checksum and write of an image.
+
+    A receiver thread copies downloaded chunks into a fixed pool of reusable
+    buffers, a hashing thread feeds them to the checksum, and the caller's
+    thread writes them out and hands the buffers back to the pool. The pool
+    size caps both the memory used and the number of chunks in flight, and
+    gives natural back pressure when either the network or the disk is the
+    slower side.
+    """
+
+    def __init__(self, image_download, chunks):
+        """Initialize an instance of the _ImagePipeline class.
+
+        :param image_download: An ImageDownload object to read from.
+        :param chunks: The number of IMAGE_CHUNK_SIZE buffers in flight.
+        """
+        self._image_download = image_download
+        self._free_buffers = queue.Queue()
+        for _ in six.moves.range(chunks):
+            self._free_buffers.put(bytearray(IMAGE_CHUNK_SIZE))
+        self._to_hash = queue.Queue()
+        self._to_write = queue.Queue()
+        self._error = None
+        self._aborted = threading.Event()
+
+    def _fail(self, error):
+        """Record the first error and stop feeding the pipeline."""
+        if self._error is None:
+            self._error = error
+        self._aborted.set()
+
+    def _receive(self):
+        """Copy downloaded chunks into free buffers and queue them."""
+        try:
+            for chunk in self._image_download.iter_chunks():
+                for offset in six.moves.range(0, len(chunk),
+                                              IMAGE_CHUNK_SIZE):
+                    data = chunk[offset:offset + IMAGE_CHUNK_SIZE]
+                    buf = self._free_buffers.get()
+                    if buf is _PIPELINE_END or self._aborted.is_set():
+                        return
+                    memoryview(buf)[:len(data)] = data
+                    self._to_hash.put((buf, len(data)))
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._to_hash.put(_PIPELINE_END)
+
+    def _hash(self):
+        """Checksum queued buffers in order and pass them to the writer."""
+        try:
+            while True:
+                item = self._to_hash.get()
+                if item is _PIPELINE_END:
+                    break
+                buf, length = item
+                if not self._aborted.is_set():
+                    self._image_download.update_checksum(
+                        memoryview(buf)[:length])
+                self._to_write.put(item)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._to_write.put(_PIPELINE_END)
+
+    def run(self, write):
+        """Run the pipeline until the whole image has been written.
+
+        :param write: A callable taking a chunk of the image, called from
+                      the current thread for every chunk in order.
+        :raises: Any error raised by the download, checksum or write.
+        """
+        stages = [threading.Thread(target=self._receive,
+                                   name='image-pipeline-receive'),
+                  threading.Thread(target=self._hash,
+                                   name='image-pipeline-hash')]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        try:
+            while True:
+                item = self._to_write.get()
+                if item is _PIPELINE_END:
+                    break
+                buf, length = item
+                if self._error is None:
+                    write(memoryview(buf)[:length])
+                self._free_buffers.put(buf)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._aborted.set()
+            self._free_buffers.put(_PIPELINE_END)
+            for stage in stages:
+                stage.join()
+        if self._error is not None:
+            raise self._error
+
+
+def _crc32(data, value=0):
+    if six.PY2 and isinstance(data, memoryview):
+        # zlib does not accept memoryview objects on Python 2
+        data = data.tobytes()
+    return zlib.crc32(data, value) & 0xffffffff
+
+
+class _DownloadCheckpoint(object):
+    """Records how much of an image has been written, to resume downloads.
+
+    The image is split into segments of CHECKPOINT_SEGMENT_SIZE bytes, and
+    the CRC32 of every segment is saved to a checkpoint file once it has
+    been written. As the state of an MD5 hash cannot be serialized, a
+    download is resumed by reading the written segments back from the
+    target, checking them against their CRC32 and hashing them again. The
+    download then continues after the last intact segment.
+    """
+
+    def __init__(self, path, image_info, digests=None):
+        """Initialize an instance of the _DownloadCheckpoint class.
+
+        :param path: The path of the checkpoint file.
+        :param image_info: Image information dictionary.
+        :param digests: Optional. The CRC32 of the segments written so far.
+        """
+        self._path = path
+        expected = _expected_checksums(image_info)
+        self._algorithms = [algo for algo, _value in expected]
+        self._checksum = ','.join(value for _algo, value in expected)
+        self._digests = list(digests or [])
+        self._position = self.offset
+        self._crc = 0
+        self._filled = 0
+
+    @classmethod
+    def load(cls, path, image_info):
+        """Load a checkpoint file left over by an earlier download.
+
+        :param path: The path of the checkpoint file.
+        :param image_info: Image information dictionary.
+        :returns: A _DownloadCheckpoint object, which is empty if there is
+                  no usable checkpoint for this image.
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return cls(path, image_info)
+        checkpoint = cls(path, image_info, data.get('digests'))
+        if (data.get('checksum') != checkpoint._checksum or
+                data.get('segment_size') != CHECKPOINT_SEGMENT_SIZE):
+            LOG.info('Ignoring download checkpoint %s made for a different '
+                     'image', path)
+            return cls(path, image_info)
+        return checkpoint
+
+    @property
+    def offset(self):
+        """The offset up to which the image is known to be written."""
+        return len(self._digests) * CHECKPOINT_SEGMENT_SIZE
+
+    def restore(self, target):
+        """Verify the image data in the target up to the checkpoint.
+
+        Segments which cannot be read back or do not match their CRC32,
+        and all segments after them, are dropped from the checkpoint.
+
+        :param target: The path of the file or device holding the image.
+        :returns: An _ImageHashes object updated with the first offset bytes
+                  of the image.
+        """
+        checksum = _ImageHashes(self._algorithms)
+        verified = 0
+        if self._digests:
+            try:
+                with open(target, 'rb') as f:
+                    for digest in self._digests:
+                        segment_checksum = checksum.copy()
+                        crc = 0
+                        remaining = CHECKPOINT_SEGMENT_SIZE
+                        while remaining:
+                            data = f.read(min(remaining, IMAGE_CHUNK_SIZE))
+                            if not data:
+                                break
+                            crc = _crc32(data, crc)
+                            segment_checksum.update(data)
+                            remaining -= len(data)
+                        if remaining or crc != digest:
+                            break
+                        checksum = segment_checksum
+                        verified += 1
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to read back the partially written '
+                            'image from %s: %s', target, e)
+            if verified < len(self._digests):
+                LOG.warning('Only %d of %d checkpointed segments of %s are '
+                            'intact', verified, len(self._digests), target)
+        del self._digests[verified:]
+        self._position = self.offset
+        self._crc = 0
+        self._filled = 0
+        return checksum
+
+    def wrap(self, write_at):
+        """Wrap a positional write function to record what it writes.
+
+        :param write_at: A callable taking an offset and a chunk of the
+                         image.
+        :returns: A callable taking the next chunk of the image, starting
+                  at the checkpoint offset.
+        """
+        def write(data):
+            write_at(self._position, data)
+            self._position += len(data)
+            self._record(data)
+        return write
+
+    def _record(self, data):
+        view = memoryview(data)
+        while len(view):
+            size = min(len(view), CHECKPOINT_SEGMENT_SIZE - self._filled)
+            self._crc = _crc32(view[:size], self._crc)
+            self._filled += size
+            view = view[size:]
+            if self._filled == CHECKPOINT_SEGMENT_SIZE:
+                self._digests.append(self._crc)
+                self._crc = 0
+                self._filled = 0
+                self.save()
+
+    def save(self):
+        """Save the checkpoint file."""
+        data = {'checksum': self._checksum,
+                'segment_size': CHECKPOINT_SEGMENT_SIZE,
+                'digests': self._digests}
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(temp_path, self._path)
+
+    def remove(self):
+        """Remove the checkpoint file."""
+        try:
+            os.unlink(self._path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _download_checkpoints(image_info):
+    """Get whether an image download is checkpointed so it can resume.
+
+    :param image_info: Image information dictionary.
+    """
+    if image_info.get('compression'):
+        # Offsets in the written image do not map to the download
+        return False
+    return strutils.bool_from_string(
+        image_info.get('download_checkpoints',
+                       CONF.image_download_checkpoints))
+
+
+def _device_checkpoint_path(image_info, device):
+    """Get the checkpoint file of an image streamed onto a device.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string, the image is written to.
+    """
+    return os.path.join(tempfile.gettempdir(), '{}.{}.checkpoint'.format(
+        image_info['id'], os.path.basename(device)))
+
+
+def _write_failure(image_info, target, error):
+    """Get the error to raise when downloading and writing an image fails.
+
+    Downloads only raise agent errors, such as ImageDownloadError, after
+    which the download may be resumed. Any other error is raised by the
+    writing of the image, and is not resumed.
+
+    :param image_info: Image information dictionary.
+    :param target: The path of the file or device the image is written to.
+    :param error: The exception raised.
+    :returns: An ImageWriteError, or error itself if it is an agent error.
+    """
+    if isinstance(error, errors.RESTError):
+        return error
+    LOG.error('Unable to write image %s to %s: %s', image_info['id'],
+              target, error)
+    return errors.ImageWriteError(target, None, None, str(error))
+
+
+def _download_resumable(image_info, target, checkpoint, write, time_obj):
+    """Downloads an image, resuming from the checkpoint after failures.
+
+    Only download failures are resumed, after a delay which doubles with
+    every attempt.
+
+    :param image_info: Image information dictionary.
+    :param target: The path of the file or device the image is written to.
+    :param checkpoint: A _DownloadCheckpoint for target.
+    :param write: A callable taking an ImageDownload and the checkpoint,
+                  which writes the image to target from the checkpoint
+                  offset onwards.
+    :param time_obj: The time the download began.
+    :raises: ImageDownloadError if the download still fails after all
+             resume attempts.
+    :raises: ImageWriteError if the image cannot be written to target.
+    :returns: A tuple of the ImageDownload object which completed the
+              image and the value returned by write.
+    """
+    attempts = int(image_info.get('download_resume_attempts',
+                                  CONF.image_download_resume_attempts))
+    delay = RESUME_DELAY
+    while True:
+        hashes = checkpoint.restore(target)
+        if checkpoint.offset:
+            LOG.info('Resuming download of image %s at offset %d',
+                     image_info['id'], checkpoint.offset)
+        try:
+            image_download = ImageDownload(image_info, time_obj=time_obj,
+                                           offset=checkpoint.offset,
+                                           hashes=hashes)
+            return image_download, write(image_download, checkpoint)
+        except errors.ImageDownloadError as e:
+            if attempts <= 0:
+                raise
+            attempts -= 1
+            LOG.warning('Download of image %s failed and will be resumed '
+                        'in %d seconds: %s', image_info['id'], delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, RESUME_MAX_DELAY)
+
+
+def _pipeline_chunks(image_info):
+    """Get the number of chunks an _ImagePipeline may keep in flight.
+
+    :param image_info: Image information dictionary.
+    :returns: The number of chunks, or 0 if the image should be processed
+              serially without a pipeline.
+    """
+    chunks = image_info.get('pipeline_chunks')
+    if chunks is None:
+        chunks = CONF.image_pipeline_chunks
+    return int(chunks)
+
+
+def _write_image_chunks(image_download, image_info, write):
+    """Downloads an image and passes every chunk to a write function.
+
+    :param image_download: An ImageDownload object to read from.
+    :param image_info: Image information dictionary.
+    :param write: A callable taking a chunk of the image.
+    """
+    image_progress = image_download.progress
+
+    def _write(chunk):
+        write(chunk)
+        image_progress.add(progress.WRITTEN, len(chunk))
+
+    chunks = _pipeline_chunks(image_info)
+    if chunks > 0:
+        _ImagePipeline(image_download, chunks).run(_write)
+    else:
+        for chunk in image_download:
+            _write(chunk)
+
+
+def _sparse_zero_request(image_info, device):
+    """Get how skipped blocks are zeroed when an image is written sparsely.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string, the image is written to.
+    :returns: BLKZEROOUT or BLKDISCARD, DISCARDED if the device was
+              discarded beforehand, or None if the image should not be
+              written sparsely.
+    """
+    sparse = strutils.bool_from_string(
+        image_info.get('sparse_writes', CONF.image_sparse_writes))
+    if not sparse:
+        return None
+    if device in _discarded_devices:
+        return image_writer.DISCARDED
+    zero_request = image_writer.get_zero_request(device)
+    if zero_request is None:
+        LOG.warning('Device %s does not guarantee that zeroed or discarded '
+                    'blocks read back as zeroes, image %s will be written '
+                    'without skipping zero blocks', device, image_info['id'])
+    return zero_request
+
+
+def _discard_devices(image_info, devices):
+    """Discard the devices a whole disk image is about to be written to.
+
+    Devices guaranteeing that discarded blocks read back as zeroes are
+    recorded, so that images written sparsely leave blocks of zeroes as
+    they are. Devices holding a partially written image, which is resumed
+    from a checkpoint, are not discarded.
+
+    :param image_info: Image information dictionary.
+    :param devices: The device names, as strings, the image is written to.
+    :returns: A tuple of the number of devices discarded and the number of
+              them guaranteeing that discarded blocks read back as zeroes,
+              or None if devices are not discarded.
+    """
+    if not strutils.bool_from_string(
+            image_info.get('discard_device', CONF.image_discard_device)):
+        return None
+    discarded = 0
+    zeroed = 0
+    for device in devices:
+        if (_download_checkpoints(image_info) and
+                os.path.exists(_device_checkpoint_path(image_info, device))):
+            LOG.info('Not discarding device %s, image %s is resumed from a '
+                     'checkpoint', device, image_info['id'])
+            continue
+        starttime = time.time()
+        try:
+            size, zeroes = image_writer.discard_device(device)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to discard device %s before writing image '
+                        '%s, writing it anyway. Error: %s', device,
+                        image_info['id'], e)
+            continue
+        if not size:
+            LOG.info('Device %s does not support discard', device)
+            continue
+        LOG.info('Discarded %d bytes of device %s in %.2f seconds, '
+                 'discarded blocks %s guaranteed to read back as zeroes',
+                 size, device, time.time() - starttime,
+                 'are' if zeroes else 'are not')
+        discarded += 1
+        if zeroes:
+            zeroed += 1
+            _discarded_devices.add(device)
+    return discarded, zeroed
+
+
+def _write_image_data(image_download, image_info, writer, sparse,
+                      checkpoint=None, shared=None):
+    """Downloads an image and passes it to an image writer.
+
+    :param image_download: An ImageDownload object to read from.
+    :param image_info: Image information dictionary.
+    :param writer: A FileWriter or DirectWriter.
+    :param sparse: Whether blocks of zeroes are passed to the
+                   write_zeroes() method of the writer.
+    :param checkpoint: Optional. A _DownloadCheckpoint recording what is
+                       written. The image is then written from the
+                       checkpoint offset onwards.
+    :param shared: Optional. A SharedImage recording the chunks written.
+    """
+    if sparse:
+        writer = image_writer.SparseWriter(writer)
+    offset = 0
+    if checkpoint is not None:
+        offset = checkpoint.offset
+        write = checkpoint.wrap(writer.write_at)
+    else:
+        write = writer.write
+    if shared is not None:
+        write = shared.wrap(write, offset=offset)
+    _write_image_chunks(image_download, image_info, write)
+    if sparse:
+        writer.flush()
+    if shared is not None:
+        shared.finish()
+
+
+def _direct_io_settings(image_info):
+    """Get the direct I/O settings used to stream an image onto a device.
+
+    :param image_info: Image information dictionary.
+    :returns: A tuple of the queue depth and the block size in bytes. A
+              queue depth of 0 means direct I/O is not used.
+    """
+    queue_depth = image_info.get('direct_io_queue_depth')
+    if queue_depth is None:
+        queue_depth = CONF.image_direct_io_queue_depth
+    block_size = image_info.get('direct_io_block_size')
+    if block_size is None:
+        block_size = CONF.image_direct_io_block_size
+    return int(queue_depth), int(block_size) * units.Mi
+
+
+def _writeback_window(image_info):
+    """Get the size of the windows flushed behind buffered image writes.
+
+    :param image_info: Image information dictionary.
+    :returns: The size in bytes, or 0 if written data is left for the
+              kernel to flush.
+    """
+    window = image_info.get('writeback_window')
+    if window is None:
+        window = CONF.image_writeback_window
+    return int(window) * units.Mi
+
+
+def _stream_direct_onto_device(image_download, image_info, device,
+                               queue_depth, block_size, zero_request=None,
+                               checkpoint=None, shared=None):
+    """Streams an image to a device with direct I/O.
+
+    :param image_download: An ImageDownload object to read from.
+    :param image_info: Image information dictionary.
+    :param device: The disk name, as a string, on which to store the image.
+    :param queue_depth: The number of writes to keep outstanding.
+    :param block_size: The size in bytes of each write.
+    :param zero_request: Optional. If given, blocks of zeroes are skipped
+                         and zeroed with this ioctl.
+    :param checkpoint: Optional. A _DownloadCheckpoint recording what is
+                       written.
+    :param shared: Optional. A SharedImage recording the chunks written.
+    :raises: ImageDownloadError if the image cannot be downloaded.
+    :raises: ImageWriteError if the image cannot be written.
+    :returns: The DirectWriter used to write the image.
+    """
+    try:
+        writer = image_writer.DirectWriter(device, queue_depth, block_size,
+                                           zero_request)
+    except (IOError, OSError) as e:
+        raise errors.ImageWriteError(device, None, None, str(e))
+
+    try:
+        _write_image_data(image_download, image_info, writer,
+                          zero_request is not None, checkpoint, shared)
+        writer.close()
+    except Exception as e:
+        writer.abort()
+        raise _write_failure(image_info, device, e)
+    return writer
+
+
+def _verify_image(image_info, image_location, checksums):
+    """Verifies the checksums of the local images match expectations.
+
+    If this function does not raise ImageChecksumError then it is very likely
+    that the local copy of the image was transmitted and stored correctly.
+
+    :param image_info: Image information dictionary.
+    :param image_location: The location of the local image.
+    :param checksums: A dictionary mapping algorithm names to the computed
+                      checksums of the local image.
+    :raises: ImageChecksumError if a checksum of the local image does not
+             match the checksum as reported by glance in image_info.
+    """
+    for algo, expected in _expected_checksums(image_info):
+        checksum = checksums.get(algo)
+        LOG.debug('Verifying image at {} against {} checksum '
+                  '{}'.format(image_location, algo, expected))
+        if checksum is None or checksum.lower() != expected:
+            LOG.error(errors.ImageChecksumError.details_str.format(
+                image_location, image_info['id'], expected, checksum))
+            raise errors.ImageChecksumError(image_location, image_info['id'],
+                                            expected, checksum)
+
+
+def _verify_writes(image_info):
+    """Get whether an image is read back and verified once written.
+
+    :param image_info: Image information dictionary.
+    """
+    return strutils.bool_from_string(
+        image_info.get('verify_writes', CONF.image_verify_writes))
+
+
+def _read_back_image(image_info, device, size, manifest=True):
+    """Reads back an image written to a device and verifies it.
+
+    The device is read with direct I/O, so that the data is read from the
+    disk rather than from the page cache. If the image has a chunk manifest,
+    the chunks are verified against it in parallel as they are read.
+    Otherwise, the image is verified against its checksums.
+
+    :param image_info: Image information dictionary.
+    :param device: The disk name, as a string, the image was written to.
+    :param size: The size in bytes of the image.
+    :param manifest: Optional. Whether an image with a chunk manifest is
+                     verified against it rather than against its checksums.
+    :raises: ImageChecksumError if the device does not hold the image.
+    :raises: BlockDeviceError if the device cannot be read.
+    :returns: The throughput of the read back in MB/s, or None if the
+              image is not written as is and cannot be verified.
+    """
+    compression = image_info.get('compression')
+    if image_info.get('disk_format') != 'raw' or (
+            compression and
+            image_info.get('checksum_stream') != 'decompressed'):
+        LOG.warning('Image %s is not written as is to device %s, it cannot '
+                    'be read back and verified', image_info['id'], device)
+        return None
+
+    verifier = None
+    if manifest and not compression:
+        # The chunk manifest of a compressed image is of the download
+        verifier = _ChunkVerifier.for_image(image_info,
+                                            image_info['urls'][0])
+    _queue_depth, block_size = _direct_io_settings(image_info)
+    threads = int(image_info.get('verify_threads') or
+                  CONF.image_verify_threads)
+    check = None
+    hash_threads = None
+    if verifier is not None:
+        chunk_size = verifier.chunk_size
+        block_size = max(1, block_size // chunk_size) * chunk_size
+
+        def _check_chunks(offset, data):
+            for start in six.moves.range(0, len(data), chunk_size):
+                chunk = data[start:start + chunk_size]
+                index = (offset + start) // chunk_size
+                location = '{} at bytes {}-{}'.format(
+                    device, offset + start, offset + start + len(chunk) - 1)
+                verifier.check(index, chunk, location)
+        check = _check_chunks
+    else:
+        hashes = _ImageHashes(
+            algo for algo, _value in _expected_checksums(image_info))
+        hash_threads = _HashThreads(hashes)
+
+    LOG.info('Reading back image %s from device %s to verify it',
+             image_info['id'], device)
+    starttime = time.time()
+    try:
+        for data in image_writer.read_back(device, size, threads,
+                                           block_size, check):
+            if hash_threads is not None:
+                hash_threads.update(data)
+    except (IOError, OSError) as e:
+        msg = 'Unable to read back image {} from device {}: {}'.format(
+            image_info['id'], device, e)
+        raise errors.BlockDeviceError(msg)
+    finally:
+        if hash_threads is not None:
+            hash_threads.finish()
+    if hash_threads is not None:
+        _verify_image(image_info, device, hashes.hexdigests())
+
+    totaltime = time.time() - starttime
+    throughput = float(size) / units.M / max(totaltime, 1e-6)
+    LOG.info('Image %s read back from device %s and verified in %.2f '
+             'seconds, at %.2f MB/s', image_info['id'], device, totaltime,
+             throughput)
+    return throughput
 
-    This class opens a HTTP connection to download an image from a URL
-    and create an iterator so the image can be downloaded in chunks. The
-    MD5 hash of the image being downloaded is calculated on-the-fly.
-    """
 
-    def __init__(self, image_info, time_obj=None):
-        """Initialize an instance of the ImageDownload class.
+def _zero_copy_url(image_info):
+    """Get the URL a raw image can be streamed from without copies.
 
-        Trys each URL in image_info successively until a URL returns a
-        successful request code. Once the object is initialized, the user may
-        retrieve chunks of the image through the standard python iterator
-        interface until either the image is fully downloaded, or an error is
-        encountered.
+    :param image_info: Image information dictionary.
+    :returns: The URL, or None if zero-copy streaming is disabled or not
+              possible for the image.
+    """
+    if not strutils.bool_from_string(image_info.get('zero_copy',
+                                                    CONF.image_zero_copy)):
+        return None
+    url = image_info['urls'][0]
+    reason = None
+    if not zero_copy.supported():
+        reason = 'splice is not available'
+    elif not url.lower().startswith('http://'):
+        reason = 'it is not served over plain HTTP'
+    elif image_info.get('proxies') or requests.utils.get_environ_proxies(
+            url, no_proxy=image_info.get('no_proxy')):
+        reason = 'it is downloaded through a proxy'
+    elif image_info.get('compression'):
+        reason = 'it is compressed'
+    elif image_info.get('swarm') is not None or image_info.get('multicast'):
+        reason = 'it may be received from peers'
+    elif _download_checkpoints(image_info):
+        reason = 'its download is checkpointed'
+    if reason is not None:
+        LOG.info('Image %s is not streamed with zero-copy, as %s',
+                 image_info['id'], reason)
+        return None
+    return url
+
+
+def _delta_deploy(image_info):
+    """Get whether an image is deployed as a delta of the device content.
 
-        :param image_info: Image information dictionary.
-        :param time_obj: Optional time object to indicate when the image
-                         download began. Defaults to None. If None, then
-                         time.time() will be used to find the start time of
-                         the download.
+    :param image_info: Image information dictionary.
+    """
+    return strutils.bool_from_string(
+        image_info.get('delta_deploy', CONF.image_delta_deploy))
 
-        :raises: ImageDownloadError if starting the image download fails for
-                 any reason.
-        """
-        self._md5checksum = hashlib.md5()
-        self._time = time_obj or time.time()
-        self._request = None
-        details = []
-        for url in image_info['urls']:
-            try:
-                LOG.info("Attempting to download image from {}".format(url))
-                self._request = self._download_file(image_info, url)
-            except errors.ImageDownloadError as e:
-                failtime = time.time() - self._time
-                log_msg = ('URL: {}; time: {} '
-                           'seconds. Error: {}').format(
-                    url, failtime, e.secondary_message)
-                LOG.warning(log_msg)
-                details.append(log_msg)
-                continue
-            else:
-                break
-        else:
-            details = '\n '.join(details)
-            raise errors.ImageDownloadError(image_info['id'], details)
 
-    def _download_file(self, image_info, url):
-        """Opens a download stream for the given URL.
+def _remote_image_size(image_info, url):
+    """Get the size of an image with a byte range request.
 
-        :param image_info: Image information dictionary.
-        :param url: The URL string to request the image from.
+    :param image_info: Image information dictionary.
+    :param url: The URL string of the image.
+    :raises: ImageDownloadError if the server does not support byte range
+             requests.
+    :returns: The size of the image in bytes.
+    """
+    try:
+        resp = requests.get(url, headers={'Range': 'bytes=0-0'},
+                            **_request_options(image_info))
+    except requests.RequestException as e:
+        msg = 'Unable to request {}: {}'.format(url, e)
+        raise errors.ImageDownloadError(image_info['id'], msg)
+    match = None
+    if resp.status_code == 206:
+        match = _CONTENT_RANGE.match(resp.headers.get('Content-Range', ''))
+    resp.close()
+    if match is None or not match.group(3).isdigit():
+        msg = ('The image server at {} does not support byte range '
+               'requests').format(url)
+        raise errors.ImageDownloadError(image_info['id'], msg)
+    return int(match.group(3))
+
+
+def _device_size(device):
+    """Get the size of a device in bytes.
+
+    :param device: The disk name, as a string.
+    :raises: OSError if the device cannot be opened.
+    """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
 
-        :raises: ImageDownloadError if the download stream was not started
-                 properly.
-        """
-        no_proxy = image_info.get('no_proxy')
-        if no_proxy:
-            os.environ['no_proxy'] = no_proxy
-        proxies = image_info.get('proxies', {})
-        verify, cert = utils.get_ssl_client_options(CONF)
-        resp = requests.get(url, stream=True, proxies=proxies,
-                            verify=verify, cert=cert)
-        if resp.status_code != 200:
-            msg = ('Received status code {} from {}, expected 200. Response '
-                   'body: {}').format(resp.status_code, url, resp.text)
-            raise errors.ImageDownloadError(image_info['id'], msg)
-        return resp
 
-    def __iter__(self):
-        """Downloads and returns the next chunk of the image.
+def _differing_chunks(image_info, device, verifier, size):
+    """Find the chunks of an image which the device does not hold.
 
-        :returns: A chunk of the image. Size of chunk is IMAGE_CHUNK_SIZE
-                  which is a constant in this module.
-        """
-        for chunk in self._request.iter_content(IMAGE_CHUNK_SIZE):
-            self._md5checksum.update(chunk)
-            yield chunk
+    The device is read with direct I/O by parallel threads, which hash its
+    content chunk by chunk and compare it to the chunk manifest.
 
-    def md5sum(self):
-        """Computes and returns the md5 checksum of the downloaded image.
+    :param image_info: Image information dictionary.
+    :param device: The disk name, as a string.
+    :param verifier: The _ChunkVerifier of the image.
+    :param size: The size in bytes of the image.
+    :raises: IOError or OSError if the device cannot be read.
+    :returns: A sorted list of the indexes of the differing chunks.
+    """
+    chunk_size = verifier.chunk_size
+    _queue_depth, block_size = _direct_io_settings(image_info)
+    block_size = max(1, block_size // chunk_size) * chunk_size
+    threads = int(image_info.get('verify_threads') or
+                  CONF.image_verify_threads)
+    differing = []
+
+    def _compare(offset, data):
+        for start in six.moves.range(0, len(data), chunk_size):
+            index = (offset + start) // chunk_size
+            if not verifier.matches(index, data[start:start + chunk_size]):
+                differing.append(index)
+
+    for _data in image_writer.read_back(device, size, threads, block_size,
+                                        _compare):
+        pass
+    return sorted(differing)
+
+
+def _delta_ranges(indexes, chunk_size, size, range_size):
+    """Merge chunks into byte ranges to fetch.
+
+    :param indexes: A sorted list of chunk indexes.
+    :param chunk_size: The size in bytes of the chunks.
+    :param size: The size in bytes of the image.
+    :param range_size: The maximum size in bytes of a range.
+    :returns: A list of (start, end) tuples, end being the offset of the
+              last byte of the range.
+    """
+    ranges = []
+    for index in indexes:
+        start = index * chunk_size
+        end = min(start + chunk_size, size) - 1
+        if (ranges and ranges[-1][1] + 1 == start and
+                end + 1 - ranges[-1][0] <= range_size):
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
 
-        Note that md5sum will not return the true checksum of the image until
-        the download has been fully completed through this object's
-        iterator inferface.
 
-        :returns: The md5 checksum of the image as a string in hexadecimal.
-        """
-        return self._md5checksum.hexdigest()
+def _staging_size(image_info):
+    """Get the size of an image once downloaded, to choose where to stage it.
 
+    The size is the 'image_size' field of image_info, the size of the image
+    once decompressed, or the size announced by the image server.
 
-def _verify_image(image_info, image_location, checksum):
-    """Verifies the checksum of the local images matches expectations.
+    :param image_info: Image information dictionary.
+    :returns: The size of the image in bytes, or None if unknown.
+    """
+    if image_info.get('image_size') is not None:
+        return int(image_info['image_size'])
+    if image_info.get('compression'):
+        return None
+    url = image_info['urls'][0]
+    try:
+        resp = requests.head(url, allow_redirects=True,
+                             **_request_options(image_info))
+    except requests.RequestException as e:
+        LOG.warning('Unable to get the size of image %s from %s: %s',
+                    image_info['id'], url, e)
+        return None
+    size = resp.headers.get('Content-Length')
+    if (resp.status_code != 200 or
+            not isinstance(size, six.string_types) or not size.isdigit()):
+        LOG.warning('Unable to get the size of image %s from %s, received '
+                    'status code %s and Content-Length %s', image_info['id'],
+                    url, resp.status_code, size)
+        return None
+    return int(size)
+
+
+def _stage_image(image_info, device=None):
+    """Choose where to download an image before it is written.
 
-    If this function does not raise ImageChecksumError then it is very likely
-    that the local copy of the image was transmitted and stored correctly.
+    :param image_info: Image information dictionary.
+    :param device: Optional. The only device the image is written to, at
+                   the end of which a whole disk image may be staged.
+    :returns: The StagedImage, also found by _image_location().
+    """
+    scratch_dir = CONF.image_staging_scratch_dir
+    tail = (device is not None and
+            image_info.get('image_type') != 'partition' and
+            strutils.bool_from_string(
+                image_info.get('staging_device_tail',
+                               CONF.image_staging_device_tail)))
+    size = None
+    if scratch_dir or tail:
+        # The image is staged in memory anyway otherwise
+        size = _staging_size(image_info)
+    staged = image_staging.allocate(
+        image_info['id'], size, CONF.image_staging_memory_reserve * units.Mi,
+        scratch_dir=scratch_dir, device=device if tail else None)
+    _staged_images[image_info['id']] = staged
+    return staged
+
+
+def _release_staged_image(image_info):
+    """Release the staging area of an image once it has been written.
 
     :param image_info: Image information dictionary.
-    :param image_location: The location of the local image.
-    :param checksum: The computed checksum of the local image.
-    :raises: ImageChecksumError if the checksum of the local image does not
-             match the checksum as reported by glance in image_info.
     """
-    LOG.debug('Verifying image at {} against MD5 checksum '
-              '{}'.format(image_location, checksum))
-    if checksum != image_info['checksum']:
-        LOG.error(errors.ImageChecksumError.details_str.format(
-            image_location, image_info['id'],
-            image_info['checksum'], checksum))
-        raise errors.ImageChecksumError(image_location, image_info['id'],
-                                        image_info['checksum'], checksum)
+    staged = _staged_images.pop(image_info['id'], None)
+    if staged is not None:
+        staged.release()
+
 
+def _check_staging_area(image, image_info, device):
+    """Check that writing an image does not overwrite its staging area.
 
-def _download_image(image_info):
+    :param image: The path of the image.
+    :param image_info: Image information dictionary.
+    :param device: The device the image is written to.
+    :raises: ImageWriteError if the image is staged at the end of the device
+             and its virtual size reaches the staging area.
+    """
+    staged = _staged_images.get(image_info['id'])
+    if staged is None or staged.path != image or staged.device != device:
+        return
+    virtual_size = disk_utils.qemu_img_info(image).virtual_size
+    if virtual_size > staged.offset:
+        msg = ('Image of virtual size {} is staged at offset {} of the '
+               'device and would overwrite itself').format(virtual_size,
+                                                           staged.offset)
+        raise errors.ImageWriteError(device, None, None, msg)
+
+
+def _download_image(image_info, device=None):
     """Downloads the specified image to the local file system.
 
+    The image is staged in memory, or on a local disk if it does not fit,
+    see _stage_image().
+
     :param image_info: Image information dictionary.
+    :param device: Optional. The only device the image is written to.
     :raises: ImageDownloadError if the image download fails for any reason.
     :raises: ImageChecksumError if the downloaded image's checksum does not
              match the one reported in image_info.
     """
     starttime = time.time()
+    staged = _stage_image(image_info, device)
     image_location = _image_location(image_info)
-    image_download = ImageDownload(image_info, time_obj=starttime)
 
-    with open(image_location, 'wb') as f:
+    def _write(image_download, checkpoint):
+        if checkpoint is not None and checkpoint.offset:
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+        with open(image_location, mode) as f:
+            offset = 0
+            if checkpoint is not None:
+                offset = checkpoint.offset
+                write = checkpoint.wrap(image_writer.FileWriter(f).write_at)
+            else:
+                write = f.write
+            shared = _shared_image(image_download, image_info,
+                                   image_location)
+            if shared is not None:
+                # Chunks are served to peers as soon as they are written
+                write = shared.wrap(write, offset=offset, flush=f.flush)
+                image_swarm.share(_swarm_key(image_info), shared)
+            try:
+                _write_image_chunks(image_download, image_info, write)
+            except Exception as e:
+                raise _write_failure(image_info, image_location, e)
+            if shared is not None:
+                f.flush()
+                shared.finish()
+
+    checkpoint = None
+    if _download_checkpoints(image_info):
+        checkpoint_path = image_location + '.checkpoint'
+        if staged.device is not None:
+            # The image is staged on a loop device
+            checkpoint_path = os.path.join(
+                image_staging.MEMORY_DIR,
+                '{}.checkpoint'.format(image_info['id']))
+        checkpoint = _DownloadCheckpoint.load(checkpoint_path, image_info)
+        image_download, _ = _download_resumable(
+            image_info, image_location, checkpoint, _write, starttime)
+    else:
+        image_download = ImageDownload(image_info, time_obj=starttime)
+        _write(image_download, None)
+
+    totaltime = time.time() - starttime
+    LOG.info("Image downloaded from {} in {} seconds: {}".format(
+        image_location, totaltime, image_download.progress.summary()))
+    try:
+        _verify_image(image_info, image_location, image_download.hexdigests())
+    except errors.ImageChecksumError:
+        if image_info.get('swarm') is not None:
+            image_swarm.unshare(_swarm_key(image_info))
+        raise
+    finally:
+        if checkpoint is not None:
+            checkpoint.remove()
+
+
+def _fetch_configdrive(configdrive, image_info):
+    """Fetch a configdrive given as a URL.
+
+    :param configdrive: The URL of the configdrive, or its base64 encoded
+                        gzipped content.
+    :param image_info: Image information dictionary.
+    :raises: InstanceDeployFailure if the configdrive cannot be downloaded.
+    :returns: The base64 encoded gzipped content of the configdrive.
+    """
+    if not configdrive.lower().startswith(('http://', 'https://')):
+        return configdrive
+    node_uuid = image_info.get('node_uuid', 'local')
+    try:
+        resp = requests.get(configdrive, **_request_options(image_info))
+    except requests.RequestException as e:
+        error = str(e)
+    else:
+        if resp.status_code == 200:
+            LOG.debug('Downloaded the configdrive of node %s from %s',
+                      node_uuid, configdrive)
+            # The content is base64 encoded text; ironic-lib checks whether
+            # it is a URL, which fails for bytes on Python 3.
+            return resp.text
+        error = 'Received status code {}, expected 200'.format(
+            resp.status_code)
+    raise exception.InstanceDeployFailure(
+        "Can't download the configdrive content for node {} from '{}'. "
+        "Reason: {}".format(node_uuid, configdrive, error))
+
+
+class _ConfigDriveStage(object):
+    """Fetches a configdrive in a thread while an image is deployed.
+
+    Only writing the configdrive partition is left once the image has been
+    written.
+    """
+
+    def __init__(self, configdrive, image_info):
+        """Initialize an instance of the _ConfigDriveStage class.
+
+        :param configdrive: The URL of the configdrive, or its base64
+                            encoded gzipped content.
+        :param image_info: Image information dictionary.
+        """
+        self._content = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(configdrive, image_info))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, configdrive, image_info):
         try:
-            for chunk in image_download:
-                f.write(chunk)
+            self._content = _fetch_configdrive(configdrive, image_info)
         except Exception as e:
-            msg = 'Unable to write image to {}. Error: {}'.format(
-                image_location, str(e))
-            raise errors.ImageDownloadError(image_info['id'], msg)
+            self._error = e
 
-    totaltime = time.time() - starttime
-    LOG.info("Image downloaded from {} in {} seconds".format(image_location,
-                                                             totaltime))
-    _verify_image(image_info, image_location, image_download.md5sum())
+    def wait(self):
+        """Wait for the configdrive to be fetched.
+
+        :raises: InstanceDeployFailure if the configdrive cannot be
+                 downloaded.
+        :returns: The base64 encoded gzipped content of the configdrive.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._content
+
+
+def _install_devices(image_info):
+    """Get the devices an image is written to.
+
+    Several devices are selected by the 'target_devices' field of
+    image_info, a list of device names, or by its 'target_device_hints'
+    field, root device hints matched by every selected device.
+
+    :param image_info: Image information dictionary.
+    :raises: DeviceNotFound if no device matches the hints.
+    :returns: A list of device names, holding the OS install device unless
+              several devices are selected.
+    """
+    devices = image_info.get('target_devices')
+    if devices:
+        return list(devices)
+    hints = image_info.get('target_device_hints')
+    if hints:
+        return hardware.dispatch_to_managers('get_os_install_devices',
+                                             root_device_hints=hints)
+    return [hardware.dispatch_to_managers('get_os_install_device')]
 
 
 def _validate_image_info(ext, image_info=None, **kwargs):
@@ -313,7 +2823,10 @@ def _validate_image_info(ext, image_info=None, **kwargs):
     """
     image_info = image_info or {}
 
-    for field in ['id', 'urls', 'checksum']:
+    required = ['id', 'urls']
+    if not image_info.get('os_hash_value'):
+        required.append('checksum')
+    for field in required:
         if field not in image_info:
             msg = 'Image is missing \'{}\' field.'.format(field)
             raise errors.InvalidCommandParamsError(msg)
@@ -322,11 +2835,115 @@ def _validate_image_info(ext, image_info=None, **kwargs):
         raise errors.InvalidCommandParamsError(
             'Image \'urls\' must be a list with at least one element.')
 
-    if (not isinstance(image_info['checksum'], six.string_types)
+    rate = image_info.get('download_rate')
+    if rate is not None and (isinstance(rate, bool) or
+                             not isinstance(rate, (float,) +
+                                            six.integer_types) or rate < 0):
+        raise errors.InvalidCommandParamsError(
+            'Image \'download_rate\' must be a non-negative number.')
+
+    image_size = image_info.get('image_size')
+    if image_size is not None and (isinstance(image_size, bool) or
+                                   not isinstance(image_size,
+                                                  six.integer_types) or
+                                   image_size < 0):
+        raise errors.InvalidCommandParamsError(
+            'Image \'image_size\' must be a non-negative integer.')
+
+    manifest = image_info.get('chunk_manifest')
+    if manifest is not None and not isinstance(manifest,
+                                               (dict,) + six.string_types):
+        raise errors.InvalidCommandParamsError(
+            'Image \'chunk_manifest\' must be a URL or a dictionary.')
+
+    compression = image_info.get('compression')
+    if compression is not None and compression not in decompress.COMPRESSIONS:
+        raise errors.InvalidCommandParamsError(
+            'Image \'compression\' must be one of {}.'.format(
+                ', '.join(decompress.COMPRESSIONS)))
+    if image_info.get('checksum_stream') not in (None, 'compressed',
+                                                 'decompressed'):
+        raise errors.InvalidCommandParamsError(
+            'Image \'checksum_stream\' must be \'compressed\' or '
+            '\'decompressed\'.')
+
+    devices = image_info.get('target_devices')
+    if devices is not None and (
+            not isinstance(devices, list) or not devices or
+            not all(isinstance(d, six.string_types) for d in devices)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'target_devices\' must be a list of device names.')
+    hints = image_info.get('target_device_hints')
+    if hints is not None and not isinstance(hints, dict):
+        raise errors.InvalidCommandParamsError(
+            'Image \'target_device_hints\' must be a dictionary.')
+    if devices is not None and hints is not None:
+        raise errors.InvalidCommandParamsError(
+            'Image \'target_devices\' and \'target_device_hints\' cannot '
+            'be used together.')
+    if ((devices is not None or hints is not None) and
+            image_info.get('image_type') == 'partition'):
+        raise errors.InvalidCommandParamsError(
+            'Partition images cannot be written to several devices.')
+
+    cache_mode = image_info.get('convert_cache_mode')
+    if (cache_mode is not None and
+            cache_mode not in image_convert.CACHE_MODES):
+        raise errors.InvalidCommandParamsError(
+            'Image \'convert_cache_mode\' must be one of {}.'.format(
+                ', '.join(image_convert.CACHE_MODES)))
+
+    group = image_info.get('multicast')
+    if group is not None:
+        if (not isinstance(group, dict) or
+                not isinstance(group.get('group'), six.string_types) or
+                not isinstance(group.get('port'), six.integer_types)):
+            raise errors.InvalidCommandParamsError(
+                'Image \'multicast\' must be a dictionary with the '
+                '\'group\' address and the \'port\' number.')
+
+    swarm = image_info.get('swarm')
+    if swarm is not None:
+        if not isinstance(swarm, dict):
+            raise errors.InvalidCommandParamsError(
+                'Image \'swarm\' must be a dictionary.')
+        if not manifest:
+            raise errors.InvalidCommandParamsError(
+                'Image \'swarm\' requires a \'chunk_manifest\'.')
+        if not isinstance(swarm.get('peers', []), list):
+            raise errors.InvalidCommandParamsError(
+                'Image swarm \'peers\' must be a list.')
+
+    if 'checksum' in image_info and (
+            not isinstance(image_info['checksum'], six.string_types)
             or not image_info['checksum']):
         raise errors.InvalidCommandParamsError(
             'Image \'checksum\' must be a non-empty string.')
 
+    if image_info.get('os_hash_value'):
+        algos = image_info.get('os_hash_algo')
+        values = image_info['os_hash_value']
+        if isinstance(values, six.string_types):
+            algos = [algos]
+            values = [values]
+        if (not isinstance(algos, list) or not isinstance(values, list) or
+                len(algos) != len(values)):
+            raise errors.InvalidCommandParamsError(
+                'Image \'os_hash_algo\' and \'os_hash_value\' must both be '
+                'strings, or lists of the same length.')
+        for algo, value in zip(algos, values):
+            if (not isinstance(algo, six.string_types) or
+                    not isinstance(value, six.string_types) or not value):
+                raise errors.InvalidCommandParamsError(
+                    'Image \'os_hash_algo\' and \'os_hash_value\' must be '
+                    'non-empty strings.')
+            try:
+                _new_hash(algo.lower())
+            except ValueError:
+                raise errors.InvalidCommandParamsError(
+                    'Image hash algorithm \'{}\' is not '
+                    'supported.'.format(algo))
+
 
 class StandbyExtension(base.BaseAgentExtension):
     """Extension which adds stand-by related functionality to agent."""
@@ -339,21 +2956,122 @@ class StandbyExtension(base.BaseAgentExtension):
 
         self.cached_image_id = None
         self.partition_uuids = None
+        self.write_throughput = None
+        self.verify_throughput = None
+        self.sparse_stats = None
+        self.delta_stats = None
+        self.discard_stats = None
+        self.image_cache = None
+        if CONF.image_cache_size:
+            self.image_cache = image_cache.ImageCache(
+                CONF.image_cache_dir, CONF.image_cache_size * units.Mi,
+                scratch_dir=CONF.image_cache_scratch_dir,
+                memory_reserve=CONF.image_cache_memory_reserve * units.Mi)
+
+    def _write_summary(self):
+        """Describe how the last image was written, for command results."""
+        summary = ''
+        if self.write_throughput is not None:
+            summary += 'at {:.2f} MB/s '.format(self.write_throughput)
+        if self.sparse_stats is not None:
+            summary += '({} bytes written, {} bytes skipped) '.format(
+                *self.sparse_stats)
+        if self.delta_stats is not None:
+            summary += '({} bytes fetched, {} bytes saved) '.format(
+                *self.delta_stats)
+        if self.discard_stats is not None:
+            summary += ('({} devices discarded, {} guaranteeing discarded '
+                        'blocks read back as zeroes) ').format(
+                *self.discard_stats)
+        if self.verify_throughput is not None:
+            summary += 'and verified at {:.2f} MB/s '.format(
+                self.verify_throughput)
+        return summary
+
+    def _cached_image(self, image_info):
+        """Find an image in the image cache.
+
+        :param image_info: Image information dictionary.
+        :returns: The path of the cached image, or None if the image cache
+                  is disabled or does not hold the image.
+        """
+        if self.image_cache is None:
+            return None
+        return self.image_cache.lookup(
+            image_cache.cache_keys(_expected_checksums(image_info)))
 
-    def _cache_and_write_image(self, image_info, device):
+    def _local_image(self, image_info, device=None,
+                     cached_image=_NOT_LOOKED_UP):
+        """Get a local copy of an image, downloading it if needed.
+
+        The image is taken from the image cache if it holds it. Otherwise,
+        it is downloaded and then added to the image cache, if enabled.
+
+        :param image_info: Image information dictionary.
+        :param device: Optional. The only device the image is written to,
+                       at the end of which it may be staged.
+        :param cached_image: Optional. The result of _cached_image(), if the
+                             image was already looked up.
+        :raises: ImageDownloadError if the image download fails for any reason.
+        :raises: ImageChecksumError if the downloaded image's checksum does not
+                  match the one reported in image_info.
+        :returns: The path of the image.
+        """
+        image = cached_image
+        if image is _NOT_LOOKED_UP:
+            image = self._cached_image(image_info)
+        if image is None:
+            _download_image(image_info, device)
+            image = _image_location(image_info)
+            staged = _staged_images.get(image_info['id'])
+            # An image staged on a device is not kept once written
+            if (self.image_cache is not None and
+                    (staged is None or staged.device is None)):
+                image = self.image_cache.add(
+                    image,
+                    image_cache.cache_keys(_expected_checksums(image_info)))
+                image_swarm.move(_image_location(image_info), image)
+        else:
+            LOG.info('Writing image %s from the image cache',
+                     image_info['id'])
+        return image
+
+    def _cache_and_write_image(self, image_info, device,
+                               cached_image=_NOT_LOOKED_UP):
         """Cache an image and write it to a local device.
 
+        The image is taken from the image cache if it holds it. Otherwise,
+        it is downloaded and then added to the image cache, if enabled.
+
         :param image_info: Image information dictionary.
         :param device: The disk name, as a string, on which to store the
                        image.  Example: '/dev/sda'
+        :param cached_image: Optional. The result of _cached_image(), if the
+                             image was already looked up.
 
         :raises: ImageDownloadError if the image download fails for any reason.
         :raises: ImageChecksumError if the downloaded image's checksum does not
                   match the one reported in image_info.
         :raises: ImageWriteError if writing the image fails.
+        :raises: ImageChecksumError if the image is read back from the
+                 device and does not match.
+        :raises: BlockDeviceError if the image cannot be read back.
         """
-        _download_image(image_info)
-        self.partition_uuids = _write_image(image_info, device)
+        image = self._local_image(image_info, device, cached_image)
+        _check_staging_area(image, image_info, device)
+        zero_request = None
+        if image_info.get('image_type') != 'partition':
+            zero_request = _sparse_zero_request(image_info, device)
+        if zero_request is not None:
+            self.sparse_stats = _write_whole_disk_image_sparse(
+                image, image_info, device, zero_request)
+            self.partition_uuids = {}
+        else:
+            self.partition_uuids = _write_image(image_info, device, image)
+        if (image_info.get('image_type') != 'partition' and
+                _verify_writes(image_info)):
+            self.verify_throughput = _read_back_image(
+                image_info, device, _image_size(image))
         self.cached_image_id = image_info['id']
 
     def _stream_raw_image_onto_device(self, image_info, device):
@@ -364,26 +3082,555 @@ class StandbyExtension(base.BaseAgentExtension):
                        image.  Example: '/dev/sda'
 
         :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageChecksumError if the checksum of the local image does not
+             match the checksum as reported by glance in image_info, or if
+             the image is read back from the device and does not match.
+        :raises: BlockDeviceError if the image cannot be read back.
+        """
+        starttime = time.time()
+        queue_depth, block_size = _direct_io_settings(image_info)
+        zero_request = _sparse_zero_request(image_info, device)
+        url = None
+        if zero_request is None:
+            url = _zero_copy_url(image_info)
+        if url is not None and self._splice_raw_image_onto_device(
+                image_info, device, url):
+            return
+
+        def _write(image_download, checkpoint):
+            # The device is only shared once the image has been written, as
+            # queued or buffered writes are not visible to readers before
+            shared = _shared_image(image_download, image_info, device)
+            if queue_depth > 0:
+                writer = _stream_direct_onto_device(
+                    image_download, image_info, device, queue_depth,
+                    block_size, zero_request, checkpoint, shared)
+            else:
+                mode = 'wb+'
+                if checkpoint is not None and checkpoint.offset:
+                    mode = 'r+b'
+                with open(device, mode) as f:
+                    writer = image_writer.FileWriter(
+                        f, zero_request, _writeback_window(image_info))
+                    try:
+                        _write_image_data(image_download, image_info, writer,
+                                          zero_request is not None,
+                                          checkpoint, shared)
+                    except Exception as e:
+                        raise _write_failure(image_info, device, e)
+            if shared is not None:
+                image_swarm.share(_swarm_key(image_info), shared)
+            return writer
+
+        checkpoint = None
+        if _download_checkpoints(image_info):
+            # The device itself holds the partially written image
+            checkpoint = _DownloadCheckpoint.load(
+                _device_checkpoint_path(image_info, device), image_info)
+            image_download, writer = _download_resumable(
+                image_info, device, checkpoint, _write, starttime)
+        else:
+            image_download = ImageDownload(image_info, time_obj=starttime)
+            writer = _write(image_download, None)
+
+        totaltime = time.time() - starttime
+        LOG.info("Image streamed onto device {} in {} seconds: {}".format(
+            device, totaltime, image_download.progress.summary()))
+        if queue_depth > 0:
+            written = writer.bytes_written + writer.bytes_zeroed
+            self.write_throughput = (float(written) / units.M /
+                                     max(totaltime, 1e-6))
+            LOG.info("Image written with direct I/O at {:.2f} "
+                     "MB/s".format(self.write_throughput))
+        if zero_request is not None:
+            self.sparse_stats = (writer.bytes_written + writer.bytes_zeroed,
+                                 writer.bytes_skipped)
+            LOG.info("{} bytes of the image were written and {} bytes of "
+                     "zeroes were skipped".format(*self.sparse_stats))
+        # Verify if the checksum of the streamed image is correct
+        try:
+            _verify_image(image_info, device, image_download.hexdigests())
+            if _verify_writes(image_info):
+                self.verify_throughput = _read_back_image(
+                    image_info, device,
+                    image_download.progress.bytes(progress.WRITTEN))
+        except errors.ImageChecksumError:
+            if image_info.get('swarm') is not None:
+                image_swarm.unshare(_swarm_key(image_info))
+            raise
+        finally:
+            if checkpoint is not None:
+                checkpoint.remove()
+
+    def _splice_raw_image_onto_device(self, image_info, device, url):
+        """Streams a raw image to a device without copying it.
+
+        The image is moved from the socket to the device with splice, and
+        the device is flushed. The image is then read back from the device
+        to verify it against its chunk manifest or checksums.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+        :param url: The plain HTTP URL of the image.
+
+        :raises: ImageDownloadError if the image download fails after the
+                 transfer started.
+        :raises: ImageWriteError if writing the image fails.
+        :raises: ImageChecksumError if the image read back from the device
+                 does not match.
+        :raises: BlockDeviceError if the image cannot be read back.
+        :returns: False if the image server response cannot be moved without
+                  copies and nothing was written, otherwise True.
+        """
+        starttime = time.time()
+        try:
+            response = zero_copy.open_response(url)
+        except (zero_copy.Unavailable, zero_copy.ResponseError) as e:
+            LOG.warning('Unable to stream image %s from %s with zero-copy, '
+                        'streaming it as usual: %s', image_info['id'], url, e)
+            return False
+
+        _apply_download_rate(image_info)
+        image_progress = progress.ImageProgress(image_info['id'],
+                                                response.length)
+        base.report_progress(image_progress.to_dict)
+
+        def _received(amount):
+            image_progress.add(progress.RECEIVED, amount)
+            _download_limiter.consume(amount)
+
+        def _written(amount):
+            image_progress.add(progress.WRITTEN, amount)
+
+        LOG.info('Streaming image %s of %d bytes from %s onto device %s '
+                 'with zero-copy', image_info['id'], response.length, url,
+                 device)
+        try:
+            try:
+                fd = os.open(device, os.O_WRONLY)
+            except OSError as e:
+                raise errors.ImageWriteError(device, None, None, str(e))
+            try:
+                zero_copy.splice_body(response, fd, _received, _written)
+                os.fsync(fd)
+            except zero_copy.ResponseError as e:
+                msg = 'Unable to stream image from {}: {}'.format(url, e)
+                raise errors.ImageDownloadError(image_info['id'], msg)
+            except (IOError, OSError) as e:
+                raise errors.ImageWriteError(device, None, None, str(e))
+            finally:
+                os.close(fd)
+        finally:
+            response.close()
+
+        totaltime = time.time() - starttime
+        self.write_throughput = (float(response.length) / units.M /
+                                 max(totaltime, 1e-6))
+        LOG.info('Image streamed onto device %s with zero-copy in %s '
+                 'seconds: %s', device, totaltime, image_progress.summary())
+        # The checksums are computed from the device
+        self.verify_throughput = _read_back_image(image_info, device,
+                                                  response.length)
+        return True
+
+    def _stream_qcow2_image_onto_device(self, image_info, device):
+        """Streams a qcow2 image to specified local device.
+
+        The image is decoded while it is downloaded, so it is never staged
+        in the ramdisk.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageFormatError if the image cannot be decoded.
         :raises: ImageChecksumError if the checksum of the local image does not
              match the checksum as reported by glance in image_info.
+        :raises: ImageWriteError if existing partition tables cannot be
+                 erased.
         """
         starttime = time.time()
         image_download = ImageDownload(image_info, time_obj=starttime)
 
+        # Like the image converters, make sure no stale GPT backup header is
+        # left past the end of the new image. Partition images are written
+        # to a partition, where there is none.
+        if image_info.get('image_type') != 'partition':
+            try:
+                utils.execute('sgdisk', '-Z', device)
+            except processutils.ProcessExecutionError as e:
+                raise errors.ImageWriteError(device, e.exit_code, e.stdout,
+                                             e.stderr)
+
+        zero_request = _sparse_zero_request(image_info, device)
         with open(device, 'wb+') as f:
+            writer = image_writer.FileWriter(f, zero_request,
+                                             _writeback_window(image_info))
+            target = writer
+            if zero_request is not None:
+                target = image_writer.SparseWriter(writer)
+            decoder = qcow2.StreamingDecoder(
+                target, CONF.image_stream_spill_size * units.Mi)
             try:
-                for chunk in image_download:
-                    f.write(chunk)
+                _write_image_chunks(image_download, image_info, decoder.feed)
+                decoder.finish()
+                if zero_request is not None:
+                    target.flush()
             except Exception as e:
-                msg = 'Unable to write image to device {}. Error: {}'.format(
-                      device, str(e))
-                raise errors.ImageDownloadError(image_info['id'], msg)
+                raise _write_failure(image_info, device, e)
 
         totaltime = time.time() - starttime
-        LOG.info("Image streamed onto device {} in {} "
-                 "seconds".format(device, totaltime))
-        # Verify if the checksum of the streamed image is correct
-        _verify_image(image_info, device, image_download.md5sum())
+        LOG.info("qcow2 image streamed onto device {} in {} seconds, {} "
+                 "bytes written, {} bytes zeroed and {} bytes skipped: "
+                 "{}".format(device, totaltime, writer.bytes_written,
+                             writer.bytes_zeroed, writer.bytes_skipped,
+                             image_download.progress.summary()))
+        if zero_request is not None:
+            self.sparse_stats = (writer.bytes_written + writer.bytes_zeroed,
+                                 writer.bytes_skipped)
+        _verify_image(image_info, device, image_download.hexdigests())
+        if _verify_writes(image_info):
+            LOG.warning('Image %s is decoded while it is written to device '
+                        '%s, it cannot be read back and verified',
+                        image_info['id'], device)
+
+    def _stream_partition_image(self, image_info, device):
+        """Streams a partition image into the root partition of a device.
+
+        The partitions are created first, like for a partition image
+        staged in the ramdisk, then the image is streamed into the root
+        partition like a whole disk image, decoding it if it is a qcow2
+        image.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+
+        :raises: InvalidCommandParamsError if the root partition is too
+                 small for the image.
+        :raises: ImageWriteError if the partitions cannot be created.
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageFormatError if a qcow2 image cannot be decoded.
+        :raises: ImageChecksumError if the checksum of the image does not
+             match the checksum as reported by glance in image_info.
+        """
+        starttime = time.time()
+        uuids = _write_partition_image(None, image_info, device)
+        root_part = uuids['partitions']['root']
+        LOG.info('Streaming partition image %s into root partition %s of '
+                 'device %s', image_info['id'], root_part, device)
+        if image_info.get('disk_format') == 'qcow2':
+            self._stream_qcow2_image_onto_device(image_info, root_part)
+        else:
+            self._stream_raw_image_onto_device(image_info, root_part)
+        # The UUID of the root file system is only known once it is written
+        try:
+            uuids['root uuid'] = disk_utils.block_uuid(root_part)
+        except processutils.ProcessExecutionError as e:
+            raise errors.ImageWriteError(root_part, e.exit_code, e.stdout,
+                                         e.stderr)
+        self.partition_uuids = uuids
+        LOG.info('Partition image %s written to device %s in %s seconds',
+                 image_info['id'], device, time.time() - starttime)
+
+    def _write_image_delta(self, image_info, device):
+        """Writes only the blocks of an image which differ from a device.
+
+        On a redeploy, most blocks of the new image are usually already on
+        the device. The device is read and compared, chunk by chunk, with
+        the chunk manifest of the image. Only the differing chunks are
+        fetched, with parallel HTTP Range requests, verified against the
+        manifest and written, out of order, with direct I/O. The whole image
+        is then read back from the device and verified.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+        :raises: ImageDownloadError if a chunk cannot be fetched.
+        :raises: ImageChecksumError if a fetched chunk does not match the
+                 manifest, or if the image read back from the device once
+                 written does not match its checksums.
+        :raises: ImageWriteError if writing the chunks fails.
+        :raises: BlockDeviceError if the image cannot be read back.
+        :returns: False if the image cannot be written as a delta, and
+                  has not been written.
+        """
+        starttime = time.time()
+        url = image_info['urls'][0]
+        if image_info.get('compression'):
+            LOG.warning('Image %s is compressed, it cannot be deployed as a '
+                        'delta', image_info['id'])
+            return False
+        verifier = _ChunkVerifier.for_image(image_info, url)
+        if verifier is None:
+            LOG.warning('Image %s has no chunk manifest, it cannot be '
+                        'deployed as a delta', image_info['id'])
+            return False
+        try:
+            size = _remote_image_size(image_info, url)
+            device_size = _device_size(device)
+            if device_size < size:
+                LOG.warning('Device %s is smaller than image %s, which '
+                            'cannot be deployed as a delta', device,
+                            image_info['id'])
+                return False
+            LOG.info('Comparing device %s with the chunk manifest of image '
+                     '%s', device, image_info['id'])
+            indexes = _differing_chunks(image_info, device, verifier, size)
+        except (errors.ImageDownloadError, IOError, OSError) as e:
+            LOG.warning('Unable to deploy image %s to device %s as a delta, '
+                        'deploying the whole image: %s', image_info['id'],
+                        device, e)
+            return False
+
+        range_size = int(image_info.get('download_range_size') or
+                         CONF.image_download_range_size) * units.Mi
+        ranges = _delta_ranges(indexes, verifier.chunk_size, size,
+                               range_size)
+        fetched = sum(end - start + 1 for start, end in ranges)
+        LOG.info('%d of the %d chunks of image %s differ from device %s, '
+                 'fetching %d bytes in %d ranges', len(indexes),
+                 -(-size // verifier.chunk_size), image_info['id'], device,
+                 fetched, len(ranges))
+        image_progress = progress.ImageProgress(image_info['id'], fetched)
+        base.report_progress(image_progress.to_dict)
+        request_options = _request_options(image_info)
+        connections = int(image_info.get('download_connections') or
+                          CONF.image_download_connections)
+        # Every worker thread uses its own HTTP session
+        local = threading.local()
+        sessions = []
+
+        def _fetch(start, end):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+                sessions.append(session)
+            data = _fetch_byte_range(session, url, image_info['id'], start,
+                                     end, request_options)
+            _download_limiter.consume(len(data))
+            image_progress.add(progress.RECEIVED, len(data))
+            chunks = []
+            for offset in six.moves.range(0, len(data), verifier.chunk_size):
+                index = (start + offset) // verifier.chunk_size
+                chunks.append(verifier.check(
+                    index, data[offset:offset + verifier.chunk_size]))
+            image_progress.add(progress.HASHED, len(data))
+            return start, b''.join(chunks)
+
+        queue_depth, block_size = _direct_io_settings(image_info)
+        try:
+            writer = image_writer.DirectWriter(device, max(queue_depth, 1),
+                                               block_size)
+        except (IOError, OSError) as e:
+            raise errors.ImageWriteError(device, None, None, str(e))
+        workers = pool.ThreadPool(connections)
+        pending = collections.deque()
+
+        def _write_next():
+            offset, data = pending.popleft().get()
+            writer.write_at(offset, data)
+            image_progress.add(progress.WRITTEN, len(data))
+
+        try:
+            for start, end in ranges:
+                pending.append(workers.apply_async(_fetch, (start, end)))
+                if len(pending) > connections:
+                    _write_next()
+            while pending:
+                _write_next()
+            # Like sgdisk -Z, do not leave a stale GPT backup header at the
+            # end of the device.
+            tail = max(size, device_size - units.Mi)
+            writer.write_zeroes(tail, device_size - tail)
+            writer.close()
+        except errors.RESTError:
+            writer.abort()
+            raise
+        except Exception as e:
+            writer.abort()
+            raise errors.ImageWriteError(device, None, None, str(e))
+        finally:
+            workers.terminate()
+            for session in sessions:
+                session.close()
+
+        totaltime = time.time() - starttime
+        self.partition_uuids = {}
+        self.delta_stats = (fetched, size - fetched)
+        self.write_throughput = float(size) / units.M / max(totaltime, 1e-6)
+        LOG.info('Image %s deployed to device %s as a delta in %s seconds, '
+                 '%d bytes fetched and %d bytes saved: %s', image_info['id'],
+                 device, totaltime, fetched, size - fetched,
+                 image_progress.summary())
+        # The chunks left on the device were only compared with the chunk
+        # manifest, so the whole image is always read back and verified
+        # against its checksums, if it has any.
+        self.verify_throughput = _read_back_image(
+            image_info, device, size,
+            manifest=not _expected_checksums(image_info))
+        return True
+
+    def _fan_out_image(self, image_info, devices, stream,
+                       cached_image=_NOT_LOOKED_UP):
+        """Writes a whole disk image to several devices at once.
+
+        The image is downloaded, or taken from the image cache, once and its
+        checksums are computed once. Raw and qcow2 images are also decoded
+        once: every chunk of guest data is written to all devices
+        concurrently, by one writer thread per device, at the pace of the
+        slowest device. Images in other formats are written to one device
+        after the other with qemu-img.
+
+        :param image_info: Image information dictionary.
+        :param devices: A list of the disk names on which to store the
+                        image. Example: ['/dev/sda', '/dev/sdb']
+        :param stream: Whether to stream the image onto the devices rather
+                       than download it first.
+        :param cached_image: Optional. The result of _cached_image(), if the
+                             image was already looked up.
+
+        :raises: ImageDownloadError if the image download fails for any reason.
+        :raises: ImageChecksumError if the image's checksum does not match
+                 the one reported in image_info, or if the image is read
+                 back from a device and does not match.
+        :raises: ImageWriteError if writing the image fails.
+        :raises: ImageFormatError if a streamed qcow2 image cannot be
+                 decoded.
+        :raises: BlockDeviceError if the image cannot be read back.
+        """
+        starttime = time.time()
+        image = image_download = None
+        if stream:
+            image_download = ImageDownload(image_info, time_obj=starttime)
+            image_format = image_info.get('disk_format')
+            image_progress = image_download.progress
+        else:
+            image = self._local_image(image_info,
+                                      cached_image=cached_image)
+            image_format = disk_utils.qemu_img_info(image).file_format
+            image_progress = progress.ImageProgress(image_info['id'],
+                                                    os.path.getsize(image))
+        self.partition_uuids = {}
+
+        def _write_with_qemu_img():
+            qemu_image_info = dict(image_info, image_converter='qemu-img')
+            for device in devices:
+                _write_whole_disk_image(image, qemu_image_info, device)
+            self._read_back_devices(image_info, devices,
+                                    os.path.getsize(image))
+            self.cached_image_id = image_info['id']
+
+        if image_format not in image_convert.BuiltinConverter.formats:
+            LOG.info('Image %s is a %s image, writing it to devices %s one '
+                     'after the other with qemu-img', image_info['id'],
+                     image_format, ', '.join(devices))
+            _write_with_qemu_img()
+            return
+
+        if image_download is None:
+            base.report_progress(image_progress.to_dict)
+        _name, cache_mode, queue_depth, block_size, memory_limit = (
+            _convert_settings(image_info))
+        zero_requests = [_sparse_zero_request(image_info, device)
+                         for device in devices]
+        writers = []
+        try:
+            for device, zero_request in zip(devices, zero_requests):
+                image_convert.erase_partition_tables(device)
+                writers.append(image_convert.open_writer(
+                    device, cache_mode, queue_depth, block_size,
+                    zero_request, _writeback_window(image_info)))
+        except Exception as e:
+            for writer in writers:
+                writer.abort()
+            if isinstance(e, processutils.ProcessExecutionError):
+                raise errors.ImageWriteError(device, e.exit_code, e.stdout,
+                                             e.stderr)
+            if isinstance(e, (IOError, OSError)):
+                raise errors.ImageWriteError(device, None, None, str(e))
+            raise
+
+        LOG.info('Writing %s image %s to devices %s, with the %s cache mode',
+                 image_format, image_info['id'], ', '.join(devices),
+                 cache_mode)
+        fan_out = image_writer.FanOutWriter(writers)
+        spill_limit = memory_limit - len(devices) * (
+            image_convert.writer_memory(cache_mode, queue_depth, block_size))
+        try:
+            sink = image_convert.ImageSink(
+                fan_out, image_format, spill_limit,
+                sparse=any(z is not None for z in zero_requests))
+            if image_download is not None:
+                _write_image_chunks(image_download, image_info, sink.write)
+            else:
+                image_convert.copy_image(image, sink.write, image_progress)
+            sink.finish()
+        except errors.ImageFormatError as e:
+            fan_out.abort()
+            if image is None:
+                raise
+            LOG.warning('Image %s cannot be decoded, writing it to devices '
+                        '%s one after the other with qemu-img. Error: %s',
+                        image_info['id'], ', '.join(devices), e)
+            self.sparse_stats = None
+            _write_with_qemu_img()
+            return
+        except errors.RESTError:
+            fan_out.abort()
+            raise
+        except Exception as e:
+            fan_out.abort()
+            raise errors.ImageWriteError(', '.join(devices), None, None,
+                                         str(e))
+        try:
+            fan_out.close()
+        except Exception as e:
+            raise errors.ImageWriteError(', '.join(devices), None, None,
+                                         str(e))
+
+        totaltime = time.time() - starttime
+        LOG.info('Image %s written to devices %s in %s seconds: %s',
+                 image_info['id'], ', '.join(devices), totaltime,
+                 image_progress.summary())
+        written = fan_out.bytes_written + fan_out.bytes_zeroed
+        self.write_throughput = (float(written) / units.M /
+                                 max(totaltime, 1e-6))
+        if any(z is not None for z in zero_requests):
+            self.sparse_stats = (written, fan_out.bytes_skipped)
+        if image_download is not None:
+            _verify_image(image_info, ', '.join(devices),
+                          image_download.hexdigests())
+        else:
+            self.cached_image_id = image_info['id']
+        if image_format == 'raw':
+            self._read_back_devices(image_info, devices,
+                                    image_progress.bytes(progress.WRITTEN))
+        elif _verify_writes(image_info):
+            LOG.warning('Image %s is decoded while it is written to devices '
+                        '%s, it cannot be read back and verified',
+                        image_info['id'], ', '.join(devices))
+
+    def _read_back_devices(self, image_info, devices, size):
+        """Reads back an image from every device, if enabled.
+
+        The verify throughput is the one of the slowest device.
+
+        :param image_info: Image information dictionary.
+        :param devices: A list of the disk names the image was written to.
+        :param size: The size in bytes of the image.
+        :raises: ImageChecksumError if a device does not hold the image.
+        :raises: BlockDeviceError if the image cannot be read back.
+        """
+        if not _verify_writes(image_info):
+            return
+        for device in devices:
+            throughput = _read_back_image(image_info, device, size)
+            if throughput is not None:
+                self.verify_throughput = min(
+                    throughput, self.verify_throughput or throughput)
 
     @base.async_command('cache_image', _validate_image_info)
     def cache_image(self, image_info=None, force=False):
@@ -400,15 +3647,31 @@ class StandbyExtension(base.BaseAgentExtension):
         :raises: ImageWriteError if writing the image fails.
         """
         LOG.debug('Caching image %s', image_info['id'])
-        device = hardware.dispatch_to_managers('get_os_install_device')
+        devices = _install_devices(image_info)
+        device = ', '.join(devices)
 
         msg = 'image ({}) already present on device {} '
+        self.write_throughput = None
+        self.verify_throughput = None
+        self.sparse_stats = None
+        self.delta_stats = None
+        self.discard_stats = None
 
         if self.cached_image_id != image_info['id'] or force:
             LOG.debug('Already had %s cached, overwriting',
                       self.cached_image_id)
-            self._cache_and_write_image(image_info, device)
-            msg = 'image ({}) cached to device {} '
+            try:
+                if image_info.get('image_type') != 'partition':
+                    self.discard_stats = _discard_devices(image_info,
+                                                          devices)
+                if len(devices) > 1:
+                    self._fan_out_image(image_info, devices, False)
+                else:
+                    self._cache_and_write_image(image_info, devices[0])
+            finally:
+                _release_staged_image(image_info)
+                _discarded_devices.difference_update(devices)
+            msg = 'image ({}) cached to device {} ' + self._write_summary()
 
         result_msg = _message_format(msg, image_info, device,
                                      self.partition_uuids)
@@ -437,40 +3700,87 @@ class StandbyExtension(base.BaseAgentExtension):
         :raises: ImageChecksumError if the checksum of the local image does not
              match the checksum as reported by glance in image_info.
         :raises: ImageWriteError if writing the image fails.
+        :raises: ImageFormatError if a streamed qcow2 image cannot be decoded.
         :raises: InstanceDeployFailure if failed to create config drive.
              large to store on the given device.
         """
         LOG.debug('Preparing image %s', image_info['id'])
-        device = hardware.dispatch_to_managers('get_os_install_device')
+        devices = _install_devices(image_info)
+        device = devices[0]
+        configdrive_stage = None
+        # the configdrive creation is taken care by ironic-lib's
+        # work_on_disk().
+        if (image_info.get('image_type') != 'partition' and
+                configdrive is not None):
+            configdrive_stage = _ConfigDriveStage(configdrive, image_info)
 
         disk_format = image_info.get('disk_format')
         stream_raw_images = image_info.get('stream_raw_images', False)
+        stream_qcow2_images = strutils.bool_from_string(
+            image_info.get('stream_qcow2_images', CONF.stream_qcow2_images))
+        self.write_throughput = None
+        self.verify_throughput = None
+        self.sparse_stats = None
+        self.delta_stats = None
+        self.discard_stats = None
         # don't write image again if already cached
         if self.cached_image_id != image_info['id']:
             if self.cached_image_id is not None:
                 LOG.debug('Already had %s cached, overwriting',
                           self.cached_image_id)
 
-            if (stream_raw_images and disk_format == 'raw' and
-                image_info.get('image_type') != 'partition'):
-                self._stream_raw_image_onto_device(image_info, device)
-            else:
-                self._cache_and_write_image(image_info, device)
-
-        # the configdrive creation is taken care by ironic-lib's
-        # work_on_disk().
-        if image_info.get('image_type') != 'partition':
-            if configdrive is not None:
-                # Will use dummy value of 'local' for 'node_uuid',
-                # if it is not available. This is to handle scenario
-                # wherein new IPA is being used with older version
-                # of Ironic that did not pass 'node_uuid' in 'image_info'
-                node_uuid = image_info.get('node_uuid', 'local')
+            # a cached image is written from the cache instead of streamed
+            cached_image = self._cached_image(image_info)
+            cached = cached_image is not None
+            streamable = (image_info.get('image_type') != 'partition' and
+                          not cached)
+            delta = (len(devices) == 1 and streamable and
+                     disk_format == 'raw' and _delta_deploy(image_info))
+            stream_partition = (len(devices) == 1 and not cached and
+                                _stream_partition_images(image_info))
+            try:
+                # the delta is computed against the content of the device
+                if image_info.get('image_type') != 'partition' and not delta:
+                    self.discard_stats = _discard_devices(image_info,
+                                                          devices)
+                if delta and self._write_image_delta(image_info, device):
+                    LOG.debug('Image %s deployed as a delta',
+                              image_info['id'])
+                elif stream_partition:
+                    self._stream_partition_image(image_info, device)
+                elif len(devices) > 1:
+                    self._fan_out_image(
+                        image_info, devices, streamable and (
+                            (stream_raw_images and disk_format == 'raw') or
+                            (stream_qcow2_images and
+                             disk_format == 'qcow2')),
+                        cached_image=cached_image)
+                elif (stream_raw_images and disk_format == 'raw' and
+                      streamable):
+                    self._stream_raw_image_onto_device(image_info, device)
+                elif (stream_qcow2_images and disk_format == 'qcow2' and
+                      streamable):
+                    self._stream_qcow2_image_onto_device(image_info, device)
+                else:
+                    self._cache_and_write_image(image_info, device,
+                                                cached_image=cached_image)
+            finally:
+                _release_staged_image(image_info)
+                _discarded_devices.difference_update(devices)
+
+        if configdrive_stage is not None:
+            configdrive = configdrive_stage.wait()
+            # Will use dummy value of 'local' for 'node_uuid',
+            # if it is not available. This is to handle scenario
+            # wherein new IPA is being used with older version
+            # of Ironic that did not pass 'node_uuid' in 'image_info'
+            node_uuid = image_info.get('node_uuid', 'local')
+            for device in devices:
                 disk_utils.create_config_drive_partition(node_uuid,
                                                          device,
                                                          configdrive)
-        msg = 'image ({}) written to device {} '
-        result_msg = _message_format(msg, image_info, device,
+        msg = 'image ({}) written to device {} ' + self._write_summary()
+        result_msg = _message_format(msg, image_info, ', '.join(devices),
                                      self.partition_uuids)
         LOG.info(result_msg)
         return result_msg
@@ -517,6 +3827,37 @@ class StandbyExtension(base.BaseAgentExtension):
         LOG.info('Powering off system')
         self._run_shutdown_command('poweroff')
 
+    @base.sync_command('set_download_rate', allowed_while_busy=True)
+    def set_download_rate(self, rate=None):
+        """Change the rate limit of image downloads.
+
+        This command can be executed while an image is being downloaded,
+        to adjust the share of the image servers the agent uses. The rate
+        takes precedence over the rate of the images downloaded, including
+        images downloaded later, until it is cleared.
+
+        :param rate: The rate in MB/s, 0 for no limit, or None to clear the
+                     rate and limit downloads to the rate of the image
+                     again.
+        :raises: InvalidCommandParamsError if the rate is not None or a
+                 non-negative number.
+        """
+        global _download_rate_override
+        if rate is None:
+            LOG.info('Clearing the image download rate, limiting downloads '
+                     'to %s MB/s again', _image_download_rate / units.M)
+            _download_rate_override = None
+            _download_limiter.set_rate(_image_download_rate)
+            return
+        if (isinstance(rate, bool) or
+                not isinstance(rate, (float,) + six.integer_types) or
+                rate < 0):
+            raise errors.InvalidCommandParamsError(
+                'Download rate must be a non-negative number.')
+        LOG.info('Setting the image download rate to %s MB/s', rate)
+        _download_rate_override = rate * units.M
+        _download_limiter.set_rate(_download_rate_override)
+
     @base.sync_command('sync')
     def sync(self):
         """Flush file system buffers forcing changed blocks to disk.
@@ -524,9 +3865,13 @@ class StandbyExtension(base.BaseAgentExtension):
         :raises: CommandExecutionError if flushing file system buffers fails.
         """
         LOG.debug('Flushing file system buffers')
+        starttime = time.time()
         try:
-            utils.execute('sync')
+            with metrics_utils.get_metrics_logger(__name__).timer('sync'):
+                utils.execute('sync')
         except processutils.ProcessExecutionError as e:
             error_msg = 'Flushing file system buffers failed. Error: %s' % e
             LOG.error(error_msg)
             raise errors.CommandExecutionError(error_msg)
+        LOG.info('Flushed file system buffers in %.2f seconds',
+                 time.time() - starttime)
@@ -531,6 +531,9 @@ class HardwareManager(object):
     def get_os_install_device(self):
         raise errors.IncompatibleHardwareMethodError
 
+    def get_os_install_devices(self, root_device_hints):
+        raise errors.IncompatibleHardwareMethodError
+
     def get_bmc_address(self):
         raise errors.IncompatibleHardwareMethodError()
 
@@ -950,6 +953,36 @@ class GenericHardwareManager(HardwareManager):
 
             return device['name']
 
+    def get_os_install_devices(self, root_device_hints):
+        """Get every device matching root device hints.
+
+        Used to write the same image to several devices, such as the
+        members of a software mirror.
+
+        :param root_device_hints: A dictionary of root device hints.
+        :raises: DeviceNotFound if the hints are invalid or no device
+                 matches them.
+        :returns: A list of the names of the matching devices.
+        """
+        devices = []
+        for dev in self.list_block_devices():
+            try:
+                device = il_utils.match_root_device_hints([dev.serialize()],
+                                                          root_device_hints)
+            except ValueError as e:
+                raise errors.DeviceNotFound(
+                    'No devices could be found using the root device hints '
+                    '%(hints)s because they failed to validate. Error: '
+                    '%(error)s' % {'hints': root_device_hints, 'error': e})
+            if device:
+                devices.append(device['name'])
+
+        if not devices:
+            raise errors.DeviceNotFound(
+                "No suitable devices were found for "
+                "deployment using these hints %s" % root_device_hints)
+        return devices
+
     def get_system_vendor_info(self):
         product_name = None
         serial_number = None
@@ -0,0 +1,227 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A content-addressed cache of verified images on the local node."""
+
+import errno
+import hashlib
+import os
+import shutil
+
+from oslo_log import log
+import psutil
+
+LOG = log.getLogger(__name__)
+
+
+def _digest_size(algo):
+    try:
+        return hashlib.new(algo).digest_size
+    except ValueError:
+        return 0
+
+
+def cache_keys(checksums):
+    """Get the cache keys of an image from its expected checksums.
+
+    The keys are ordered from the strongest checksum to the weakest, by
+    digest size. Images are cached and looked up under the first key.
+
+    :param checksums: A list of (algorithm, checksum) tuples.
+    :returns: A list of cache keys, one per checksum.
+    """
+    checksums = sorted(checksums, key=lambda c: _digest_size(c[0]),
+                       reverse=True)
+    return ['{}-{}'.format(algo, value.lower()) for algo, value in checksums]
+
+
+def _free_space(directory):
+    """Get the number of bytes available in the file system of a directory.
+
+    :param directory: The path of the directory.
+    """
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class ImageCache(object):
+    """A cache of verified images, keyed by their checksums.
+
+    Images are kept as files named after their checksum, so that an image
+    is found again whatever its ID or URLs. Images are cached in memory,
+    normally on a tmpfs, and spill to a scratch directory on disk when
+    they would leave less free memory than the configured reserve. The
+    least recently used images are evicted to keep the total size of the
+    cache within its budget.
+
+    The modification time of a cached file records when it was last used.
+    """
+
+    def __init__(self, directory, size, scratch_dir=None, memory_reserve=0):
+        """Initialize an instance of the ImageCache class.
+
+        :param directory: The directory images are cached in, in memory.
+        :param size: The maximum total size of the cached images in bytes.
+        :param scratch_dir: Optional. The directory images which do not fit
+                            in memory are cached in.
+        :param memory_reserve: Optional. The number of bytes of memory to
+                               leave free when caching an image in memory.
+        """
+        self.directory = directory
+        self.size = size
+        self.scratch_dir = scratch_dir
+        self.memory_reserve = memory_reserve
+
+    def _directories(self):
+        directories = [self.directory]
+        if self.scratch_dir:
+            directories.append(self.scratch_dir)
+        return directories
+
+    def _entries(self):
+        """Get the cached images.
+
+        :returns: A list of (last use, size, path) tuples, from the least
+                  to the most recently used.
+        """
+        entries = []
+        for directory in self._directories():
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def lookup(self, keys):
+        """Find a cached image and mark it as used.
+
+        Only the first, strongest, key is looked up: an image cached under
+        a weaker checksum than the strongest one expected has not been
+        verified against it, and is not used.
+
+        :param keys: The cache keys of the image, from cache_keys().
+        :returns: The path of the cached image, or None if it is not cached.
+        """
+        if not keys:
+            return None
+        for directory in self._directories():
+            path = os.path.join(directory, keys[0])
+            try:
+                os.utime(path, None)
+            except OSError:
+                continue
+            LOG.info('Found image %s in the image cache', path)
+            return path
+        return None
+
+    def _evict(self, needed):
+        """Evict the least recently used images to make space.
+
+        :param needed: The number of bytes to make space for.
+        """
+        entries = self._entries()
+        used = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if used + needed <= self.size:
+                break
+            LOG.info('Evicting image %s of %d bytes from the image cache',
+                     path, size)
+            try:
+                os.unlink(path)
+            except OSError as e:
+                LOG.warning('Unable to evict image %s from the image cache: '
+                            '%s', path, e)
+                continue
+            used -= size
+
+    def _fits_in_memory(self, path, size):
+        """Get whether an image can be kept in memory.
+
+        :param path: The path of the image.
+        :param size: The size of the image in bytes.
+        """
+        try:
+            if os.stat(path).st_dev == os.stat(self.directory).st_dev:
+                # The image already takes up memory where it is
+                size = 0
+            available = psutil.virtual_memory().available
+            free = _free_space(self.directory)
+        except OSError as e:
+            LOG.warning('Unable to get the free memory of the image cache: '
+                        '%s', e)
+            return False
+        return size + self.memory_reserve <= min(available, free)
+
+    def add(self, path, keys):
+        """Add a verified image to the cache.
+
+        The image is moved into the cache: the returned path must be used
+        to read the image afterwards. When there is enough free memory,
+        the image is moved to the cache directory, which is a rename if it
+        is on the same file system. Otherwise, it is moved to the scratch
+        directory, if there is one, releasing the memory it used.
+
+        :param path: The path of the image.
+        :param keys: The cache keys of the image.
+        :returns: The path of the image, which is unchanged if the image
+                  could not be cached.
+        """
+        size = os.path.getsize(path)
+        if not keys or size > self.size:
+            LOG.info('Image %s of %d bytes is not cached, the image cache '
+                     'only holds %d bytes', path, size, self.size)
+            return path
+
+        self._evict(size)
+        try:
+            _makedirs(self.directory)
+            if self._fits_in_memory(path, size):
+                cached = os.path.join(self.directory, keys[0])
+                shutil.move(path, cached)
+            elif self.scratch_dir:
+                _makedirs(self.scratch_dir)
+                if size > _free_space(self.scratch_dir):
+                    LOG.warning('Image %s does not fit in memory nor in the '
+                                'image cache scratch directory %s', path,
+                                self.scratch_dir)
+                    return path
+                cached = os.path.join(self.scratch_dir, keys[0])
+                LOG.info('Image %s does not fit in memory, moving it to '
+                         'the image cache scratch directory %s', path,
+                         self.scratch_dir)
+                shutil.move(path, cached)
+            else:
+                LOG.info('Image %s is not cached, it does not fit in '
+                         'memory', path)
+                return path
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to add image %s to the image cache: %s',
+                        path, e)
+            return path
+        LOG.info('Image %s added to the image cache as %s', path, cached)
+        return cached
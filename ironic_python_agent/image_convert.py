@@ -0,0 +1,278 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Engines converting whole disk images onto block devices.
+
+Image converters are loaded with stevedore from the
+ironic_python_agent.image_converters entry point namespace, so that other
+engines can be plugged in. Two are provided: 'builtin', which decodes raw
+and qcow2 images in-process and writes them with a pool of direct I/O
+writer threads, and 'qemu-img', which handles every format qemu-img
+supports.
+"""
+
+from oslo_concurrency import processutils
+from oslo_log import log
+from oslo_utils import units
+import psutil
+from stevedore import driver
+
+from ironic_python_agent import image_writer
+from ironic_python_agent import progress
+from ironic_python_agent import qcow2
+from ironic_python_agent import utils
+
+LOG = log.getLogger(__name__)
+
+NAMESPACE = 'ironic_python_agent.image_converters'
+
+CACHE_MODES = ('none', 'directsync', 'writeback')
+"""The cache modes of the writes, named like the qemu-img cache modes."""
+
+QEMU_IMG_MIN_MEMORY = units.Gi
+"""The minimum address space qemu-img is allowed, as it used to be."""
+
+READ_SIZE = units.Mi
+
+
+def memory_budget(percent):
+    """Get the memory an image conversion may use.
+
+    :param percent: The percentage of the available memory to use.
+    :returns: The memory budget in bytes.
+    """
+    return psutil.virtual_memory().available * percent // 100
+
+
+def get_converter(name):
+    """Load an image converter.
+
+    :param name: The name of the entry point of the converter.
+    :raises: RuntimeError if no converter has this name.
+    :returns: An instance of the converter.
+    """
+    try:
+        return driver.DriverManager(NAMESPACE, name,
+                                    invoke_on_load=True).driver
+    except Exception as e:
+        raise RuntimeError('Unable to load image converter {}: {}'.format(
+            name, e))
+
+
+def erase_partition_tables(device):
+    """Erase the GPT and MBR data structures of a device.
+
+    This makes sure no stale GPT backup header is left past the end of the
+    new image.
+
+    :param device: The path of the device.
+    :raises: ProcessExecutionError if sgdisk fails.
+    """
+    utils.execute('sgdisk', '-Z', device)
+
+
+def open_writer(device, cache_mode, queue_depth, block_size,
+                zero_request=None, writeback_window=0):
+    """Open a writer for a device, according to a cache mode.
+
+    :param device: The path of the device.
+    :param cache_mode: One of CACHE_MODES.
+    :param queue_depth: The number of writes to keep outstanding.
+    :param block_size: The size in bytes of each write.
+    :param zero_request: Optional. BLKZEROOUT or BLKDISCARD, to zero ranges
+                         with an ioctl.
+    :param writeback_window: Optional. With 'writeback', the size in bytes
+                             of the windows of written data flushed while
+                             writing, or 0 to leave it for the kernel.
+    :raises: IOError or OSError if the device cannot be opened.
+    :returns: A DirectWriter, or a BufferedDeviceWriter for 'writeback'.
+    """
+    if cache_mode == 'writeback':
+        return image_writer.BufferedDeviceWriter(device, zero_request,
+                                                 writeback_window)
+    return image_writer.DirectWriter(device, queue_depth, block_size,
+                                     zero_request,
+                                     sync_writes=cache_mode == 'directsync')
+
+
+def writer_memory(cache_mode, queue_depth, block_size):
+    """Get the memory taken by the buffers of a writer from open_writer().
+
+    :param cache_mode: One of CACHE_MODES.
+    :param queue_depth: The number of writes to keep outstanding.
+    :param block_size: The size in bytes of each write.
+    """
+    if cache_mode == 'writeback':
+        return 0
+    return (queue_depth + 1) * block_size
+
+
+class ImageSink(object):
+    """Passes the guest data of an image to a writer.
+
+    qcow2 images are decoded, and blocks of zeroes are turned into
+    write_zeroes() calls if sparse. finish() must be called once the whole
+    image has been written.
+    """
+
+    def __init__(self, writer, image_format, spill_limit, sparse=False):
+        """Initialize an instance of the ImageSink class.
+
+        :param writer: The writer to pass the guest data to.
+        :param image_format: 'raw' or 'qcow2'.
+        :param spill_limit: The memory in bytes which may hold qcow2 host
+                            clusters stored before their tables.
+        :param sparse: Optional. Whether to skip blocks of zeroes.
+        """
+        self._target = writer
+        if sparse:
+            self._target = image_writer.SparseWriter(writer)
+        self._decoder = None
+        if image_format == 'qcow2':
+            self._decoder = qcow2.StreamingDecoder(self._target,
+                                                   max(spill_limit, 0))
+            self.write = self._decoder.feed
+        else:
+            self.write = self._target.write
+        self._sparse = sparse
+
+    def finish(self):
+        """Pass the end of the image to the writer.
+
+        :raises: ImageFormatError if a qcow2 image is truncated.
+        """
+        if self._decoder is not None:
+            self._decoder.finish()
+        if self._sparse:
+            self._target.flush()
+
+
+def copy_image(image, write, image_progress=None):
+    """Read an image file sequentially and pass it to a write function.
+
+    :param image: The path of the image file.
+    :param write: A callable taking a chunk of the image.
+    :param image_progress: Optional. An ImageProgress recording the bytes
+                           of the image read and written.
+    """
+    with open(image, 'rb') as source:
+        while True:
+            chunk = source.read(READ_SIZE)
+            if not chunk:
+                break
+            if image_progress is not None:
+                image_progress.add(progress.RECEIVED, len(chunk))
+            write(chunk)
+            if image_progress is not None:
+                image_progress.add(progress.WRITTEN, len(chunk))
+
+
+class BaseImageConverter(object):
+    """Base class of the image converters."""
+
+    formats = None
+    """The image formats the converter handles, or None for any format."""
+
+    def supports(self, image_format):
+        """Whether the converter handles an image format.
+
+        :param image_format: The format of the image, as reported by
+                             qemu-img.
+        """
+        return self.formats is None or image_format in self.formats
+
+    def convert(self, image, image_format, device, cache_mode, queue_depth,
+                block_size, memory_limit, zero_request=None,
+                image_progress=None, writeback_window=0):
+        """Write an image to a device.
+
+        :param image: The path of the image file.
+        :param image_format: The format of the image.
+        :param device: The path of the device.
+        :param cache_mode: One of CACHE_MODES.
+        :param queue_depth: The number of writes to keep outstanding.
+        :param block_size: The size in bytes of each write.
+        :param memory_limit: The memory the conversion may use, in bytes.
+        :param zero_request: Optional. BLKZEROOUT or BLKDISCARD, to skip
+                             blocks of zeroes and zero them with an ioctl.
+        :param image_progress: Optional. An ImageProgress recording the
+                               bytes of the image read and written.
+        :param writeback_window: Optional. With the 'writeback' cache mode,
+                                 the size in bytes of the windows of
+                                 written data flushed while writing, or 0
+                                 to leave it for the kernel.
+        :raises: ProcessExecutionError if a command fails.
+        :raises: IOError or OSError if reading or writing fails.
+        :raises: ImageFormatError if the image cannot be decoded.
+        :returns: A tuple of the number of bytes written, zeroed and
+                  skipped, or None if unknown.
+        """
+        raise NotImplementedError()
+
+
+class QemuImgConverter(BaseImageConverter):
+    """Converts images with qemu-img."""
+
+    def convert(self, image, image_format, device, cache_mode, queue_depth,
+                block_size, memory_limit, zero_request=None,
+                image_progress=None, writeback_window=0):
+        erase_partition_tables(device)
+        limits = processutils.ProcessLimits(
+            address_space=max(memory_limit, QEMU_IMG_MIN_MEMORY))
+        LOG.info('Converting image %s to device %s with qemu-img, with '
+                 'the %s cache mode', image, device, cache_mode)
+        utils.execute('qemu-img', 'convert', '-t', cache_mode,
+                      '-O', 'host_device', image, device, prlimit=limits)
+        utils.execute('sync')
+        return None
+
+
+class BuiltinConverter(BaseImageConverter):
+    """Converts raw and qcow2 images in-process.
+
+    The image is read sequentially. Its guest data, decoded from qcow2 if
+    needed, is staged into buffers written by queue_depth threads, which
+    complete in any order. With the 'none' and 'directsync' cache modes,
+    the device is written with direct I/O, with every write being synced
+    with 'directsync', and the device is flushed once the image has been
+    written. With 'writeback', writes go through the page cache, and are
+    flushed progressively if a writeback_window is given.
+
+    Host clusters of a qcow2 image stored before the tables referencing
+    them are kept in the memory left over by the write buffers.
+    """
+
+    formats = ('raw', 'qcow2')
+
+    def convert(self, image, image_format, device, cache_mode, queue_depth,
+                block_size, memory_limit, zero_request=None,
+                image_progress=None, writeback_window=0):
+        erase_partition_tables(device)
+        LOG.info('Converting %s image %s to device %s, with the %s cache '
+                 'mode and %d outstanding writes of %d bytes', image_format,
+                 image, device, cache_mode, queue_depth, block_size)
+        writer = open_writer(device, cache_mode, queue_depth, block_size,
+                             zero_request, writeback_window)
+        try:
+            sink = ImageSink(
+                writer, image_format,
+                memory_limit - writer_memory(cache_mode, queue_depth,
+                                             block_size),
+                sparse=zero_request is not None)
+            copy_image(image, sink.write, image_progress)
+            sink.finish()
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return (writer.bytes_written, writer.bytes_zeroed,
+                writer.bytes_skipped)
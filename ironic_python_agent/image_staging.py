@@ -0,0 +1,203 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Staging of the images downloaded before being written.
+
+Images are staged in memory, on the tmpfs of the ramdisk, when they fit in
+the free memory. Otherwise, they are staged in a scratch directory on a
+local disk, if one is configured, or at the end of the device the image is
+written to, through a loop device.
+"""
+
+import errno
+import os
+
+from ironic_lib import utils as ironic_utils
+from oslo_concurrency import processutils
+from oslo_log import log
+from oslo_utils import units
+import psutil
+
+from ironic_python_agent import utils
+
+LOG = log.getLogger(__name__)
+
+MEMORY_DIR = '/tmp'
+
+TAIL_ALIGNMENT = units.Mi
+"""The alignment of the staging area at the end of a device."""
+
+TAIL_MARGIN = units.Mi
+"""The space left at the end of a device, holding the GPT backup header."""
+
+
+def _free_space(directory):
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _device_size(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def fits_in_memory(size, reserve):
+    """Get whether an image can be staged in memory.
+
+    :param size: The size of the image in bytes.
+    :param reserve: The number of bytes of memory to leave free.
+    """
+    try:
+        free = min(psutil.virtual_memory().available,
+                   _free_space(MEMORY_DIR))
+    except OSError as e:
+        LOG.warning('Unable to get the free memory of %s: %s', MEMORY_DIR, e)
+        return False
+    return size + reserve <= free
+
+
+def _tail_offset(device, size):
+    """Get the offset of a staging area at the end of a device.
+
+    The staging area must not overlap the first size bytes of the device,
+    where a raw image of the same size is written from it.
+
+    :param device: The path of the device.
+    :param size: The size of the image in bytes.
+    :returns: The offset, or None if the device is too small.
+    """
+    try:
+        device_size = _device_size(device)
+    except OSError as e:
+        LOG.warning('Unable to get the size of device %s: %s', device, e)
+        return None
+    offset = (device_size - size - TAIL_MARGIN) // TAIL_ALIGNMENT
+    offset *= TAIL_ALIGNMENT
+    if offset < size:
+        return None
+    return offset
+
+
+class StagedImage(object):
+    """The location an image is staged in before it is written."""
+
+    def __init__(self, path, size=None, device=None, offset=None,
+                 temporary=False):
+        """Initialize an instance of the StagedImage class.
+
+        :param path: The path of the file or loop device the image is
+                     staged in.
+        :param size: Optional. The size of the image in bytes, if known.
+        :param device: Optional. The device the image is staged at the end
+                       of, through the loop device at path.
+        :param offset: Optional. The offset of the image on device.
+        :param temporary: Optional. Whether the file is removed once the
+                          image has been written.
+        """
+        self.path = path
+        self.size = size
+        self.device = device
+        self.offset = offset
+        self.temporary = temporary
+
+    def release(self):
+        """Release the staging area once the image has been written."""
+        if self.device is not None:
+            try:
+                utils.execute('losetup', '--detach', self.path)
+            except processutils.ProcessExecutionError as e:
+                LOG.warning('Unable to detach loop device %s: %s',
+                            self.path, e)
+        elif self.temporary:
+            ironic_utils.unlink_without_raise(self.path)
+
+
+def _stage_on_device(name, size, device):
+    """Stage an image at the end of a device.
+
+    :param name: The name of the image.
+    :param size: The size of the image in bytes.
+    :param device: The path of the device.
+    :returns: A StagedImage, or None if the image cannot be staged there.
+    """
+    offset = _tail_offset(device, size)
+    if offset is None:
+        LOG.info('Device %s is too small to stage image %s of %d bytes at '
+                 'its end', device, name, size)
+        return None
+    try:
+        stdout, _stderr = utils.execute(
+            'losetup', '--find', '--show', '--offset', str(offset),
+            '--sizelimit', str(size), device)
+    except processutils.ProcessExecutionError as e:
+        LOG.warning('Unable to set up a loop device at the end of device '
+                    '%s: %s', device, e)
+        return None
+    path = stdout.strip()
+    LOG.info('Staging image %s of %d bytes at offset %d of device %s, '
+             'through loop device %s', name, size, offset, device, path)
+    return StagedImage(path, size, device=device, offset=offset)
+
+
+def allocate(name, size, memory_reserve, scratch_dir=None, device=None):
+    """Choose where to stage an image.
+
+    The image is staged in memory when it fits, leaving memory_reserve
+    bytes free, or when its size is unknown. Otherwise it is staged in the
+    scratch directory, then at the end of the device, if given and if
+    there is room. When no staging area fits, the image is staged in
+    memory anyway.
+
+    :param name: The name of the image, used as its file name.
+    :param size: The size of the image in bytes, or None if unknown.
+    :param memory_reserve: The number of bytes of memory to leave free.
+    :param scratch_dir: Optional. A directory on a local disk to stage
+                        images in.
+    :param device: Optional. The device the image is written to, at the
+                   end of which it may be staged.
+    :returns: A StagedImage.
+    """
+    memory_path = os.path.join(MEMORY_DIR, name)
+    if size is None or fits_in_memory(size, memory_reserve):
+        return StagedImage(memory_path, size)
+
+    if scratch_dir:
+        try:
+            os.makedirs(scratch_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                LOG.warning('Unable to create the staging directory %s: %s',
+                            scratch_dir, e)
+        try:
+            fits = size <= _free_space(scratch_dir)
+        except OSError as e:
+            LOG.warning('Unable to get the free space of the staging '
+                        'directory %s: %s', scratch_dir, e)
+            fits = False
+        if fits:
+            LOG.info('Image %s of %d bytes does not fit in memory, staging '
+                     'it in %s', name, size, scratch_dir)
+            return StagedImage(os.path.join(scratch_dir, name), size,
+                               temporary=True)
+
+    if device is not None:
+        staged = _stage_on_device(name, size, device)
+        if staged is not None:
+            return staged
+
+    LOG.warning('Image %s of %d bytes does not fit in memory and no other '
+                'staging area is available, staging it in memory anyway',
+                name, size)
+    return StagedImage(memory_path, size)
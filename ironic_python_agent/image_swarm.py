@@ -0,0 +1,195 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sharing of verified image chunks between agents deploying an image.
+
+Agents deploying the same image, with a chunk manifest, serve the chunks
+they have already verified and written to other agents over the agent API,
+at /v1/images/<key>/<index>. Other agents fetch chunks from these peers
+first, and only fall back to the image URLs for chunks no peer could
+provide.
+"""
+
+import threading
+
+from oslo_log import log
+import requests
+import six
+
+LOG = log.getLogger(__name__)
+
+_shared_images = {}
+_lock = threading.Lock()
+
+
+class SharedImage(object):
+    """An image, or part of an image, which can be served to peers.
+
+    Chunks are only recorded once they have been written to the file or
+    device holding the image, so that they can be read back from it.
+    """
+
+    def __init__(self, path, chunk_size):
+        """Initialize an instance of the SharedImage class.
+
+        :param path: The path of the file or device holding the image.
+        :param chunk_size: The size in bytes of the chunks of the image.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self._lengths = {}
+        self._position = 0
+
+    def wrap(self, write, offset=0, flush=None):
+        """Wrap a write function to record the chunks written through it.
+
+        :param write: A callable taking the next chunk of the image.
+        :param offset: Optional. The offset in bytes of the first byte
+                       written. The chunks before it are recorded as
+                       already written.
+        :param flush: Optional. A callable making the data written so far
+                      readable from the path of the image.
+        :returns: A callable taking the next chunk of the image.
+        """
+        self._position = offset
+        for index in six.moves.range(offset // self.chunk_size):
+            self._lengths[index] = self.chunk_size
+
+        def _write(data):
+            write(data)
+            start = self._position
+            self._position += len(data)
+            if self._position // self.chunk_size > start // self.chunk_size:
+                if flush is not None:
+                    flush()
+                for index in six.moves.range(start // self.chunk_size,
+                                             self._position //
+                                             self.chunk_size):
+                    self._lengths[index] = self.chunk_size
+        return _write
+
+    def finish(self):
+        """Record the last, possibly partial, chunk of the image."""
+        remainder = self._position % self.chunk_size
+        if remainder:
+            self._lengths[self._position // self.chunk_size] = remainder
+
+    def read_chunk(self, index):
+        """Read a chunk of the image.
+
+        :param index: The index of the chunk.
+        :returns: The content of the chunk, or None if it is not available.
+        """
+        length = self._lengths.get(index)
+        if length is None:
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(index * self.chunk_size)
+                data = f.read(length)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to read chunk %d of shared image %s: %s',
+                        index, self.path, e)
+            return None
+        if len(data) != length:
+            return None
+        return data
+
+
+def share(key, shared_image):
+    """Start serving the chunks of an image to peers.
+
+    Any other image shared from the same path is no longer shared, as it is
+    being overwritten.
+
+    :param key: The key the image is shared as.
+    :param shared_image: A SharedImage object.
+    """
+    with _lock:
+        for other in [k for k, v in _shared_images.items()
+                      if v.path == shared_image.path]:
+            del _shared_images[other]
+        _shared_images[key] = shared_image
+    LOG.info('Sharing image %s from %s with peers', key, shared_image.path)
+
+
+def move(path, new_path):
+    """Record that the images shared from a path have been moved.
+
+    :param path: The path the images were shared from.
+    :param new_path: The path the images are now at.
+    """
+    with _lock:
+        for shared_image in _shared_images.values():
+            if shared_image.path == path:
+                shared_image.path = new_path
+
+
+def unshare(key):
+    """Stop serving the chunks of an image to peers.
+
+    :param key: The key the image is shared as.
+    """
+    with _lock:
+        _shared_images.pop(key, None)
+
+
+def get_shared_image(key):
+    """Get a shared image.
+
+    :param key: The key the image is shared as.
+    :returns: A SharedImage object, or None if the image is not shared.
+    """
+    with _lock:
+        return _shared_images.get(key)
+
+
+def chunk_url(peer, key, index):
+    """Get the URL of a chunk of an image on a peer.
+
+    :param peer: The base URL of the agent API of the peer, for example
+                 'http://10.0.0.5:9999'.
+    :param key: The key the image is shared as.
+    :param index: The index of the chunk.
+    """
+    return '{}/v1/images/{}/{}'.format(peer.rstrip('/'), key, index)
+
+
+def discover_peers(swarm, key, request_options):
+    """Get the peers which may hold chunks of an image.
+
+    The peers are the 'peers' seed list of the swarm information, followed
+    by the peers returned by its 'tracker' URL. The tracker is queried with
+    the key of the image in the 'image' parameter, and must return a JSON
+    document with a list of the base URLs of the peers in its 'peers' field.
+
+    :param swarm: The swarm information dictionary of the image.
+    :param key: The key the image is shared as.
+    :param request_options: The keyword arguments to pass to requests.
+    :returns: A list of base URLs of the agent API of peers.
+    """
+    peers = list(swarm.get('peers') or [])
+    tracker = swarm.get('tracker')
+    if tracker:
+        try:
+            resp = requests.get(tracker, params={'image': key},
+                                **request_options)
+            resp.raise_for_status()
+            peers.extend(resp.json().get('peers') or [])
+        except (requests.RequestException, ValueError, AttributeError) as e:
+            LOG.warning('Unable to get the peers of image %s from tracker '
+                        '%s: %s', key, tracker, e)
+    unique = []
+    for peer in peers:
+        if peer not in unique:
+            unique.append(peer)
+    return unique
@@ -0,0 +1,1033 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writers used to put image data onto a local file or block device.
+
+Written image data can be read back with read_back(), to verify that the
+device holds it.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+from multiprocessing import pool
+import os
+import stat
+import struct
+import threading
+
+from oslo_log import log
+from oslo_utils import units
+from six.moves import queue
+
+LOG = log.getLogger(__name__)
+
+# Largest single write issued when filling a range with zeroes
+ZERO_CHUNK_SIZE = units.Mi
+
+# ioctl returning the logical sector size of a block device
+BLKSSZGET = 0x1268
+
+# ioctls discarding or zeroing a byte range of a block device
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+DISCARDED = -1
+"""The zero request of devices discarded before being written, whose
+discarded blocks read back as zeroes, so ranges are zeroed by skipping
+them."""
+
+# The number of bytes discarded by each BLKDISCARD ioctl, at most, and the
+# number of ioctls issued in parallel
+DISCARD_CHUNK_SIZE = units.Gi
+DISCARD_THREADS = 4
+
+# Granularity at which runs of zeroes are detected in image data
+SPARSE_BLOCK_SIZE = 64 * units.Ki
+
+# Alignment used for direct I/O when the sector size cannot be queried
+DEFAULT_ALIGNMENT = 4096
+
+# Number of operations queued for every writer of a FanOutWriter
+FAN_OUT_QUEUE_SIZE = 8
+
+# sync_file_range() flags
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+POSIX_FADV_DONTNEED = 4
+
+_STOP = object()
+
+_libc = None
+
+
+def _get_libc():
+    """Load the C library, used for positional reads and writes.
+
+    os.pread(), os.pwrite() and os.splice() are not available on every
+    supported Python version, and calling them through ctypes also releases
+    the GIL for the duration of the I/O.
+    """
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        for function in (libc.pread, libc.pwrite):
+            function.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_int64]
+            function.restype = ctypes.c_ssize_t
+        if hasattr(libc, 'sync_file_range'):
+            libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                             ctypes.c_int64, ctypes.c_uint]
+            libc.sync_file_range.restype = ctypes.c_int
+        libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                       ctypes.c_int64, ctypes.c_int]
+        libc.posix_fadvise.restype = ctypes.c_int
+        if hasattr(libc, 'splice'):
+            libc.splice.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_int, ctypes.c_void_p,
+                                    ctypes.c_size_t, ctypes.c_uint]
+            libc.splice.restype = ctypes.c_ssize_t
+        _libc = libc
+    return _libc
+
+
+def _sector_size(fd):
+    """Get the alignment required for direct I/O on a file descriptor.
+
+    :param fd: An open file descriptor.
+    :returns: The logical sector size of the block device, or
+              DEFAULT_ALIGNMENT if fd does not refer to a block device.
+    """
+    try:
+        result = fcntl.ioctl(fd, BLKSSZGET, struct.pack('i', 0))
+    except (IOError, OSError):
+        return DEFAULT_ALIGNMENT
+    return struct.unpack('i', result)[0] or DEFAULT_ALIGNMENT
+
+
+def _read_queue_attribute(queue_dir, name):
+    try:
+        with open(os.path.join(queue_dir, name)) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _queue_dir(path):
+    """Get the sysfs directory of the request queue of a block device.
+
+    :param path: The path of the device.
+    :returns: The path of the directory, or None if path is not a block
+              device.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+
+    sysfs_dir = '/sys/dev/block/{}:{}'.format(os.major(st.st_rdev),
+                                              os.minor(st.st_rdev))
+    queue_dir = os.path.join(sysfs_dir, 'queue')
+    if not os.path.isdir(queue_dir):
+        # Partitions share the queue of their parent device
+        queue_dir = os.path.join(sysfs_dir, '..', 'queue')
+    return queue_dir
+
+
+def get_zero_request(path):
+    """Find out how a range of a device can be cheaply zeroed.
+
+    A range is only zeroed without writing zeroes to it if the device
+    guarantees that reads return zeroes afterwards: either it supports
+    offloading BLKZEROOUT with a write zeroes command, or it reports that
+    discarded blocks read back as zeroes.
+
+    :param path: The path of the device.
+    :returns: BLKZEROOUT, BLKDISCARD or None if there is no cheap way of
+              zeroing a range of the device.
+    """
+    queue_dir = _queue_dir(path)
+    if queue_dir is None:
+        return None
+
+    if _read_queue_attribute(queue_dir, 'write_zeroes_max_bytes') > 0:
+        return BLKZEROOUT
+    if (_read_queue_attribute(queue_dir, 'discard_max_bytes') > 0 and
+            _read_queue_attribute(queue_dir, 'discard_zeroes_data') == 1):
+        return BLKDISCARD
+    return None
+
+
+def discard_device(path, threads=DISCARD_THREADS,
+                   chunk_size=DISCARD_CHUNK_SIZE):
+    """Discard all the blocks of a device.
+
+    Support is detected from the discard_* attributes of the request queue
+    of the device. The device is discarded with BLKDISCARD ioctls of at
+    most chunk_size bytes, or what the device accepts at once, issued by a
+    pool of threads.
+
+    :param path: The path of the device.
+    :param threads: Optional. The number of ioctls issued in parallel.
+    :param chunk_size: Optional. The size in bytes of every ioctl, at most.
+    :raises: IOError or OSError if discarding fails.
+    :returns: A tuple of the number of bytes discarded, 0 if the device
+              does not support discard, and whether the device guarantees
+              that discarded blocks read back as zeroes.
+    """
+    queue_dir = _queue_dir(path)
+    if queue_dir is None:
+        return 0, False
+    max_bytes = _read_queue_attribute(queue_dir, 'discard_max_bytes')
+    if max_bytes <= 0:
+        return 0, False
+    granularity = max(_read_queue_attribute(queue_dir,
+                                            'discard_granularity'),
+                      DEFAULT_ALIGNMENT)
+    chunk_size = max(min(chunk_size, max_bytes) // granularity, 1)
+    chunk_size *= granularity
+    # Always 0 since Linux 4.12, which no longer reports the guarantee
+    zeroes = _read_queue_attribute(queue_dir, 'discard_zeroes_data') == 1
+
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+
+        def _discard(offset):
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack(
+                'QQ', offset, min(chunk_size, size - offset)))
+
+        workers = pool.ThreadPool(threads)
+        try:
+            workers.map(_discard, range(0, size, chunk_size))
+        finally:
+            workers.terminate()
+            workers.join()
+    finally:
+        os.close(fd)
+    return size, zeroes
+
+
+def _zero_fd_range(fd, request, offset, length):
+    """Zero the page aligned part of a byte range with an ioctl.
+
+    :param fd: A file descriptor of a block device.
+    :param request: BLKZEROOUT, BLKDISCARD or DISCARDED, in which case the
+                    whole range already reads back as zeroes.
+    :param offset: The offset in bytes of the start of the range.
+    :param length: The length in bytes of the range.
+    :returns: A tuple of the start and end offsets of the zeroed part of
+              the range, which are equal if nothing was zeroed.
+    """
+    if request == DISCARDED:
+        return offset, offset + length
+    start = -(-offset // DEFAULT_ALIGNMENT) * DEFAULT_ALIGNMENT
+    end = (offset + length) // DEFAULT_ALIGNMENT * DEFAULT_ALIGNMENT
+    if end <= start:
+        return offset, offset
+    fcntl.ioctl(fd, request, struct.pack('QQ', start, end - start))
+    return start, end
+
+
+class WritebackController(object):
+    """Flushes data written through the page cache behind the writer.
+
+    Every time a window of data has been written past the flushed part of
+    the file, writeback of that window is started with sync_file_range(),
+    then the previous window is waited for and dropped from the page cache
+    with posix_fadvise(). The dirty pages of the writer are thus bounded to
+    about two windows, the cost of flushing them is spread over the
+    transfer, and the final sync only has the last windows left to write.
+
+    Data written behind the flushed part of the file, out of order, is left
+    for the final sync.
+    """
+
+    def __init__(self, fd, window):
+        """Initialize an instance of the WritebackController class.
+
+        :param fd: The file descriptor the data is written to.
+        :param window: The size in bytes of the windows flushed at once.
+        """
+        self._fd = fd
+        self._window = window
+        self._position = 0
+        self._flushed = 0
+        self._previous = None
+        libc = _get_libc()
+        self._sync_file_range = getattr(libc, 'sync_file_range', None)
+        self._fadvise = libc.posix_fadvise
+        if self._sync_file_range is None:
+            LOG.warning('sync_file_range() is not available, written data '
+                        'is left for the kernel to flush')
+
+    def _call(self, function, *args):
+        if function(self._fd, *args) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def wrote(self, offset, length):
+        """Record that data was written, flushing the windows behind it.
+
+        :param offset: The offset in bytes the data was written at.
+        :param length: The length in bytes of the data.
+        """
+        if self._sync_file_range is None:
+            return
+        self._position = max(self._position, offset + length)
+        while self._position - self._flushed >= self._window:
+            start = self._flushed
+            try:
+                self._call(self._sync_file_range, start, self._window,
+                           SYNC_FILE_RANGE_WRITE)
+                if self._previous is not None:
+                    self._call(self._sync_file_range, self._previous,
+                               self._window,
+                               SYNC_FILE_RANGE_WAIT_BEFORE |
+                               SYNC_FILE_RANGE_WRITE |
+                               SYNC_FILE_RANGE_WAIT_AFTER)
+                    # posix_fadvise() returns the error number
+                    error = self._fadvise(self._fd, self._previous,
+                                          self._window, POSIX_FADV_DONTNEED)
+                    if error:
+                        raise OSError(error, os.strerror(error))
+            except OSError as e:
+                LOG.warning('Unable to flush written data progressively, '
+                            'it is left for the kernel to flush: %s', e)
+                self._sync_file_range = None
+                return
+            self._previous = start
+            self._flushed += self._window
+
+
+class FileWriter(object):
+    """Writes image data to an already opened file or block device.
+
+    Data can either be appended at the current position with write(), or
+    placed at an absolute offset with write_at(), which is what image
+    decoders producing out-of-order guest data need.
+
+    If a zero_request is given, ranges passed to write_zeroes() are zeroed
+    with that ioctl rather than by writing zeroes, and are counted in
+    bytes_skipped instead of bytes_zeroed.
+
+    If a writeback_window is given, the written data is flushed
+    progressively by a WritebackController.
+    """
+
+    def __init__(self, fileobj, zero_request=None, writeback_window=0):
+        """Initialize an instance of the FileWriter class.
+
+        :param fileobj: A file object opened for writing in binary mode.
+        :param zero_request: Optional. BLKZEROOUT or BLKDISCARD, as returned
+                             by get_zero_request(), or DISCARDED.
+        :param writeback_window: Optional. The size in bytes of the windows
+                                 of written data flushed at once, or 0 to
+                                 leave the data for the kernel to flush.
+        """
+        self._file = fileobj
+        self._zero_request = zero_request
+        self._zeroes = None
+        self._writeback = None
+        if writeback_window:
+            self._writeback = WritebackController(fileobj.fileno(),
+                                                  writeback_window)
+        self.bytes_written = 0
+        self.bytes_zeroed = 0
+        self.bytes_skipped = 0
+
+    def _wrote(self, length):
+        if self._writeback is not None:
+            # The file object buffers at most a few pages
+            self._file.flush()
+            self._writeback.wrote(self._file.tell() - length, length)
+
+    def write(self, data):
+        """Write data at the current position.
+
+        :param data: The data to write, as bytes or a buffer object.
+        """
+        self._file.write(data)
+        self.bytes_written += len(data)
+        self._wrote(len(data))
+
+    def write_at(self, offset, data):
+        """Write data at an absolute offset.
+
+        :param offset: The offset in bytes to write the data at.
+        :param data: The data to write, as bytes or a buffer object.
+        """
+        self._file.seek(offset)
+        self.write(data)
+
+    def write_zeroes(self, offset, length):
+        """Fill a range with zeroes.
+
+        :param offset: The offset in bytes of the start of the range.
+        :param length: The length in bytes of the range.
+        """
+        if self._zero_request is not None:
+            self._file.flush()
+            try:
+                start, end = _zero_fd_range(self._file.fileno(),
+                                            self._zero_request, offset,
+                                            length)
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to zero a range of the device, zeroes '
+                            'will be written instead. Error: %s', e)
+                self._zero_request = None
+            else:
+                self.bytes_skipped += end - start
+                self._fill(offset, start - offset)
+                self._fill(end, offset + length - end)
+                return
+        self._fill(offset, length)
+
+    def _fill(self, offset, length):
+        if self._zeroes is None:
+            self._zeroes = bytes(bytearray(ZERO_CHUNK_SIZE))
+        self._file.seek(offset)
+        while length > 0:
+            size = min(length, ZERO_CHUNK_SIZE)
+            self._file.write(self._zeroes[:size])
+            self.bytes_zeroed += size
+            self._wrote(size)
+            length -= size
+
+
+class BufferedDeviceWriter(FileWriter):
+    """A FileWriter opening the device it writes to through the page cache.
+
+    Like DirectWriter, it must be finished with close(), or with abort()
+    after an error.
+    """
+
+    def __init__(self, path, zero_request=None, writeback_window=0):
+        """Initialize an instance of the BufferedDeviceWriter class.
+
+        :param path: The path of the device or file to write to.
+        :param zero_request: Optional. BLKZEROOUT or BLKDISCARD, as returned
+                             by get_zero_request(), or DISCARDED.
+        :param writeback_window: Optional. The size in bytes of the windows
+                                 of written data flushed at once, or 0 to
+                                 leave the data for the kernel to flush.
+        """
+        fileobj = open(path, 'wb+')
+        try:
+            super(BufferedDeviceWriter, self).__init__(fileobj, zero_request,
+                                                       writeback_window)
+        except Exception:
+            fileobj.close()
+            raise
+
+    def close(self):
+        """Flush the written data to the device and close it."""
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+    def abort(self):
+        """Close the device, without waiting for the written data."""
+        self._file.close()
+
+
+class AlignedBuffer(object):
+    """A reusable buffer whose memory is suitably aligned for direct I/O."""
+
+    def __init__(self, size, alignment):
+        """Initialize an instance of the AlignedBuffer class.
+
+        :param size: The size of the buffer in bytes.
+        :param alignment: The required alignment of the buffer address.
+        """
+        self._storage = bytearray(size + alignment)
+        address = ctypes.addressof(ctypes.c_char.from_buffer(self._storage))
+        padding = -address % alignment
+        self.address = address + padding
+        self.size = size
+        # The exported view also prevents the storage from being resized,
+        # which keeps self.address valid.
+        self.view = memoryview(self._storage)[padding:padding + size]
+
+
+class DirectWriter(object):
+    """Writes image data to a block device using direct I/O.
+
+    The device is opened with O_DIRECT so that image data bypasses the
+    page cache. Data is staged into aligned, reusable buffers of
+    block_size bytes, and full buffers are written by a pool of
+    queue_depth threads, so that several writes at different offsets are
+    outstanding at the same time. Writes which are not aligned to the
+    sector size of the device, such as the tail of an image, go through a
+    separate buffered file descriptor.
+
+    Like with FileWriter, a zero_request can be given to zero ranges passed
+    to write_zeroes() with an ioctl. With sync_writes, the device is also
+    opened with O_DSYNC, so that every write reaches stable storage before
+    it completes.
+
+    The writer must be finished with close(), or with abort() after an
+    error.
+    """
+
+    def __init__(self, path, queue_depth, block_size, zero_request=None,
+                 sync_writes=False):
+        """Initialize an instance of the DirectWriter class.
+
+        :param path: The path of the device or file to write to.
+        :param queue_depth: The number of writes to keep outstanding.
+        :param block_size: The size in bytes of each write. It is rounded
+                           up to a multiple of the device sector size.
+        :param zero_request: Optional. BLKZEROOUT or BLKDISCARD, as returned
+                             by get_zero_request(), or DISCARDED.
+        :param sync_writes: Optional. Whether every write is synced to the
+                            device.
+        """
+        self._path = path
+        self._flags = os.O_DSYNC if sync_writes else 0
+        self._direct_fd = self._open_direct(path, self._flags)
+        self._buffered_fd = None
+        self.alignment = _sector_size(self._direct_fd)
+        self.block_size = -(-block_size // self.alignment) * self.alignment
+        self.queue_depth = queue_depth
+        self.bytes_written = 0
+        self.bytes_zeroed = 0
+        self.bytes_skipped = 0
+        self._zero_request = zero_request
+
+        self._libc = _get_libc()
+        self._lock = threading.Lock()
+        self._error = None
+        self._closed = False
+        self._buffer = None
+        self._buffer_offset = 0
+        self._filled = 0
+        self._position = 0
+        self._zeroes = None
+
+        # One buffer more than the queue depth, so the caller can fill a
+        # buffer while queue_depth others are being written.
+        self._free_buffers = queue.Queue()
+        for _i in range(queue_depth + 1):
+            self._free_buffers.put(AlignedBuffer(self.block_size,
+                                                 self.alignment))
+        self._pending = queue.Queue()
+        self._threads = []
+        for _i in range(queue_depth):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def _open_direct(path, flags=0):
+        try:
+            return os.open(path, os.O_WRONLY | os.O_DIRECT | flags)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.warning('Direct I/O is not supported for %s, falling back '
+                        'to buffered writes', path)
+            return os.open(path, os.O_WRONLY | flags)
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _pwrite(self, fd, address, length, offset):
+        done = 0
+        while done < length:
+            result = self._libc.pwrite(fd, address + done, length - done,
+                                       offset + done)
+            if result < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error), self._path)
+            if result == 0:
+                raise IOError(errno.EIO, 'Short write at offset {}'.format(
+                    offset + done), self._path)
+            done += result
+
+    def _write_buffer(self, buf, offset, length):
+        if offset % self.alignment or length % self.alignment:
+            with self._lock:
+                if self._buffered_fd is None:
+                    self._buffered_fd = os.open(self._path, os.O_WRONLY |
+                                                self._flags)
+            fd = self._buffered_fd
+        else:
+            fd = self._direct_fd
+        self._pwrite(fd, buf.address, length, offset)
+
+    def _worker(self):
+        while True:
+            item = self._pending.get()
+            if item is _STOP:
+                return
+            buf, offset, length = item
+            try:
+                if self._error is None:
+                    self._write_buffer(buf, offset, length)
+            except Exception as e:
+                self._fail(e)
+            finally:
+                self._free_buffers.put(buf)
+
+    def _submit(self):
+        if self._filled:
+            self._pending.put((self._buffer, self._buffer_offset,
+                               self._filled))
+            self._buffer = None
+            self._filled = 0
+
+    def _stage(self, offset, data):
+        self._check_error()
+        if self._filled and offset != self._buffer_offset + self._filled:
+            self._submit()
+        data = memoryview(data)
+        length = len(data)
+        done = 0
+        while done < length:
+            if self._buffer is None:
+                self._buffer = self._free_buffers.get()
+                self._check_error()
+            if not self._filled:
+                self._buffer_offset = offset + done
+            size = min(length - done, self.block_size - self._filled)
+            self._buffer.view[self._filled:self._filled + size] = (
+                data[done:done + size])
+            self._filled += size
+            done += size
+            if self._filled == self.block_size:
+                self._submit()
+        self._position = offset + length
+
+    def write(self, data):
+        """Write data at the current position.
+
+        :param data: The data to write, as bytes or a buffer object.
+        """
+        self._stage(self._position, data)
+        self.bytes_written += len(data)
+
+    def write_at(self, offset, data):
+        """Write data at an absolute offset.
+
+        :param offset: The offset in bytes to write the data at.
+        :param data: The data to write, as bytes or a buffer object.
+        """
+        self._stage(offset, data)
+        self.bytes_written += len(data)
+
+    def write_zeroes(self, offset, length):
+        """Fill a range with zeroes.
+
+        :param offset: The offset in bytes of the start of the range.
+        :param length: The length in bytes of the range.
+        """
+        if self._zero_request is not None:
+            self._check_error()
+            try:
+                start, end = _zero_fd_range(self._direct_fd,
+                                            self._zero_request, offset,
+                                            length)
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to zero a range of %s, zeroes will be '
+                            'written instead. Error: %s', self._path, e)
+                self._zero_request = None
+            else:
+                self.bytes_skipped += end - start
+                self._fill(offset, start - offset)
+                self._fill(end, offset + length - end)
+                self._position = offset + length
+                return
+        self._fill(offset, length)
+
+    def _fill(self, offset, length):
+        if self._zeroes is None:
+            self._zeroes = bytes(bytearray(ZERO_CHUNK_SIZE))
+        while length > 0:
+            size = min(length, ZERO_CHUNK_SIZE)
+            self._stage(offset, memoryview(self._zeroes)[:size])
+            self.bytes_zeroed += size
+            offset += size
+            length -= size
+
+    def _shutdown(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _thread in self._threads:
+            self._pending.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        try:
+            if self._error is None:
+                for fd in (self._direct_fd, self._buffered_fd):
+                    if fd is not None:
+                        os.fsync(fd)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for fd in (self._direct_fd, self._buffered_fd):
+                if fd is not None:
+                    os.close(fd)
+
+    def close(self):
+        """Write out any staged data, wait for all writes and close.
+
+        :raises: The first error encountered by any of the writes.
+        """
+        if not self._closed:
+            try:
+                self._submit()
+            finally:
+                self._shutdown()
+        self._check_error()
+
+    def abort(self):
+        """Stop writing and close the device, discarding staged data."""
+        self._buffer = None
+        self._filled = 0
+        self._fail(IOError('Writer was aborted'))
+        self._shutdown()
+
+
+class SparseWriter(object):
+    """Turns runs of zeroes in image data into write_zeroes() calls.
+
+    Data is inspected in blocks of block_size bytes, aligned to the offset
+    it is written at. Consecutive all-zero blocks are passed to the
+    write_zeroes() method of the wrapped writer, which can skip them
+    entirely when it was given a zero_request, and everything else is
+    passed to its write_at() method.
+
+    flush() must be called once all data has been written.
+    """
+
+    def __init__(self, writer, block_size=SPARSE_BLOCK_SIZE):
+        """Initialize an instance of the SparseWriter class.
+
+        :param writer: A FileWriter or DirectWriter to pass data to.
+        :param block_size: The size in bytes of the blocks inspected for
+                           zeroes.
+        """
+        self._writer = writer
+        self._block_size = block_size
+        self._zeroes = memoryview(bytes(bytearray(block_size)))
+        self._position = 0
+        self._zero_start = None
+        self._zero_end = None
+
+    @property
+    def bytes_written(self):
+        return self._writer.bytes_written
+
+    @property
+    def bytes_zeroed(self):
+        return self._writer.bytes_zeroed
+
+    @property
+    def bytes_skipped(self):
+        return self._writer.bytes_skipped
+
+    def write(self, data):
+        """Write data at the current position.
+
+        :param data: The data to write, as bytes or a buffer object.
+        """
+        self.write_at(self._position, data)
+
+    def write_at(self, offset, data):
+        """Write data at an absolute offset.
+
+        :param offset: The offset in bytes to write the data at.
+        :param data: The data to write, as bytes or a buffer object.
+        """
+        data = memoryview(data)
+        length = len(data)
+        data_start = None
+        pos = 0
+        while pos < length:
+            end = min(length, pos + self._block_size -
+                      (offset + pos) % self._block_size)
+            if data[pos:end] == self._zeroes[:end - pos]:
+                if data_start is not None:
+                    self._writer.write_at(offset + data_start,
+                                          data[data_start:pos])
+                    data_start = None
+                self.write_zeroes(offset + pos, end - pos)
+            elif data_start is None:
+                self._flush_zeroes()
+                data_start = pos
+            pos = end
+        if data_start is not None:
+            self._writer.write_at(offset + data_start, data[data_start:])
+        self._position = offset + length
+
+    def write_zeroes(self, offset, length):
+        """Fill a range with zeroes.
+
+        Adjacent ranges are merged, so that the wrapped writer receives as
+        few write_zeroes() calls as possible.
+
+        :param offset: The offset in bytes of the start of the range.
+        :param length: The length in bytes of the range.
+        """
+        if self._zero_end != offset:
+            self._flush_zeroes()
+            self._zero_start = offset
+        self._zero_end = offset + length
+        self._position = offset + length
+
+    def _flush_zeroes(self):
+        if self._zero_start is not None:
+            self._writer.write_zeroes(self._zero_start,
+                                      self._zero_end - self._zero_start)
+            self._zero_start = self._zero_end = None
+
+    def flush(self):
+        """Pass any pending range of zeroes to the wrapped writer."""
+        self._flush_zeroes()
+
+
+class FanOutWriter(object):
+    """Writes the same image data to several writers concurrently.
+
+    Every writer, usually one per device, has a thread of its own, which
+    takes the operations to perform from a queue of at most queue_size
+    entries. Once the queue of a writer is full, callers block until its
+    thread catches up, so the image is written at the pace of the slowest
+    device. Writers must have close() and abort() methods, which the
+    threads call once all operations are done.
+
+    The counters of bytes written, zeroed and skipped are those of the
+    first writer.
+    """
+
+    def __init__(self, writers, queue_size=FAN_OUT_QUEUE_SIZE):
+        """Initialize an instance of the FanOutWriter class.
+
+        :param writers: A list of writers, such as DirectWriter or
+                        BufferedDeviceWriter instances.
+        :param queue_size: Optional. The number of operations queued for
+                           every writer.
+        """
+        self.writers = writers
+        self._lock = threading.Lock()
+        self._error = None
+        self._closed = False
+        self._queues = []
+        self._threads = []
+        for writer in writers:
+            operations = queue.Queue(queue_size)
+            thread = threading.Thread(target=self._worker,
+                                      args=(writer, operations))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(operations)
+            self._threads.append(thread)
+
+    @property
+    def bytes_written(self):
+        return self.writers[0].bytes_written
+
+    @property
+    def bytes_zeroed(self):
+        return self.writers[0].bytes_zeroed
+
+    @property
+    def bytes_skipped(self):
+        return self.writers[0].bytes_skipped
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _worker(self, writer, operations):
+        while True:
+            operation = operations.get()
+            if operation is _STOP:
+                break
+            # After an error, the queue is still drained so that callers
+            # never block on it.
+            if self._error is None:
+                method, args = operation
+                try:
+                    getattr(writer, method)(*args)
+                except Exception as e:
+                    self._fail(e)
+        try:
+            if self._error is None:
+                writer.close()
+            else:
+                writer.abort()
+        except Exception as e:
+            self._fail(e)
+
+    def _submit(self, method, *args):
+        self._check_error()
+        for operations in self._queues:
+            operations.put((method, args))
+
+    def write(self, data):
+        """Write data at the current position.
+
+        :param data: The data to write, as bytes or a buffer object. It is
+                     copied unless it is immutable.
+        """
+        self._submit('write', self._immutable(data))
+
+    def write_at(self, offset, data):
+        """Write data at an absolute offset.
+
+        :param offset: The offset in bytes to write the data at.
+        :param data: The data to write, as bytes or a buffer object. It is
+                     copied unless it is immutable.
+        """
+        self._submit('write_at', offset, self._immutable(data))
+
+    def write_zeroes(self, offset, length):
+        """Fill a range with zeroes.
+
+        :param offset: The offset in bytes of the start of the range.
+        :param length: The length in bytes of the range.
+        """
+        self._submit('write_zeroes', offset, length)
+
+    @staticmethod
+    def _immutable(data):
+        # The data is only written once every thread got to it, by which
+        # time the caller may have reused a mutable buffer.
+        if isinstance(data, bytes) or isinstance(getattr(data, 'obj', None),
+                                                 bytes):
+            return data
+        return bytes(data)
+
+    def _shutdown(self):
+        if self._closed:
+            return
+        self._closed = True
+        for operations in self._queues:
+            operations.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def close(self):
+        """Wait for all writes and close every writer.
+
+        :raises: The first error encountered by any of the writers.
+        """
+        self._shutdown()
+        self._check_error()
+
+    def abort(self):
+        """Stop writing and abort every writer."""
+        self._fail(IOError('Writer was aborted'))
+        self._shutdown()
+
+
+def _open_direct_read(path):
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        LOG.warning('Direct I/O is not supported for %s, reading it back '
+                    'through the page cache', path)
+        return os.open(path, os.O_RDONLY)
+
+
+def read_back(path, length, threads, block_size, check=None):
+    """Read back data written to a device, bypassing the page cache.
+
+    The device is flushed, then blocks of block_size bytes are read with
+    direct I/O by a pool of threads, at most twice as many blocks as
+    threads being read at the same time.
+
+    :param path: The path of the device or file to read.
+    :param length: The number of bytes to read from the start of the
+                   device.
+    :param threads: The number of blocks read in parallel.
+    :param block_size: The size in bytes of the blocks.
+    :param check: Optional. A callable taking the offset and the content
+                  of a block, called for every block from the thread which
+                  read it, which may raise an exception to stop reading.
+    :raises: IOError or OSError if reading the device fails, or any
+             exception raised by check.
+    :returns: A generator of the contents of the blocks, in order.
+    """
+    fd = _open_direct_read(path)
+    try:
+        os.fsync(fd)
+        alignment = _sector_size(fd)
+    except Exception:
+        os.close(fd)
+        raise
+    libc = _get_libc()
+    buffers = threading.local()
+
+    def _read(offset, size):
+        start = offset // alignment * alignment
+        end = -(-(offset + size) // alignment) * alignment
+        buf = getattr(buffers, 'buffer', None)
+        if buf is None or buf.size < end - start:
+            buf = buffers.buffer = AlignedBuffer(end - start, alignment)
+        done = 0
+        while done < end - start:
+            result = libc.pread(fd, buf.address + done, end - start - done,
+                                start + done)
+            if result < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error), path)
+            if result == 0:
+                break
+            done += result
+        if done < offset - start + size:
+            raise IOError(errno.EIO, 'Short read at offset {}'.format(
+                start + done), path)
+        data = buf.view[offset - start:offset - start + size].tobytes()
+        if check is not None:
+            check(offset, data)
+        return data
+
+    workers = pool.ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        offset = 0
+        while offset < length or pending:
+            while offset < length and len(pending) < 2 * threads:
+                size = min(block_size, length - offset)
+                pending.append(workers.apply_async(_read, (offset, size)))
+                offset += size
+            yield pending.popleft().get()
+    finally:
+        workers.terminate()
+        workers.join()
+        os.close(fd)
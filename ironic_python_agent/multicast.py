@@ -0,0 +1,373 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Delivery of images over UDP multicast with forward error correction.
+
+An image is sent as blocks of block_size bytes, in groups of group_size
+blocks. Every group is followed by parity blocks: parity block j is the XOR
+of the data blocks i of the group with i % parity == j, so any loss of up to
+parity consecutive blocks of a group can be recovered. The blocks which
+could not be recovered are fetched again by the receiver, from the image URL
+with HTTP Range requests.
+
+Every packet starts with a header holding a magic string, the protocol
+version, the kind of the packet, the session number, the group number, and
+the index of the block within the group. Only IPv4 multicast groups are
+supported.
+"""
+
+import binascii
+import os
+import socket
+import struct
+import threading
+import time
+
+from oslo_log import log
+import six
+
+LOG = log.getLogger(__name__)
+
+MAGIC = b'IPAM'
+VERSION = 1
+HEADER = struct.Struct('!4sBBIIH')
+
+DATA = 0
+PARITY = 1
+END = 2
+
+DEFAULT_BLOCK_SIZE = 1400
+"""The default size of a block, which fits a 1500 bytes MTU."""
+
+DEFAULT_GROUP_SIZE = 64
+"""The default number of data blocks in a group."""
+
+DEFAULT_PARITY = 4
+"""The default number of parity blocks sent after every group."""
+
+END_PACKETS = 3
+"""The number of times the end of a transmission is announced."""
+
+
+class ProtocolError(Exception):
+    """A packet which is not part of a multicast image transmission."""
+
+
+def pack(kind, session, group, index, payload=b''):
+    """Build a packet.
+
+    :param kind: DATA, PARITY or END.
+    :param session: The session number of the transmission.
+    :param group: The group number of the block.
+    :param index: The index of the block within its group.
+    :param payload: The content of the block.
+    :returns: The packet, as bytes.
+    """
+    return HEADER.pack(MAGIC, VERSION, kind, session, group, index) + payload
+
+
+def unpack(packet):
+    """Parse a packet.
+
+    :param packet: The packet, as bytes.
+    :raises: ProtocolError if the packet is not a valid packet.
+    :returns: A tuple of the kind, the session number, the group number, the
+              index and the payload of the packet.
+    """
+    if len(packet) < HEADER.size:
+        raise ProtocolError('Packet of {} bytes is too short'.format(
+            len(packet)))
+    magic, version, kind, session, group, index = HEADER.unpack_from(packet)
+    if magic != MAGIC or version != VERSION:
+        raise ProtocolError('Unknown packet format')
+    if kind not in (DATA, PARITY, END):
+        raise ProtocolError('Unknown packet kind {}'.format(kind))
+    return kind, session, group, index, packet[HEADER.size:]
+
+
+def _xor(a, b, size):
+    """XOR two blocks, padded with zeroes to size bytes."""
+    value = (int(binascii.hexlify(a.ljust(size, b'\0')), 16) ^
+             int(binascii.hexlify(b.ljust(size, b'\0')), 16))
+    return binascii.unhexlify('%0*x' % (size * 2, value))
+
+
+def encode(blocks, parity, block_size):
+    """Compute the parity blocks of a group.
+
+    :param blocks: The list of data blocks of the group.
+    :param parity: The number of parity blocks.
+    :param block_size: The size of a block in bytes.
+    :returns: The list of parity blocks, each of block_size bytes.
+    """
+    result = []
+    for j in six.moves.range(min(parity, len(blocks))):
+        value = b''
+        for block in blocks[j::parity]:
+            value = _xor(value, block, block_size)
+        result.append(value)
+    return result
+
+
+def recover(blocks, parity_blocks, lengths, parity, block_size):
+    """Recover missing data blocks of a group from its parity blocks.
+
+    :param blocks: A dictionary mapping the index of every received data
+                   block of the group to its content. Recovered blocks are
+                   added to it.
+    :param parity_blocks: A dictionary mapping the index of every received
+                          parity block of the group to its content.
+    :param lengths: The list of the lengths of all data blocks of the group.
+    :param parity: The number of parity blocks of a group.
+    :param block_size: The size of a block in bytes.
+    :returns: The number of blocks recovered.
+    """
+    recovered = 0
+    for j, value in parity_blocks.items():
+        members = six.moves.range(j, len(lengths), parity)
+        missing = [i for i in members if i not in blocks]
+        if len(missing) != 1:
+            continue
+        for i in members:
+            if i in blocks:
+                value = _xor(value, blocks[i], block_size)
+        blocks[missing[0]] = value[:lengths[missing[0]]]
+        recovered += 1
+    return recovered
+
+
+class Receiver(object):
+    """Receives the blocks of an image from a multicast group.
+
+    Packets are received on a dedicated thread and buffered by group, so
+    that the socket keeps being drained while earlier groups are written or
+    repaired. Groups too far ahead of the group being consumed are dropped
+    once the buffer is full.
+    """
+
+    def __init__(self, group, port, session=0, interface=None,
+                 timeout=10, max_groups=64):
+        """Initialize an instance of the Receiver class.
+
+        :param group: The IPv4 address of the multicast group.
+        :param port: The UDP port of the transmission.
+        :param session: Optional. The session number of the transmission.
+                        Packets of other sessions are ignored.
+        :param interface: Optional. The IPv4 address of the interface to
+                          join the group on. Defaults to the interface
+                          chosen by the kernel.
+        :param timeout: Optional. The number of seconds without any packet
+                        after which the transmission is considered over.
+        :param max_groups: Optional. The maximum number of groups buffered.
+        """
+        self.session = session
+        self.timeout = timeout
+        self.max_groups = max_groups
+        self.done = False
+        self.highest = -1
+        self._groups = {}
+        self._floor = 0
+        self._condition = threading.Condition()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                   socket.IPPROTO_UDP)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                      8 * 1024 * 1024)
+            except socket.error:
+                pass
+            self._sock.bind((group, port))
+            membership = struct.pack(
+                '4s4s', socket.inet_aton(group),
+                socket.inet_aton(interface or '0.0.0.0'))
+            self._sock.setsockopt(socket.IPPROTO_IP,
+                                  socket.IP_ADD_MEMBERSHIP, membership)
+            self._sock.settimeout(timeout)
+        except Exception:
+            self._sock.close()
+            raise
+        self._thread = threading.Thread(target=self._run,
+                                        name='multicast-receiver')
+        self._thread.daemon = True
+
+    def start(self):
+        """Start receiving packets."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop receiving packets and leave the group."""
+        with self._condition:
+            self.done = True
+            self._groups.clear()
+            self._condition.notify_all()
+        self._sock.close()
+
+    def _run(self):
+        """Receive packets until the transmission ends or times out."""
+        try:
+            while not self.done:
+                try:
+                    packet = self._sock.recv(65535)
+                except socket.timeout:
+                    LOG.info('No multicast packet received for %s seconds, '
+                             'considering the transmission over',
+                             self.timeout)
+                    break
+                self.handle_packet(packet)
+        except (socket.error, ValueError) as e:
+            if not self.done:
+                LOG.warning('Unable to receive multicast packets: %s', e)
+        finally:
+            with self._condition:
+                self.done = True
+                self._condition.notify_all()
+
+    def handle_packet(self, packet):
+        """Buffer a received packet.
+
+        :param packet: The packet, as bytes.
+        """
+        try:
+            kind, session, group, index, payload = unpack(packet)
+        except ProtocolError as e:
+            LOG.debug('Ignoring multicast packet: %s', e)
+            return
+        if session != self.session:
+            return
+        with self._condition:
+            if kind == END:
+                self.done = True
+            else:
+                self.highest = max(self.highest, group)
+                if self._floor <= group < self._floor + self.max_groups:
+                    data, parity = self._groups.setdefault(group, ({}, {}))
+                    (data if kind == DATA else parity)[index] = payload
+            self._condition.notify_all()
+
+    def missed(self, group):
+        """Whether no packet of a group is buffered or will be received.
+
+        :param group: The group number.
+        """
+        with self._condition:
+            return (group not in self._groups and
+                    (self.done or self.highest > group))
+
+    def take(self, group, count):
+        """Wait for a group and remove it from the buffer.
+
+        Waits until all data blocks of the group have been received, a
+        packet of a later group has been received, or the transmission is
+        over.
+
+        :param group: The group number.
+        :param count: The number of data blocks in the group.
+        :returns: A tuple of two dictionaries, mapping the indexes of the
+                  received data blocks and parity blocks to their content.
+        """
+        with self._condition:
+            while not (self.done or self.highest > group or
+                       len(self._groups.get(group, ({}, {}))[0]) >= count):
+                self._condition.wait()
+            for stale in [g for g in self._groups if g <= group]:
+                if stale != group:
+                    del self._groups[stale]
+            self._floor = group + 1
+            return self._groups.pop(group, ({}, {}))
+
+    def skip(self, group):
+        """Drop all groups before a group.
+
+        :param group: The first group to keep.
+        """
+        with self._condition:
+            for stale in [g for g in self._groups if g < group]:
+                del self._groups[stale]
+            self._floor = max(self._floor, group)
+
+
+class Sender(object):
+    """Sends an image to a multicast group."""
+
+    def __init__(self, group, port, session=0, block_size=DEFAULT_BLOCK_SIZE,
+                 group_size=DEFAULT_GROUP_SIZE, parity=DEFAULT_PARITY,
+                 ttl=1, interface=None, rate=0):
+        """Initialize an instance of the Sender class.
+
+        :param group: The IPv4 address of the multicast group.
+        :param port: The UDP port of the transmission.
+        :param session: Optional. The session number of the transmission.
+        :param block_size: Optional. The size of a block in bytes.
+        :param group_size: Optional. The number of data blocks in a group.
+        :param parity: Optional. The number of parity blocks of a group.
+        :param ttl: Optional. The multicast TTL. Defaults to 1, which keeps
+                    the transmission within the local network.
+        :param interface: Optional. The IPv4 address of the interface to
+                          send from.
+        :param rate: Optional. The maximum rate in Mbit/s, or 0 for no
+                     limit.
+        """
+        self.address = (group, port)
+        self.session = session
+        self.block_size = block_size
+        self.group_size = group_size
+        self.parity = parity
+        self.rate = rate
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                   socket.IPPROTO_UDP)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                              ttl)
+        if interface:
+            self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                  socket.inet_aton(interface))
+        self._sent = 0
+        self._start = None
+
+    def _send(self, packet):
+        self._sock.sendto(packet, self.address)
+        self._sent += len(packet)
+        if self.rate:
+            ahead = (self._sent * 8.0 / (self.rate * 10 ** 6) -
+                     (time.time() - self._start))
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def send(self, path):
+        """Send an image.
+
+        :param path: The path of the image file.
+        """
+        self._start = time.time()
+        LOG.info('Sending %s (%d bytes) to %s:%d', path,
+                 os.path.getsize(path), self.address[0], self.address[1])
+        with open(path, 'rb') as f:
+            group = 0
+            while True:
+                blocks = []
+                for _ in six.moves.range(self.group_size):
+                    block = f.read(self.block_size)
+                    if not block:
+                        break
+                    blocks.append(block)
+                if not blocks:
+                    break
+                for index, block in enumerate(blocks):
+                    self._send(pack(DATA, self.session, group, index, block))
+                for index, block in enumerate(
+                        encode(blocks, self.parity, self.block_size)):
+                    self._send(pack(PARITY, self.session, group, index,
+                                    block))
+                group += 1
+        for _ in six.moves.range(END_PACKETS):
+            self._send(pack(END, self.session, 0, 0))
+        self._sock.close()
@@ -0,0 +1,139 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Progress of image transfers, reported while commands are running."""
+
+import threading
+import time
+
+from oslo_utils import units
+
+RECEIVED = 'received'
+HASHED = 'hashed'
+WRITTEN = 'written'
+STAGES = (RECEIVED, HASHED, WRITTEN)
+
+RATE_WINDOW = 5
+"""The number of seconds the current rate of a stage is measured over."""
+
+
+class _Stage(object):
+    """The bytes processed by a stage and its rates."""
+
+    def __init__(self, start, initial):
+        self.bytes = initial
+        self.start = start
+        self.initial = initial
+        self.current_rate = None
+        self._window_start = start
+        self._window_bytes = initial
+
+    def roll(self, now):
+        """Measure the current rate once the window is over."""
+        if now - self._window_start >= RATE_WINDOW:
+            self.current_rate = ((self.bytes - self._window_bytes) /
+                                 (now - self._window_start))
+            self._window_start = now
+            self._window_bytes = self.bytes
+
+    def average_rate(self, now):
+        return (self.bytes - self.initial) / max(now - self.start, 1e-6)
+
+
+def _mb(rate):
+    return round(rate / units.M, 2)
+
+
+class ImageProgress(object):
+    """The progress of an image through the stages of its deployment.
+
+    Tracks the bytes received from the network, hashed for the checksums
+    and written, with the current rate of every stage over the last
+    RATE_WINDOW seconds and its average rate since the start. A stalled
+    stage has a current rate of 0 after at most RATE_WINDOW seconds.
+    """
+
+    def __init__(self, image_id, total=None, offset=0):
+        """Initialize an instance of the ImageProgress class.
+
+        :param image_id: The ID of the image.
+        :param total: Optional. The size in bytes of the image received, if
+                      known, used to estimate the remaining time.
+        :param offset: Optional. The number of bytes of the image already
+                       processed by every stage, when a transfer resumes.
+        """
+        self.image_id = image_id
+        self.total = total
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._stages = dict((stage, _Stage(self._start, offset))
+                            for stage in STAGES)
+
+    def add(self, stage, amount):
+        """Record bytes processed by a stage.
+
+        :param stage: RECEIVED, HASHED or WRITTEN.
+        :param amount: The number of bytes.
+        """
+        with self._lock:
+            stats = self._stages[stage]
+            stats.bytes += amount
+            stats.roll(time.time())
+
+    def bytes(self, stage):
+        """Get the number of bytes processed by a stage.
+
+        :param stage: RECEIVED, HASHED or WRITTEN.
+        """
+        with self._lock:
+            return self._stages[stage].bytes
+
+    def to_dict(self):
+        """Describe the progress.
+
+        :returns: A dictionary with the 'image_id', the 'total_bytes' if
+                  known, the 'elapsed' and estimated remaining ('eta')
+                  seconds, and for every stage a dictionary of the 'bytes'
+                  processed and the 'current_rate' and 'average_rate' in
+                  MB/s.
+        """
+        with self._lock:
+            now = time.time()
+            result = {'image_id': self.image_id,
+                      'total_bytes': self.total,
+                      'elapsed': round(now - self._start, 1),
+                      'eta': None}
+            for name, stats in self._stages.items():
+                stats.roll(now)
+                average = stats.average_rate(now)
+                current = stats.current_rate
+                result[name] = {
+                    'bytes': stats.bytes,
+                    'current_rate': _mb(average if current is None
+                                        else current),
+                    'average_rate': _mb(average)}
+            received = self._stages[RECEIVED]
+            rate = received.current_rate
+            if rate is None:
+                rate = received.average_rate(now)
+            if self.total is not None and rate > 0:
+                result['eta'] = round(
+                    max(self.total - received.bytes, 0) / rate, 1)
+            return result
+
+    def summary(self):
+        """Describe the progress in a sentence, for logs."""
+        info = self.to_dict()
+        return ', '.join(
+            '{} bytes {} at {:.2f} MB/s'.format(
+                info[stage]['bytes'], stage, info[stage]['average_rate'])
+            for stage in STAGES)
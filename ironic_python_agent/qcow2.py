@@ -0,0 +1,388 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming decoder for qcow2 images.
+
+qemu-img needs random access to a qcow2 image, so the image has to be
+staged in full before it can be converted. The decoder in this module
+instead consumes the image front to back, as it is being downloaded, and
+writes guest data straight to its final offset on the target.
+
+Host clusters whose meaning is not known yet, because the L1 or L2 table
+referencing them has not been received, are kept in a bounded spill area
+until either a table claims them or all tables have been parsed. Images
+produced by ``qemu-img convert -O qcow2`` store their tables ahead of the
+data they describe, so in practice the spill area only ever holds a few
+refcount blocks.
+"""
+
+import functools
+import struct
+import zlib
+
+from oslo_log import log
+import six
+
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+MAGIC = b'QFI\xfb'
+
+# Version 2 header, followed by the version 3 additions
+_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+_V3_HEADER = struct.Struct('>QQQII')
+_HEADER_SIZE = _HEADER.size + _V3_HEADER.size
+
+_OFFSET_MASK = 0x00fffffffffffe00
+_COPIED = 1 << 63
+_COMPRESSED = 1 << 62
+_ZERO = 1
+
+# The only incompatible feature that does not change how data is laid out
+_INCOMPAT_DIRTY = 1
+
+_MIN_CLUSTER_BITS = 9
+_MAX_CLUSTER_BITS = 21
+
+
+class _Extent(object):
+    """A range of the host file some part of the decoder is waiting for."""
+
+    def __init__(self, start, length, callback, exclusive, allow_short):
+        self.start = start
+        self.length = length
+        self.callback = callback
+        self.exclusive = exclusive
+        self.allow_short = allow_short
+        self.data = bytearray(length)
+        self.missing = length
+        self.done = False
+
+    def fill(self, offset, data):
+        """Copy the part of data overlapping this extent.
+
+        :param offset: The host offset of data.
+        :param data: A part of the host file.
+        """
+        low = max(self.start, offset)
+        high = min(self.start + self.length, offset + len(data))
+        if low < high:
+            self.data[low - self.start:high - self.start] = (
+                data[low - offset:high - offset])
+            self.missing -= high - low
+
+    def complete(self, data=None):
+        """Hand the extent to its callback, at most once."""
+        if not self.done:
+            self.done = True
+            self.callback(self.data if data is None else data)
+
+
+class StreamingDecoder(object):
+    """Decodes a qcow2 image fed to it in order into guest data.
+
+    Guest data is written through a writer object providing write_at() and
+    write_zeroes() methods, such as image_writer.FileWriter. Guest ranges
+    which are not allocated in the image are zeroed by finish().
+    """
+
+    def __init__(self, writer, spill_limit):
+        """Initialize an instance of the StreamingDecoder class.
+
+        :param writer: The writer to put guest data onto.
+        :param spill_limit: The maximum number of bytes of host clusters to
+                            keep while waiting for the tables referencing
+                            them.
+        """
+        self._writer = writer
+        self._spill_limit = spill_limit
+        self._spill = {}
+        self._spill_bytes = 0
+        self._extents = {}
+        self._pending = bytearray()
+        self._next_cluster = 0
+        self._tables = 0
+        self._metadata_done = False
+        self._written = None
+        self.cluster_size = None
+        self.virtual_size = None
+        self.version = None
+
+    def _parse_header(self):
+        """Validate the image header and request the L1 table.
+
+        :raises: ImageFormatError if the image is not a qcow2 image, or uses
+                 features which cannot be streamed.
+        """
+        (magic, version, backing_file_offset, _backing_file_size,
+         cluster_bits, size, crypt_method, l1_size, l1_table_offset,
+         _refcount_table_offset, _refcount_table_clusters, _nb_snapshots,
+         _snapshots_offset) = _HEADER.unpack_from(bytes(self._pending))
+        if magic != MAGIC:
+            raise errors.ImageFormatError('The image is not a qcow2 image')
+        if version not in (2, 3):
+            raise errors.ImageFormatError(
+                'qcow2 version {} is not supported'.format(version))
+        if backing_file_offset:
+            raise errors.ImageFormatError(
+                'qcow2 images with a backing file are not supported')
+        if crypt_method:
+            raise errors.ImageFormatError(
+                'Encrypted qcow2 images are not supported')
+        if not _MIN_CLUSTER_BITS <= cluster_bits <= _MAX_CLUSTER_BITS:
+            raise errors.ImageFormatError(
+                'Invalid qcow2 cluster size 2^{}'.format(cluster_bits))
+        if version == 3:
+            incompatible = _V3_HEADER.unpack_from(bytes(self._pending),
+                                                  _HEADER.size)[0]
+            if incompatible & ~_INCOMPAT_DIRTY:
+                raise errors.ImageFormatError(
+                    'qcow2 incompatible features {:#x} are not '
+                    'supported'.format(incompatible & ~_INCOMPAT_DIRTY))
+
+        self.version = version
+        self._cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.virtual_size = size
+        self._l2_entries = self.cluster_size // 8
+        guest_clusters = (size + self.cluster_size - 1) // self.cluster_size
+        if l1_size * self._l2_entries < guest_clusters:
+            raise errors.ImageFormatError(
+                'qcow2 L1 table is too small for the image size')
+        self._written = bytearray(guest_clusters)
+        LOG.info('Streaming qcow2 version %(version)s image with virtual '
+                 'size %(size)s and cluster size %(cluster)s',
+                 {'version': version, 'size': size,
+                  'cluster': self.cluster_size})
+
+        if l1_size:
+            self._tables += 1
+            self._register(l1_table_offset, l1_size * 8, self._on_l1,
+                           exclusive=True)
+        self._check_metadata_done()
+
+    def _register(self, start, length, callback, exclusive=False,
+                  allow_short=False):
+        """Ask for a range of the host file to be passed to a callback.
+
+        Parts of the range which have already gone past are taken from the
+        spill area.
+
+        :param start: The host offset of the range.
+        :param length: The length of the range.
+        :param callback: Called with the content of the range once it has
+                         been received in full.
+        :param exclusive: Whether the host clusters covered by the range are
+                          used by this range only, and need not be spilled.
+        :param allow_short: Whether the range may be cut short by the end of
+                            the image, as compressed clusters can be.
+        :raises: ImageFormatError if part of the range was already discarded.
+        """
+        extent = _Extent(start, length, callback, exclusive, allow_short)
+        first = start // self.cluster_size
+        last = (start + length - 1) // self.cluster_size
+        for index in six.moves.range(first, last + 1):
+            if index >= self._next_cluster:
+                self._extents.setdefault(index, []).append(extent)
+                continue
+            data = self._spill.get(index)
+            if data is None:
+                raise errors.ImageFormatError(
+                    'qcow2 host cluster at offset {} is referenced after it '
+                    'was discarded'.format(index * self.cluster_size))
+            extent.fill(index * self.cluster_size, data)
+            if exclusive:
+                self._spill_bytes -= len(self._spill.pop(index))
+        if not extent.missing:
+            extent.complete()
+
+    def _spill_cluster(self, index, data):
+        """Keep a host cluster until the tables referencing it arrive.
+
+        :raises: ImageFormatError if the spill area is full.
+        """
+        self._spill[index] = data
+        self._spill_bytes += len(data)
+        if self._spill_bytes > self._spill_limit:
+            raise errors.ImageFormatError(
+                'Streaming the qcow2 image requires more than {} bytes of '
+                'spill space, its tables are probably stored after the '
+                'data they describe. Rewrite the image with "qemu-img '
+                'convert -O qcow2" or deploy it without '
+                'streaming'.format(self._spill_limit))
+
+    def _check_metadata_done(self):
+        """Release the spill area once every table has been parsed."""
+        if not self._tables and not self._metadata_done:
+            LOG.debug('All qcow2 tables parsed at host offset %s, '
+                      'releasing %s bytes of spill space',
+                      self._next_cluster * self.cluster_size,
+                      self._spill_bytes)
+            self._metadata_done = True
+            self._spill.clear()
+            self._spill_bytes = 0
+
+    def _process_cluster(self, index, data):
+        """Hand a host cluster to the extents waiting for it.
+
+        :param index: The index of the host cluster.
+        :param data: The content of the cluster. Only the last cluster of
+                     the image may be shorter than the cluster size.
+        """
+        extents = self._extents.pop(index, [])
+        exclusive = index == 0
+        for extent in extents:
+            extent.fill(index * self.cluster_size, data)
+            exclusive = exclusive or extent.exclusive
+        if not exclusive and not self._metadata_done:
+            self._spill_cluster(index, data)
+        self._next_cluster = index + 1
+        for extent in extents:
+            if not extent.missing:
+                extent.complete()
+
+    def _on_l1(self, data):
+        """Request every L2 table referenced by the L1 table."""
+        entries = struct.unpack('>{}Q'.format(len(data) // 8), bytes(data))
+        tables = [(l1_index, entry & _OFFSET_MASK)
+                  for l1_index, entry in enumerate(entries)
+                  if entry & _OFFSET_MASK]
+        # Count the L2 tables before requesting any of them, as tables
+        # found in the spill area are parsed straight away.
+        self._tables += len(tables)
+        for l1_index, offset in tables:
+            self._check_aligned(offset, 'L2 table')
+            self._register(offset, self.cluster_size,
+                           functools.partial(self._on_l2, l1_index),
+                           exclusive=True)
+        self._tables -= 1
+        self._check_metadata_done()
+
+    def _on_l2(self, l1_index, data):
+        """Request the data of every allocated cluster in an L2 table."""
+        entries = struct.unpack('>{}Q'.format(self._l2_entries), bytes(data))
+        base = l1_index * self._l2_entries * self.cluster_size
+        for l2_index, entry in enumerate(entries):
+            guest = base + l2_index * self.cluster_size
+            if guest >= self.virtual_size:
+                break
+            if entry & _COMPRESSED:
+                self._register_compressed(guest, entry)
+                continue
+            offset = entry & _OFFSET_MASK
+            if not offset or (self.version >= 3 and entry & _ZERO):
+                # Unallocated or zero cluster, left for finish()
+                continue
+            self._check_aligned(offset, 'data cluster')
+            self._register(offset, self.cluster_size,
+                           functools.partial(self._on_data, guest),
+                           exclusive=bool(entry & _COPIED))
+        self._tables -= 1
+        self._check_metadata_done()
+
+    def _register_compressed(self, guest, entry):
+        """Request the data of a compressed cluster."""
+        shift = 62 - (self._cluster_bits - 8)
+        offset = entry & ((1 << shift) - 1)
+        sectors = ((entry & ~_COMPRESSED & ~_COPIED) >> shift) + 1
+        length = sectors * 512 - (offset & 511)
+        self._register(offset, length,
+                       functools.partial(self._on_compressed, guest),
+                       allow_short=True)
+
+    def _check_aligned(self, offset, what):
+        if offset % self.cluster_size:
+            raise errors.ImageFormatError(
+                'qcow2 {} at host offset {} is not aligned to a '
+                'cluster'.format(what, offset))
+
+    def _guest_length(self, guest):
+        return min(self.cluster_size, self.virtual_size - guest)
+
+    def _on_data(self, guest, data):
+        """Write a standard cluster to its guest offset."""
+        length = self._guest_length(guest)
+        self._writer.write_at(guest, memoryview(data)[:length])
+        self._written[guest // self.cluster_size] = 1
+
+    def _on_compressed(self, guest, data):
+        """Decompress a cluster and write it to its guest offset."""
+        length = self._guest_length(guest)
+        try:
+            cluster = zlib.decompressobj(-12).decompress(bytes(data),
+                                                         self.cluster_size)
+        except zlib.error as e:
+            raise errors.ImageFormatError(
+                'Unable to decompress qcow2 cluster for guest offset {}: '
+                '{}'.format(guest, e))
+        if len(cluster) < length:
+            raise errors.ImageFormatError(
+                'Compressed qcow2 cluster for guest offset {} is '
+                'truncated'.format(guest))
+        self._writer.write_at(guest, cluster[:length])
+        self._written[guest // self.cluster_size] = 1
+
+    def feed(self, data):
+        """Decode the next part of the image.
+
+        :param data: The next part of the image, as bytes or a buffer object.
+        :raises: ImageFormatError if the image cannot be decoded.
+        """
+        self._pending += data
+        if self.cluster_size is None:
+            if len(self._pending) < _HEADER_SIZE:
+                return
+            self._parse_header()
+        offset = 0
+        while len(self._pending) - offset >= self.cluster_size:
+            self._process_cluster(
+                self._next_cluster,
+                bytes(self._pending[offset:offset + self.cluster_size]))
+            offset += self.cluster_size
+        del self._pending[:offset]
+
+    def finish(self):
+        """Complete the image once it has been fed in full.
+
+        Compressed clusters cut short by the end of the image are decoded,
+        and every guest range not allocated in the image is zeroed.
+
+        :raises: ImageFormatError if the image is truncated.
+        """
+        if self.cluster_size is None:
+            raise errors.ImageFormatError(
+                'The image is too short to be a qcow2 image')
+        if self._pending:
+            self._process_cluster(self._next_cluster, bytes(self._pending))
+            self._pending = bytearray()
+        for extents in list(self._extents.values()):
+            for extent in extents:
+                if extent.done:
+                    continue
+                if not extent.allow_short:
+                    raise errors.ImageFormatError(
+                        'The qcow2 image is truncated, data at host offset '
+                        '{} is missing'.format(extent.start))
+                extent.complete(
+                    extent.data[:extent.length - extent.missing])
+        self._extents.clear()
+
+        index = self._written.find(b'\x00')
+        while index != -1:
+            end = self._written.find(b'\x01', index)
+            if end == -1:
+                end = len(self._written)
+            offset = index * self.cluster_size
+            length = min(end * self.cluster_size, self.virtual_size) - offset
+            self._writer.write_zeroes(offset, length)
+            index = self._written.find(b'\x00', end)
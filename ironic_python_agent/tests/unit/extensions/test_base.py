@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 import mock
 from oslotest import base as test_base
 from stevedore import extension
@@ -51,6 +53,10 @@ class FakeExtension(base.BaseAgentExtension):
     def second_sync_command(self):
         pass
 
+    @base.sync_command('fake_adjust_command', allowed_while_busy=True)
+    def fake_adjust_command(self, param=None):
+        return param
+
 
 class FakeAgent(base.ExecuteCommandMixin):
     def __init__(self):
@@ -116,6 +122,36 @@ class TestExecuteCommandMixin(test_base.BaseTestCase):
                          result.command_status)
         self.assertEqual(exc, result.command_error)
 
+    def _executing(self):
+        running = mock.Mock(id='running')
+        running.is_done.return_value = False
+        self.agent.command_results[running.id] = running
+        return running
+
+    def test_execute_command_busy(self):
+        self._executing()
+        self.assertRaises(errors.CommandExecutionError,
+                          self.agent.execute_command,
+                          'fake.fake_sync_command', is_valid=True)
+        self.assertEqual(1, len(self.agent.command_results))
+
+    def test_execute_command_allowed_while_busy(self):
+        running = self._executing()
+        result = self.agent.execute_command('fake.fake_adjust_command',
+                                            param='v1')
+        self.assertEqual(base.AgentCommandStatus.SUCCEEDED,
+                         result.command_status)
+        self.assertEqual('v1', result.command_result['result'])
+        # The executing command is still the last one
+        self.assertEqual([running],
+                         list(self.agent.command_results.values()))
+
+    def test_execute_command_allowed_while_busy_not_busy(self):
+        result = self.agent.execute_command('fake.fake_adjust_command',
+                                            param='v1')
+        self.assertEqual([result],
+                         list(self.agent.command_results.values()))
+
 
 class TestExtensionDecorators(test_base.BaseTestCase):
     def setUp(self):
@@ -150,6 +186,30 @@ class TestExtensionDecorators(test_base.BaseTestCase):
         self.assertEqual({'result': 'fake_async_command: v1'},
                          result.command_result)
 
+    def test_async_command_progress(self):
+        reported = threading.Event()
+        finish = threading.Event()
+
+        def _execute():
+            base.report_progress(lambda: {'bytes': 42})
+            reported.set()
+            finish.wait(10)
+            return 'done'
+
+        result = base.AsyncCommandResult('fake_command', {}, _execute)
+        result.start()
+        reported.wait(10)
+        self.assertEqual({'progress': {'bytes': 42}},
+                         result.serialize()['command_result'])
+        finish.set()
+        result.join()
+        self.assertEqual({'result': 'fake_command: done'},
+                         result.serialize()['command_result'])
+
+    def test_report_progress_outside_command(self):
+        # Nothing to report to, and nothing fails
+        base.report_progress(lambda: {'bytes': 42})
+
     def test_async_command_validation_failure(self):
         self.assertRaises(errors.InvalidCommandParamsError,
                           self.extension.execute,
@@ -214,5 +274,6 @@ class TestExtensionDecorators(test_base.BaseTestCase):
             'fake_sync_command': self.extension.fake_sync_command,
             'other_async_name': self.extension.second_async_command,
             'other_sync_name': self.extension.second_sync_command,
+            'fake_adjust_command': self.extension.fake_adjust_command,
         }
         self.assertEqual(expected_map, self.extension.command_map)
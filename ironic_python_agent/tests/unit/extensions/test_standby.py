@@ -12,14 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import errno
+import hashlib
 import os
-
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from ironic_lib import disk_utils
+from ironic_lib import exception
+from ironic_lib import utils as ironic_utils
 import mock
 from oslo_concurrency import processutils
+from oslo_utils import units
 from oslotest import base as test_base
+import requests
 
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import standby
+from ironic_python_agent import image_cache
+from ironic_python_agent import image_convert
+from ironic_python_agent import image_staging
+from ironic_python_agent import image_swarm
+from ironic_python_agent import image_writer
+from ironic_python_agent import multicast
+from ironic_python_agent.tests.unit import test_qcow2
+from ironic_python_agent.tests.unit import test_zero_copy
+from ironic_python_agent import zero_copy
 
 
 def _build_fake_image_info():
@@ -33,6 +54,11 @@ def _build_fake_image_info():
     }
 
 
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 def _build_fake_partition_image_info():
     return {
         'id': 'fake_id',
@@ -102,6 +128,89 @@ class TestStandbyExtension(test_base.BaseTestCase):
                           standby._validate_image_info,
                           invalid_info)
 
+    def test_validate_image_info_os_hash_only(self):
+        image_info = _build_fake_image_info()
+        del image_info['checksum']
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = 'abc456'
+        standby._validate_image_info(None, image_info)
+
+    def test_validate_image_info_os_hash_lists(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = ['sha256', 'sha512']
+        image_info['os_hash_value'] = ['abc456', 'def789']
+        standby._validate_image_info(None, image_info)
+
+    def test_validate_image_info_os_hash_length_mismatch(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['os_hash_algo'] = ['sha256', 'sha512']
+        invalid_info['os_hash_value'] = ['abc456']
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_os_hash_unknown_algo(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['os_hash_algo'] = 'not-a-hash'
+        invalid_info['os_hash_value'] = 'abc456'
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'not-a-hash',
+                               standby._validate_image_info,
+                               None, invalid_info)
+
+    def test_validate_image_info_invalid_chunk_manifest(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['chunk_manifest'] = ['not', 'a', 'manifest']
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_invalid_compression(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['compression'] = 'bzip2'
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_invalid_download_rate(self):
+        for rate in (-1, '10', True):
+            invalid_info = _build_fake_image_info()
+            invalid_info['download_rate'] = rate
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    def test_validate_image_info_invalid_multicast(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['multicast'] = {'group': '239.1.2.3', 'port': '5000'}
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_swarm_without_chunk_manifest(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['swarm'] = {'peers': ['http://peer:9999']}
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'chunk_manifest',
+                               standby._validate_image_info,
+                               None, invalid_info)
+
+    def test_validate_image_info_invalid_swarm_peers(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['chunk_manifest'] = 'http://example.org/manifest'
+        invalid_info['swarm'] = {'peers': 'http://peer:9999'}
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
     def test_cache_image_invalid_image_list(self):
         self.assertRaises(errors.InvalidCommandParamsError,
                           self.agent_extension.cache_image,
@@ -112,21 +221,151 @@ class TestStandbyExtension(test_base.BaseTestCase):
         location = standby._image_location(image_info)
         self.assertEqual('/tmp/fake_id', location)
 
-    @mock.patch('six.moves.builtins.open', autospec=True)
+    def _make_sparse_files(self, image_data):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        image = os.path.join(tempdir, 'image')
+        device = os.path.join(tempdir, 'device')
+        with open(image, 'wb') as f:
+            f.write(image_data)
+        return image, device
+
+    @mock.patch('ironic_python_agent.image_convert.get_converter',
+                autospec=True)
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_whole_disk_image_sparse(self, execute_mock, info_mock,
+                                           ioctl_mock, converter_mock):
+        image_data = (b'a' * 100 + b'\0' * (256 * units.Ki - 100) +
+                      b'b' * 4096)
+        image, device = self._make_sparse_files(image_data)
+        info_mock.return_value.file_format = 'raw'
+        converter_mock.return_value = image_convert.BuiltinConverter()
+        image_info = _build_fake_image_info()
+        image_info['convert_cache_mode'] = 'writeback'
+
+        stats = standby._write_whole_disk_image_sparse(
+            image, image_info, device, image_writer.BLKZEROOUT)
+
+        converter_mock.assert_called_once_with('builtin')
+        execute_mock.assert_called_once_with('sgdisk', '-Z', device)
+        ioctl_mock.assert_called_once_with(mock.ANY, image_writer.BLKZEROOUT,
+                                           mock.ANY)
+        # Zeroes are detected in 64 KiB blocks
+        self.assertEqual((64 * units.Ki + 4096, 192 * units.Ki), stats)
+        with open(device, 'rb') as f:
+            self.assertEqual(image_data, f.read())
+
+    @mock.patch.object(image_convert.QemuImgConverter, 'convert',
+                       autospec=True)
+    @mock.patch('ironic_python_agent.image_convert.get_converter',
+                autospec=True)
+    @mock.patch('os.path.getsize', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    def test_write_whole_disk_image_sparse_unsupported_format(
+            self, info_mock, getsize_mock, converter_mock, convert_mock):
+        info_mock.return_value.file_format = 'vmdk'
+        getsize_mock.return_value = 1024
+        converter_mock.return_value = image_convert.BuiltinConverter()
+        convert_mock.return_value = None
+        image_info = _build_fake_image_info()
+
+        self.assertIsNone(standby._write_whole_disk_image_sparse(
+            '/tmp/image', image_info, '/dev/foo', image_writer.BLKZEROOUT))
+        convert_mock.assert_called_once_with(
+            mock.ANY, '/tmp/image', 'vmdk', '/dev/foo', 'none', 8,
+            4 * units.Mi, mock.ANY, zero_request=None,
+            image_progress=mock.ANY, writeback_window=0)
+
+    @mock.patch.object(image_convert.QemuImgConverter, 'convert',
+                       autospec=True)
+    @mock.patch.object(image_convert.BuiltinConverter, 'convert',
+                       autospec=True)
+    @mock.patch('ironic_python_agent.image_convert.get_converter',
+                autospec=True)
+    @mock.patch('os.path.getsize', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    def test_write_whole_disk_image_format_error(
+            self, info_mock, getsize_mock, converter_mock, builtin_mock,
+            qemu_mock):
+        info_mock.return_value.file_format = 'qcow2'
+        getsize_mock.return_value = 1024
+        converter_mock.return_value = image_convert.BuiltinConverter()
+        builtin_mock.side_effect = errors.ImageFormatError(
+            'unsupported incompatible features')
+        qemu_mock.return_value = None
+        image_info = _build_fake_image_info()
+
+        self.assertIsNone(standby._write_whole_disk_image(
+            '/tmp/image', image_info, '/dev/foo'))
+        self.assertEqual(1, builtin_mock.call_count)
+        qemu_mock.assert_called_once_with(
+            mock.ANY, '/tmp/image', 'qcow2', '/dev/foo', 'none', 8,
+            4 * units.Mi, mock.ANY)
+
+    @mock.patch.object(image_convert.QemuImgConverter, 'convert',
+                       autospec=True)
+    @mock.patch.object(image_convert.BuiltinConverter, 'convert',
+                       autospec=True)
+    @mock.patch('ironic_python_agent.image_convert.get_converter',
+                autospec=True)
+    @mock.patch('os.path.getsize', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    def test_write_whole_disk_image_sparse_format_error(
+            self, info_mock, getsize_mock, converter_mock, builtin_mock,
+            qemu_mock):
+        info_mock.return_value.file_format = 'qcow2'
+        getsize_mock.return_value = 1024
+        converter_mock.return_value = image_convert.BuiltinConverter()
+        builtin_mock.side_effect = errors.ImageFormatError('backing file')
+        qemu_mock.return_value = None
+        image_info = _build_fake_image_info()
+
+        self.assertIsNone(standby._write_whole_disk_image_sparse(
+            '/tmp/image', image_info, '/dev/foo', image_writer.BLKZEROOUT))
+        builtin_mock.assert_called_once_with(
+            mock.ANY, '/tmp/image', 'qcow2', '/dev/foo', 'none', 8,
+            4 * units.Mi, mock.ANY, zero_request=image_writer.BLKZEROOUT,
+            image_progress=mock.ANY, writeback_window=0)
+        qemu_mock.assert_called_once_with(
+            mock.ANY, '/tmp/image', 'qcow2', '/dev/foo', 'none', 8,
+            4 * units.Mi, mock.ANY)
+
+    @mock.patch('ironic_python_agent.image_convert.memory_budget',
+                autospec=True)
+    @mock.patch('ironic_python_agent.image_convert.get_converter',
+                autospec=True)
+    @mock.patch('os.path.getsize', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_write_image(self, execute_mock, open_mock):
+    def test_write_image(self, execute_mock, info_mock, getsize_mock,
+                         converter_mock, budget_mock):
         image_info = _build_fake_image_info()
+        image_info['image_converter'] = 'qemu-img'
+        image_info['convert_cache_mode'] = 'directsync'
         device = '/dev/sda'
         location = standby._image_location(image_info)
-        script = standby._path_to_script('shell/write_image.sh')
-        command = ['/bin/bash', script, location, device]
+        info_mock.return_value.file_format = 'qcow2'
+        getsize_mock.return_value = 1024
+        converter_mock.return_value = image_convert.QemuImgConverter()
+        budget_mock.return_value = 2 * units.Gi
         execute_mock.return_value = ('', '')
 
         standby._write_image(image_info, device)
-        execute_mock.assert_called_once_with(*command, check_exit_code=[0])
+        converter_mock.assert_called_once_with('qemu-img')
+        budget_mock.assert_called_once_with(25)
+        execute_mock.assert_has_calls([
+            mock.call('sgdisk', '-Z', device),
+            mock.call('qemu-img', 'convert', '-t', 'directsync',
+                      '-O', 'host_device', location, device,
+                      prlimit=mock.ANY),
+            mock.call('sync')])
+        self.assertEqual(
+            2 * units.Gi,
+            execute_mock.call_args_list[1][1]['prlimit'].address_space)
 
         execute_mock.reset_mock()
-        execute_mock.return_value = ('', '')
         execute_mock.side_effect = processutils.ProcessExecutionError
 
         self.assertRaises(errors.ImageWriteError,
@@ -134,7 +373,78 @@ class TestStandbyExtension(test_base.BaseTestCase):
                           image_info,
                           device)
 
-        execute_mock.assert_called_once_with(*command, check_exit_code=[0])
+        execute_mock.assert_called_once_with('sgdisk', '-Z', device)
+
+    @mock.patch('ironic_python_agent.image_convert.get_converter',
+                autospec=True)
+    def test_write_image_unknown_converter(self, converter_mock):
+        converter_mock.side_effect = RuntimeError('no such converter')
+
+        self.assertRaises(errors.ImageWriteError,
+                          standby._write_image,
+                          _build_fake_image_info(),
+                          '/dev/sda')
+
+    def test_validate_image_info_target_devices(self):
+        image_info = _build_fake_image_info()
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        standby._validate_image_info(None, image_info)
+
+        for devices in ([], '/dev/sda', [42]):
+            image_info['target_devices'] = devices
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, image_info)
+
+    def test_validate_image_info_target_device_hints(self):
+        image_info = _build_fake_image_info()
+        image_info['target_device_hints'] = 'model'
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, image_info)
+
+        image_info['target_device_hints'] = {'model': 'foo'}
+        image_info['target_devices'] = ['/dev/sda']
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, image_info)
+
+    def test_validate_image_info_target_devices_partition(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, image_info)
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_install_devices(self, dispatch_mock):
+        dispatch_mock.return_value = '/dev/sda'
+        image_info = _build_fake_image_info()
+        self.assertEqual(['/dev/sda'], standby._install_devices(image_info))
+        dispatch_mock.assert_called_once_with('get_os_install_device')
+
+        dispatch_mock.reset_mock()
+        image_info['target_devices'] = ['/dev/sdb', '/dev/sdc']
+        self.assertEqual(['/dev/sdb', '/dev/sdc'],
+                         standby._install_devices(image_info))
+        self.assertFalse(dispatch_mock.called)
+
+        del image_info['target_devices']
+        image_info['target_device_hints'] = {'model': 'foo'}
+        dispatch_mock.return_value = ['/dev/sdb', '/dev/sdc']
+        self.assertEqual(['/dev/sdb', '/dev/sdc'],
+                         standby._install_devices(image_info))
+        dispatch_mock.assert_called_once_with(
+            'get_os_install_devices', root_device_hints={'model': 'foo'})
+
+    def test_validate_image_info_invalid_convert_cache_mode(self):
+        image_info = _build_fake_image_info()
+        image_info['convert_cache_mode'] = 'unsafe'
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, image_info)
 
     @mock.patch('six.moves.builtins.open', autospec=True)
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
@@ -364,7 +674,7 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info = _build_fake_image_info()
         image_location = '/foo/bar'
         checksum = image_info['checksum']
-        standby._verify_image(image_info, image_location, checksum)
+        standby._verify_image(image_info, image_location, {'md5': checksum})
 
     def test_verify_image_failure(self):
         image_info = _build_fake_image_info()
@@ -372,7 +682,23 @@ class TestStandbyExtension(test_base.BaseTestCase):
         checksum = 'invalid-checksum'
         self.assertRaises(errors.ImageChecksumError,
                           standby._verify_image,
-                          image_info, image_location, checksum)
+                          image_info, image_location, {'md5': checksum})
+
+    def test_verify_image_os_hash(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha512'
+        image_info['os_hash_value'] = 'ABC456'
+        checksums = {'md5': image_info['checksum'], 'sha512': 'abc456'}
+        standby._verify_image(image_info, '/foo/bar', checksums)
+
+    def test_verify_image_os_hash_failure(self):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha512'
+        image_info['os_hash_value'] = 'abc456'
+        checksums = {'md5': image_info['checksum'], 'sha512': 'invalid'}
+        self.assertRaisesRegex(errors.ImageChecksumError, 'abc456',
+                               standby._verify_image, image_info, '/foo/bar',
+                               checksums)
 
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
                 autospec=True)
@@ -388,8 +714,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           '/tmp/fake_id')
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -413,8 +740,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           '/tmp/fake_id')
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -442,8 +770,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
             image_info=image_info, force=True
         )
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           '/tmp/fake_id')
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -504,8 +833,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           '/tmp/fake_id')
         dispatch_mock.assert_called_once_with('get_os_install_device')
         configdrive_copy_mock.assert_called_once_with(image_info['node_uuid'],
                                                       'manager',
@@ -517,6 +847,108 @@ class TestStandbyExtension(test_base.BaseTestCase):
                       '{} ').format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
 
+    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._fan_out_image', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_prepare_image_configdrive_url(self, requests_mock,
+                                           fan_out_mock,
+                                           configdrive_copy_mock):
+        image_info = _build_fake_image_info()
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.text = 'configdrive_data'
+
+        def _fan_out(ext, info, devices, stream, cached_image):
+            # The configdrive is fetched while the image is deployed
+            self.assertTrue(stage_mock.called)
+            ext.partition_uuids = {}
+
+        fan_out_mock.side_effect = _fan_out
+        with mock.patch.object(standby, '_ConfigDriveStage',
+                               side_effect=standby._ConfigDriveStage,
+                               autospec=True) as stage_mock:
+            async_result = self.agent_extension.prepare_image(
+                image_info=image_info,
+                configdrive='http://example.org/configdrive')
+            async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        # The configdrive is downloaded once for every device
+        requests_mock.assert_called_once_with(
+            'http://example.org/configdrive', proxies={}, verify=True,
+            cert=None)
+        configdrive_copy_mock.assert_has_calls([
+            mock.call(image_info['node_uuid'], '/dev/sda',
+                      'configdrive_data'),
+            mock.call(image_info['node_uuid'], '/dev/sdb',
+                      'configdrive_data')])
+
+    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_prepare_image_configdrive_url_fails(self, requests_mock,
+                                                 download_mock, write_mock,
+                                                 dispatch_mock,
+                                                 configdrive_copy_mock):
+        image_info = _build_fake_image_info()
+        dispatch_mock.return_value = 'manager'
+        requests_mock.return_value.status_code = 404
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive='http://example.org/configdrive')
+        async_result.join()
+
+        self.assertEqual('FAILED', async_result.command_status)
+        self.assertIn('Received status code 404',
+                      str(async_result.command_error))
+        self.assertFalse(configdrive_copy_mock.called)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_fetch_configdrive_content(self, requests_mock):
+        self.assertEqual('H4sI', standby._fetch_configdrive(
+            'H4sI', _build_fake_image_info()))
+        self.assertFalse(requests_mock.called)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_fetch_configdrive_url(self, requests_mock):
+        content = base64.b64encode(_gzip(b'configdrive_data'))
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.content = content
+        requests_mock.return_value.text = content.decode('ascii')
+
+        configdrive = standby._fetch_configdrive(
+            'https://example.org/configdrive', _build_fake_image_info())
+
+        # ironic-lib must be able to tell the content from a URL
+        self.assertFalse(ironic_utils.is_http_url(configdrive))
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        size, path = disk_utils._get_configdrive(configdrive, 'fake_uuid',
+                                                 tempdir=tempdir)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'configdrive_data', f.read())
+        self.assertEqual(1, size)
+        requests_mock.assert_called_once_with(
+            'https://example.org/configdrive', proxies={}, verify=True,
+            cert=None)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_fetch_configdrive_request_error(self, requests_mock):
+        requests_mock.side_effect = requests.ConnectionError('boom')
+        self.assertRaisesRegex(exception.InstanceDeployFailure, 'boom',
+                               standby._fetch_configdrive,
+                               'https://example.org/configdrive',
+                               _build_fake_image_info())
+
     @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
                 autospec=True)
     @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
@@ -542,8 +974,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           '/tmp/fake_id')
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertFalse(configdrive_copy_mock.called)
 
@@ -600,8 +1033,9 @@ class TestStandbyExtension(test_base.BaseTestCase):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info, 'manager')
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           '/tmp/fake_id')
         dispatch_mock.assert_called_once_with('get_os_install_device')
 
         self.assertEqual(0, configdrive_copy_mock.call_count)
@@ -641,9 +1075,71 @@ class TestStandbyExtension(test_base.BaseTestCase):
             self.assertFalse(cache_write_mock.called)
         else:
             cache_write_mock.assert_called_once_with(mock.ANY, image_info,
-                                                     '/dev/foo')
+                                                     '/dev/foo',
+                                                     cached_image=None)
+            self.assertFalse(stream_mock.called)
+
+    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_qcow2_image_onto_device', autospec=True)
+    def _test_prepare_image_qcow2(self, image_info, stream_mock,
+                                  cache_write_mock, dispatch_mock,
+                                  configdrive_copy_mock):
+        dispatch_mock.return_value = '/dev/foo'
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        if image_info.get('stream_qcow2_images'):
+            stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                                '/dev/foo')
+            self.assertFalse(cache_write_mock.called)
+        else:
+            cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                     '/dev/foo',
+                                                     cached_image=None)
             self.assertFalse(stream_mock.called)
 
+    def test_prepare_image_qcow2_stream_true(self):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['stream_qcow2_images'] = True
+        self._test_prepare_image_qcow2(image_info)
+
+    def test_prepare_image_qcow2_stream_default(self):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        self._test_prepare_image_qcow2(image_info)
+
+    def test_prepare_image_qcow2_stream_partition(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['stream_qcow2_images'] = True
+        with mock.patch.object(standby.StandbyExtension,
+                               '_cache_and_write_image',
+                               autospec=True) as cache_write_mock:
+            cache_write_mock.side_effect = (
+                lambda ext, info, dev, cached_image: setattr(
+                    ext, 'partition_uuids', {}))
+            with mock.patch.object(standby.StandbyExtension,
+                                   '_stream_qcow2_image_onto_device',
+                                   autospec=True) as stream_mock:
+                with mock.patch('ironic_python_agent.hardware.'
+                                'dispatch_to_managers', autospec=True):
+                    self.agent_extension.prepare_image(
+                        image_info=image_info).join()
+        self.assertTrue(cache_write_mock.called)
+        self.assertFalse(stream_mock.called)
+
     def test_prepare_image_raw_stream_true(self):
         image_info = _build_fake_image_info()
         image_info['disk_format'] = 'raw'
@@ -656,6 +1152,91 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info['stream_raw_images'] = False
         self._test_prepare_image_raw(image_info)
 
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_raw_stream_throughput(self, stream_mock,
+                                                 dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        dispatch_mock.return_value = '/dev/foo'
+        stream_mock.side_effect = (
+            lambda ext, info, dev: setattr(ext, 'write_throughput', 512.345))
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('prepare_image: image (fake_id) written to device '
+                         '/dev/foo at 512.35 MB/s ',
+                         async_result.command_result['result'])
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    def test_prepare_image_sparse_stats(self, cache_write_mock,
+                                        dispatch_mock):
+        image_info = _build_fake_image_info()
+        dispatch_mock.return_value = '/dev/foo'
+        cache_write_mock.side_effect = (
+            lambda ext, info, dev, cached_image: setattr(
+                ext, 'sparse_stats', (4096, 8192)))
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('prepare_image: image (fake_id) written to device '
+                         '/dev/foo (4096 bytes written, 8192 bytes skipped) ',
+                         async_result.command_result['result'])
+
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._write_whole_disk_image_sparse', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.image_writer.get_zero_request',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_sparse(self, download_mock, zero_mock,
+                                          write_mock, sparse_mock):
+        image_info = _build_fake_image_info()
+        image_info['sparse_writes'] = 'true'
+        zero_mock.return_value = image_writer.BLKZEROOUT
+        sparse_mock.return_value = (4096, 8192)
+
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+
+        sparse_mock.assert_called_once_with(
+            standby._image_location(image_info), image_info, '/dev/foo',
+            image_writer.BLKZEROOUT)
+        self.assertFalse(write_mock.called)
+        self.assertEqual((4096, 8192), self.agent_extension.sparse_stats)
+        self.assertEqual({}, self.agent_extension.partition_uuids)
+
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._write_whole_disk_image_sparse', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.image_writer.get_zero_request',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_sparse_unsupported(
+            self, download_mock, zero_mock, write_mock, sparse_mock):
+        image_info = _build_fake_image_info()
+        image_info['sparse_writes'] = True
+        zero_mock.return_value = None
+
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+
+        write_mock.assert_called_once_with(image_info, '/dev/foo',
+                                           '/tmp/fake_id')
+        self.assertFalse(sparse_mock.called)
+
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
     def test_run_shutdown_command_invalid(self, execute_mock):
         self.assertRaises(errors.InvalidCommandParamsError,
@@ -754,6 +1335,58 @@ class TestStandbyExtension(test_base.BaseTestCase):
         execute_mock.assert_called_once_with('sync')
         self.assertEqual('SUCCEEDED', result.command_status)
 
+    @mock.patch('ironic_lib.metrics_utils.get_metrics_logger', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_sync_timed(self, execute_mock, metrics_mock):
+        self.agent_extension.sync()
+        metrics_mock.assert_called_once_with(
+            'ironic_python_agent.extensions.standby')
+        metrics_mock.return_value.timer.assert_called_once_with('sync')
+        execute_mock.assert_called_once_with('sync')
+
+    def test_writeback_window(self):
+        self.assertEqual(0, standby._writeback_window({}))
+        self.assertEqual(
+            16 * units.Mi, standby._writeback_window({'writeback_window': 16}))
+        standby.CONF.set_override('image_writeback_window', 32)
+        self.addCleanup(standby.CONF.clear_override, 'image_writeback_window')
+        self.assertEqual(32 * units.Mi, standby._writeback_window({}))
+        self.assertEqual(0,
+                         standby._writeback_window({'writeback_window': 0}))
+
+    @mock.patch.object(standby, '_download_rate_override', None)
+    @mock.patch.object(standby, '_download_limiter', autospec=True)
+    def test_set_download_rate(self, limiter_mock):
+        result = self.agent_extension.set_download_rate(rate=12.5)
+        limiter_mock.set_rate.assert_called_once_with(12.5 * units.M)
+        self.assertEqual('SUCCEEDED', result.command_status)
+        self.assertTrue(
+            self.agent_extension.set_download_rate.allowed_while_busy)
+
+    @mock.patch.object(standby, '_image_download_rate', 0.0)
+    @mock.patch.object(standby, '_download_rate_override', None)
+    @mock.patch.object(standby, '_download_limiter', autospec=True)
+    def test_set_download_rate_overrides_image_rate(self, limiter_mock):
+        image_info = _build_fake_image_info()
+        image_info['download_rate'] = 2
+        self.agent_extension.set_download_rate(rate=12.5)
+
+        # Such as a download resumed or started after the rate was set
+        standby._apply_download_rate(image_info)
+        limiter_mock.set_rate.assert_called_once_with(12.5 * units.M)
+
+        self.agent_extension.set_download_rate(rate=None)
+        limiter_mock.set_rate.assert_called_with(2 * units.M)
+        standby._apply_download_rate(image_info)
+        self.assertEqual(3, limiter_mock.set_rate.call_count)
+        self.assertIsNone(standby._download_rate_override)
+
+    @mock.patch.object(standby, '_download_limiter', autospec=True)
+    def test_set_download_rate_invalid(self, limiter_mock):
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          self.agent_extension.set_download_rate, rate=-1)
+        self.assertFalse(limiter_mock.set_rate.called)
+
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
     def test_sync_error(self, execute_mock):
         execute_mock.side_effect = processutils.ProcessExecutionError
@@ -769,56 +1402,1161 @@ class TestStandbyExtension(test_base.BaseTestCase):
         image_info = _build_fake_image_info()
         device = '/dev/foo'
         self.agent_extension._cache_and_write_image(image_info, device)
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, device)
+        download_mock.assert_called_once_with(image_info, '/dev/foo')
+        write_mock.assert_called_once_with(image_info, device,
+                                           '/tmp/fake_id')
 
-    @mock.patch('hashlib.md5', autospec=True)
-    @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
-    def test_stream_raw_image_onto_device(self, requests_mock, open_mock,
-                                          md5_mock):
+    @mock.patch('os.path.getsize', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._read_back_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_verify_writes(self, download_mock,
+                                                 write_mock, read_back_mock,
+                                                 getsize_mock):
         image_info = _build_fake_image_info()
-        response = requests_mock.return_value
-        response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
-        file_mock = mock.Mock()
-        open_mock.return_value.__enter__.return_value = file_mock
-        file_mock.read.return_value = None
-        hexdigest_mock = md5_mock.return_value.hexdigest
-        hexdigest_mock.return_value = image_info['checksum']
+        image_info['verify_writes'] = True
+        getsize_mock.return_value = 4096
+        read_back_mock.return_value = 12.5
 
-        self.agent_extension._stream_raw_image_onto_device(image_info,
-                                                           '/dev/foo')
-        requests_mock.assert_called_once_with(image_info['urls'][0],
-                                              cert=None, verify=True,
-                                              stream=True, proxies={})
-        expected_calls = [mock.call('some'), mock.call('content')]
-        file_mock.write.assert_has_calls(expected_calls)
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
 
-    @mock.patch('hashlib.md5', autospec=True)
-    @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
-    def test_stream_raw_image_onto_device_write_error(self, requests_mock,
-                                                      open_mock, md5_mock):
-        image_info = _build_fake_image_info()
-        response = requests_mock.return_value
-        response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
-        file_mock = mock.Mock()
-        open_mock.return_value.__enter__.return_value = file_mock
-        file_mock.write.side_effect = Exception('Surprise!!!1!')
-        hexdigest_mock = md5_mock.return_value.hexdigest
-        hexdigest_mock.return_value = image_info['checksum']
+        read_back_mock.assert_called_once_with(image_info, '/dev/foo', 4096)
+        getsize_mock.assert_called_once_with('/tmp/fake_id')
+        self.assertEqual(12.5, self.agent_extension.verify_throughput)
+        self.assertIn('verified at 12.50 MB/s',
+                      self.agent_extension._write_summary())
 
-        self.assertRaises(errors.ImageDownloadError,
-                          self.agent_extension._stream_raw_image_onto_device,
-                          image_info, '/dev/foo')
-        requests_mock.assert_called_once_with(image_info['urls'][0],
-                                              cert=None, verify=True,
-                                              stream=True, proxies={})
-        # Assert write was only called once and failed!
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_adds_to_cache(self, download_mock,
+                                                 write_mock):
+        image_info = _build_fake_image_info()
+        cache = mock.Mock(spec=image_cache.ImageCache)
+        cache.lookup.return_value = None
+        cache.add.return_value = '/cache/md5-abc123'
+        self.agent_extension.image_cache = cache
+
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+
+        download_mock.assert_called_once_with(image_info, '/dev/foo')
+        cache.lookup.assert_called_once_with(['md5-abc123'])
+        cache.add.assert_called_once_with('/tmp/fake_id', ['md5-abc123'])
+        write_mock.assert_called_once_with(image_info, '/dev/foo',
+                                           '/cache/md5-abc123')
+
+    def _staged(self, image_info, *args, **kwargs):
+        staged = image_staging.StagedImage(*args, **kwargs)
+        standby._staged_images[image_info['id']] = staged
+        self.addCleanup(standby._staged_images.pop, image_info['id'], None)
+        return staged
+
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_staged_on_device(self, download_mock,
+                                                    write_mock, info_mock):
+        image_info = _build_fake_image_info()
+        cache = mock.Mock(spec=image_cache.ImageCache)
+        cache.lookup.return_value = None
+        self.agent_extension.image_cache = cache
+        info_mock.return_value.virtual_size = 3000
+        download_mock.side_effect = lambda info, device: self._staged(
+            info, '/dev/loop3', 1000, device=device, offset=3000)
+
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+
+        # An image staged on a device is not cached
+        self.assertFalse(cache.add.called)
+        info_mock.assert_called_once_with('/dev/loop3')
+        write_mock.assert_called_once_with(image_info, '/dev/foo',
+                                           '/dev/loop3')
+
+        # The image must not reach its staging area once written
+        info_mock.return_value.virtual_size = 3001
+        self.agent_extension.cached_image_id = None
+        write_mock.reset_mock()
+        self.assertRaisesRegex(
+            errors.ImageWriteError, 'staged at offset 3000',
+            self.agent_extension._cache_and_write_image, image_info,
+            '/dev/foo')
+        self.assertFalse(write_mock.called)
+
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    def test_cache_image_releases_staged_image(self, dispatch_mock,
+                                               download_mock, write_mock):
+        image_info = _build_fake_image_info()
+        dispatch_mock.return_value = '/dev/foo'
+        staged = []
+        download_mock.side_effect = lambda info, device: staged.append(
+            self._staged(info, '/tmp/scratch/fake_id', 1000,
+                         temporary=True))
+        write_mock.side_effect = errors.ImageWriteError('/dev/foo', 1, '',
+                                                        '')
+
+        with mock.patch.object(image_staging.StagedImage, 'release',
+                               autospec=True) as release_mock:
+            async_result = self.agent_extension.cache_image(
+                image_info=image_info)
+            async_result.join()
+
+        self.assertEqual('FAILED', async_result.command_status)
+        write_mock.assert_called_once_with(image_info, '/dev/foo',
+                                           '/tmp/scratch/fake_id')
+        release_mock.assert_called_once_with(staged[0])
+        self.assertNotIn(image_info['id'], standby._staged_images)
+        self.assertEqual('/tmp/fake_id', standby._image_location(image_info))
+
+    @mock.patch.object(image_staging, 'allocate', autospec=True)
+    @mock.patch('requests.head', autospec=True)
+    def test_stage_image(self, head_mock, allocate_mock):
+        image_info = _build_fake_image_info()
+        allocate_mock.return_value = image_staging.StagedImage('/dev/loop3')
+        self.addCleanup(standby._staged_images.pop, image_info['id'], None)
+
+        # The image is staged in memory without other staging area
+        standby._stage_image(image_info, '/dev/foo')
+        allocate_mock.assert_called_once_with(
+            'fake_id', None, 1024 * units.Mi, scratch_dir=None, device=None)
+        self.assertFalse(head_mock.called)
+
+        image_info['staging_device_tail'] = True
+        head_mock.return_value.status_code = 200
+        head_mock.return_value.headers = {'Content-Length': '12345'}
+        allocate_mock.reset_mock()
+        staged = standby._stage_image(image_info, '/dev/foo')
+        allocate_mock.assert_called_once_with(
+            'fake_id', 12345, 1024 * units.Mi, scratch_dir=None,
+            device='/dev/foo')
+        head_mock.assert_called_once_with(
+            'http://example.org', allow_redirects=True, proxies={},
+            verify=True, cert=None)
+        self.assertIs(staged, standby._staged_images['fake_id'])
+        self.assertEqual('/dev/loop3', standby._image_location(image_info))
+
+        # Partition images are not staged on the device they are written to
+        image_info['image_type'] = 'partition'
+        allocate_mock.reset_mock()
+        standby._stage_image(image_info, '/dev/foo')
+        allocate_mock.assert_called_once_with(
+            'fake_id', None, 1024 * units.Mi, scratch_dir=None, device=None)
+
+    @mock.patch('requests.head', autospec=True)
+    def test_staging_size(self, head_mock):
+        image_info = _build_fake_image_info()
+        head_mock.return_value.status_code = 404
+        head_mock.return_value.headers = {}
+        self.assertIsNone(standby._staging_size(image_info))
+
+        head_mock.side_effect = requests.ConnectionError('boom')
+        self.assertIsNone(standby._staging_size(image_info))
+
+        # The size of compressed images is only known from image_info
+        head_mock.reset_mock()
+        image_info['compression'] = 'gzip'
+        self.assertIsNone(standby._staging_size(image_info))
+        image_info['image_size'] = 4096
+        self.assertEqual(4096, standby._staging_size(image_info))
+        self.assertFalse(head_mock.called)
+
+    def test_validate_image_info_image_size(self):
+        image_info = _build_fake_image_info()
+        for size in (-1, '10', True):
+            image_info['image_size'] = size
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info, None, image_info)
+
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_and_write_image_from_cache(self, download_mock,
+                                              write_mock):
+        image_info = _build_fake_image_info()
+        cache = mock.Mock(spec=image_cache.ImageCache)
+        cache.lookup.return_value = '/cache/md5-abc123'
+        self.agent_extension.image_cache = cache
+
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
+
+        self.assertFalse(download_mock.called)
+        self.assertFalse(cache.add.called)
+        write_mock.assert_called_once_with(image_info, '/dev/foo',
+                                           '/cache/md5-abc123')
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_raw_from_cache(self, stream_mock,
+                                          cache_write_mock, dispatch_mock):
+        dispatch_mock.return_value = '/dev/foo'
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        cache = mock.Mock(spec=image_cache.ImageCache)
+        cache.lookup.return_value = '/cache/md5-abc123'
+        self.agent_extension.image_cache = cache
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        cache.lookup.assert_called_once_with(
+            image_cache.cache_keys([('md5', image_info['checksum'])]))
+        cache_write_mock.assert_called_once_with(
+            mock.ANY, image_info, '/dev/foo',
+            cached_image='/cache/md5-abc123')
+        self.assertFalse(stream_mock.called)
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device(self, requests_mock, open_mock,
+                                          md5_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        file_mock.read.return_value = None
+        hexdigest_mock = md5_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        requests_mock.assert_called_once_with(image_info['urls'][0],
+                                              cert=None, verify=True,
+                                              stream=True, proxies={})
+        expected_calls = [mock.call('some'), mock.call('content')]
+        file_mock.write.assert_has_calls(expected_calls)
+
+    def _zero_copy_image(self, body, response=None):
+        server = test_zero_copy.FakeImageServer(
+            response or test_zero_copy.http_response(body))
+        self.addCleanup(server.stop)
+        fd, device = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, device)
+        image_info = _build_fake_image_info()
+        image_info['urls'] = [server.url]
+        image_info['checksum'] = hashlib.md5(body).hexdigest()
+        image_info['zero_copy'] = True
+        image_info['disk_format'] = 'raw'
+        return image_info, device
+
+    @unittest.skipUnless(zero_copy.supported(), 'splice is not supported')
+    @mock.patch.object(standby, 'ImageDownload', autospec=True)
+    def test_stream_raw_image_onto_device_zero_copy(self, download_mock):
+        body = os.urandom(3 * units.Mi + 7)
+        image_info, device = self._zero_copy_image(body)
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device)
+
+        with open(device, 'rb') as f:
+            self.assertEqual(body, f.read())
+        self.assertFalse(download_mock.called)
+        self.assertIsNotNone(self.agent_extension.write_throughput)
+        self.assertIsNotNone(self.agent_extension.verify_throughput)
+
+    @unittest.skipUnless(zero_copy.supported(), 'splice is not supported')
+    def test_stream_raw_image_onto_device_zero_copy_mismatch(self):
+        image_info, device = self._zero_copy_image(b'image')
+        image_info['checksum'] = hashlib.md5(b'other').hexdigest()
+
+        self.assertRaises(errors.ImageChecksumError,
+                          self.agent_extension._stream_raw_image_onto_device,
+                          image_info, device)
+
+    @unittest.skipUnless(zero_copy.supported(), 'splice is not supported')
+    def test_stream_raw_image_onto_device_zero_copy_truncated(self):
+        image_info, device = self._zero_copy_image(
+            b'image', test_zero_copy.http_response(
+                b'image', headers=['Content-Length: 100']))
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'closed with 95 bytes',
+                               self.agent_extension
+                               ._stream_raw_image_onto_device,
+                               image_info, device)
+
+    @mock.patch.object(zero_copy, 'open_response', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_zero_copy_fallback(
+            self, requests_mock, open_mock, md5_mock, open_response_mock):
+        image_info = _build_fake_image_info()
+        image_info['zero_copy'] = True
+        open_response_mock.side_effect = zero_copy.Unavailable(
+            'Received status code 302, expected 200')
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        with mock.patch.object(zero_copy, 'supported', return_value=True,
+                               autospec=True):
+            self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                               '/dev/foo')
+
+        open_response_mock.assert_called_once_with('http://example.org')
+        file_mock.write.assert_has_calls([mock.call('some'),
+                                          mock.call('content')])
+
+    @mock.patch.object(zero_copy, 'supported', return_value=True,
+                       autospec=True)
+    @mock.patch('requests.utils.get_environ_proxies', autospec=True)
+    def test_zero_copy_url(self, proxies_mock, supported_mock):
+        image_info = _build_fake_image_info()
+        proxies_mock.return_value = {}
+        self.assertIsNone(standby._zero_copy_url(image_info))
+        image_info['zero_copy'] = True
+        self.assertEqual('http://example.org',
+                         standby._zero_copy_url(image_info))
+        proxies_mock.assert_called_once_with('http://example.org',
+                                             no_proxy=None)
+
+        for field, value in (('urls', ['https://example.org']),
+                             ('proxies', {'http': 'http://proxy:3128'}),
+                             ('compression', 'gzip'),
+                             ('swarm', {}),
+                             ('download_checkpoints', True)):
+            info = dict(image_info)
+            info[field] = value
+            self.assertIsNone(standby._zero_copy_url(info), field)
+
+        proxies_mock.return_value = {'http': 'http://proxy:3128'}
+        self.assertIsNone(standby._zero_copy_url(image_info))
+
+        proxies_mock.return_value = {}
+        supported_mock.return_value = False
+        self.assertIsNone(standby._zero_copy_url(image_info))
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_write_error(self, requests_mock,
+                                                      open_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        file_mock.write.side_effect = Exception('Surprise!!!1!')
+        hexdigest_mock = md5_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['checksum']
+
+        self.assertRaises(errors.ImageWriteError,
+                          self.agent_extension._stream_raw_image_onto_device,
+                          image_info, '/dev/foo')
+        requests_mock.assert_called_once_with(image_info['urls'][0],
+                                              cert=None, verify=True,
+                                              stream=True, proxies={})
+        # Assert write was only called once and failed!
         file_mock.write.assert_called_once_with('some')
 
+    @mock.patch('ironic_python_agent.image_writer.DirectWriter',
+                autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_direct_io(self, requests_mock,
+                                                    md5_mock, writer_mock):
+        image_info = _build_fake_image_info()
+        image_info['direct_io_queue_depth'] = 4
+        image_info['direct_io_block_size'] = 2
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        writer = writer_mock.return_value
+        writer.bytes_written = 11
+        writer.bytes_zeroed = 0
+        hexdigest_mock = md5_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+
+        writer_mock.assert_called_once_with('/dev/foo', 4, 2 * units.Mi,
+                                            None)
+        writer.write.assert_has_calls([mock.call('some'),
+                                       mock.call('content')])
+        writer.close.assert_called_once_with()
+        self.assertFalse(writer.abort.called)
+        self.assertGreater(self.agent_extension.write_throughput, 0)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    @mock.patch('ironic_python_agent.image_writer.get_zero_request',
+                autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_sparse(self, requests_mock,
+                                                 open_mock, md5_mock,
+                                                 zero_mock, ioctl_mock):
+        image_info = _build_fake_image_info()
+        image_info['sparse_writes'] = True
+        zero_mock.return_value = image_writer.BLKZEROOUT
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some',
+                                              b'\0' * 128 * units.Ki]
+        file_mock = mock.Mock()
+        file_mock.fileno.return_value = 42
+        open_mock.return_value.__enter__.return_value = file_mock
+        hexdigest_mock = md5_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+
+        zero_mock.assert_called_once_with('/dev/foo')
+        ioctl_mock.assert_called_once_with(
+            42, image_writer.BLKZEROOUT, mock.ANY)
+        # Only the page aligned part of the zeroes is skipped
+        self.assertEqual((4 + 4096, 128 * units.Ki - 4096),
+                         self.agent_extension.sparse_stats)
+
+    def _make_fan_out_devices(self, count=2):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        devices = [os.path.join(tempdir, 'device%d' % i)
+                   for i in range(count)]
+        for device in devices:
+            open(device, 'wb').close()
+        return tempdir, devices
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_fan_out_image_stream(self, requests_mock, execute_mock):
+        content = b'a' * 5000 + b'b' * 7000
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(content).hexdigest()
+        image_info['disk_format'] = 'raw'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [content[:5000],
+                                              content[5000:]]
+        _tempdir, devices = self._make_fan_out_devices()
+
+        self.agent_extension._fan_out_image(image_info, devices, True)
+
+        self.assertEqual(1, requests_mock.call_count)
+        execute_mock.assert_has_calls([mock.call('sgdisk', '-Z', device)
+                                       for device in devices])
+        for device in devices:
+            with open(device, 'rb') as f:
+                self.assertEqual(content, f.read())
+        self.assertGreater(self.agent_extension.write_throughput, 0)
+        self.assertIsNone(self.agent_extension.cached_image_id)
+        self.assertEqual({}, self.agent_extension.partition_uuids)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_fan_out_image_stream_checksum_mismatch(self, requests_mock,
+                                                    execute_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'content']
+        _tempdir, devices = self._make_fan_out_devices()
+
+        self.assertRaises(errors.ImageChecksumError,
+                          self.agent_extension._fan_out_image,
+                          image_info, devices, True)
+
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._read_back_image', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._local_image', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_fan_out_image_qcow2(self, execute_mock, local_mock, info_mock,
+                                 read_back_mock):
+        guest = {0: test_qcow2._cluster(1), 5: test_qcow2._cluster(2)}
+        virtual_size = 8 * test_qcow2.CLUSTER_SIZE
+        tempdir, devices = self._make_fan_out_devices(3)
+        image = os.path.join(tempdir, 'image')
+        with open(image, 'wb') as f:
+            f.write(test_qcow2.build_qcow2(guest, virtual_size))
+        local_mock.return_value = image
+        info_mock.return_value.file_format = 'qcow2'
+        image_info = _build_fake_image_info()
+        image_info['convert_cache_mode'] = 'writeback'
+        image_info['verify_writes'] = True
+
+        self.agent_extension._fan_out_image(image_info, devices, False)
+
+        expected = bytearray(virtual_size)
+        for index, value in guest.items():
+            start = index * test_qcow2.CLUSTER_SIZE
+            expected[start:start + test_qcow2.CLUSTER_SIZE] = value
+        for device in devices:
+            with open(device, 'rb') as f:
+                self.assertEqual(bytes(expected), f.read())
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+        self.assertFalse(read_back_mock.called)
+
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._write_whole_disk_image', autospec=True)
+    @mock.patch('os.path.getsize', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._local_image', autospec=True)
+    def test_fan_out_image_unsupported_format(self, local_mock, info_mock,
+                                              getsize_mock, write_mock):
+        local_mock.return_value = '/tmp/image'
+        info_mock.return_value.file_format = 'vmdk'
+        getsize_mock.return_value = 1024
+        image_info = _build_fake_image_info()
+
+        self.agent_extension._fan_out_image(image_info,
+                                            ['/dev/sda', '/dev/sdb'], False)
+
+        qemu_image_info = dict(image_info, image_converter='qemu-img')
+        write_mock.assert_has_calls([
+            mock.call('/tmp/image', qemu_image_info, '/dev/sda'),
+            mock.call('/tmp/image', qemu_image_info, '/dev/sdb')])
+
+    @mock.patch('ironic_python_agent.extensions.standby'
+                '._write_whole_disk_image', autospec=True)
+    @mock.patch('ironic_python_agent.image_convert.copy_image',
+                autospec=True)
+    @mock.patch('ironic_lib.disk_utils.qemu_img_info', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._local_image', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_fan_out_image_format_error(self, execute_mock, local_mock,
+                                        info_mock, copy_mock, write_mock):
+        tempdir, devices = self._make_fan_out_devices(2)
+        image = os.path.join(tempdir, 'image')
+        with open(image, 'wb') as f:
+            f.write(b'qcow2')
+        local_mock.return_value = image
+        info_mock.return_value.file_format = 'qcow2'
+        copy_mock.side_effect = errors.ImageFormatError('external data file')
+        image_info = _build_fake_image_info()
+
+        self.agent_extension._fan_out_image(image_info, devices, False)
+
+        qemu_image_info = dict(image_info, image_converter='qemu-img')
+        write_mock.assert_has_calls([
+            mock.call(image, qemu_image_info, devices[0]),
+            mock.call(image, qemu_image_info, devices[1])])
+        self.assertEqual('fake_id', self.agent_extension.cached_image_id)
+
+    @mock.patch('ironic_python_agent.image_convert.open_writer',
+                autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_fan_out_image_write_error(self, requests_mock, execute_mock,
+                                       open_writer_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'a' * 10] * 100
+        good_writer = mock.Mock()
+        bad_writer = mock.Mock()
+        bad_writer.write.side_effect = IOError('disk failure')
+        open_writer_mock.side_effect = [good_writer, bad_writer]
+
+        self.assertRaises(errors.ImageWriteError,
+                          self.agent_extension._fan_out_image,
+                          image_info, ['/dev/sda', '/dev/sdb'], True)
+        good_writer.abort.assert_called_once_with()
+        bad_writer.abort.assert_called_once_with()
+        self.assertFalse(good_writer.close.called)
+
+    def _setup_delta(self, old, new, chunk_size=4096, device_size=None):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        device = os.path.join(tempdir, 'device')
+        with open(device, 'wb') as f:
+            f.write(old)
+            f.truncate(device_size or len(old))
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['checksum'] = hashlib.md5(new).hexdigest()
+        image_info['chunk_manifest'] = {
+            'chunk_size': chunk_size,
+            'digests': [hashlib.sha256(new[i:i + chunk_size]).hexdigest()
+                        for i in range(0, len(new), chunk_size)]}
+        requested = []
+        # Ranges are fetched with sessions, sent through requests.get too
+        patcher = mock.patch('requests.Session', autospec=True)
+        self.session_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session_mock.return_value.get.side_effect = (
+            lambda url, **kwargs: requests.get(url, **kwargs))
+
+        def _get(url, headers=None, **kwargs):
+            start, end = [int(value) for value in
+                          headers['Range'][len('bytes='):].split('-')]
+            requested.append((start, end))
+            resp = mock.Mock(status_code=206,
+                             content=new[start:end + 1],
+                             headers={'Content-Range': 'bytes {}-{}/{}'.format(
+                                 start, end, len(new))})
+            return resp
+
+        return image_info, device, requested, _get
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta(self, requests_mock):
+        old = b'a' * 4096 + b'b' * 4096 + b'c' * 4096 + b'd' * 4096 + b'e'
+        new = b'a' * 4096 + b'X' * 4096 + b'Y' * 4096 + b'd' * 4096 + b'Z'
+        image_info, device, requested, requests_mock.side_effect = (
+            self._setup_delta(old, new, device_size=3 * units.Mi))
+
+        self.assertTrue(self.agent_extension._write_image_delta(image_info,
+                                                                '%s' % device))
+
+        with open(device, 'rb') as f:
+            content = f.read()
+        self.assertEqual(new, content[:len(new)])
+        self.assertEqual(b'\0' * units.Mi, content[-units.Mi:])
+        # The size probe, then the two adjacent differing chunks are merged
+        # into one range
+        self.assertEqual([(0, 0), (4096, 12287), (16384, 16384)], requested)
+        self.assertEqual((8193, len(new) - 8193),
+                         self.agent_extension.delta_stats)
+        self.assertEqual({}, self.agent_extension.partition_uuids)
+        self.assertIn('(8193 bytes fetched, 8192 bytes saved) ',
+                      self.agent_extension._write_summary())
+        self.assertEqual(2, self.session_mock.return_value.get.call_count)
+        self.assertEqual(self.session_mock.call_count,
+                         self.session_mock.return_value.close.call_count)
+
+    @mock.patch.object(standby, '_download_limiter', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_rate(self, requests_mock, limiter_mock):
+        old = b'a' * 4096 + b'b' * 4096 + b'c' * 4096
+        new = b'a' * 4096 + b'X' * 4096 + b'c' * 4096 + b'Z'
+        image_info, device, requested, requests_mock.side_effect = (
+            self._setup_delta(old + b'\0', new))
+
+        self.assertTrue(self.agent_extension._write_image_delta(image_info,
+                                                                device))
+        self.assertEqual([(0, 0), (4096, 8191), (12288, 12288)], requested)
+        limiter_mock.consume.assert_has_calls([mock.call(4096),
+                                               mock.call(1)], any_order=True)
+        self.assertEqual(2, limiter_mock.consume.call_count)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_refetch(self, requests_mock):
+        old = b'a' * 8192
+        new = b'a' * 4096 + b'b' * 4096
+        image_info, device, requested, get = self._setup_delta(old, new)
+        image_info['chunk_refetch_attempts'] = 1
+        corrupted = []
+
+        def _get(url, headers=None, **kwargs):
+            resp = get(url, headers=headers, **kwargs)
+            if resp.content == b'b' * 4096 and not corrupted:
+                corrupted.append(True)
+                resp.content = b'c' * 4096
+            return resp
+
+        requests_mock.side_effect = _get
+
+        self.assertTrue(self.agent_extension._write_image_delta(image_info,
+                                                                device))
+        with open(device, 'rb') as f:
+            self.assertEqual(new, f.read())
+        self.assertEqual([(0, 0), (4096, 8191), (4096, 8191)], requested)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_checksum_mismatch(self, requests_mock):
+        # The manifest matches the device, but not the image checksum
+        image_info, device, requested, requests_mock.side_effect = (
+            self._setup_delta(b'a' * 8192, b'a' * 8192))
+        image_info['checksum'] = hashlib.md5(b'other').hexdigest()
+
+        self.assertRaises(errors.ImageChecksumError,
+                          self.agent_extension._write_image_delta,
+                          image_info, device)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_no_checksum(self, requests_mock):
+        image_info, device, requested, requests_mock.side_effect = (
+            self._setup_delta(b'a' * 8192, b'a' * 4096 + b'b' * 4096))
+        del image_info['checksum']
+
+        self.assertTrue(self.agent_extension._write_image_delta(image_info,
+                                                                device))
+        self.assertIsNotNone(self.agent_extension.verify_throughput)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_unchanged(self, requests_mock):
+        image = b'a' * 8192
+        image_info, device, requested, requests_mock.side_effect = (
+            self._setup_delta(image, image))
+
+        self.assertTrue(self.agent_extension._write_image_delta(image_info,
+                                                                device))
+        self.assertEqual([(0, 0)], requested)
+        self.assertEqual((0, 8192), self.agent_extension.delta_stats)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_device_too_small(self, requests_mock):
+        image_info, device, requested, requests_mock.side_effect = (
+            self._setup_delta(b'a' * 4096, b'a' * 8192))
+        self.assertFalse(self.agent_extension._write_image_delta(image_info,
+                                                                 device))
+        self.assertEqual([(0, 0)], requested)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_write_image_delta_no_ranges(self, requests_mock):
+        image_info, device, _requested, _get = self._setup_delta(
+            b'a' * 4096, b'a' * 4096)
+        requests_mock.return_value.status_code = 200
+        self.assertFalse(self.agent_extension._write_image_delta(image_info,
+                                                                 device))
+
+    def test_write_image_delta_no_manifest(self):
+        image_info = _build_fake_image_info()
+        self.assertFalse(self.agent_extension._write_image_delta(
+            image_info, '/dev/foo'))
+
+    def test_delta_ranges(self):
+        self.assertEqual(
+            [(0, 9), (20, 39), (40, 44)],
+            standby._delta_ranges([0, 2, 3, 4], 10, 45, 20))
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._write_image_delta', autospec=True)
+    def test_prepare_image_delta(self, delta_mock, stream_mock,
+                                 dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        image_info['delta_deploy'] = True
+        dispatch_mock.return_value = '/dev/foo'
+
+        def _delta(ext, info, device):
+            ext.partition_uuids = {}
+            ext.delta_stats = (100, 900)
+            return True
+
+        delta_mock.side_effect = _delta
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        delta_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        self.assertFalse(stream_mock.called)
+        self.assertEqual('prepare_image: image (fake_id) written to device '
+                         '/dev/foo (100 bytes fetched, 900 bytes saved) ',
+                         async_result.command_result['result'])
+
+        # The whole image is deployed if it cannot be deployed as a delta
+        delta_mock.side_effect = None
+        delta_mock.return_value = False
+        stream_mock.side_effect = (
+            lambda ext, info, dev: setattr(ext, 'partition_uuids', {}))
+        self.agent_extension.prepare_image(image_info=image_info).join()
+        stream_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+
+    @mock.patch('ironic_python_agent.image_writer.discard_device',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_discard(self, stream_mock, dispatch_mock,
+                                   discard_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        image_info['discard_device'] = True
+        image_info['sparse_writes'] = True
+        dispatch_mock.return_value = '/dev/foo'
+        discard_mock.return_value = (units.Gi, True)
+        zero_requests = []
+
+        def _stream(ext, info, device):
+            ext.partition_uuids = {}
+            zero_requests.append(standby._sparse_zero_request(info, device))
+
+        stream_mock.side_effect = _stream
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        discard_mock.assert_called_once_with('/dev/foo')
+        self.assertEqual([image_writer.DISCARDED], zero_requests)
+        self.assertIn('(1 devices discarded, 1 guaranteeing discarded blocks '
+                      'read back as zeroes) ',
+                      async_result.command_result['result'])
+        self.assertNotIn('/dev/foo', standby._discarded_devices)
+
+    @mock.patch('ironic_python_agent.image_writer.discard_device',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._write_image_delta', autospec=True)
+    def test_prepare_image_delta_not_discarded(self, delta_mock,
+                                               dispatch_mock, discard_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        image_info['delta_deploy'] = True
+        image_info['discard_device'] = True
+        dispatch_mock.return_value = '/dev/foo'
+        delta_mock.side_effect = (
+            lambda ext, info, dev: setattr(ext, 'partition_uuids', {}) or
+            True)
+
+        self.agent_extension.prepare_image(image_info=image_info).join()
+
+        delta_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        self.assertFalse(discard_mock.called)
+
+    @mock.patch('ironic_python_agent.image_writer.discard_device',
+                autospec=True)
+    def test_discard_devices(self, discard_mock):
+        image_info = _build_fake_image_info()
+        self.addCleanup(standby._discarded_devices.clear)
+
+        self.assertIsNone(standby._discard_devices(image_info, ['/dev/foo']))
+        self.assertFalse(discard_mock.called)
+
+        image_info['discard_device'] = True
+        discard_mock.side_effect = [(units.Gi, True), (units.Gi, False),
+                                    (0, False),
+                                    OSError(errno.EOPNOTSUPP, 'Nope')]
+        self.assertEqual((2, 1), standby._discard_devices(
+            image_info, ['/dev/a', '/dev/b', '/dev/c', '/dev/d']))
+        self.assertEqual(4, discard_mock.call_count)
+        self.assertEqual({'/dev/a'}, standby._discarded_devices)
+
+    @mock.patch('os.path.exists', autospec=True)
+    @mock.patch('ironic_python_agent.image_writer.discard_device',
+                autospec=True)
+    def test_discard_devices_checkpoint(self, discard_mock, exists_mock):
+        image_info = _build_fake_image_info()
+        image_info['discard_device'] = True
+        image_info['download_checkpoints'] = True
+        exists_mock.return_value = True
+
+        standby._discard_devices(image_info, ['/dev/foo'])
+
+        exists_mock.assert_called_once_with(
+            standby._device_checkpoint_path(image_info, '/dev/foo'))
+        self.assertFalse(discard_mock.called)
+
+    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._fan_out_image', autospec=True)
+    def test_prepare_image_fan_out(self, fan_out_mock, configdrive_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        image_info['target_devices'] = ['/dev/sda', '/dev/sdb']
+        fan_out_mock.side_effect = (
+            lambda ext, info, devs, stream, cached_image: setattr(
+                ext, 'partition_uuids', {}))
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info, configdrive='configdrive_data')
+        async_result.join()
+
+        fan_out_mock.assert_called_once_with(
+            mock.ANY, image_info, ['/dev/sda', '/dev/sdb'], True,
+            cached_image=None)
+        configdrive_mock.assert_has_calls([
+            mock.call(image_info['node_uuid'], '/dev/sda',
+                      'configdrive_data'),
+            mock.call(image_info['node_uuid'], '/dev/sdb',
+                      'configdrive_data')])
+        self.assertEqual('prepare_image: image (fake_id) written to device '
+                         '/dev/sda, /dev/sdb ',
+                         async_result.command_result['result'])
+
+    @mock.patch('ironic_python_agent.image_writer.DirectWriter',
+                autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_direct_io_error(
+            self, requests_mock, md5_mock, writer_mock):
+        image_info = _build_fake_image_info()
+        image_info['direct_io_queue_depth'] = 2
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        writer = writer_mock.return_value
+        writer.close.side_effect = OSError(5, 'Input/output error')
+
+        self.assertRaisesRegex(errors.ImageWriteError,
+                               'Input/output error',
+                               self.agent_extension
+                               ._stream_raw_image_onto_device,
+                               image_info, '/dev/foo')
+        writer.abort.assert_called_once_with()
+        self.assertFalse(md5_mock.return_value.hexdigest.called)
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_pipeline(self, requests_mock,
+                                                   open_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['pipeline_chunks'] = 2
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content', b'more']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        written = []
+        file_mock.write.side_effect = lambda data: written.append(
+            data.tobytes())
+        hashed = []
+        md5_mock.return_value.update.side_effect = lambda data: hashed.append(
+            data.tobytes())
+        hexdigest_mock = md5_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        self.assertEqual([b'some', b'content', b'more'], written)
+        self.assertEqual([b'some', b'content', b'more'], hashed)
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_onto_device_pipeline_write_error(
+            self, requests_mock, open_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['pipeline_chunks'] = 1
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'some', b'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        file_mock.write.side_effect = Exception('Surprise!!!1!')
+
+        self.assertRaises(errors.ImageWriteError,
+                          self.agent_extension._stream_raw_image_onto_device,
+                          image_info, '/dev/foo')
+        self.assertEqual(1, file_mock.write.call_count)
+        self.assertFalse(md5_mock.return_value.hexdigest.called)
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_pipeline_download_error(self, requests_mock,
+                                                    open_mock, md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['pipeline_chunks'] = 4
+
+        def _iter_content(chunk_size):
+            yield b'some'
+            raise IOError('Connection reset')
+
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.side_effect = _iter_content
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Connection reset',
+                               standby._download_image, image_info)
+        self.assertFalse(md5_mock.return_value.hexdigest.called)
+
+    @mock.patch('ironic_python_agent.qcow2.StreamingDecoder', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_device(self, requests_mock, open_mock,
+                                            md5_mock, execute_mock,
+                                            decoder_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        self.agent_extension._stream_qcow2_image_onto_device(image_info,
+                                                             '/dev/foo')
+
+        execute_mock.assert_called_once_with('sgdisk', '-Z', '/dev/foo')
+        open_mock.assert_called_once_with('/dev/foo', 'wb+')
+        decoder = decoder_mock.return_value
+        decoder.feed.assert_has_calls([mock.call('some'),
+                                       mock.call('content')])
+        decoder.finish.assert_called_once_with()
+
+    @mock.patch('ironic_python_agent.qcow2.StreamingDecoder', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_device_format_error(
+            self, requests_mock, open_mock, md5_mock, execute_mock,
+            decoder_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        decoder_mock.return_value.finish.side_effect = (
+            errors.ImageFormatError('truncated'))
+
+        self.assertRaises(errors.ImageFormatError,
+                          self.agent_extension._stream_qcow2_image_onto_device,
+                          image_info, '/dev/foo')
+        self.assertFalse(md5_mock.return_value.hexdigest.called)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_device_erase_fails(self, requests_mock,
+                                                        execute_mock):
+        image_info = _build_fake_image_info()
+        requests_mock.return_value.status_code = 200
+        execute_mock.side_effect = processutils.ProcessExecutionError
+
+        self.assertRaises(errors.ImageWriteError,
+                          self.agent_extension._stream_qcow2_image_onto_device,
+                          image_info, '/dev/foo')
+
+    @mock.patch('ironic_python_agent.qcow2.StreamingDecoder', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_qcow2_image_onto_partition(self, requests_mock,
+                                               open_mock, md5_mock,
+                                               execute_mock, decoder_mock):
+        image_info = _build_fake_partition_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['some', 'content']
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        self.agent_extension._stream_qcow2_image_onto_device(image_info,
+                                                             '/dev/foo1')
+
+        self.assertFalse(execute_mock.called)
+        open_mock.assert_called_once_with('/dev/foo1', 'wb+')
+
+    @mock.patch('ironic_lib.disk_utils.block_uuid', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.work_on_disk', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_qcow2_image_onto_device', autospec=True)
+    def test_stream_partition_image(self, qcow2_mock, raw_mock,
+                                    work_on_disk_mock, uuid_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        work_on_disk_mock.return_value = {
+            'root uuid': 'partition_uuid',
+            'efi system partition uuid': None,
+            'partitions': {'root': '/dev/sda2', 'swap': '/dev/sda1'}}
+        uuid_mock.return_value = 'fs_uuid'
+
+        self.agent_extension._stream_partition_image(image_info, '/dev/sda')
+
+        work_on_disk_mock.assert_called_once_with(
+            '/dev/sda', '10', '10', '10', 'abc', None, 'node_uuid',
+            preserve_ephemeral='False', configdrive='configdrive',
+            boot_option='netboot', boot_mode='bios', disk_label='msdos')
+        raw_mock.assert_called_once_with(mock.ANY, image_info, '/dev/sda2')
+        self.assertFalse(qcow2_mock.called)
+        uuid_mock.assert_called_once_with('/dev/sda2')
+        self.assertEqual('fs_uuid',
+                         self.agent_extension.partition_uuids['root uuid'])
+
+        raw_mock.reset_mock()
+        image_info['disk_format'] = 'qcow2'
+        self.agent_extension._stream_partition_image(image_info, '/dev/sda')
+        qcow2_mock.assert_called_once_with(mock.ANY, image_info, '/dev/sda2')
+        self.assertFalse(raw_mock.called)
+
+    @mock.patch('ironic_lib.disk_utils.work_on_disk', autospec=True)
+    def test_stream_partition_image_too_large(self, work_on_disk_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['image_size'] = 10 * units.Mi + 1
+
+        self.assertRaisesRegex(
+            errors.InvalidCommandParamsError, 'Image virtual size: 11 MB',
+            self.agent_extension._stream_partition_image, image_info,
+            '/dev/sda')
+        self.assertFalse(work_on_disk_mock.called)
+
+    def test_stream_partition_images(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+        self.assertFalse(standby._stream_partition_images(image_info))
+        image_info['stream_partition_images'] = True
+        self.assertTrue(standby._stream_partition_images(image_info))
+        image_info['disk_format'] = 'vmdk'
+        self.assertFalse(standby._stream_partition_images(image_info))
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_partition_images'] = True
+        self.assertFalse(standby._stream_partition_images(image_info))
+
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_partition_image', autospec=True)
+    def test_prepare_image_stream_partition(self, stream_mock, cache_mock,
+                                            dispatch_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_partition_images'] = True
+        dispatch_mock.return_value = '/dev/sda'
+        stream_mock.side_effect = (
+            lambda ext, info, dev: setattr(ext, 'partition_uuids',
+                                           {'root uuid': 'fs_uuid'}))
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info)
+        async_result.join()
+
+        stream_mock.assert_called_once_with(mock.ANY, image_info, '/dev/sda')
+        self.assertFalse(cache_mock.called)
+        self.assertEqual('prepare_image: image (fake_id) written to device '
+                         '/dev/sda root_uuid=fs_uuid',
+                         async_result.command_result['result'])
+
     def test__message_format_whole_disk(self):
         image_info = _build_fake_image_info()
         msg = 'image ({}) already present on device {}'
@@ -909,3 +2647,1054 @@ class TestImageDownload(test_base.BaseTestCase):
         requests_mock.assert_called_once_with(image_info['urls'][0],
                                               cert=None, verify=True,
                                               stream=True, proxies={})
+
+    @mock.patch('requests.Session', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged(self, requests_mock, session_mock):
+        content = b''.join(bytes(bytearray([i % 256])) * 1024
+                           for i in range(3 * 1024 + 1))
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(content))}
+
+        def _get_range(url, headers, **kwargs):
+            start, end = headers['Range'][len('bytes='):].split('-')
+            range_response = mock.Mock(status_code=206)
+            range_response.content = content[int(start):int(end) + 1]
+            return range_response
+
+        session_mock.return_value.get.side_effect = _get_range
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_info['download_range_size'] = 1
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, b''.join(image_download))
+        response.close.assert_called_once_with()
+        self.assertEqual(4, session_mock.return_value.get.call_count)
+        session_mock.return_value.get.assert_any_call(
+            image_info['urls'][0], headers={'Range': 'bytes=0-1048575'},
+            cert=None, verify=True, proxies={})
+
+    @mock.patch('requests.Session', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged_not_supported(self, requests_mock,
+                                                 session_mock):
+        content = [b'SpongeBob', b'SquarePants']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': '20'}
+        response.iter_content.return_value = content
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 4
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        self.assertFalse(response.close.called)
+        self.assertFalse(session_mock.called)
+
+    @mock.patch('requests.Session', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_ranged_fails(self, requests_mock, session_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': '10'}
+        session_mock.return_value.get.return_value = mock.Mock(
+            status_code=500)
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertRaises(errors.ImageDownloadError, list, image_download)
+        self.assertEqual(standby.RANGE_FETCH_ATTEMPTS,
+                         session_mock.return_value.get.call_count)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_compressed(self, requests_mock):
+        compressed = _gzip(b'SpongeBobSquarePants')
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [compressed[:10],
+                                              compressed[10:]]
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(b'SpongeBobSquarePants', b''.join(image_download))
+        self.assertEqual(hashlib.md5(compressed).hexdigest(),
+                         image_download.md5sum())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_compressed_checksum_decompressed(
+            self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [
+            _gzip(b'SpongeBobSquarePants')]
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+        image_info['checksum_stream'] = 'decompressed'
+        image_download = standby.ImageDownload(image_info)
+        written = []
+
+        standby._ImagePipeline(image_download, 2).run(
+            lambda chunk: written.append(bytes(chunk)))
+
+        self.assertEqual(b'SpongeBobSquarePants', b''.join(written))
+        self.assertEqual(hashlib.md5(b'SpongeBobSquarePants').hexdigest(),
+                         image_download.md5sum())
+
+    @mock.patch.object(standby, '_image_download_rate', 0.0)
+    @mock.patch.object(standby, '_download_limiter', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_rate(self, requests_mock, limiter_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBob', b'SquarePants']
+        image_info = _build_fake_image_info()
+        image_info['download_rate'] = 2
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual([b'SpongeBob', b'SquarePants'],
+                         list(image_download))
+        limiter_mock.set_rate.assert_called_once_with(2 * units.M)
+        limiter_mock.consume.assert_has_calls([mock.call(9),
+                                               mock.call(11)])
+
+    @mock.patch.object(standby.base, 'report_progress', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_progress(self, requests_mock, report_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': '20'}
+        response.iter_content.return_value = [b'SpongeBob', b'SquarePants']
+        image_info = _build_fake_image_info()
+        image_download = standby.ImageDownload(image_info)
+        written = []
+
+        standby._write_image_chunks(image_download, image_info,
+                                    written.append)
+
+        report_mock.assert_called_once_with(image_download.progress.to_dict)
+        result = image_download.progress.to_dict()
+        self.assertEqual(20, result['total_bytes'])
+        for stage in ('received', 'hashed', 'written'):
+            self.assertEqual(20, result[stage]['bytes'])
+        self.assertEqual(0, result['eta'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_progress_compressed(self, requests_mock):
+        compressed = _gzip(b'SpongeBobSquarePants')
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(compressed))}
+        response.iter_content.return_value = [compressed]
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+        image_download = standby.ImageDownload(image_info)
+
+        standby._write_image_chunks(image_download, image_info,
+                                    lambda chunk: None)
+
+        result = image_download.progress.to_dict()
+        self.assertEqual(len(compressed), result['received']['bytes'])
+        self.assertEqual(len(compressed), result['hashed']['bytes'])
+        self.assertEqual(20, result['written']['bytes'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_compressed_invalid(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBobSquarePants']
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertRaisesRegex(errors.ImageDownloadError, 'decompress',
+                               list, image_download)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_os_hash(self, requests_mock):
+        content = [b'SpongeBob', b'SquarePants']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = content
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = ['sha256', 'sha512']
+        image_info['os_hash_value'] = ['abc456', 'def789']
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        data = b''.join(content)
+        self.assertEqual({'md5': hashlib.md5(data).hexdigest(),
+                          'sha256': hashlib.sha256(data).hexdigest(),
+                          'sha512': hashlib.sha512(data).hexdigest()},
+                         image_download.hexdigests())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_os_hash_without_md5(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBob']
+        image_info = _build_fake_image_info()
+        del image_info['checksum']
+        image_info['os_hash_algo'] = 'SHA256'
+        image_info['os_hash_value'] = 'abc456'
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual([b'SpongeBob'], list(image_download))
+        self.assertEqual({'sha256': hashlib.sha256(b'SpongeBob').hexdigest()},
+                         image_download.hexdigests())
+        self.assertIsNone(image_download.md5sum())
+
+    @mock.patch.object(standby, '_new_hash', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_hash_error(self, requests_mock, new_hash_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBob']
+        new_hash_mock.return_value.update.side_effect = ValueError('boom')
+        image_info = _build_fake_image_info()
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertRaisesRegex(ValueError, 'boom', list, image_download)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.headers = {'Content-Range': 'bytes 6-11/12'}
+        response.iter_content.return_value = [b'PantsX']
+        image_info = _build_fake_image_info()
+        hashes = standby._ImageHashes(['md5'])
+        hashes.update(b'Square')
+
+        image_download = standby.ImageDownload(image_info, offset=6,
+                                               hashes=hashes)
+
+        self.assertEqual([b'PantsX'], list(image_download))
+        requests_mock.assert_called_once_with(
+            image_info['urls'][0], cert=None, verify=True, stream=True,
+            proxies={}, headers={'Range': 'bytes=6-'})
+        self.assertEqual(hashlib.md5(b'SquarePantsX').hexdigest(),
+                         image_download.md5sum())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_range_ignored(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'Squ', b'arePa', b'ntsX']
+        image_info = _build_fake_image_info()
+        hashes = standby._ImageHashes(['md5'])
+        hashes.update(b'Square')
+
+        image_download = standby.ImageDownload(image_info, offset=6,
+                                               hashes=hashes)
+
+        self.assertEqual([b'Pa', b'ntsX'], list(image_download))
+        self.assertEqual(hashlib.md5(b'SquarePantsX').hexdigest(),
+                         image_download.md5sum())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_wrong_range(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.headers = {'Content-Range': 'bytes 0-11/12'}
+        image_info = _build_fake_image_info()
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'expected the image from offset 6',
+                               standby.ImageDownload, image_info, offset=6)
+
+    @mock.patch('requests.Session', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_ranged(self, requests_mock,
+                                          session_mock):
+        content = b'0123456789' * 300
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.headers = {'Content-Range': 'bytes 1000-2999/3000'}
+
+        def _get_range(url, headers, **kwargs):
+            start, end = headers['Range'][len('bytes='):].split('-')
+            range_response = mock.Mock(status_code=206)
+            range_response.content = content[int(start):int(end) + 1]
+            return range_response
+
+        session_mock.return_value.get.side_effect = _get_range
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        hashes = standby._ImageHashes(['md5'])
+        hashes.update(content[:1000])
+
+        image_download = standby.ImageDownload(image_info, offset=1000,
+                                               hashes=hashes)
+
+        self.assertEqual(content[1000:], b''.join(image_download))
+        self.assertEqual(hashlib.md5(content).hexdigest(),
+                         image_download.md5sum())
+        response.close.assert_called_once_with()
+
+
+class TestMirrorSelection(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestMirrorSelection, self).setUp()
+        self.image_info = _build_fake_image_info()
+        self.image_info['urls'] = ['http://a.example.org',
+                                   'http://b.example.org']
+
+    @mock.patch('time.time', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_probe_mirror(self, requests_mock, time_mock):
+        time_mock.side_effect = [10.0, 10.5, 12.0]
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.iter_content.return_value = [b'a' * 2048, b'b' * 2048]
+
+        result = standby._probe_mirror(self.image_info, 'http://a', 2048)
+
+        self.assertEqual((0.5, 1024.0), result)
+        requests_mock.assert_called_once_with(
+            'http://a', stream=True, headers={'Range': 'bytes=0-2047'},
+            timeout=10, cert=None, verify=True, proxies={})
+        response.close.assert_called_once_with()
+
+    @mock.patch('requests.get', autospec=True)
+    def test_probe_mirror_error(self, requests_mock):
+        requests_mock.side_effect = requests.ConnectionError('boom')
+        self.assertIsNone(standby._probe_mirror(self.image_info, 'http://a',
+                                                2048))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_probe_mirror_bad_status(self, requests_mock):
+        requests_mock.return_value.status_code = 404
+        self.assertIsNone(standby._probe_mirror(self.image_info, 'http://a',
+                                                2048))
+
+    @mock.patch.object(standby, '_probe_mirror', autospec=True)
+    def test_rank_mirrors(self, probe_mock):
+        results = {'http://a': (0.1, 10.0), 'http://b': None,
+                   'http://c': (0.5, 50.0), 'http://d': (0.2, 50.0)}
+        probe_mock.side_effect = lambda info, url, size: results[url]
+
+        ranked = standby._rank_mirrors(self.image_info, sorted(results))
+
+        self.assertEqual(['http://d', 'http://c', 'http://a', 'http://b'],
+                         ranked)
+        probe_mock.assert_any_call(self.image_info, 'http://a', 1024 * 1024)
+
+    @mock.patch.object(standby, '_rank_mirrors', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_fastest_mirror(self, requests_mock, rank_mock):
+        rank_mock.return_value = ['http://b.example.org',
+                                  'http://a.example.org']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBob']
+        self.image_info['mirror_selection'] = 'fastest'
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual([b'SpongeBob'], list(image_download))
+        rank_mock.assert_called_once_with(self.image_info,
+                                          self.image_info['urls'])
+        requests_mock.assert_called_once_with(
+            'http://b.example.org', cert=None, verify=True, stream=True,
+            proxies={})
+
+    def _failover_responses(self, first_chunks):
+        def _iter_chunks(chunks):
+            for chunk in chunks:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+
+        first = mock.Mock(status_code=200)
+        first.iter_content.return_value = _iter_chunks(first_chunks)
+        second = mock.Mock(status_code=206,
+                           headers={'Content-Range': 'bytes 3-5/6'})
+        second.iter_content.return_value = iter([b'def'])
+        return first, second
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_failover_on_error(self, requests_mock):
+        first, second = self._failover_responses(
+            [b'abc', requests.ConnectionError('reset')])
+        requests_mock.side_effect = [first, second]
+        self.image_info['mirror_failover_throughput'] = 1
+        self.image_info['checksum'] = hashlib.md5(b'abcdef').hexdigest()
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual([b'abc', b'def'], list(image_download))
+        self.assertEqual(self.image_info['checksum'],
+                         image_download.md5sum())
+        requests_mock.assert_called_with(
+            'http://b.example.org', cert=None, verify=True, stream=True,
+            proxies={}, timeout=30, headers={'Range': 'bytes=3-'})
+        first.close.assert_called_once_with()
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_failover_on_error_no_mirror_left(self, requests_mock):
+        first, _second = self._failover_responses(
+            [b'abc', requests.ConnectionError('reset')])
+        requests_mock.side_effect = [first,
+                                     mock.Mock(status_code=500, text='')]
+        self.image_info['mirror_failover_throughput'] = 1
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertRaisesRegex(errors.ImageDownloadError, 'offset 3',
+                               list, image_download)
+
+    @mock.patch.object(standby, 'MIRROR_SWITCH_LIMIT', 1)
+    @mock.patch('time.time', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_failover_on_slow_mirror(self, requests_mock,
+                                              time_mock):
+        time_mock.side_effect = (100.0 * i for i in range(100))
+        first, second = self._failover_responses([b'abc', b'xxx'])
+        requests_mock.side_effect = [first, second]
+        self.image_info['mirror_failover_throughput'] = 1
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual([b'abc', b'def'], list(image_download))
+        self.assertEqual(2, requests_mock.call_count)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_no_failover_single_url(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'abc']
+        self.image_info['urls'] = ['http://a.example.org']
+        self.image_info['mirror_failover_throughput'] = 1
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual([b'abc'], list(image_download))
+        requests_mock.assert_called_once_with(
+            'http://a.example.org', cert=None, verify=True, stream=True,
+            proxies={})
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TestChunkVerifier(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestChunkVerifier, self).setUp()
+        self.image_info = _build_fake_image_info()
+        self.content = b'aaaabbbbcc'
+        self.manifest = {'chunk_size': 4,
+                         'digests': [_sha256(b'aaaa'), _sha256(b'bbbb'),
+                                     _sha256(b'cc')]}
+        self.url = self.image_info['urls'][0]
+
+    def _verify(self, chunks, offset=0):
+        verifier = standby._ChunkVerifier(self.image_info, self.url,
+                                          self.manifest, offset)
+        return list(verifier.verify(iter(chunks)))
+
+    def test_verify(self):
+        result = self._verify([b'aaa', b'abbbbc', b'c'])
+        self.assertEqual([b'aaaa', b'bbbb', b'cc'], result)
+
+    def test_verify_md5_manifest(self):
+        self.manifest = {'chunk_size': 4, 'algorithm': 'MD5',
+                         'digests': [hashlib.md5(b'aaaa').hexdigest()]}
+        self.assertEqual([b'aaaa'], self._verify([b'aaaa']))
+
+    def test_verify_from_offset(self):
+        result = self._verify([b'abbb', b'bcc'], offset=3)
+        self.assertEqual([b'a', b'bbbb', b'cc'], result)
+
+    def test_verify_mismatch_fails_fast(self):
+        self.assertRaisesRegex(errors.ImageChecksumError, 'bytes 4-7',
+                               self._verify, [b'aaaabxbbcc'])
+
+    @mock.patch('requests.get', autospec=True)
+    def test_verify_mismatch_refetch(self, requests_mock):
+        self.image_info['chunk_refetch_attempts'] = 2
+        bad = mock.Mock(status_code=206, content=b'bxbb')
+        good = mock.Mock(status_code=206, content=b'bbbb')
+        requests_mock.side_effect = [bad, good]
+
+        result = self._verify([b'aaaabxbbcc'])
+
+        self.assertEqual([b'aaaa', b'bbbb', b'cc'], result)
+        requests_mock.assert_called_with(
+            self.url, cert=None, verify=True, proxies={},
+            headers={'Range': 'bytes=4-7'})
+        self.assertEqual(2, requests_mock.call_count)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_verify_mismatch_refetch_exhausted(self, requests_mock):
+        self.image_info['chunk_refetch_attempts'] = 1
+        requests_mock.return_value = mock.Mock(status_code=200,
+                                               content=b'aaaabbbbcc')
+
+        self.assertRaises(errors.ImageChecksumError, self._verify,
+                          [b'aaaabbbbcx'])
+        self.assertEqual(1, requests_mock.call_count)
+
+    def test_check(self):
+        verifier = standby._ChunkVerifier(self.image_info, self.url,
+                                          self.manifest)
+        self.assertEqual(b'bbbb', verifier.check(1, b'bbbb'))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_check_refetch(self, requests_mock):
+        self.image_info['chunk_refetch_attempts'] = 1
+        requests_mock.return_value = mock.Mock(status_code=206,
+                                               content=b'bbbb')
+        verifier = standby._ChunkVerifier(self.image_info, self.url,
+                                          self.manifest)
+
+        self.assertEqual(b'bbbb', verifier.check(1, b'bxbb'))
+        requests_mock.assert_called_once_with(
+            self.url, cert=None, verify=True, proxies={},
+            headers={'Range': 'bytes=4-7'})
+
+    @mock.patch('requests.get', autospec=True)
+    def test_check_location(self, requests_mock):
+        verifier = standby._ChunkVerifier(self.image_info, self.url,
+                                          self.manifest)
+
+        self.assertRaisesRegex(errors.ImageChecksumError, '/dev/foo',
+                               verifier.check, 1, b'bxbb', '/dev/foo')
+        self.assertFalse(requests_mock.called)
+
+    def test_check_no_such_chunk(self):
+        verifier = standby._ChunkVerifier(self.image_info, self.url,
+                                          self.manifest)
+        self.assertRaisesRegex(errors.ImageDownloadError, 'larger',
+                               verifier.check, 3, b'dd')
+
+    def test_verify_image_too_large(self):
+        del self.manifest['digests'][2]
+        self.assertRaisesRegex(errors.ImageDownloadError, 'larger',
+                               self._verify, [b'aaaabbbbcc'])
+
+    def test_verify_image_too_small(self):
+        self.assertRaisesRegex(errors.ImageDownloadError, 'smaller',
+                               self._verify, [b'aaaabbbb'])
+
+    def test_for_image_without_manifest(self):
+        self.assertIsNone(standby._ChunkVerifier.for_image(self.image_info,
+                                                           self.url))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_for_image_manifest_url(self, requests_mock):
+        self.image_info['chunk_manifest'] = 'http://example.org/manifest'
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.json.return_value = self.manifest
+
+        verifier = standby._ChunkVerifier.for_image(self.image_info,
+                                                    self.url)
+
+        requests_mock.assert_called_once_with(
+            'http://example.org/manifest', cert=None, verify=True,
+            proxies={})
+        self.assertEqual([b'aaaa', b'bbbb', b'cc'],
+                         list(verifier.verify(iter([self.content]))))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_for_image_manifest_url_error(self, requests_mock):
+        self.image_info['chunk_manifest'] = 'http://example.org/manifest'
+        requests_mock.return_value.status_code = 404
+
+        self.assertRaisesRegex(errors.ImageDownloadError, '404',
+                               standby._ChunkVerifier.for_image,
+                               self.image_info, self.url)
+
+    def test_for_image_invalid_manifest(self):
+        self.image_info['chunk_manifest'] = {'digests': ['abc']}
+        self.assertRaisesRegex(errors.ImageDownloadError, 'invalid',
+                               standby._ChunkVerifier.for_image,
+                               self.image_info, self.url)
+
+    def test_for_image_unknown_algorithm(self):
+        self.manifest['algorithm'] = 'not-a-hash'
+        self.image_info['chunk_manifest'] = self.manifest
+        self.assertRaisesRegex(errors.ImageDownloadError, 'invalid',
+                               standby._ChunkVerifier.for_image,
+                               self.image_info, self.url)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_image_download_verifies_chunks(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'aaaab', b'bbbcc']
+        self.image_info['chunk_manifest'] = self.manifest
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual([b'aaaa', b'bbbb', b'cc'], list(image_download))
+        self.assertEqual(hashlib.md5(self.content).hexdigest(),
+                         image_download.md5sum())
+
+
+@mock.patch('requests.Session', autospec=True)
+@mock.patch('requests.get', autospec=True)
+class TestSwarmDownload(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSwarmDownload, self).setUp()
+        self.content = b'aaaabbbbcc'
+        self.image_info = _build_fake_image_info()
+        self.image_info['checksum'] = hashlib.md5(self.content).hexdigest()
+        self.image_info['chunk_manifest'] = {
+            'chunk_size': 4,
+            'digests': [_sha256(b'aaaa'), _sha256(b'bbbb'), _sha256(b'cc')]}
+        self.image_info['swarm'] = {'peers': ['http://peer:9999']}
+        self.origin_ranges = []
+        self.addCleanup(image_swarm.unshare,
+                        'md5-' + self.image_info['checksum'])
+
+    def _mock_origin(self, requests_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(self.content))}
+        response.iter_content.return_value = [self.content]
+
+    def _get(self, peer_chunks, origin_content=None):
+        origin_content = origin_content or self.content
+
+        def _session_get(url, headers=None, **kwargs):
+            if '/v1/images/' in url:
+                index = int(url.rsplit('/', 1)[1])
+                data = peer_chunks.get(index)
+                if isinstance(data, Exception):
+                    raise data
+                return mock.Mock(status_code=200 if data else 404,
+                                 content=data)
+            start, end = headers['Range'][len('bytes='):].split('-')
+            self.origin_ranges.append((int(start), int(end)))
+            return mock.Mock(status_code=206,
+                             content=origin_content[int(start):int(end) + 1])
+        return _session_get
+
+    def test_chunks_from_peers(self, requests_mock, session_mock):
+        self._mock_origin(requests_mock)
+        session_mock.return_value.get.side_effect = self._get(
+            {0: b'aaaa', 1: b'bbbb', 2: b'cc'})
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual(self.content, b''.join(image_download))
+        self.assertEqual([], self.origin_ranges)
+        self.assertEqual(self.image_info['checksum'],
+                         image_download.md5sum())
+        session_mock.return_value.get.assert_any_call(
+            'http://peer:9999/v1/images/md5-{}/1'.format(
+                self.image_info['checksum']),
+            cert=None, verify=True, timeout=standby.SWARM_PEER_TIMEOUT)
+
+    def test_corrupted_chunk_from_origin(self, requests_mock, session_mock):
+        self._mock_origin(requests_mock)
+        session_mock.return_value.get.side_effect = self._get(
+            {0: b'aaaa', 1: b'bxbb'})
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual(self.content, b''.join(image_download))
+        self.assertEqual([(4, 7), (8, 9)], sorted(self.origin_ranges))
+
+    def test_unreachable_peer(self, requests_mock, session_mock):
+        # Fetch chunks one at a time, so that the peer is known to be
+        # unreachable before the next chunk is fetched
+        standby.CONF.set_override('image_swarm_connections', 1)
+        self.addCleanup(standby.CONF.clear_override,
+                        'image_swarm_connections')
+        self._mock_origin(requests_mock)
+        self.image_info['swarm']['peers'].append('http://other:9999')
+        error = requests.ConnectionError('boom')
+        session_mock.return_value.get.side_effect = self._get(
+            {0: error, 1: error, 2: error})
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual(self.content, b''.join(image_download))
+        self.assertEqual([(0, 3), (4, 7), (8, 9)], sorted(self.origin_ranges))
+        peer_calls = [c for c in session_mock.return_value.get.call_args_list
+                      if c[0][0].startswith('http://peer:9999')]
+        self.assertEqual(1, len(peer_calls))
+
+    def test_corrupted_origin(self, requests_mock, session_mock):
+        self._mock_origin(requests_mock)
+        session_mock.return_value.get.side_effect = self._get(
+            {}, origin_content=b'aaaabxbbcc')
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertRaises(errors.ImageChecksumError, b''.join,
+                          image_download)
+
+    @mock.patch('ironic_python_agent.image_swarm.discover_peers',
+                autospec=True)
+    def test_resume_within_chunk(self, discover_mock, requests_mock,
+                                 session_mock):
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.headers = {'Content-Range': 'bytes 5-9/10'}
+        response.iter_content.return_value = [b'bbbcc']
+
+        image_download = standby.ImageDownload(self.image_info, offset=5)
+
+        self.assertEqual(b'bbbcc', b''.join(image_download))
+        self.assertFalse(discover_mock.called)
+        self.assertFalse(session_mock.called)
+
+    @mock.patch.object(standby, '_image_location', autospec=True)
+    def test_download_image_shares_chunks(self, location_mock,
+                                          requests_mock, session_mock):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        location_mock.return_value = os.path.join(tempdir, 'image')
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'aaaab', b'bbbcc']
+        self.image_info['swarm'] = {}
+
+        standby._download_image(self.image_info)
+
+        shared = image_swarm.get_shared_image(
+            'md5-' + self.image_info['checksum'])
+        self.assertEqual(b'bbbb', shared.read_chunk(1))
+        self.assertEqual(b'cc', shared.read_chunk(2))
+        self.assertIsNone(shared.read_chunk(3))
+
+
+@mock.patch('requests.Session', autospec=True)
+class TestMulticastDownload(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestMulticastDownload, self).setUp()
+        self.content = b'aaaabbbbccccddddeeeeff'
+        self.image_info = _build_fake_image_info()
+        self.image_info['multicast'] = {'group': '239.1.2.3', 'port': 5000}
+        self.origin_ranges = []
+        with mock.patch('socket.socket', autospec=True):
+            self.receiver = multicast.Receiver('239.1.2.3', 5000)
+        self.receiver.start = mock.Mock()
+
+    def _get(self, url, headers, **kwargs):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        self.origin_ranges.append((int(start), int(end)))
+        return mock.Mock(status_code=206,
+                         content=self.content[int(start):int(end) + 1])
+
+    def _download(self, offset=0):
+        return standby._MulticastDownload(
+            self.image_info, self.image_info['urls'][0], len(self.content),
+            self.receiver, 4, 2, 1, offset=offset)
+
+    def _receive(self, kind, group, index, payload=b''):
+        self.receiver.handle_packet(multicast.pack(kind, 0, group, index,
+                                                   payload))
+
+    def test_receive_and_repair(self, session_mock):
+        session_mock.return_value.get.side_effect = self._get
+        # Group 0 was sent before the group was joined, the first block of
+        # group 1 is recovered from parity, the last block is lost.
+        self._receive(multicast.DATA, 1, 1, b'dddd')
+        self._receive(multicast.PARITY, 1, 0,
+                      multicast.encode([b'cccc', b'dddd'], 1, 4)[0])
+        self._receive(multicast.DATA, 2, 0, b'eeee')
+        self._receive(multicast.END, 0, 0)
+        download = self._download()
+
+        self.assertEqual(self.content, b''.join(download))
+        self.assertEqual([(0, 7), (20, 21)], self.origin_ranges)
+        self.assertEqual(1, download.blocks_recovered)
+        self.assertEqual(10, download.bytes_repaired)
+        self.receiver.start.assert_called_once_with()
+
+    def test_receive_from_offset(self, session_mock):
+        for group, index, block in [(1, 0, b'cccc'), (1, 1, b'dddd'),
+                                    (2, 0, b'eeee'), (2, 1, b'ff')]:
+            self._receive(multicast.DATA, group, index, block)
+        self._receive(multicast.END, 0, 0)
+
+        self.assertEqual(self.content[10:], b''.join(self._download(10)))
+        self.assertFalse(session_mock.return_value.get.called)
+
+    def test_wrong_block_length_repaired(self, session_mock):
+        session_mock.return_value.get.side_effect = self._get
+        for group, index, block in [(0, 0, b'aaaa'), (0, 1, b'bbbb'),
+                                    (1, 0, b'cccc'), (1, 1, b'dddd'),
+                                    (2, 0, b'eeee'), (2, 1, b'fff')]:
+            self._receive(multicast.DATA, group, index, block)
+        self._receive(multicast.END, 0, 0)
+
+        self.assertEqual(self.content, b''.join(self._download()))
+        self.assertEqual([(20, 21)], self.origin_ranges)
+
+    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(multicast, 'Receiver', autospec=True)
+    def test_image_download_multicast(self, receiver_mock, requests_mock,
+                                      session_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(self.content))}
+        self.image_info['multicast']['session'] = 3
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        receiver_mock.assert_called_once_with(
+            '239.1.2.3', 5000, session=3, interface=None, timeout=10,
+            max_groups=64 * units.Mi // (multicast.DEFAULT_BLOCK_SIZE *
+                                         multicast.DEFAULT_GROUP_SIZE))
+        response.close.assert_called_once_with()
+        self.assertIsInstance(image_download._ranged_download,
+                              standby._MulticastDownload)
+
+    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(multicast, 'Receiver', autospec=True)
+    def test_image_download_multicast_unavailable(self, receiver_mock,
+                                                  requests_mock,
+                                                  session_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(self.content))}
+        response.iter_content.return_value = [self.content]
+        receiver_mock.side_effect = OSError('No such device')
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        self.assertEqual([self.content], list(image_download))
+        self.assertFalse(response.close.called)
+        self.assertFalse(session_mock.called)
+
+
+class TestReadBackImage(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestReadBackImage, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.device = os.path.join(tempdir, 'device')
+        self.content = b'aaaabbbbcc'
+        with open(self.device, 'wb') as f:
+            f.write(self.content + b'garbage')
+        self.image_info = _build_fake_image_info()
+        self.image_info['checksum'] = hashlib.md5(self.content).hexdigest()
+        self.image_info['disk_format'] = 'raw'
+
+    def _read_back(self):
+        return standby._read_back_image(self.image_info, self.device,
+                                        len(self.content))
+
+    def test_checksum(self):
+        self.assertIsNotNone(self._read_back())
+
+    def test_checksum_mismatch(self):
+        self.image_info['checksum'] = hashlib.md5(b'other').hexdigest()
+        self.assertRaises(errors.ImageChecksumError, self._read_back)
+
+    def test_chunk_manifest(self):
+        self.image_info['checksum'] = 'not checked'
+        self.image_info['chunk_manifest'] = {
+            'chunk_size': 4,
+            'digests': [_sha256(b'aaaa'), _sha256(b'bbbb'), _sha256(b'cc')]}
+        self.assertIsNotNone(self._read_back())
+
+    def test_chunk_manifest_mismatch(self):
+        self.image_info['chunk_manifest'] = {
+            'chunk_size': 4,
+            'digests': [_sha256(b'aaaa'), _sha256(b'bxbb'), _sha256(b'cc')]}
+        self.assertRaisesRegex(errors.ImageChecksumError, 'bytes 4-7',
+                               self._read_back)
+
+    def test_not_raw(self):
+        self.image_info['disk_format'] = 'qcow2'
+        self.image_info['checksum'] = hashlib.md5(b'other').hexdigest()
+        self.assertIsNone(self._read_back())
+
+    def test_compressed(self):
+        self.image_info['compression'] = 'gzip'
+        self.assertIsNone(self._read_back())
+        self.image_info['checksum_stream'] = 'decompressed'
+        self.assertIsNotNone(self._read_back())
+
+    def test_read_error(self):
+        self.assertRaises(errors.BlockDeviceError,
+                          standby._read_back_image, self.image_info,
+                          self.device, 1024)
+
+
+@mock.patch.object(standby, 'CHECKPOINT_SEGMENT_SIZE', 4)
+class TestDownloadCheckpoint(test_base.BaseTestCase):
+
+    def setUp(self):
+        super(TestDownloadCheckpoint, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.target = os.path.join(self.tempdir, 'image')
+        self.path = os.path.join(self.tempdir, 'image.checkpoint')
+        self.image_info = _build_fake_image_info()
+        patcher = mock.patch('time.sleep', autospec=True)
+        self.sleep_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, checkpoint, chunks):
+        with open(self.target, 'r+b' if checkpoint.offset else 'wb') as f:
+            write = checkpoint.wrap(image_writer.FileWriter(f).write_at)
+            for chunk in chunks:
+                write(chunk)
+
+    def test_record_and_restore(self):
+        checkpoint = standby._DownloadCheckpoint(self.path, self.image_info)
+        self._write(checkpoint, [b'aaaaab', b'bbbcc'])
+        self.assertEqual(8, checkpoint.offset)
+
+        loaded = standby._DownloadCheckpoint.load(self.path, self.image_info)
+        hashes = loaded.restore(self.target)
+
+        self.assertEqual(8, loaded.offset)
+        self.assertEqual({'md5': hashlib.md5(b'aaaaabbb').hexdigest()},
+                         hashes.hexdigests())
+
+    def test_restore_os_hash(self):
+        self.image_info['os_hash_algo'] = 'sha512'
+        self.image_info['os_hash_value'] = 'def456'
+        checkpoint = standby._DownloadCheckpoint(self.path, self.image_info)
+        self._write(checkpoint, [b'aaaabbbbcc'])
+
+        hashes = checkpoint.restore(self.target)
+
+        self.assertEqual({'md5': hashlib.md5(b'aaaabbbb').hexdigest(),
+                          'sha512': hashlib.sha512(b'aaaabbbb').hexdigest()},
+                         hashes.hexdigests())
+
+    def test_restore_corrupted_segment(self):
+        checkpoint = standby._DownloadCheckpoint(self.path, self.image_info)
+        self._write(checkpoint, [b'aaaabbbbcccc'])
+        with open(self.target, 'r+b') as f:
+            f.seek(5)
+            f.write(b'X')
+
+        hashes = checkpoint.restore(self.target)
+
+        self.assertEqual(4, checkpoint.offset)
+        self.assertEqual({'md5': hashlib.md5(b'aaaa').hexdigest()},
+                         hashes.hexdigests())
+
+    def test_restore_missing_target(self):
+        checkpoint = standby._DownloadCheckpoint(self.path, self.image_info,
+                                                 [1, 2])
+        checkpoint.restore(os.path.join(self.tempdir, 'missing'))
+        self.assertEqual(0, checkpoint.offset)
+
+    def test_load_other_image(self):
+        checkpoint = standby._DownloadCheckpoint(self.path, self.image_info)
+        self._write(checkpoint, [b'aaaabbbb'])
+        self.image_info['checksum'] = 'def456'
+
+        loaded = standby._DownloadCheckpoint.load(self.path, self.image_info)
+
+        self.assertEqual(0, loaded.offset)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resumed(self, requests_mock):
+        def _first_attempt(chunk_size):
+            yield b'aaaabb'
+            yield b'bbcc'
+            raise requests.ConnectionError('Connection reset')
+
+        first = mock.Mock(status_code=200)
+        first.iter_content.side_effect = _first_attempt
+        second = mock.Mock(status_code=206,
+                           headers={'Content-Range': 'bytes 8-11/12'})
+        second.iter_content.return_value = [b'cccc']
+        requests_mock.side_effect = [first, second]
+        self.image_info['download_checkpoints'] = True
+        self.image_info['checksum'] = hashlib.md5(
+            b'aaaabbbbcccc').hexdigest()
+
+        with mock.patch.object(standby, '_image_location', autospec=True,
+                               return_value=self.target):
+            standby._download_image(self.image_info)
+
+        self.assertEqual({'Range': 'bytes=8-'},
+                         requests_mock.call_args[1]['headers'])
+        with open(self.target, 'rb') as f:
+            self.assertEqual(b'aaaabbbbcccc', f.read())
+        self.assertFalse(os.path.exists(self.target + '.checkpoint'))
+
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_resume_attempts_exhausted(self, requests_mock):
+        requests_mock.return_value = mock.Mock(status_code=503,
+                                               text='Unavailable')
+        self.image_info['download_checkpoints'] = True
+        self.image_info['download_resume_attempts'] = 2
+
+        with mock.patch.object(standby, '_image_location', autospec=True,
+                               return_value=self.target):
+            self.assertRaises(errors.ImageDownloadError,
+                              standby._download_image, self.image_info)
+        self.assertEqual(3, requests_mock.call_count)
+        self.sleep_mock.assert_has_calls([mock.call(standby.RESUME_DELAY),
+                                          mock.call(standby.RESUME_DELAY * 2)])
+
+    @mock.patch.object(image_writer.FileWriter, 'write_at', autospec=True)
+    @mock.patch('requests.get', autospec=True)
+    def test_download_image_write_error_not_resumed(self, requests_mock,
+                                                    write_mock):
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'aaaabbbbcccc']
+        write_mock.side_effect = IOError(errno.EIO, 'Input/output error')
+        self.image_info['download_checkpoints'] = True
+
+        with mock.patch.object(standby, '_image_location', autospec=True,
+                               return_value=self.target):
+            self.assertRaisesRegex(errors.ImageWriteError,
+                                   'Input/output error',
+                                   standby._download_image, self.image_info)
+        self.assertEqual(1, requests_mock.call_count)
+        self.assertFalse(self.sleep_mock.called)
+
+    @mock.patch('requests.get', autospec=True)
+    def test_stream_raw_image_resumed(self, requests_mock):
+        # The device holds the first two segments from an earlier attempt
+        with open(self.target, 'wb') as f:
+            f.write(b'aaaabbbbXXXX')
+        self.image_info['download_checkpoints'] = 'true'
+        self.image_info['checksum'] = hashlib.md5(
+            b'aaaabbbbcccc').hexdigest()
+        checkpoint = standby._DownloadCheckpoint(
+            os.path.join(tempfile.gettempdir(), 'fake_id.image.checkpoint'),
+            self.image_info, [standby._crc32(b'aaaa'),
+                              standby._crc32(b'bbbb')])
+        checkpoint.save()
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.headers = {'Content-Range': 'bytes 8-11/12'}
+        response.iter_content.return_value = [b'cccc']
+
+        standby.StandbyExtension()._stream_raw_image_onto_device(
+            self.image_info, self.target)
+
+        with open(self.target, 'rb') as f:
+            self.assertEqual(b'aaaabbbbcccc', f.read())
+        self.assertEqual(1, requests_mock.call_count)
@@ -20,6 +20,7 @@ import pecan.testing
 
 from ironic_python_agent import agent
 from ironic_python_agent.extensions import base
+from ironic_python_agent import image_swarm
 from ironic_python_agent.tests.unit import base as ironic_agent_base
 
 
@@ -312,3 +313,37 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
         self.assertEqual(200, response.status_code)
         data = response.json
         self.assertEqual(serialized_cmd_result, data)
+
+    @mock.patch.object(image_swarm, 'get_shared_image', autospec=True)
+    def test_get_image_chunk(self, get_mock):
+        get_mock.return_value.read_chunk.return_value = b'chunk data'
+
+        response = self.get_json('/images/sha256-abc/3')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'chunk data', response.body)
+        self.assertEqual('application/octet-stream', response.content_type)
+        get_mock.assert_called_once_with('sha256-abc')
+        get_mock.return_value.read_chunk.assert_called_once_with(3)
+
+    @mock.patch.object(image_swarm, 'get_shared_image', autospec=True)
+    def test_get_image_chunk_not_available(self, get_mock):
+        get_mock.return_value.read_chunk.return_value = None
+
+        response = self.get_json('/images/sha256-abc/3', expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+
+    @mock.patch.object(image_swarm, 'get_shared_image', autospec=True)
+    def test_get_image_chunk_image_not_shared(self, get_mock):
+        get_mock.return_value = None
+
+        response = self.get_json('/images/sha256-abc/3', expect_errors=True)
+
+        self.assertEqual(404, response.status_code)
+
+    def test_get_image_chunk_invalid_index(self):
+        response = self.get_json('/images/sha256-abc/three',
+                                 expect_errors=True)
+
+        self.assertEqual(400, response.status_code)
@@ -0,0 +1,158 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import zlib
+
+import mock
+import testtools
+
+from ironic_python_agent import decompress
+from ironic_python_agent.tests.unit import base
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _bgzf(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    return (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC' +
+            struct.pack('<HH', 2, len(body) + 25) + body +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def _chunks(data, size=7):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+class TestDecompress(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDecompress, self).setUp()
+        self.data = b''.join(b'%05d' % i for i in range(2000))
+
+    def _decompress(self, data, compression, threads=2):
+        return b''.join(decompress.decompress(_chunks(data), compression,
+                                              threads))
+
+    def test_gzip(self):
+        self.assertEqual(self.data, self._decompress(_gzip(self.data),
+                                                     'gzip'))
+
+    def test_gzip_multiple_members(self):
+        compressed = _gzip(self.data[:100]) + _gzip(self.data[100:])
+        self.assertEqual(self.data, self._decompress(compressed, 'gzip'))
+
+    @mock.patch.object(decompress, 'OUTPUT_CHUNK_SIZE', 16)
+    def test_gzip_bounded_output(self):
+        chunks = list(decompress.decompress(iter([_gzip(b'\0' * 1000)]),
+                                            'gzip'))
+        self.assertEqual(b'\0' * 1000, b''.join(chunks))
+        self.assertTrue(all(len(chunk) <= 16 for chunk in chunks))
+
+    @mock.patch.object(decompress._Gzip, 'decode', autospec=True,
+                       side_effect=decompress._Gzip.decode)
+    def test_bgzf_in_parallel(self, decode_mock):
+        compressed = (_bgzf(self.data[:3000]) + _bgzf(self.data[3000:]) +
+                      _gzip(b'tail'))
+        self.assertEqual(self.data + b'tail',
+                         self._decompress(compressed, 'gzip'))
+        self.assertEqual(2, decode_mock.call_count)
+
+    @mock.patch.object(decompress, '_ZLIB_EOF', False)
+    def test_gzip_without_zlib_eof(self):
+        # The end of the member is found from its trailer, as on Python 2
+        self.assertEqual(self.data, self._decompress(_gzip(self.data),
+                                                     'gzip'))
+        self.assertEqual(b'', self._decompress(_gzip(b''), 'gzip'))
+
+    @mock.patch.object(decompress, '_ZLIB_EOF', False)
+    @mock.patch.object(decompress, 'OUTPUT_CHUNK_SIZE', 16)
+    def test_gzip_without_zlib_eof_multiple_members(self):
+        compressed = _gzip(self.data[:100]) + _gzip(self.data[100:])
+        self.assertEqual(self.data, self._decompress(compressed, 'gzip'))
+
+    @mock.patch.object(decompress, '_ZLIB_EOF', False)
+    def test_gzip_without_zlib_eof_truncated(self):
+        self.assertRaisesRegex(decompress.DecompressionError, 'truncated',
+                               self._decompress, _gzip(self.data)[:-4],
+                               'gzip')
+
+    def test_gzip_frame_of_bytearray(self):
+        gzip = decompress._Gzip()
+        self.assertIs(decompress.UNKNOWN,
+                      gzip.frame(bytearray(_gzip(self.data))))
+        member = _bgzf(self.data)
+        self.assertEqual((len(member), len(self.data)),
+                         gzip.frame(bytearray(member)))
+
+    def test_gzip_truncated(self):
+        self.assertRaisesRegex(decompress.DecompressionError, 'truncated',
+                               self._decompress, _gzip(self.data)[:-10],
+                               'gzip')
+
+    def test_gzip_invalid(self):
+        self.assertRaises(decompress.DecompressionError, self._decompress,
+                          b'not a gzip stream', 'gzip')
+
+    @testtools.skipIf(decompress.lzma is None, 'lzma is not available')
+    def test_xz(self):
+        compressed = decompress.lzma.compress(self.data)
+        self.assertEqual(self.data, self._decompress(compressed, 'xz'))
+
+    def test_unknown_compression(self):
+        self.assertRaises(decompress.DecompressionError,
+                          decompress.decompress, iter([]), 'bzip2')
+
+    def test_zstd_frame(self):
+        # Frame header without a window descriptor, 1 byte content size,
+        # and a checksum, followed by a raw block and a last RLE block.
+        frame = (struct.pack('<I', 0xFD2FB528) + b'\x24\x08' +
+                 b'\x18\x00\x00abc' + b'\x2b\x00\x00x' + b'\x00' * 4)
+        zstd = decompress._Zstd()
+        self.assertEqual((len(frame), 2 * 128 * 1024),
+                         zstd.frame(frame + b'next'))
+        self.assertIsNone(zstd.frame(frame[:-1]))
+
+    def test_zstd_skippable_frame(self):
+        frame = struct.pack('<II', 0x184D2A5E, 3) + b'abc'
+        self.assertEqual((11, 0), decompress._Zstd().frame(frame))
+
+    @testtools.skipIf(decompress.zstandard is None,
+                      'zstandard is not available')
+    def test_zstd_frames(self):
+        compressor = decompress.zstandard.ZstdCompressor(write_checksum=True)
+        compressed = (struct.pack('<II', 0x184D2A50, 2) + b'xx' +
+                      compressor.compress(self.data[:4000]) +
+                      compressor.compress(self.data[4000:]))
+        self.assertEqual(self.data, self._decompress(compressed, 'zstd'))
+
+    @testtools.skipIf(decompress.zstandard is None,
+                      'zstandard is not available')
+    @mock.patch.object(decompress, 'MAX_FRAME_OUTPUT', 0)
+    def test_zstd_stream(self):
+        compressed = decompress.zstandard.ZstdCompressor().compress(
+            self.data)
+        self.assertEqual(self.data * 2,
+                         self._decompress(compressed + compressed, 'zstd'))
+
+    @testtools.skipIf(decompress.zstandard is None,
+                      'zstandard is not available')
+    def test_zstd_truncated(self):
+        compressed = decompress.zstandard.ZstdCompressor().compress(
+            self.data)
+        self.assertRaises(decompress.DecompressionError, self._decompress,
+                          compressed[:-3], 'zstd')
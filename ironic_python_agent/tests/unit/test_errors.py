@@ -110,6 +110,7 @@ class TestErrors(base.IronicAgentTest):
                  (errors.ImageWriteError('device', 'exit_code', 'stdout',
                                          'stderr'),
                   DIFF_CL_DETAILS),
+                 (errors.ImageFormatError(DETAILS), SAME_DETAILS),
                  (errors.SystemRebootError('exit_code', 'stdout', 'stderr'),
                   DIFF_CL_DETAILS),
                  (errors.BlockDeviceEraseError(DETAILS), SAME_DETAILS),
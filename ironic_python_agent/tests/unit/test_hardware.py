@@ -771,6 +771,33 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         mock_cached_node.assert_called_once_with()
         mock_dev.assert_called_once_with()
 
+    @mock.patch.object(hardware, 'list_all_block_devices', autospec=True)
+    def test_get_os_install_devices(self, mock_dev):
+        mock_dev.return_value = [
+            hardware.BlockDevice(name='/dev/sda', model='Mirror Disk',
+                                 size=10737418240, rotational=False),
+            hardware.BlockDevice(name='/dev/sdb', model='TinyUSB Drive',
+                                 size=3116853504, rotational=False),
+            hardware.BlockDevice(name='/dev/sdc', model='Mirror Disk',
+                                 size=10737418240, rotational=False),
+        ]
+        self.assertEqual(
+            ['/dev/sda', '/dev/sdc'],
+            self.hardware.get_os_install_devices({'model': 'Mirror Disk'}))
+
+    @mock.patch.object(hardware, 'list_all_block_devices', autospec=True)
+    def test_get_os_install_devices_not_found(self, mock_dev):
+        mock_dev.return_value = [
+            hardware.BlockDevice(name='/dev/sda', model='TinyUSB Drive',
+                                 size=3116853504, rotational=False),
+        ]
+        self.assertRaises(errors.DeviceNotFound,
+                          self.hardware.get_os_install_devices,
+                          {'model': 'Mirror Disk'})
+        self.assertRaises(errors.DeviceNotFound,
+                          self.hardware.get_os_install_devices,
+                          {'size': 'not-int'})
+
     def test__get_device_info(self):
         fileobj = mock.mock_open(read_data='fake-vendor')
         with mock.patch(
@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ironic_python_agent import image_cache
+from ironic_python_agent.tests.unit import base
+
+
+@mock.patch('psutil.virtual_memory', autospec=True)
+class TestImageCache(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.directory = os.path.join(self.tempdir, 'cache')
+        self.scratch_dir = os.path.join(self.tempdir, 'scratch')
+        self.cache = image_cache.ImageCache(self.directory, 100,
+                                            scratch_dir=self.scratch_dir,
+                                            memory_reserve=10)
+
+    def _image(self, name, size):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_cache_keys(self, memory_mock):
+        self.assertEqual(['sha512-ghi', 'sha256-def', 'md5-abc'],
+                         image_cache.cache_keys([('md5', 'ABC'),
+                                                 ('sha256', 'def'),
+                                                 ('sha512', 'ghi')]))
+
+    def test_lookup_strongest_key(self, memory_mock):
+        memory_mock.return_value.available = 1000
+        cached = self.cache.add(self._image('image', 40), ['md5-abc'])
+
+        self.assertEqual(cached, self.cache.lookup(['md5-abc']))
+        # Not verified against the stronger checksum
+        self.assertIsNone(self.cache.lookup(
+            image_cache.cache_keys([('md5', 'abc'), ('sha256', 'def')])))
+        self.assertIsNone(self.cache.lookup([]))
+
+    def test_add_and_lookup(self, memory_mock):
+        memory_mock.return_value.available = 1000
+        path = self._image('image', 40)
+
+        cached = self.cache.add(path, ['md5-abc', 'sha256-def'])
+
+        self.assertEqual(os.path.join(self.directory, 'md5-abc'), cached)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(cached, self.cache.lookup(['md5-abc']))
+        self.assertIsNone(self.cache.lookup(['sha256-def']))
+        self.assertIsNone(self.cache.lookup(['md5-other']))
+
+    def test_add_spills_to_scratch_dir(self, memory_mock):
+        memory_mock.return_value.available = 5
+        path = self._image('image', 40)
+
+        cached = self.cache.add(path, ['md5-abc'])
+
+        self.assertEqual(os.path.join(self.scratch_dir, 'md5-abc'), cached)
+        self.assertEqual(cached, self.cache.lookup(['md5-abc']))
+
+    def test_add_no_memory_no_scratch_dir(self, memory_mock):
+        memory_mock.return_value.available = 5
+        self.cache.scratch_dir = None
+        path = self._image('image', 40)
+
+        self.assertEqual(path, self.cache.add(path, ['md5-abc']))
+        self.assertTrue(os.path.exists(path))
+        self.assertIsNone(self.cache.lookup(['md5-abc']))
+
+    def test_add_too_large(self, memory_mock):
+        memory_mock.return_value.available = 1000
+        path = self._image('image', 101)
+
+        self.assertEqual(path, self.cache.add(path, ['md5-abc']))
+        self.assertIsNone(self.cache.lookup(['md5-abc']))
+
+    def test_add_evicts_least_recently_used(self, memory_mock):
+        memory_mock.return_value.available = 1000
+        first = self.cache.add(self._image('first', 40), ['md5-first'])
+        second = self.cache.add(self._image('second', 40), ['md5-second'])
+        os.utime(first, (1000, 1000))
+        os.utime(second, (2000, 2000))
+        # Using the first image makes the second one least recently used
+        self.cache.lookup(['md5-first'])
+
+        self.cache.add(self._image('third', 40), ['md5-third'])
+
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertIsNotNone(self.cache.lookup(['md5-third']))
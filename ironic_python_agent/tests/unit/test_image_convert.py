@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo_concurrency import processutils
+from oslo_utils import units
+
+from ironic_python_agent import errors
+from ironic_python_agent import image_convert
+from ironic_python_agent import image_writer
+from ironic_python_agent import progress
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent.tests.unit import test_qcow2
+
+
+class TestImageConvert(base.IronicAgentTest):
+
+    @mock.patch('psutil.virtual_memory', autospec=True)
+    def test_memory_budget(self, memory_mock):
+        memory_mock.return_value.available = 8 * units.Gi
+        self.assertEqual(2 * units.Gi, image_convert.memory_budget(25))
+
+    @mock.patch('stevedore.driver.DriverManager', autospec=True)
+    def test_get_converter(self, manager_mock):
+        converter = image_convert.get_converter('builtin')
+        manager_mock.assert_called_once_with(image_convert.NAMESPACE,
+                                             'builtin', invoke_on_load=True)
+        self.assertEqual(manager_mock.return_value.driver, converter)
+
+    @mock.patch('stevedore.driver.DriverManager', autospec=True)
+    def test_get_converter_not_found(self, manager_mock):
+        manager_mock.side_effect = RuntimeError('not found')
+        self.assertRaises(RuntimeError, image_convert.get_converter, 'foo')
+
+    def test_supports(self):
+        self.assertTrue(image_convert.BuiltinConverter().supports('qcow2'))
+        self.assertFalse(image_convert.BuiltinConverter().supports('vmdk'))
+        self.assertTrue(image_convert.QemuImgConverter().supports('vmdk'))
+
+
+class TestQemuImgConverter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestQemuImgConverter, self).setUp()
+        self.execute_mock = self._exec_patch
+        self.execute_mock.side_effect = None
+        self.execute_mock.return_value = ('', '')
+
+    def test_convert(self):
+        image_convert.QemuImgConverter().convert(
+            '/tmp/image', 'vmdk', '/dev/sda', 'none', 8, units.Mi,
+            512 * units.Mi)
+
+        self.execute_mock.assert_has_calls([
+            mock.call('sgdisk', '-Z', '/dev/sda'),
+            mock.call('qemu-img', 'convert', '-t', 'none', '-O',
+                      'host_device', '/tmp/image', '/dev/sda',
+                      prlimit=mock.ANY),
+            mock.call('sync')])
+        limits = self.execute_mock.call_args_list[1][1]['prlimit']
+        self.assertEqual(units.Gi, limits.address_space)
+
+    def test_convert_fails(self):
+        self.execute_mock.side_effect = [
+            ('', ''), processutils.ProcessExecutionError()]
+        self.assertRaises(processutils.ProcessExecutionError,
+                          image_convert.QemuImgConverter().convert,
+                          '/tmp/image', 'vmdk', '/dev/sda', 'none', 8,
+                          units.Mi, 2 * units.Gi)
+        self.assertEqual(2, self.execute_mock.call_count)
+
+
+class TestBuiltinConverter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestBuiltinConverter, self).setUp()
+        self.execute_mock = self._exec_patch
+        self.execute_mock.side_effect = None
+        self.execute_mock.return_value = ('', '')
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.image = os.path.join(tempdir, 'image')
+        self.device = os.path.join(tempdir, 'device')
+        open(self.device, 'wb').close()
+
+    def _convert(self, image_data, image_format, cache_mode='none',
+                 memory_limit=units.Gi, zero_request=None,
+                 image_progress=None):
+        with open(self.image, 'wb') as f:
+            f.write(image_data)
+        return image_convert.BuiltinConverter().convert(
+            self.image, image_format, self.device, cache_mode, 3, 4096,
+            memory_limit, zero_request=zero_request,
+            image_progress=image_progress)
+
+    def _read(self):
+        with open(self.device, 'rb') as f:
+            return f.read()
+
+    def test_convert_raw(self):
+        image_data = b''.join(bytes(bytearray([i])) * 5000
+                              for i in range(1, 10))
+        image_progress = progress.ImageProgress('fake_id', len(image_data))
+
+        stats = self._convert(image_data, 'raw',
+                              image_progress=image_progress)
+
+        self.execute_mock.assert_called_once_with('sgdisk', '-Z', self.device)
+        self.assertEqual((len(image_data), 0, 0), stats)
+        self.assertEqual(image_data, self._read())
+        self.assertEqual(len(image_data),
+                         image_progress.bytes(progress.RECEIVED))
+        self.assertEqual(len(image_data),
+                         image_progress.bytes(progress.WRITTEN))
+
+    def test_convert_raw_directsync(self):
+        image_data = b'a' * 10000
+        with mock.patch.object(image_writer, 'DirectWriter',
+                               wraps=image_writer.DirectWriter) as dw_mock:
+            self._convert(image_data, 'raw', cache_mode='directsync')
+        dw_mock.assert_called_once_with(self.device, 3, 4096, None,
+                                        sync_writes=True)
+        self.assertEqual(image_data, self._read())
+
+    def test_convert_qcow2(self):
+        guest = {0: test_qcow2._cluster(1), 5: test_qcow2._cluster(2)}
+        virtual_size = 8 * test_qcow2.CLUSTER_SIZE
+        image_data = test_qcow2.build_qcow2(guest, virtual_size)
+
+        self._convert(image_data, 'qcow2')
+
+        expected = bytearray(virtual_size)
+        for index, value in guest.items():
+            start = index * test_qcow2.CLUSTER_SIZE
+            expected[start:start + test_qcow2.CLUSTER_SIZE] = value
+        self.assertEqual(bytes(expected), self._read())
+
+    def test_convert_qcow2_memory_limit(self):
+        guest = {0: test_qcow2._cluster(1), 5: test_qcow2._cluster(2)}
+        image_data = test_qcow2.build_qcow2(
+            guest, 8 * test_qcow2.CLUSTER_SIZE, tables_last=True)
+
+        # The write buffers take the whole budget, leaving no memory to
+        # hold the clusters stored before the tables.
+        self.assertRaises(errors.ImageFormatError, self._convert,
+                          image_data, 'qcow2', memory_limit=4 * 4096)
+
+    @mock.patch.object(image_writer, '_zero_fd_range', autospec=True)
+    def test_convert_sparse_writeback(self, zero_mock):
+        zero_mock.return_value = (64 * units.Ki, 192 * units.Ki)
+        image_data = b'a' * 100 + b'\0' * (192 * units.Ki - 100)
+
+        stats = self._convert(image_data, 'raw', cache_mode='writeback',
+                              zero_request=image_writer.BLKZEROOUT)
+
+        self.assertEqual((64 * units.Ki, 0, 128 * units.Ki), stats)
+        self.assertEqual(b'a' * 100, self._read()[:100])
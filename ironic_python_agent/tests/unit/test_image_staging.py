@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo_concurrency import processutils
+from oslo_utils import units
+
+from ironic_python_agent import image_staging
+from ironic_python_agent.tests.unit import base
+
+
+@mock.patch.object(image_staging, '_free_space', autospec=True)
+@mock.patch('psutil.virtual_memory', autospec=True)
+class TestAllocate(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestAllocate, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.scratch_dir = os.path.join(self.tempdir, 'scratch')
+        self.device = os.path.join(self.tempdir, 'device')
+        with open(self.device, 'wb') as f:
+            f.truncate(100 * units.Mi)
+        self._exec_patch.side_effect = None
+        self._exec_patch.return_value = ('/dev/loop3\n', '')
+
+    def test_memory(self, memory_mock, free_mock):
+        memory_mock.return_value.available = 1000
+        free_mock.return_value = 500
+
+        staged = image_staging.allocate('image', 400, 100,
+                                        scratch_dir=self.scratch_dir,
+                                        device=self.device)
+
+        self.assertEqual('/tmp/image', staged.path)
+        self.assertEqual(400, staged.size)
+        self.assertIsNone(staged.device)
+        free_mock.assert_called_once_with('/tmp')
+        self.assertFalse(self._exec_patch.called)
+
+    def test_unknown_size(self, memory_mock, free_mock):
+        staged = image_staging.allocate('image', None, 100,
+                                        scratch_dir=self.scratch_dir,
+                                        device=self.device)
+
+        self.assertEqual('/tmp/image', staged.path)
+        self.assertFalse(memory_mock.called)
+
+    def test_scratch_dir(self, memory_mock, free_mock):
+        memory_mock.return_value.available = 1000
+        # tmpfs, then scratch directory
+        free_mock.side_effect = [450, 400]
+
+        staged = image_staging.allocate('image', 400, 100,
+                                        scratch_dir=self.scratch_dir,
+                                        device=self.device)
+
+        self.assertEqual(os.path.join(self.scratch_dir, 'image'), staged.path)
+        self.assertTrue(os.path.isdir(self.scratch_dir))
+        self.assertTrue(staged.temporary)
+        self.assertFalse(self._exec_patch.called)
+
+        with open(staged.path, 'wb') as f:
+            f.write(b'image')
+        staged.release()
+        self.assertFalse(os.path.exists(staged.path))
+
+    def test_device_tail(self, memory_mock, free_mock):
+        memory_mock.return_value.available = units.Mi
+        free_mock.return_value = 10 * units.Mi
+        size = 40 * units.Mi + 5
+
+        staged = image_staging.allocate('image', size, 0,
+                                        scratch_dir=self.scratch_dir,
+                                        device=self.device)
+
+        # 100 MiB device, 1 MiB margin, aligned down to 1 MiB
+        offset = 58 * units.Mi
+        self.assertEqual('/dev/loop3', staged.path)
+        self.assertEqual(self.device, staged.device)
+        self.assertEqual(offset, staged.offset)
+        self.assertEqual(size, staged.size)
+        self._exec_patch.assert_called_once_with(
+            'losetup', '--find', '--show', '--offset', str(offset),
+            '--sizelimit', str(size), self.device)
+
+        self._exec_patch.reset_mock()
+        staged.release()
+        self._exec_patch.assert_called_once_with('losetup', '--detach',
+                                                 '/dev/loop3')
+
+    def test_device_too_small(self, memory_mock, free_mock):
+        memory_mock.return_value.available = units.Mi
+        free_mock.return_value = units.Mi
+
+        staged = image_staging.allocate('image', 50 * units.Mi, 0,
+                                        device=self.device)
+
+        self.assertEqual('/tmp/image', staged.path)
+        self.assertIsNone(staged.device)
+        self.assertFalse(self._exec_patch.called)
+
+    def test_device_losetup_fails(self, memory_mock, free_mock):
+        memory_mock.return_value.available = units.Mi
+        free_mock.return_value = units.Mi
+        self._exec_patch.side_effect = processutils.ProcessExecutionError()
+
+        staged = image_staging.allocate('image', 10 * units.Mi, 0,
+                                        device=self.device)
+
+        self.assertEqual('/tmp/image', staged.path)
+        self.assertIsNone(staged.device)
+
+    def test_memory_release_keeps_image(self, memory_mock, free_mock):
+        path = os.path.join(self.tempdir, 'image')
+        with open(path, 'wb') as f:
+            f.write(b'image')
+
+        image_staging.StagedImage(path, 5).release()
+
+        self.assertTrue(os.path.exists(path))
@@ -0,0 +1,223 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+from wsgiref import simple_server
+
+import mock
+import requests
+
+from ironic_python_agent.api import app
+from ironic_python_agent.extensions import standby
+from ironic_python_agent import image_swarm
+from ironic_python_agent.tests.unit import base
+
+
+class TestSharedImage(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSharedImage, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'image')
+        self.shared = image_swarm.SharedImage(self.path, 4)
+
+    def test_chunks_recorded_once_written(self):
+        flush = mock.Mock()
+        with open(self.path, 'wb') as f:
+            write = self.shared.wrap(f.write, flush=flush)
+            write(b'aaa')
+            self.assertFalse(flush.called)
+            self.assertIsNone(self.shared.read_chunk(0))
+            write(b'abbbbc')
+            flush.assert_called_once_with()
+            f.flush()
+            self.assertEqual(b'aaaa', self.shared.read_chunk(0))
+            self.assertEqual(b'bbbb', self.shared.read_chunk(1))
+            self.assertIsNone(self.shared.read_chunk(2))
+            write(b'c')
+        self.shared.finish()
+
+        self.assertEqual(b'cc', self.shared.read_chunk(2))
+        self.assertIsNone(self.shared.read_chunk(3))
+
+    def test_wrap_from_offset(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'aaaabb')
+            write = self.shared.wrap(f.write, offset=6)
+            write(b'bbcc')
+        self.shared.finish()
+
+        self.assertEqual(b'aaaa', self.shared.read_chunk(0))
+        self.assertEqual(b'bbbb', self.shared.read_chunk(1))
+        self.assertEqual(b'cc', self.shared.read_chunk(2))
+
+    def test_read_chunk_missing_file(self):
+        self.shared.wrap(mock.Mock())(b'aaaa')
+        self.assertIsNone(self.shared.read_chunk(0))
+
+
+class TestSharing(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSharing, self).setUp()
+        self.addCleanup(image_swarm.unshare, 'md5-abc')
+        self.addCleanup(image_swarm.unshare, 'md5-def')
+
+    def test_share_and_unshare(self):
+        shared = image_swarm.SharedImage('/dev/sda', 4)
+        image_swarm.share('md5-abc', shared)
+        self.assertIs(shared, image_swarm.get_shared_image('md5-abc'))
+
+        image_swarm.unshare('md5-abc')
+        self.assertIsNone(image_swarm.get_shared_image('md5-abc'))
+
+    def test_share_replaces_image_on_same_path(self):
+        image_swarm.share('md5-abc', image_swarm.SharedImage('/dev/sda', 4))
+        shared = image_swarm.SharedImage('/dev/sda', 4)
+        image_swarm.share('md5-def', shared)
+
+        self.assertIsNone(image_swarm.get_shared_image('md5-abc'))
+        self.assertIs(shared, image_swarm.get_shared_image('md5-def'))
+
+    def test_move(self):
+        shared = image_swarm.SharedImage('/tmp/fake_id', 4)
+        image_swarm.share('md5-abc', shared)
+
+        image_swarm.move('/tmp/fake_id', '/tmp/cache/md5-abc')
+
+        self.assertEqual('/tmp/cache/md5-abc', shared.path)
+
+    def test_chunk_url(self):
+        self.assertEqual('http://10.0.0.5:9999/v1/images/md5-abc/3',
+                         image_swarm.chunk_url('http://10.0.0.5:9999/',
+                                               'md5-abc', 3))
+
+
+@mock.patch('requests.get', autospec=True)
+class TestDiscoverPeers(base.IronicAgentTest):
+
+    def test_seed_peers(self, requests_mock):
+        peers = image_swarm.discover_peers({'peers': ['http://a:9999']},
+                                           'md5-abc', {})
+        self.assertEqual(['http://a:9999'], peers)
+        self.assertFalse(requests_mock.called)
+
+    def test_tracker(self, requests_mock):
+        requests_mock.return_value.json.return_value = {
+            'peers': ['http://a:9999', 'http://b:9999']}
+        swarm = {'peers': ['http://a:9999'],
+                 'tracker': 'http://tracker/peers'}
+
+        peers = image_swarm.discover_peers(swarm, 'md5-abc',
+                                           {'verify': True})
+
+        self.assertEqual(['http://a:9999', 'http://b:9999'], peers)
+        requests_mock.assert_called_once_with(
+            'http://tracker/peers', params={'image': 'md5-abc'},
+            verify=True)
+
+    def test_tracker_unavailable(self, requests_mock):
+        requests_mock.side_effect = requests.ConnectionError('boom')
+        swarm = {'peers': ['http://a:9999'],
+                 'tracker': 'http://tracker/peers'}
+
+        self.assertEqual(['http://a:9999'],
+                         image_swarm.discover_peers(swarm, 'md5-abc', {}))
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve_peer(path, key, chunk_size, offset, data, conn):
+    """Run the agent API of a peer sharing part of an image.
+
+    Runs in its own process, so that every peer has its own shared images.
+    """
+    shared = image_swarm.SharedImage(path, chunk_size)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * offset)
+        shared.wrap(f.write, offset=offset)(data)
+    shared.finish()
+    image_swarm.share(key, shared)
+    server = simple_server.make_server(
+        '127.0.0.1', 0, app.VersionSelectorApplication(agent=None),
+        handler_class=_QuietHandler)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+class TestSwarmPeers(base.IronicAgentTest):
+    """Fetches an image from agent APIs serving it on the loopback."""
+
+    def setUp(self):
+        super(TestSwarmPeers, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.content = b'aaaabbbbcc'
+        self.image_info = {
+            'id': 'fake_id',
+            'urls': ['http://127.0.0.1:1/fake_id'],
+            'checksum': hashlib.md5(self.content).hexdigest(),
+            'chunk_manifest': {
+                'chunk_size': 4,
+                'digests': [hashlib.sha256(self.content[i:i + 4]).hexdigest()
+                            for i in range(0, len(self.content), 4)]},
+        }
+        self.key = 'md5-' + self.image_info['checksum']
+
+    def _start_peer(self, name, offset, data):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        peer = multiprocessing.Process(
+            target=_serve_peer,
+            args=(os.path.join(self.tempdir, name), self.key, 4, offset,
+                  data, child_conn))
+        peer.daemon = True
+        peer.start()
+        self.addCleanup(peer.join, 10)
+        self.addCleanup(peer.terminate)
+        self.assertTrue(parent_conn.poll(30))
+        return 'http://127.0.0.1:{}'.format(parent_conn.recv())
+
+    @mock.patch('requests.get', autospec=True)
+    def test_chunks_from_peers(self, requests_mock):
+        # The first peer has written the first two chunks. The second one
+        # only has the last chunk, and zeroes in place of the others.
+        peers = [self._start_peer('peer1', 0, self.content[:8]),
+                 self._start_peer('peer2', 8, self.content[8:])]
+        self.image_info['swarm'] = {'peers': peers}
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(self.content))}
+
+        for peer, index, status in [(peers[0], 1, 200), (peers[0], 2, 404),
+                                    (peers[1], 2, 200)]:
+            self.assertEqual(status, requests.Session().get(
+                image_swarm.chunk_url(peer, self.key, index)).status_code)
+
+        image_download = standby.ImageDownload(self.image_info)
+
+        # Nothing listens on the image URL, so every chunk must come from
+        # the peers
+        self.assertEqual(self.content, b''.join(image_download))
+        self.assertEqual(self.image_info['checksum'],
+                         image_download.md5sum())
+        self.assertEqual(len(self.content),
+                         image_download._ranged_download.bytes_from_peers)
@@ -0,0 +1,511 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import io
+import os
+import shutil
+import stat
+import struct
+import tempfile
+
+import mock
+from oslo_utils import units
+
+from ironic_python_agent import image_writer
+from ironic_python_agent.tests.unit import base
+
+
+class TestDirectWriter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDirectWriter, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.path = os.path.join(tempdir, 'device')
+        with open(self.path, 'wb') as f:
+            f.truncate(64 * 1024)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_aligned_buffer(self):
+        buf = image_writer.AlignedBuffer(8192, 4096)
+        self.assertEqual(0, buf.address % 4096)
+        self.assertEqual(8192, len(buf.view))
+
+    def test_write(self):
+        writer = image_writer.DirectWriter(self.path, 3, 4096)
+        data = b''.join(bytes(bytearray([i])) * 1000 for i in range(1, 20))
+        for offset in range(0, len(data), 1000):
+            writer.write(memoryview(data)[offset:offset + 1000])
+        writer.close()
+
+        self.assertEqual(len(data), writer.bytes_written)
+        self.assertEqual(data, self._read()[:len(data)])
+
+    def test_write_at_and_write_zeroes(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\xff' * 32 * 1024)
+        writer = image_writer.DirectWriter(self.path, 2, 4096)
+        writer.write_at(8192, b'a' * 5000)
+        writer.write_at(512, b'b' * 100)
+        writer.write_zeroes(16384, 8192)
+        writer.close()
+
+        result = self._read()
+        self.assertEqual(b'\xff' * 512 + b'b' * 100, result[:612])
+        self.assertEqual(b'a' * 5000, result[8192:13192])
+        self.assertEqual(b'\0' * 8192, result[16384:24576])
+        self.assertEqual(5100, writer.bytes_written)
+        self.assertEqual(8192, writer.bytes_zeroed)
+
+    def test_block_size_rounded_to_alignment(self):
+        writer = image_writer.DirectWriter(self.path, 1, 5000)
+        writer.close()
+        self.assertEqual(0, writer.block_size % writer.alignment)
+        self.assertGreaterEqual(writer.block_size, 5000)
+
+    def test_sync_writes(self):
+        with mock.patch('os.open', autospec=True,
+                        side_effect=os.open) as open_mock:
+            writer = image_writer.DirectWriter(self.path, 1, 4096,
+                                               sync_writes=True)
+            writer.write(b'x' * 100)
+            writer.close()
+
+        for call in open_mock.call_args_list:
+            self.assertTrue(call[0][1] & os.O_DSYNC)
+        self.assertEqual(b'x' * 100, self._read()[:100])
+
+    def test_write_error(self):
+        writer = image_writer.DirectWriter(self.path, 2, 4096)
+        with mock.patch.object(writer, '_libc') as libc_mock:
+            libc_mock.pwrite.return_value = -1
+            with mock.patch('ctypes.get_errno', autospec=True,
+                            return_value=errno.EIO):
+                writer.write(b'x' * 4096)
+                self.assertRaises(OSError, writer.close)
+
+    def test_abort(self):
+        writer = image_writer.DirectWriter(self.path, 2, 4096)
+        writer.write(b'x' * 100)
+        writer.abort()
+        self.assertEqual(b'\0' * 100, self._read()[:100])
+
+    @mock.patch.object(image_writer, '_zero_fd_range', autospec=True)
+    def test_write_zeroes_with_zero_request(self, zero_mock):
+        zero_mock.return_value = (4096, 8192)
+        writer = image_writer.DirectWriter(self.path, 2, 4096,
+                                           image_writer.BLKZEROOUT)
+        writer.write_zeroes(1000, 10000)
+        writer.write(b'x' * 10)
+        writer.close()
+
+        zero_mock.assert_called_once_with(mock.ANY, image_writer.BLKZEROOUT,
+                                          1000, 10000)
+        self.assertEqual(4096, writer.bytes_skipped)
+        self.assertEqual(10000 - 4096, writer.bytes_zeroed)
+        self.assertEqual(b'x' * 10, self._read()[11000:11010])
+
+
+class TestReadBack(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestReadBack, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.path = os.path.join(tempdir, 'device')
+        self.data = b''.join(bytes(bytearray([i])) * 1000
+                             for i in range(1, 20))
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+            f.truncate(64 * 1024)
+
+    def test_read_back(self):
+        blocks = list(image_writer.read_back(self.path, len(self.data), 3,
+                                             4096))
+        self.assertEqual([4096] * 4 + [len(self.data) - 4 * 4096],
+                         [len(block) for block in blocks])
+        self.assertEqual(self.data, b''.join(blocks))
+
+    def test_read_back_unaligned_block_size(self):
+        blocks = list(image_writer.read_back(self.path, len(self.data), 2,
+                                             1000))
+        self.assertEqual(19, len(blocks))
+        self.assertEqual(self.data, b''.join(blocks))
+
+    def test_read_back_check(self):
+        checked = {}
+
+        def _check(offset, data):
+            checked[offset] = data
+
+        list(image_writer.read_back(self.path, 8192, 2, 4096, _check))
+        self.assertEqual({0: self.data[:4096], 4096: self.data[4096:8192]},
+                         checked)
+
+    def test_read_back_check_fails(self):
+        def _check(offset, data):
+            if offset == 4096:
+                raise ValueError('mismatch')
+
+        self.assertRaisesRegex(ValueError, 'mismatch', list,
+                               image_writer.read_back(self.path, 32 * 1024,
+                                                      2, 4096, _check))
+
+    def test_read_back_short(self):
+        self.assertRaises(IOError, list,
+                          image_writer.read_back(self.path, 128 * 1024, 2,
+                                                 4096))
+
+
+class TestFileWriter(base.IronicAgentTest):
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_write_zeroes_with_zero_request(self, ioctl_mock):
+        target = io.BytesIO(b'\xff' * 12288)
+        target.fileno = mock.Mock(return_value=42)
+        writer = image_writer.FileWriter(target, image_writer.BLKDISCARD)
+
+        writer.write_zeroes(1000, 10000)
+
+        ioctl_mock.assert_called_once_with(42, image_writer.BLKDISCARD,
+                                           struct.pack('QQ', 4096, 4096))
+        result = target.getvalue()
+        self.assertEqual(b'\0' * 3096, result[1000:4096])
+        self.assertEqual(b'\0' * 2808, result[8192:11000])
+        self.assertEqual(b'\xff' * 1288, result[11000:])
+        self.assertEqual(4096, writer.bytes_skipped)
+        self.assertEqual(5904, writer.bytes_zeroed)
+        self.assertEqual(11000, target.tell())
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_write_zeroes_ioctl_fails(self, ioctl_mock):
+        ioctl_mock.side_effect = IOError(errno.EOPNOTSUPP, 'Not supported')
+        target = io.BytesIO()
+        target.fileno = mock.Mock(return_value=42)
+        writer = image_writer.FileWriter(target, image_writer.BLKZEROOUT)
+
+        writer.write_zeroes(0, 8192)
+        writer.write_zeroes(8192, 8192)
+
+        self.assertEqual(1, ioctl_mock.call_count)
+        self.assertEqual(b'\0' * 16384, target.getvalue())
+        self.assertEqual(0, writer.bytes_skipped)
+        self.assertEqual(16384, writer.bytes_zeroed)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_write_zeroes_discarded(self, ioctl_mock):
+        target = io.BytesIO(b'\0' * 12288)
+        target.fileno = mock.Mock(return_value=42)
+        writer = image_writer.FileWriter(target, image_writer.DISCARDED)
+
+        writer.write_zeroes(1000, 10000)
+
+        self.assertFalse(ioctl_mock.called)
+        self.assertEqual(10000, writer.bytes_skipped)
+        self.assertEqual(0, writer.bytes_zeroed)
+
+
+@mock.patch('fcntl.ioctl', autospec=True)
+class TestDiscardDevice(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDiscardDevice, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.device = os.path.join(self.tempdir, 'device')
+        with open(self.device, 'wb') as f:
+            f.truncate(10 * 8192 + 4096)
+        self.queue_dir = os.path.join(self.tempdir, 'queue')
+        os.mkdir(self.queue_dir)
+        patcher = mock.patch.object(image_writer, '_queue_dir',
+                                    autospec=True,
+                                    return_value=self.queue_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _attributes(self, **attributes):
+        for name, value in attributes.items():
+            with open(os.path.join(self.queue_dir, name), 'w') as f:
+                f.write('{}\n'.format(value))
+
+    def test_discard(self, ioctl_mock):
+        self._attributes(discard_max_bytes=8192 * 3 + 100,
+                         discard_granularity=8192, discard_zeroes_data=1)
+
+        self.assertEqual((10 * 8192 + 4096, True),
+                         image_writer.discard_device(self.device, threads=2))
+
+        ranges = sorted(struct.unpack('QQ', c[0][2])
+                        for c in ioctl_mock.call_args_list)
+        self.assertEqual([(0, 3 * 8192), (3 * 8192, 3 * 8192),
+                          (6 * 8192, 3 * 8192), (9 * 8192, 8192 + 4096)],
+                         ranges)
+        for c in ioctl_mock.call_args_list:
+            self.assertEqual(image_writer.BLKDISCARD, c[0][1])
+
+    def test_discard_no_zeroes(self, ioctl_mock):
+        self._attributes(discard_max_bytes=units.Gi)
+
+        self.assertEqual((10 * 8192 + 4096, False),
+                         image_writer.discard_device(self.device))
+        ioctl_mock.assert_called_once_with(
+            mock.ANY, image_writer.BLKDISCARD,
+            struct.pack('QQ', 0, 10 * 8192 + 4096))
+
+    def test_not_supported(self, ioctl_mock):
+        self._attributes(discard_max_bytes=0)
+
+        self.assertEqual((0, False), image_writer.discard_device(self.device))
+        self.assertFalse(ioctl_mock.called)
+
+    def test_error(self, ioctl_mock):
+        self._attributes(discard_max_bytes=units.Gi)
+        ioctl_mock.side_effect = IOError(errno.EOPNOTSUPP, 'Not supported')
+
+        self.assertRaises(IOError, image_writer.discard_device, self.device)
+
+
+class TestSparseWriter(base.IronicAgentTest):
+
+    def test_write(self):
+        target = mock.Mock(spec=['write_at', 'write_zeroes'])
+        written = []
+        target.write_at.side_effect = (
+            lambda offset, data: written.append((offset, data.tobytes())))
+        writer = image_writer.SparseWriter(target, block_size=16)
+
+        writer.write(b'a' * 20 + b'\0' * 28)
+        writer.write(b'\0' * 20)
+        writer.write(b'\0' * 4 + b'b' * 8)
+        writer.flush()
+
+        self.assertEqual([(0, b'a' * 20 + b'\0' * 12),
+                          (68, b'\0' * 4 + b'b' * 8)], written)
+        target.write_zeroes.assert_called_once_with(32, 36)
+
+    def test_write_at_and_write_zeroes(self):
+        target = mock.Mock(spec=['write_at', 'write_zeroes'])
+        writer = image_writer.SparseWriter(target, block_size=16)
+
+        writer.write_zeroes(0, 16)
+        writer.write_at(16, b'\0' * 16)
+        writer.write_at(64, b'\0' * 16)
+        writer.flush()
+
+        self.assertEqual([mock.call(0, 32), mock.call(64, 16)],
+                         target.write_zeroes.call_args_list)
+        self.assertFalse(target.write_at.called)
+
+
+class TestBufferedDeviceWriter(base.IronicAgentTest):
+
+    def test_write_and_close(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'device')
+        writer = image_writer.BufferedDeviceWriter(path)
+        writer.write(b'abc')
+        writer.write_at(10, b'def')
+        writer.close()
+
+        with open(path, 'rb') as f:
+            self.assertEqual(b'abc' + b'\0' * 7 + b'def', f.read())
+
+
+@mock.patch.object(image_writer, '_get_libc', autospec=True)
+class TestWritebackController(base.IronicAgentTest):
+
+    def _controller(self, libc_mock, window=100):
+        libc_mock.return_value.sync_file_range.return_value = 0
+        libc_mock.return_value.posix_fadvise.return_value = 0
+        return image_writer.WritebackController(42, window)
+
+    def test_wrote(self, libc_mock):
+        controller = self._controller(libc_mock)
+        libc = libc_mock.return_value
+
+        controller.wrote(0, 60)
+        self.assertFalse(libc.sync_file_range.called)
+
+        controller.wrote(60, 60)
+        libc.sync_file_range.assert_called_once_with(
+            42, 0, 100, image_writer.SYNC_FILE_RANGE_WRITE)
+        self.assertFalse(libc.posix_fadvise.called)
+
+        libc.sync_file_range.reset_mock()
+        controller.wrote(120, 200)
+        wait = (image_writer.SYNC_FILE_RANGE_WAIT_BEFORE |
+                image_writer.SYNC_FILE_RANGE_WRITE |
+                image_writer.SYNC_FILE_RANGE_WAIT_AFTER)
+        self.assertEqual([mock.call(42, 100, 100,
+                                    image_writer.SYNC_FILE_RANGE_WRITE),
+                          mock.call(42, 0, 100, wait),
+                          mock.call(42, 200, 100,
+                                    image_writer.SYNC_FILE_RANGE_WRITE),
+                          mock.call(42, 100, 100, wait)],
+                         libc.sync_file_range.call_args_list)
+        self.assertEqual([mock.call(42, 0, 100,
+                                    image_writer.POSIX_FADV_DONTNEED),
+                          mock.call(42, 100, 100,
+                                    image_writer.POSIX_FADV_DONTNEED)],
+                         libc.posix_fadvise.call_args_list)
+
+    def test_wrote_behind(self, libc_mock):
+        controller = self._controller(libc_mock)
+
+        controller.wrote(150, 10)
+        controller.wrote(0, 10)
+
+        libc_mock.return_value.sync_file_range.assert_called_once_with(
+            42, 0, 100, image_writer.SYNC_FILE_RANGE_WRITE)
+
+    @mock.patch('ctypes.get_errno', autospec=True)
+    def test_error_disables(self, errno_mock, libc_mock):
+        controller = self._controller(libc_mock)
+        libc = libc_mock.return_value
+        libc.sync_file_range.return_value = -1
+        errno_mock.return_value = errno.ENOSYS
+
+        controller.wrote(0, 100)
+        controller.wrote(100, 100)
+
+        self.assertEqual(1, libc.sync_file_range.call_count)
+
+    def test_unavailable(self, libc_mock):
+        del libc_mock.return_value.sync_file_range
+        controller = image_writer.WritebackController(42, 100)
+
+        controller.wrote(0, 1000)
+
+        self.assertFalse(libc_mock.return_value.posix_fadvise.called)
+
+    def test_file_writer(self, libc_mock):
+        self._controller(libc_mock)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'device')
+        writer = image_writer.BufferedDeviceWriter(path,
+                                                   writeback_window=4096)
+        fd = writer._file.fileno()
+        writer.write(b'a' * 3000)
+        writer.write_zeroes(3000, 3000)
+        writer.write_at(9000, b'b' * 100)
+        writer.close()
+
+        with open(path, 'rb') as f:
+            self.assertEqual(b'a' * 3000 + b'\0' * 6000 + b'b' * 100,
+                             f.read())
+        libc_mock.return_value.sync_file_range.assert_has_calls([
+            mock.call(fd, 0, 4096, image_writer.SYNC_FILE_RANGE_WRITE),
+            mock.call(fd, 4096, 4096, image_writer.SYNC_FILE_RANGE_WRITE)])
+
+
+class TestFanOutWriter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestFanOutWriter, self).setUp()
+        self.targets = [io.BytesIO(), io.BytesIO()]
+        self.writers = []
+        for target in self.targets:
+            writer = image_writer.FileWriter(target)
+            writer.close = mock.Mock()
+            writer.abort = mock.Mock()
+            self.writers.append(writer)
+
+    def test_write(self):
+        writer = image_writer.FanOutWriter(self.writers, queue_size=1)
+        buf = bytearray(b'abcd')
+        writer.write(buf)
+        # Mutable data is copied before being queued
+        buf[:] = b'wxyz'
+        writer.write(memoryview(b'efgh')[1:])
+        writer.write_at(10, b'ijk')
+        writer.write_zeroes(2, 3)
+        writer.close()
+
+        for target, sub_writer in zip(self.targets, self.writers):
+            self.assertEqual(b'ab\0\0\0gh\0\0\0ijk', target.getvalue())
+            sub_writer.close.assert_called_once_with()
+            self.assertFalse(sub_writer.abort.called)
+        self.assertEqual(10, writer.bytes_written)
+        self.assertEqual(3, writer.bytes_zeroed)
+
+    def test_write_error(self):
+        self.writers[1].write = mock.Mock(side_effect=IOError('failed'))
+        writer = image_writer.FanOutWriter(self.writers, queue_size=1)
+
+        def _write_all():
+            for _i in range(100):
+                writer.write(b'x')
+
+        self.assertRaises(IOError, _write_all)
+        writer.abort()
+        for sub_writer in self.writers:
+            sub_writer.abort.assert_called_once_with()
+            self.assertFalse(sub_writer.close.called)
+
+    def test_close_error(self):
+        self.writers[0].close.side_effect = OSError('sync failed')
+        writer = image_writer.FanOutWriter(self.writers)
+        writer.write(b'x')
+        self.assertRaises(OSError, writer.close)
+        # Depending on timing, the other writer is closed or, once the
+        # error is known, aborted
+        self.assertEqual(1, self.writers[1].close.call_count +
+                         self.writers[1].abort.call_count)
+
+
+class TestGetZeroRequest(base.IronicAgentTest):
+
+    def test_not_block_device(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertIsNone(image_writer.get_zero_request(f.name))
+
+    def _test_block_device(self, attributes, stat_mock, open_mock):
+        stat_mock.return_value = mock.Mock(st_mode=stat.S_IFBLK | 0o660,
+                                           st_rdev=os.makedev(8, 0))
+
+        def _open(path):
+            name = os.path.basename(path)
+            if name not in attributes:
+                raise IOError(errno.ENOENT, 'No such file')
+            return io.StringIO(u'%d\n' % attributes[name])
+
+        open_mock.side_effect = _open
+        with mock.patch('os.path.isdir', autospec=True, return_value=True):
+            return image_writer.get_zero_request('/dev/sda')
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('os.stat', autospec=True)
+    def test_write_zeroes_offload(self, stat_mock, open_mock):
+        self.assertEqual(image_writer.BLKZEROOUT, self._test_block_device(
+            {'write_zeroes_max_bytes': 1 << 20}, stat_mock, open_mock))
+        open_mock.assert_called_once_with(
+            '/sys/dev/block/8:0/queue/write_zeroes_max_bytes')
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('os.stat', autospec=True)
+    def test_discard_zeroes_data(self, stat_mock, open_mock):
+        self.assertEqual(image_writer.BLKDISCARD, self._test_block_device(
+            {'write_zeroes_max_bytes': 0, 'discard_max_bytes': 1 << 30,
+             'discard_zeroes_data': 1}, stat_mock, open_mock))
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch('os.stat', autospec=True)
+    def test_no_zeroing(self, stat_mock, open_mock):
+        self.assertIsNone(self._test_block_device(
+            {'discard_max_bytes': 1 << 30, 'discard_zeroes_data': 0},
+            stat_mock, open_mock))
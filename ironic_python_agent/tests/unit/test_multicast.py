@@ -0,0 +1,166 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ironic_python_agent import multicast
+from ironic_python_agent.tests.unit import base
+
+
+class TestPackets(base.IronicAgentTest):
+
+    def test_pack_unpack(self):
+        packet = multicast.pack(multicast.PARITY, 7, 42, 3, b'data')
+        self.assertEqual((multicast.PARITY, 7, 42, 3, b'data'),
+                         multicast.unpack(packet))
+
+    def test_unpack_invalid(self):
+        self.assertRaises(multicast.ProtocolError, multicast.unpack, b'IPA')
+        self.assertRaises(multicast.ProtocolError, multicast.unpack,
+                          b'XXXX' + multicast.pack(multicast.DATA, 0, 0,
+                                                   0)[4:])
+        self.assertRaises(multicast.ProtocolError, multicast.unpack,
+                          multicast.pack(9, 0, 0, 0))
+
+
+class TestForwardErrorCorrection(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestForwardErrorCorrection, self).setUp()
+        self.blocks = [b'aaaa', b'bbbb', b'cccc', b'dddd', b'ee']
+        self.lengths = [len(block) for block in self.blocks]
+        self.parity = multicast.encode(self.blocks, 2, 4)
+
+    def test_encode(self):
+        self.assertEqual(2, len(self.parity))
+        self.assertTrue(all(len(block) == 4 for block in self.parity))
+
+    def test_recover_burst(self):
+        received = {0: b'aaaa', 3: b'dddd', 4: b'ee'}
+
+        recovered = multicast.recover(received, dict(enumerate(self.parity)),
+                                      self.lengths, 2, 4)
+
+        self.assertEqual(2, recovered)
+        self.assertEqual(dict(enumerate(self.blocks)), received)
+
+    def test_recover_short_block(self):
+        received = {0: b'aaaa', 1: b'bbbb', 2: b'cccc', 3: b'dddd'}
+
+        multicast.recover(received, {0: self.parity[0]}, self.lengths, 2, 4)
+
+        self.assertEqual(b'ee', received[4])
+
+    def test_recover_too_many_lost(self):
+        received = {1: b'bbbb', 3: b'dddd'}
+
+        recovered = multicast.recover(received, dict(enumerate(self.parity)),
+                                      self.lengths, 2, 4)
+
+        self.assertEqual(0, recovered)
+        self.assertEqual({1: b'bbbb', 3: b'dddd'}, received)
+
+
+@mock.patch('socket.socket', autospec=True)
+class TestReceiver(base.IronicAgentTest):
+
+    def test_join_group(self, socket_mock):
+        multicast.Receiver('239.1.2.3', 5000, interface='10.0.0.1')
+
+        sock = socket_mock.return_value
+        sock.bind.assert_called_once_with(('239.1.2.3', 5000))
+        sock.setsockopt.assert_any_call(
+            multicast.socket.IPPROTO_IP, multicast.socket.IP_ADD_MEMBERSHIP,
+            b'\xef\x01\x02\x03\x0a\x00\x00\x01')
+
+    def test_join_group_fails(self, socket_mock):
+        socket_mock.return_value.bind.side_effect = OSError('no route')
+
+        self.assertRaises(OSError, multicast.Receiver, '239.1.2.3', 5000)
+        socket_mock.return_value.close.assert_called_once_with()
+
+    def test_take(self, socket_mock):
+        receiver = multicast.Receiver('239.1.2.3', 5000, session=1)
+        receiver.handle_packet(multicast.pack(multicast.DATA, 1, 0, 0, b'a'))
+        receiver.handle_packet(multicast.pack(multicast.DATA, 2, 0, 1, b'x'))
+        receiver.handle_packet(multicast.pack(multicast.DATA, 1, 0, 1, b'b'))
+        receiver.handle_packet(multicast.pack(multicast.PARITY, 1, 0, 0,
+                                              b'p'))
+
+        self.assertEqual(({0: b'a', 1: b'b'}, {0: b'p'}),
+                         receiver.take(0, 2))
+
+    def test_take_group_passed(self, socket_mock):
+        receiver = multicast.Receiver('239.1.2.3', 5000)
+        receiver.handle_packet(multicast.pack(multicast.DATA, 0, 0, 0, b'a'))
+        receiver.handle_packet(multicast.pack(multicast.DATA, 0, 1, 0, b'c'))
+
+        self.assertEqual(({0: b'a'}, {}), receiver.take(0, 2))
+        self.assertFalse(receiver.missed(1))
+        self.assertFalse(receiver.missed(2))
+
+    def test_missed(self, socket_mock):
+        receiver = multicast.Receiver('239.1.2.3', 5000, max_groups=2)
+        receiver.handle_packet(multicast.pack(multicast.DATA, 0, 3, 0, b'a'))
+
+        # The packet is beyond the buffer, but more of its group may come
+        self.assertTrue(receiver.missed(0))
+        self.assertFalse(receiver.missed(3))
+        self.assertFalse(receiver.missed(4))
+
+        receiver.handle_packet(multicast.pack(multicast.END, 0, 0, 0))
+        self.assertTrue(receiver.done)
+        self.assertTrue(receiver.missed(3))
+
+    def test_skip(self, socket_mock):
+        receiver = multicast.Receiver('239.1.2.3', 5000)
+        receiver.handle_packet(multicast.pack(multicast.DATA, 0, 0, 0, b'a'))
+        receiver.handle_packet(multicast.pack(multicast.DATA, 0, 2, 0, b'c'))
+
+        receiver.skip(2)
+        receiver.handle_packet(multicast.pack(multicast.DATA, 0, 1, 0, b'b'))
+
+        self.assertTrue(receiver.missed(0))
+        self.assertTrue(receiver.missed(1))
+        self.assertFalse(receiver.missed(2))
+
+
+@mock.patch('socket.socket', autospec=True)
+class TestSender(base.IronicAgentTest):
+
+    def test_send(self, socket_mock):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'image')
+        with open(path, 'wb') as f:
+            f.write(b'aaaabbbbccccdd')
+
+        multicast.Sender('239.1.2.3', 5000, session=5, block_size=4,
+                         group_size=2, parity=1).send(path)
+
+        packets = [multicast.unpack(c[0][0]) for c in
+                   socket_mock.return_value.sendto.call_args_list]
+        self.assertEqual(
+            [(multicast.DATA, 5, 0, 0, b'aaaa'),
+             (multicast.DATA, 5, 0, 1, b'bbbb'),
+             (multicast.PARITY, 5, 0, 0, b'\x03\x03\x03\x03'),
+             (multicast.DATA, 5, 1, 0, b'cccc'),
+             (multicast.DATA, 5, 1, 1, b'dd'),
+             (multicast.PARITY, 5, 1, 0, b'\x07\x07cc')] +
+            [(multicast.END, 5, 0, 0, b'')] * multicast.END_PACKETS,
+            packets)
+        socket_mock.return_value.sendto.assert_called_with(
+            mock.ANY, ('239.1.2.3', 5000))
@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslo_utils import units
+
+from ironic_python_agent import progress
+from ironic_python_agent.tests.unit import base
+
+
+@mock.patch('time.time', autospec=True)
+class TestImageProgress(base.IronicAgentTest):
+
+    def test_to_dict(self, time_mock):
+        time_mock.return_value = 100.0
+        image_progress = progress.ImageProgress('fake_id', 40 * units.M)
+        time_mock.return_value = 102.0
+        image_progress.add(progress.RECEIVED, 10 * units.M)
+        image_progress.add(progress.HASHED, 8 * units.M)
+        image_progress.add(progress.WRITTEN, 4 * units.M)
+
+        result = image_progress.to_dict()
+
+        self.assertEqual('fake_id', result['image_id'])
+        self.assertEqual(40 * units.M, result['total_bytes'])
+        self.assertEqual(2.0, result['elapsed'])
+        self.assertEqual({'bytes': 10 * units.M, 'current_rate': 5.0,
+                          'average_rate': 5.0}, result['received'])
+        self.assertEqual({'bytes': 8 * units.M, 'current_rate': 4.0,
+                          'average_rate': 4.0}, result['hashed'])
+        self.assertEqual({'bytes': 4 * units.M, 'current_rate': 2.0,
+                          'average_rate': 2.0}, result['written'])
+        self.assertEqual(6.0, result['eta'])
+
+    def test_current_rate(self, time_mock):
+        time_mock.return_value = 100.0
+        image_progress = progress.ImageProgress('fake_id')
+        time_mock.return_value = 105.0
+        image_progress.add(progress.RECEIVED, 50 * units.M)
+        time_mock.return_value = 110.0
+        image_progress.add(progress.RECEIVED, 10 * units.M)
+
+        result = image_progress.to_dict()
+
+        self.assertEqual(2.0, result['received']['current_rate'])
+        self.assertEqual(6.0, result['received']['average_rate'])
+        self.assertIsNone(result['total_bytes'])
+        self.assertIsNone(result['eta'])
+
+    def test_stalled(self, time_mock):
+        time_mock.return_value = 100.0
+        image_progress = progress.ImageProgress('fake_id', 100 * units.M)
+        time_mock.return_value = 105.0
+        image_progress.add(progress.RECEIVED, 50 * units.M)
+        image_progress.add(progress.WRITTEN, 50 * units.M)
+        time_mock.return_value = 110.0
+        image_progress.add(progress.RECEIVED, 10 * units.M)
+        time_mock.return_value = 116.0
+
+        result = image_progress.to_dict()
+
+        self.assertEqual(0.0, result['written']['current_rate'])
+        self.assertEqual(0.0, result['received']['current_rate'])
+        self.assertIsNone(result['eta'])
+
+    def test_offset(self, time_mock):
+        time_mock.return_value = 100.0
+        image_progress = progress.ImageProgress('fake_id', 20 * units.M,
+                                                offset=10 * units.M)
+        time_mock.return_value = 101.0
+        image_progress.add(progress.RECEIVED, 5 * units.M)
+
+        result = image_progress.to_dict()
+
+        self.assertEqual(15 * units.M, result['received']['bytes'])
+        self.assertEqual(5.0, result['received']['average_rate'])
+        self.assertEqual(1.0, result['eta'])
+
+    def test_summary(self, time_mock):
+        time_mock.return_value = 100.0
+        image_progress = progress.ImageProgress('fake_id')
+        time_mock.return_value = 102.0
+        image_progress.add(progress.RECEIVED, 10)
+
+        self.assertEqual('10 bytes received at 0.00 MB/s, '
+                         '0 bytes hashed at 0.00 MB/s, '
+                         '0 bytes written at 0.00 MB/s',
+                         image_progress.summary())
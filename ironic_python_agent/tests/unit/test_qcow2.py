@@ -0,0 +1,214 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import struct
+import zlib
+
+from ironic_python_agent import errors
+from ironic_python_agent import image_writer
+from ironic_python_agent import qcow2
+from ironic_python_agent.tests.unit import base
+
+CLUSTER_BITS = 9
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+L2_ENTRIES = CLUSTER_SIZE // 8
+
+
+def _cluster(value):
+    return bytes(bytearray([value])) * CLUSTER_SIZE
+
+
+def _compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+    return compressor.compress(data) + compressor.flush()
+
+
+def build_qcow2(guest, virtual_size, tables_last=False, version=3,
+                header_overrides=None):
+    """Build a small qcow2 image.
+
+    :param guest: A dict mapping guest cluster indexes to either the
+                  cluster content, 'zero' for a zero cluster, or a tuple
+                  ('compressed', content).
+    :param virtual_size: The virtual size of the image.
+    :param tables_last: Whether to put the L2 tables after the data.
+    :returns: The image as bytes.
+    """
+    guest_clusters = (virtual_size + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+    l1_size = (guest_clusters + L2_ENTRIES - 1) // L2_ENTRIES
+    used_l2 = sorted(set(index // L2_ENTRIES for index in guest))
+    data_indexes = sorted(i for i in guest if isinstance(guest[i], bytes))
+    compressed_indexes = sorted(i for i in guest
+                                if isinstance(guest[i], tuple))
+
+    next_cluster = 2
+    l2_offsets = {}
+    data_offsets = {}
+    if not tables_last:
+        for l1_index in used_l2:
+            l2_offsets[l1_index] = next_cluster * CLUSTER_SIZE
+            next_cluster += 1
+    for index in data_indexes:
+        data_offsets[index] = next_cluster * CLUSTER_SIZE
+        next_cluster += 1
+    if tables_last:
+        for l1_index in used_l2:
+            l2_offsets[l1_index] = next_cluster * CLUSTER_SIZE
+            next_cluster += 1
+
+    image = bytearray(next_cluster * CLUSTER_SIZE)
+    compressed_entries = {}
+    for index in compressed_indexes:
+        offset = len(image)
+        blob = _compress(guest[index][1])
+        image += blob
+        sectors = (offset + len(blob) - 1) // 512 - offset // 512
+        shift = 62 - (CLUSTER_BITS - 8)
+        compressed_entries[index] = (qcow2._COMPRESSED | (sectors << shift) |
+                                     offset)
+    image += bytearray(-len(image) % 512)
+
+    fields = {'magic': qcow2.MAGIC, 'version': version,
+              'backing_file_offset': 0, 'cluster_bits': CLUSTER_BITS,
+              'size': virtual_size, 'crypt_method': 0, 'l1_size': l1_size,
+              'l1_table_offset': CLUSTER_SIZE, 'incompatible': 0}
+    fields.update(header_overrides or {})
+    struct.pack_into('>4sIQIIQIIQQIIQ', image, 0, fields['magic'],
+                     fields['version'], fields['backing_file_offset'], 0,
+                     fields['cluster_bits'], fields['size'],
+                     fields['crypt_method'], fields['l1_size'],
+                     fields['l1_table_offset'], 0, 0, 0, 0)
+    struct.pack_into('>QQQII', image, 72, fields['incompatible'], 0, 0, 4,
+                     104)
+
+    for l1_index, offset in l2_offsets.items():
+        struct.pack_into('>Q', image, CLUSTER_SIZE + l1_index * 8,
+                         offset | qcow2._COPIED)
+    for index, value in guest.items():
+        l2_offset = l2_offsets[index // L2_ENTRIES]
+        entry_offset = l2_offset + (index % L2_ENTRIES) * 8
+        if value == 'zero':
+            entry = qcow2._ZERO
+        elif isinstance(value, tuple):
+            entry = compressed_entries[index]
+        else:
+            entry = data_offsets[index] | qcow2._COPIED
+            image[data_offsets[index]:data_offsets[index] + CLUSTER_SIZE] = (
+                value)
+        struct.pack_into('>Q', image, entry_offset, entry)
+    return bytes(image)
+
+
+class TestStreamingDecoder(base.IronicAgentTest):
+
+    def _decode(self, image, chunk_size=1000, spill_limit=1 << 20):
+        target = io.BytesIO()
+        writer = image_writer.FileWriter(target)
+        decoder = qcow2.StreamingDecoder(writer, spill_limit)
+        for offset in range(0, len(image), chunk_size):
+            decoder.feed(image[offset:offset + chunk_size])
+        decoder.finish()
+        return target.getvalue(), writer
+
+    def test_decode(self):
+        guest = {0: _cluster(1), 3: _cluster(2), 70: _cluster(3)}
+        virtual_size = 100 * CLUSTER_SIZE
+        image = build_qcow2(guest, virtual_size)
+
+        result, writer = self._decode(image)
+
+        expected = bytearray(virtual_size)
+        for index, value in guest.items():
+            expected[index * CLUSTER_SIZE:(index + 1) * CLUSTER_SIZE] = value
+        self.assertEqual(bytes(expected), result)
+        self.assertEqual(3 * CLUSTER_SIZE, writer.bytes_written)
+        self.assertEqual(97 * CLUSTER_SIZE, writer.bytes_zeroed)
+
+    def test_decode_partial_last_cluster(self):
+        virtual_size = 2 * CLUSTER_SIZE + 100
+        image = build_qcow2({2: _cluster(7)}, virtual_size)
+
+        result, writer = self._decode(image, chunk_size=CLUSTER_SIZE)
+
+        self.assertEqual(bytes(bytearray(2 * CLUSTER_SIZE)) +
+                         _cluster(7)[:100], result)
+
+    def test_decode_zero_and_compressed_clusters(self):
+        data = b'compressible' * 50
+        guest = {0: 'zero', 1: ('compressed', data[:CLUSTER_SIZE]),
+                 2: _cluster(9)}
+        image = build_qcow2(guest, 3 * CLUSTER_SIZE)
+
+        result, writer = self._decode(image, chunk_size=77)
+
+        self.assertEqual(bytes(bytearray(CLUSTER_SIZE)) +
+                         data[:CLUSTER_SIZE] + _cluster(9), result)
+
+    def test_decode_tables_after_data_uses_spill(self):
+        guest = {0: _cluster(1), 1: _cluster(2)}
+        image = build_qcow2(guest, 4 * CLUSTER_SIZE, tables_last=True)
+
+        result, writer = self._decode(image)
+
+        self.assertEqual(_cluster(1) + _cluster(2) +
+                         bytes(bytearray(2 * CLUSTER_SIZE)), result)
+
+    def test_decode_spill_limit_exceeded(self):
+        guest = {0: _cluster(1), 1: _cluster(2), 2: _cluster(3)}
+        image = build_qcow2(guest, 4 * CLUSTER_SIZE, tables_last=True)
+
+        self.assertRaisesRegex(errors.ImageFormatError, 'spill space',
+                               self._decode, image,
+                               spill_limit=2 * CLUSTER_SIZE)
+
+    def test_decode_truncated(self):
+        image = build_qcow2({0: _cluster(1), 1: _cluster(2)},
+                            2 * CLUSTER_SIZE)
+
+        self.assertRaisesRegex(errors.ImageFormatError, 'truncated',
+                               self._decode, image[:-CLUSTER_SIZE])
+
+    def test_decode_not_qcow2(self):
+        self.assertRaisesRegex(errors.ImageFormatError, 'not a qcow2',
+                               self._decode, b'\0' * 4096)
+
+    def test_decode_too_short(self):
+        self.assertRaisesRegex(errors.ImageFormatError, 'too short',
+                               self._decode, qcow2.MAGIC)
+
+    def test_decode_backing_file(self):
+        image = build_qcow2({}, CLUSTER_SIZE,
+                            header_overrides={'backing_file_offset': 1024})
+        self.assertRaisesRegex(errors.ImageFormatError, 'backing file',
+                               self._decode, image)
+
+    def test_decode_encrypted(self):
+        image = build_qcow2({}, CLUSTER_SIZE,
+                            header_overrides={'crypt_method': 1})
+        self.assertRaisesRegex(errors.ImageFormatError, 'Encrypted',
+                               self._decode, image)
+
+    def test_decode_unsupported_feature(self):
+        image = build_qcow2({}, CLUSTER_SIZE,
+                            header_overrides={'incompatible': 1 << 2})
+        self.assertRaisesRegex(errors.ImageFormatError, '0x4',
+                               self._decode, image)
+
+    def test_decode_dirty_v2(self):
+        guest = {1: _cluster(5)}
+        image = build_qcow2(guest, 2 * CLUSTER_SIZE, version=2)
+
+        result, writer = self._decode(image)
+
+        self.assertEqual(bytes(bytearray(CLUSTER_SIZE)) + _cluster(5),
+                         result)
@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import mock
+
+from ironic_python_agent.tests.unit import base
+from ironic_python_agent import throttle
+
+
+@mock.patch('time.time', autospec=True)
+class TestTokenBucket(base.IronicAgentTest):
+
+    def _bucket(self, time_mock, rate, burst=None):
+        bucket = throttle.TokenBucket(rate, burst)
+        # Waiting advances the clock by the time waited
+        bucket._condition = mock.MagicMock()
+
+        def _wait(timeout):
+            time_mock.return_value += timeout
+        bucket._condition.wait.side_effect = _wait
+        return bucket
+
+    def test_unlimited(self, time_mock):
+        time_mock.return_value = 100.0
+        bucket = self._bucket(time_mock, 0)
+        for _ in range(10):
+            bucket.consume(10 ** 9)
+        self.assertFalse(bucket._condition.wait.called)
+
+    def test_rate(self, time_mock):
+        time_mock.return_value = 100.0
+        bucket = self._bucket(time_mock, 1000)
+        for _ in range(5):
+            bucket.consume(500)
+        # The first chunk is free, every following one waits for the
+        # previous one to be paid back
+        self.assertAlmostEqual(102.0, time_mock.return_value)
+
+    def test_burst(self, time_mock):
+        time_mock.return_value = 100.0
+        bucket = self._bucket(time_mock, 1000, burst=2000)
+        time_mock.return_value = 200.0
+        bucket.consume(1500)
+        bucket.consume(500)
+        bucket.consume(500)
+        self.assertFalse(bucket._condition.wait.called)
+        bucket.consume(500)
+        self.assertAlmostEqual(200.5, time_mock.return_value)
+
+    def test_default_burst(self, time_mock):
+        time_mock.return_value = 100.0
+        bucket = throttle.TokenBucket(1000)
+        self.assertEqual(1000 * throttle.BURST_SECONDS, bucket.burst)
+
+    def test_set_rate(self, time_mock):
+        time_mock.return_value = 100.0
+        bucket = self._bucket(time_mock, 1000)
+        bucket.consume(4000)
+        bucket.set_rate(4000)
+        bucket.consume(1)
+        self.assertAlmostEqual(101.0, time_mock.return_value)
+        bucket._condition.notify_all.assert_called_with()
+
+    def test_set_rate_unlimited(self, time_mock):
+        time_mock.return_value = 100.0
+        bucket = self._bucket(time_mock, 1000)
+        bucket.consume(10 ** 6)
+        bucket.set_rate(0)
+        bucket.consume(10 ** 6)
+        bucket.consume(10 ** 6)
+        self.assertFalse(bucket._condition.wait.called)
+        self.assertEqual(100.0, time_mock.return_value)
+
+
+class TestTokenBucketThreads(base.IronicAgentTest):
+
+    def test_set_rate_wakes_waiter(self):
+        bucket = throttle.TokenBucket(1)
+        bucket.consume(10 ** 6)
+        waiter = threading.Thread(target=bucket.consume, args=(1,))
+        waiter.start()
+        bucket.set_rate(0)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
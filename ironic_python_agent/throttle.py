@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate limiting of data transfers."""
+
+import threading
+import time
+
+BURST_SECONDS = 0.25
+"""The default burst of a bucket, in seconds of transfer at its rate."""
+
+
+class TokenBucket(object):
+    """A token bucket limiting the rate of a transfer.
+
+    Tokens are added to the bucket at the rate of the transfer, up to its
+    burst, and every byte transferred takes a token. A transfer may take
+    more tokens than the bucket holds, the next one then waits until the
+    debt has been paid back. The rate can be changed at any time, including
+    while a transfer is waiting.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        """Initialize an instance of the TokenBucket class.
+
+        :param rate: Optional. The rate in bytes per second, or 0 for no
+                     limit.
+        :param burst: Optional. The maximum number of bytes which can be
+                      transferred at once after the bucket has been idle.
+                      Defaults to BURST_SECONDS of transfer at the rate.
+        """
+        self._condition = threading.Condition()
+        self._tokens = 0.0
+        self._last = time.time()
+        self.rate = 0
+        self.burst = 0
+        self.set_rate(rate, burst)
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate of the bucket.
+
+        :param rate: The rate in bytes per second, or 0 for no limit.
+        :param burst: Optional. The maximum number of bytes which can be
+                      transferred at once after the bucket has been idle.
+                      Defaults to BURST_SECONDS of transfer at the rate.
+        """
+        with self._condition:
+            self._refill()
+            self.rate = max(float(rate or 0), 0.0)
+            self.burst = (burst if burst is not None
+                          else self.rate * BURST_SECONDS)
+            if not self.rate:
+                self._tokens = 0.0
+            self._tokens = min(self._tokens, self.burst)
+            self._condition.notify_all()
+
+    def consume(self, amount):
+        """Take tokens from the bucket, waiting for earlier debt if needed.
+
+        :param amount: The number of bytes transferred.
+        """
+        with self._condition:
+            while True:
+                self._refill()
+                if not self.rate or self._tokens >= 0:
+                    break
+                self._condition.wait(-self._tokens / self.rate)
+            if self.rate:
+                self._tokens -= amount
@@ -0,0 +1,248 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Zero-copy transfers of images from HTTP servers to block devices.
+
+The body of an HTTP response is moved from the socket to the device with
+splice(2), through a pipe, so that it is never copied into Python objects.
+Only responses to plain HTTP requests sent directly to the image server,
+with a known length and no transfer or content encoding, can be moved
+this way.
+"""
+
+import ctypes
+import fcntl
+import os
+import socket
+
+from oslo_log import log
+from oslo_utils import units
+from six.moves.urllib import parse
+
+from ironic_python_agent import image_writer
+
+LOG = log.getLogger(__name__)
+
+PIPE_SIZE = units.Mi
+"""The size requested for the pipe, which is the size of every splice."""
+
+CONNECT_TIMEOUT = 30
+
+MAX_HEADER_SIZE = 64 * units.Ki
+
+# Linux fcntl command and splice(2) flags, only exposed by the fcntl and os
+# modules of Python 3.10+
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+_SPLICE_F_MOVE = getattr(os, 'SPLICE_F_MOVE', 1)
+_SPLICE_F_MORE = getattr(os, 'SPLICE_F_MORE', 4)
+
+# os.splice() is used when available, splice(2) is called through the C
+# library otherwise
+_os_splice = getattr(os, 'splice', None)
+
+
+def supported():
+    """Get whether splice(2) can be called."""
+    if _os_splice is not None:
+        return True
+    try:
+        return hasattr(image_writer._get_libc(), 'splice')
+    except OSError:
+        return False
+
+
+def _splice(src, dst, length, flags):
+    """Move data between file descriptors, one of which is a pipe.
+
+    :param src: The file descriptor to move data from.
+    :param dst: The file descriptor to move data to.
+    :param length: The maximum number of bytes to move.
+    :param flags: splice(2) flags.
+    :raises: OSError if splice(2) fails.
+    :returns: The number of bytes moved, 0 at the end of src.
+    """
+    if _os_splice is not None:
+        return _os_splice(src, dst, length, flags=flags)
+    result = image_writer._get_libc().splice(src, None, dst, None, length,
+                                             flags)
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+class Unavailable(Exception):
+    """The response of the image server cannot be moved without copies."""
+
+
+class ResponseError(Exception):
+    """The image cannot be received from the image server."""
+
+
+class Response(object):
+    """A response of an image server, whose body is yet to be received."""
+
+    def __init__(self, sock, length, head):
+        """Initialize an instance of the Response class.
+
+        :param sock: The connected socket.
+        :param length: The length of the body in bytes.
+        :param head: The first bytes of the body, received with the headers.
+        """
+        self.sock = sock
+        self.length = length
+        self.head = head[:length]
+
+    def close(self):
+        self.sock.close()
+
+
+def _read_headers(sock):
+    """Receive the status and headers of an HTTP response.
+
+    :param sock: The connected socket.
+    :raises: ResponseError if the response is malformed.
+    :returns: A tuple of the status code, a dictionary of the headers with
+              lower case names, and the bytes of the body received with
+              them.
+    """
+    data = b''
+    while b'\r\n\r\n' not in data:
+        if len(data) > MAX_HEADER_SIZE:
+            raise ResponseError('The response headers are larger than {} '
+                                'bytes'.format(MAX_HEADER_SIZE))
+        chunk = sock.recv(16 * units.Ki)
+        if not chunk:
+            raise ResponseError('The connection was closed before the '
+                                'response headers were received')
+        data += chunk
+    headers, _sep, head = data.partition(b'\r\n\r\n')
+    lines = headers.decode('latin-1').split('\r\n')
+    status = lines[0].split(None, 2)
+    if len(status) < 2 or not status[1].isdigit():
+        raise ResponseError('Malformed status line {!r}'.format(lines[0]))
+    fields = {}
+    for line in lines[1:]:
+        name, _sep, value = line.partition(':')
+        fields[name.strip().lower()] = value.strip()
+    return int(status[1]), fields, head
+
+
+def open_response(url, timeout=CONNECT_TIMEOUT):
+    """Request an image from a plain HTTP server.
+
+    Redirections are not followed.
+
+    :param url: The URL of the image.
+    :param timeout: Optional. The time in seconds allowed to connect.
+    :raises: Unavailable if the response body cannot be moved without
+             copies, including when the request is not successful.
+    :raises: ResponseError if the request fails.
+    :returns: A Response.
+    """
+    parsed = parse.urlsplit(url)
+    if parsed.scheme.lower() != 'http':
+        raise Unavailable('{} is not a plain HTTP URL'.format(url))
+    if parsed.username is not None or parsed.password is not None:
+        raise Unavailable('{} holds credentials'.format(url))
+    target = parsed.path or '/'
+    if parsed.query:
+        target += '?' + parsed.query
+    try:
+        sock = socket.create_connection((parsed.hostname, parsed.port or 80),
+                                        timeout)
+    except (socket.error, OSError) as e:
+        raise ResponseError('Unable to connect to {}: {}'.format(
+            parsed.netloc, e))
+    try:
+        # splice(2) needs a blocking socket
+        sock.settimeout(None)
+        request = ('GET {} HTTP/1.1\r\nHost: {}\r\n'
+                   'Accept-Encoding: identity\r\n'
+                   'Connection: close\r\n\r\n').format(target, parsed.netloc)
+        try:
+            sock.sendall(request.encode('latin-1'))
+            status, fields, head = _read_headers(sock)
+        except (socket.error, OSError) as e:
+            raise ResponseError('Unable to request {}: {}'.format(url, e))
+        if status != 200:
+            raise Unavailable('Received status code {}, expected '
+                              '200'.format(status))
+        for name in ('transfer-encoding', 'content-encoding'):
+            if fields.get(name, 'identity').lower() != 'identity':
+                raise Unavailable('The response has the {} {}'.format(
+                    name, fields[name]))
+        length = fields.get('content-length', '')
+        if not length.isdigit():
+            raise Unavailable('The response has no Content-Length')
+    except Exception:
+        sock.close()
+        raise
+    return Response(sock, int(length), head)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def splice_body(response, fd, received=None, written=None):
+    """Move the body of a response to a file descriptor.
+
+    :param response: A Response from open_response().
+    :param fd: The file descriptor to write the body to, at its position.
+    :param received: Optional. A callable taking the number of bytes
+                     received every time some are.
+    :param written: Optional. A callable taking the number of bytes
+                    written every time some are.
+    :raises: ResponseError if the body cannot be received.
+    :raises: IOError or OSError if writing fails.
+    """
+    if response.head:
+        if received is not None:
+            received(len(response.head))
+        _write_all(fd, response.head)
+        if written is not None:
+            written(len(response.head))
+    remaining = response.length - len(response.head)
+    sock_fd = response.sock.fileno()
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(write_fd, _F_SETPIPE_SZ, PIPE_SIZE)
+        except (IOError, OSError) as e:
+            # Limited by the fs.pipe-max-size sysctl
+            LOG.debug('Unable to grow the splice pipe to %d bytes: %s',
+                      PIPE_SIZE, e)
+        while remaining:
+            try:
+                moved = _splice(sock_fd, write_fd, min(remaining, PIPE_SIZE),
+                                _SPLICE_F_MOVE | _SPLICE_F_MORE)
+            except (IOError, OSError) as e:
+                raise ResponseError('Unable to receive the response: '
+                                    '{}'.format(e))
+            if not moved:
+                raise ResponseError('The connection was closed with {} '
+                                    'bytes of the response left'.format(
+                                        remaining))
+            remaining -= moved
+            if received is not None:
+                received(moved)
+            while moved:
+                done = _splice(read_fd, fd, moved, _SPLICE_F_MOVE)
+                moved -= done
+                if written is not None:
+                    written(done)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)